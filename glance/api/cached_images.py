@@ -72,6 +72,26 @@ class Controller(controller.BaseController):
         self._enforce(req)
         return dict(num_deleted=self.cache.delete_all_cached_images())
 
+    def get_stats(self, req):
+        """
+        GET /cache_stats
+
+        Returns the counters of image cache activity of all the processes
+        using the cache, with the hit ratio and fill throughput derived
+        from them and the current size of the cache.
+        """
+        self._enforce(req)
+        return dict(cache_stats=self.cache.get_stats())
+
+    def reset_stats(self, req):
+        """
+        DELETE /cache_stats
+
+        Sets the counters of image cache activity to 0.
+        """
+        self._enforce(req)
+        self.cache.reset_stats()
+
     def get_queued_images(self, req):
         """
         GET /queued_images
@@ -89,9 +109,17 @@ class Controller(controller.BaseController):
         Queues an image for caching. We do not check to see if
         the image is in the registry here. That is done by the
         prefetcher...
+
+        An optional integer ``priority`` query parameter puts the image
+        ahead of queued images with a lower priority.
         """
         self._enforce(req)
-        self.cache.queue_image(image_id)
+        try:
+            priority = int(req.params.get('priority', 0))
+        except ValueError:
+            msg = _("Image priority must be an integer")
+            raise webob.exc.HTTPBadRequest(explanation=msg)
+        self.cache.queue_image(image_id, priority)
 
     def delete_queued_image(self, req, image_id):
         """
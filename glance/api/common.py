@@ -14,16 +14,101 @@
 #    under the License.
 
 from oslo.config import cfg
+import webob.byterange
+import webob.exc
 
 from glance.common import exception
+from glance.common import wsgi
 from glance.openstack.common import log as logging
 
 LOG = logging.getLogger(__name__)
 CONF = cfg.CONF
 
 
+def get_requested_range(request, image_size, checksum=None):
+    """
+    Returns an (offset, length) tuple for the byte range asked for by the
+    Range header of a request for image data, or None if the whole image
+    should be returned. Range headers that can't be parsed or that ask for
+    more than one range are ignored, as are ranges conditional on an
+    If-Range header that doesn't match the image checksum.
+
+    :param request: The WSGI/Webob Request object
+    :param image_size: Size of the image in bytes, or None if unknown
+    :param checksum: Checksum of the image, which is also its ETag
+
+    :raises HTTPRequestRangeNotSatisfiable if the range starts beyond the
+            end of the image
+    """
+    header = request.headers.get('Range')
+    if not header or image_size is None or ',' in header:
+        return None
+
+    if_range = request.headers.get('If-Range')
+    if if_range is not None and if_range.strip('"') != checksum:
+        return None
+
+    byte_range = webob.byterange.Range.parse(header)
+    if byte_range is None:
+        return None
+
+    image_size = int(image_size)
+    span = byte_range.range_for_length(image_size)
+    if span is None:
+        msg = _("Requested range not satisfiable")
+        raise webob.exc.HTTPRequestRangeNotSatisfiable(
+            explanation=msg, request=request,
+            headers=[('Content-Range', 'bytes */%d' % image_size)])
+    start, stop = span
+    return start, stop - start
+
+
+def set_range_headers(response, offset, length, image_size):
+    """
+    Makes a response one for partial content holding `length` bytes of an
+    image of `image_size` bytes, starting at `offset`.
+    """
+    response.status_int = 206
+    response.headers['Content-Range'] = 'bytes %d-%d/%d' % (
+        offset, offset + length - 1, int(image_size))
+    response.headers['Content-Length'] = str(length)
+
+
 def size_checked_iter(response, image_meta, expected_size, image_iter,
                       notifier):
+    if isinstance(image_iter, wsgi.FileWrapper):
+        return size_checked_file(response, image_meta, expected_size,
+                                 image_iter, notifier)
+    return _size_checked_iter(response, image_meta, expected_size,
+                              image_iter, notifier)
+
+
+def size_checked_file(response, image_meta, expected_size, file_wrapper,
+                      notifier):
+    """
+    Equivalent of size_checked_iter for a wsgi.FileWrapper. The wrapper is
+    returned as is so that the server can send it with sendfile(2), and the
+    size is checked once the response has been sent.
+    """
+    image_id = image_meta['id']
+
+    def notify_image_sent_hook(env):
+        bytes_written = file_wrapper.bytes_sent
+        if expected_size != bytes_written:
+            msg = _("File for image %(image_id)s ended after writing only "
+                    "%(bytes_written)d bytes") % locals()
+            LOG.error(msg)
+        image_send_notification(bytes_written, expected_size,
+                                image_meta, response.request, notifier)
+
+    if 'eventlet.posthooks' in response.request.environ:
+        response.request.environ['eventlet.posthooks'].append(
+            (notify_image_sent_hook, (), {}))
+    return file_wrapper
+
+
+def _size_checked_iter(response, image_meta, expected_size, image_iter,
+                       notifier):
     image_id = image_meta['id']
     bytes_written = 0
 
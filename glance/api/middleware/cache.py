@@ -22,25 +22,40 @@ this middleware caches the returned image file to local filesystem.
 
 When subsequent requests for the same image file are received,
 the local cached copy of the image file is returned.
+
+When image_cache_peers is set, a cache miss first asks the caches of the
+other API nodes for the image, and only reads it from the store if none
+of them has it.
+
+When image_cache_metadata_ttl is set, the image metadata needed to answer
+a cache hit is kept next to the cached image, so hot images are served
+without asking the registry or the database.
 """
 
+import copy
 import re
 
+from oslo.config import cfg
 import webob
+import webob.exc
 
+from glance.api import common
 from glance.api.common import size_checked_iter
 from glance.api.v1 import images
 from glance.common import exception
-from glance.common import utils
 from glance.common import wsgi
 import glance.db
 from glance import image_cache
+from glance.image_cache import partitions
+from glance.image_cache import peers
 import glance.openstack.common.log as logging
 from glance import notifier
 import glance.registry.client.v1.api as registry
 
 LOG = logging.getLogger(__name__)
 
+CONF = cfg.CONF
+
 PATTERNS = {
     ('v1', 'GET'): re.compile(r'^/v1/images/([^\/]+)$'),
     ('v1', 'DELETE'): re.compile(r'^/v1/images/([^\/]+)$'),
@@ -48,12 +63,20 @@ PATTERNS = {
     ('v2', 'DELETE'): re.compile(r'^/v2/images/([^\/]+)$')
 }
 
+# Requests other than GET and HEAD on these paths may change the metadata
+# or the members of an image
+CHANGE_PATTERN = re.compile(r'^/v[12]/images/([^\/]+)')
+
 
 class CacheFilter(wsgi.Middleware):
 
+    peers = None
+
     def __init__(self, app):
         self.cache = image_cache.ImageCache()
         self.serializer = images.ImageSerializer()
+        if CONF.image_cache_peers:
+            self.peers = peers.PeerClient()
         LOG.info(_("Initialized image cache middleware"))
         super(CacheFilter, self).__init__(app)
 
@@ -98,6 +121,8 @@ class CacheFilter(wsgi.Middleware):
         the image metadata in headers. If not present, we pass
         the request on to the next application in the pipeline.
         """
+        self._drop_changed_image_meta(request)
+
         match = self._match_request(request)
         try:
             (version, method, image_id) = match
@@ -107,11 +132,65 @@ class CacheFilter(wsgi.Middleware):
 
         self._stash_request_info(request, image_id, method)
 
-        if request.method != 'GET' or not self.cache.is_cached(image_id):
+        if request.method != 'GET':
             return None
 
-        LOG.debug(_("Cache hit for image '%s'"), image_id)
-        image_iterator = self.get_from_cache(image_id)
+        ranged = 'Range' in request.headers
+        peer_request = peers.PEER_HEADER in request.headers
+        image_range = None
+        partial_range = None
+        is_cached = self.cache.is_cached(image_id)
+        if ranged and not is_cached:
+            partial_range = self._get_partial_range(request, image_id)
+        if is_cached:
+            if ranged and 'If-Range' in request.headers:
+                # The checksum to compare If-Range against isn't known until
+                # the image metadata is fetched, so leave these to the API
+                self.cache.stats.incr('misses')
+                return None
+            LOG.debug(_("Cache hit for image '%s'"), image_id)
+            cached = True
+            source = 'cache'
+            image_range = common.get_requested_range(
+                request, self.cache.get_image_size(image_id))
+            image_iterator = self._get_cached_image_iter(request, image_id,
+                                                         image_range)
+        elif partial_range is not None:
+            # Only part of the image is cached, but that part covers the
+            # requested range
+            LOG.debug(_("Requested range of image '%s' is cached"), image_id)
+            cached = True
+            source = 'cache'
+            image_range = partial_range
+            image_iterator = self.cache.get_partial_iter(image_id,
+                                                         *image_range)
+        elif (self.cache.is_fill_active(image_id) and not ranged and
+                not peer_request):
+            # The response is streamed from the cache fill already in
+            # progress by process_response, which keeps the image from
+            # the store to fall back on should the fill fail
+            LOG.debug(_("Image '%s' is being cached, following the "
+                        "cache fill"), image_id)
+            return None
+        elif peer_request:
+            # Peers are only served from the cache, never from the store
+            return webob.exc.HTTPNotFound()
+        elif self.peers is not None and not ranged:
+            image_iterator = self._get_from_peers(request, image_id)
+            self.cache.stats.incr('misses')
+            if image_iterator is None:
+                return None
+            cached = False
+            source = 'peers'
+            self.cache.stats.incr('peer_hits')
+        else:
+            self.cache.stats.incr('misses')
+            return None
+
+        if source == 'cache':
+            self.cache.stats.incr('hits')
+        request.environ['api.cache.image_range'] = image_range
+        request.environ['api.cache.source'] = source
         method = getattr(self, '_process_%s_request' % version)
 
         try:
@@ -121,7 +200,10 @@ class CacheFilter(wsgi.Middleware):
                     "however the registry did not contain metadata for "
                     "that image!") % image_id
             LOG.error(msg)
-            self.cache.delete_cached_image(image_id)
+            if cached:
+                self.cache.delete_cached_image(image_id)
+            elif hasattr(image_iterator, 'close'):
+                image_iterator.close()
 
     @staticmethod
     def _stash_request_info(request, image_id, method):
@@ -145,18 +227,64 @@ class CacheFilter(wsgi.Middleware):
         else:
             return (image_id, method)
 
+    def _drop_changed_image_meta(self, request):
+        """
+        Removes the stored metadata of an image that a request may change.
+        It is removed both before and after the request is processed, so
+        that a cache hit served in between cannot store the old metadata
+        again for long.
+        """
+        if self.cache.metadata is None or request.method in ('GET', 'HEAD'):
+            return
+        match = CHANGE_PATTERN.match(request.path_info)
+        if match is not None:
+            self.cache.metadata.delete(match.group(1))
+
+    def _get_stored_image_meta(self, request, image_id, api_version):
+        """
+        Returns the metadata of a cached image stored by an earlier cache
+        hit, if it may be used for this request, or None.
+        """
+        if self.cache.metadata is None:
+            return None
+        image_meta = self.cache.metadata.get(request.context, image_id,
+                                             api_version)
+        if image_meta is not None:
+            self.cache.stats.incr('metadata_hits')
+        return image_meta
+
+    def _store_image_meta(self, request, image_id, api_version, image_meta):
+        if self.cache.metadata is None:
+            return
+        self.cache.stats.incr('metadata_misses')
+        try:
+            self.cache.metadata.put(request.context, image_id, api_version,
+                                    copy.deepcopy(image_meta))
+        except (IOError, OSError, TypeError, ValueError) as e:
+            LOG.warn(_("Unable to store the metadata of cached image "
+                       "%(image_id)s: %(e)s"),
+                     {'image_id': image_id, 'e': e})
+
     def _process_v1_request(self, request, image_id, image_iterator):
-        image_meta = registry.get_image_metadata(request.context, image_id)
-        # Don't display location
-        if 'location' in image_meta:
-            del image_meta['location']
-        image_meta.pop('location_data', None)
+        image_meta = self._get_stored_image_meta(request, image_id, 'v1')
+        if image_meta is None:
+            image_meta = registry.get_image_metadata(request.context,
+                                                     image_id)
+            # Don't display location
+            if 'location' in image_meta:
+                del image_meta['location']
+            image_meta.pop('location_data', None)
+            self._store_image_meta(request, image_id, 'v1', image_meta)
         self._verify_metadata(image_meta)
+        image_range = request.environ.get('api.cache.image_range')
+        self._count_bytes_served(request, image_range[1] if image_range
+                                 else image_meta['size'])
 
         response = webob.Response(request=request)
         raw_response = {
             'image_iterator': image_iterator,
             'image_meta': image_meta,
+            'image_range': image_range,
         }
         return self.serializer.show(response, raw_response)
 
@@ -166,14 +294,24 @@ class CacheFilter(wsgi.Middleware):
         # will generate a notification.
         # TODO(mclaren): Make notification happen more
         # naturally once caching is part of the domain model.
-        db_api = glance.db.get_api()
-        image_repo = glance.db.ImageRepo(request.context, db_api)
-        image = image_repo.get(image_id)
-        image_meta = glance.notifier.format_image_notification(image)
+        image_meta = self._get_stored_image_meta(request, image_id, 'v2')
+        if image_meta is None:
+            db_api = glance.db.get_api()
+            image_repo = glance.db.ImageRepo(request.context, db_api)
+            image = image_repo.get(image_id)
+            image_meta = glance.notifier.format_image_notification(image)
+            self._store_image_meta(request, image_id, 'v2', image_meta)
+        image_size = image_meta['size']
+        image_checksum = image_meta['checksum']
         self._verify_metadata(image_meta)
+        image_range = request.environ.get('api.cache.image_range')
+        expected_size = image_meta['size']
+        if image_range is not None:
+            expected_size = image_range[1]
+        self._count_bytes_served(request, expected_size)
         response = webob.Response(request=request)
         response.app_iter = size_checked_iter(response, image_meta,
-                                              image_meta['size'],
+                                              expected_size,
                                               image_iterator,
                                               notifier.Notifier())
         # NOTE (flwang): Set the content-type, content-md5 and content-length
@@ -186,16 +324,31 @@ class CacheFilter(wsgi.Middleware):
         # content-length got by the method "download" because of this issue:
         # https://github.com/Pylons/webob/issues/86
         response.headers['Content-Type'] = 'application/octet-stream'
-        response.headers['Content-MD5'] = image.checksum
-        response.headers['Content-Length'] = str(image.size)
+        response.headers['Accept-Ranges'] = 'bytes'
+        if image_range is not None:
+            common.set_range_headers(response, image_range[0],
+                                     image_range[1], image_size)
+            return response
+        response.headers['Content-MD5'] = image_checksum
+        response.headers['Content-Length'] = str(image_size)
         return response
 
+    def _count_bytes_served(self, request, num_bytes):
+        source = request.environ.get('api.cache.source', 'cache')
+        try:
+            num_bytes = int(num_bytes)
+        except (TypeError, ValueError):
+            return
+        self.cache.stats.incr('bytes_from_%s' % source, num_bytes)
+
     def process_response(self, resp):
         """
         We intercept the response coming back from the main
         images Resource, removing image file from the cache
         if necessary
         """
+        self._drop_changed_image_meta(resp.request)
+
         if not 200 <= self.get_status_code(resp) < 300:
             return resp
 
@@ -221,6 +374,16 @@ class CacheFilter(wsgi.Middleware):
         return resp
 
     def _process_GET_response(self, resp, image_id):
+        try:
+            self.cache.stats.incr('bytes_from_backend',
+                                  int(resp.headers.get('Content-Length', 0)))
+        except ValueError:
+            pass
+
+        if self.get_status_code(resp) == 206:
+            # Only part of the image is being returned
+            return resp
+
         image_checksum = resp.headers.get('Content-MD5', None)
 
         if not image_checksum:
@@ -230,10 +393,47 @@ class CacheFilter(wsgi.Middleware):
         if not image_checksum:
             LOG.error(_("Checksum header is missing."))
 
+        image_meta = self._get_response_image_meta(resp, image_id)
         resp.app_iter = self.cache.get_caching_iter(image_id, image_checksum,
-                                                    resp.app_iter)
+                                                    resp.app_iter,
+                                                    image_meta=image_meta)
         return resp
 
+    @staticmethod
+    def _get_response_image_meta(resp, image_id):
+        """
+        Returns the size and disk format of the image being sent in a
+        response, for the admission filter of the cache, and its owner and
+        visibility, for the partitioning of the cache.
+        """
+        size = resp.headers.get('x-image-meta-size',
+                                resp.headers.get('Content-Length'))
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            size = None
+        image_meta = {'size': size,
+                      'disk_format': resp.headers.get(
+                          'x-image-meta-disk_format')}
+        if 'x-image-meta-is_public' in resp.headers:
+            image_meta['owner'] = resp.headers.get('x-image-meta-owner')
+            image_meta['is_public'] = resp.headers['x-image-meta-is_public']
+
+        if ((image_meta['disk_format'] is None and
+             CONF.image_cache_admission_disk_formats) or
+                ('is_public' not in image_meta and partitions.is_enabled())):
+            # API V2 doesn't send the metadata with the image data
+            db_api = glance.db.get_api()
+            image_repo = glance.db.ImageRepo(resp.request.context, db_api)
+            try:
+                image = image_repo.get(image_id)
+            except exception.NotFound:
+                return image_meta
+            image_meta['disk_format'] = image.disk_format
+            image_meta['owner'] = image.owner
+            image_meta['visibility'] = image.visibility
+        return image_meta
+
     def get_status_code(self, response):
         """
         Returns the integer status code from the response, which
@@ -243,9 +443,109 @@ class CacheFilter(wsgi.Middleware):
             return response.status_int
         return response.status
 
-    def get_from_cache(self, image_id):
+    def _get_cached_image_iter(self, request, image_id, image_range=None):
+        """
+        Returns the body for a cache hit. When the server offers a
+        wsgi.file_wrapper the cached file is handed to it, which lets
+        glance's own server send it with sendfile(2) on plain TCP
+        connections. Otherwise the file is read through get_from_cache.
+
+        :param image_range: Optional (offset, length) of the bytes to return
+        """
+        offset, length = image_range or (0, None)
+        file_wrapper = request.environ.get('wsgi.file_wrapper')
+        if file_wrapper is None or not self.cache.driver.whole_files:
+            return self.get_from_cache(image_id, offset, length)
+        # Data held whole in the memory tier beats sendfile, but a prefix
+        # followed by a chunked read of the rest does not
+        memory_iter = self.cache.get_memory_iter(image_id, offset, length,
+                                                 partial=False)
+        if memory_iter is not None:
+            return memory_iter
+        return file_wrapper(_CachedImageFile(self.cache, image_id,
+                                             offset, length))
+
+    def _get_partial_range(self, request, image_id):
+        """
+        Returns the (offset, length) range asked for by a ranged request
+        for an image that is only partly cached, if that range is in the
+        cache, and None otherwise.
+        """
+        if ('If-Range' in request.headers or
+                not self.cache.is_partly_cached(image_id)):
+            return None
+        image_range = common.get_requested_range(
+            request, self.cache.get_image_size(image_id))
+        if (image_range is None or
+                not self.cache.is_range_cached(image_id, *image_range)):
+            return None
+        return image_range
+
+    def _get_from_peers(self, request, image_id):
+        """
+        Returns an iterator over an image read from the cache of a peer
+        API node, that writes the image into the local cache and checks
+        it against the checksum the peer reports. Returns None if no peer
+        has the image cached.
+        """
+        peer_image = self.peers.get_image(image_id,
+                                          request.headers.get('X-Auth-Token'))
+        if peer_image is None:
+            return None
+        image_meta, image_iterator = peer_image
+        return self.cache.get_caching_iter(image_id, image_meta['checksum'],
+                                           image_iterator,
+                                           image_meta=image_meta)
+
+    def get_from_cache(self, image_id, offset=0, length=None):
         """Called if cache hit"""
-        with self.cache.open_for_read(image_id) as cache_file:
-            chunks = utils.chunkiter(cache_file)
-            for chunk in chunks:
-                yield chunk
+        return self.cache.get_cached_iter(image_id, offset, length)
+
+
+class _CachedImageFile(object):
+    """
+    File-like object for a cached image, for use with wsgi.file_wrapper.
+
+    The file is opened through the cache's open_for_read on first use and
+    the read is completed when the server closes the object, so the image's
+    hit count is updated just as it is for get_from_cache. Reads can be
+    limited to a range of the file.
+    """
+
+    def __init__(self, cache, image_id, offset=0, length=None):
+        self.cache = cache
+        self.image_id = image_id
+        self.offset = offset
+        self.remaining = length
+        self._context = None
+        self._file = None
+
+    def _open(self):
+        if self._file is None:
+            self._context = self.cache.open_for_read(self.image_id)
+            self._file = self._context.__enter__()
+            if self.offset:
+                self._file.seek(self.offset)
+        return self._file
+
+    def fileno(self):
+        return self._open().fileno()
+
+    def tell(self):
+        return self._open().tell()
+
+    def read(self, size=-1):
+        if self.remaining is not None:
+            if size < 0 or size > self.remaining:
+                size = self.remaining
+            if size == 0:
+                return ''
+        data = self._open().read(size)
+        if self.remaining is not None:
+            self.remaining -= len(data)
+        return data
+
+    def close(self):
+        if self._context is not None:
+            context, self._context = self._context, None
+            context.__exit__(None, None, None)
@@ -50,7 +50,8 @@ import glance.registry.client.v1.api as registry
 from glance.store import (get_from_backend,
                           get_size_from_backend,
                           get_store_from_location,
-                          get_store_from_scheme)
+                          get_store_from_scheme,
+                          is_in_store)
 
 LOG = logging.getLogger(__name__)
 SUPPORTED_PARAMS = glance.api.v1.SUPPORTED_PARAMS
@@ -403,9 +404,11 @@ class Controller(controller.BaseController):
         return Controller._validate_source(source, req)
 
     @staticmethod
-    def _get_from_store(context, where):
+    def _get_from_store(context, where, offset=0, length=None):
         try:
-            image_data, image_size = get_from_backend(context, where)
+            image_data, image_size = get_from_backend(context, where,
+                                                      offset=offset,
+                                                      length=length)
         except exception.NotFound as e:
             raise HTTPNotFound(explanation="%s" % e)
         image_size = int(image_size) if image_size else None
@@ -427,7 +430,15 @@ class Controller(controller.BaseController):
 
         self._enforce_read_protected_props(image_meta, req)
 
-        if image_meta.get('size') == 0:
+        image_range = common.get_requested_range(req, image_meta.get('size'),
+                                                 image_meta.get('checksum'))
+        if image_range is not None:
+            offset, length = image_range
+            image_iterator, size = self._get_from_store(req.context,
+                                                        image_meta['location'],
+                                                        offset, length)
+            image_iterator = utils.cooperative_iter(image_iterator)
+        elif image_meta.get('size') == 0:
             image_iterator = iter([])
         else:
             image_iterator, size = self._get_from_store(req.context,
@@ -439,6 +450,7 @@ class Controller(controller.BaseController):
         return {
             'image_iterator': image_iterator,
             'image_meta': image_meta,
+            'image_range': image_range,
         }
 
     def _reserve(self, req, image_meta):
@@ -513,8 +525,15 @@ class Controller(controller.BaseController):
         :retval The location where the image was stored
         """
 
+        saving = False
         copy_from = self._copy_from(req)
         if copy_from:
+            copied = self._copy_in_store(req, image_meta, copy_from)
+            if copied:
+                return copied
+            # the store may have turned down the copy after the image was
+            # already set to saving, in which case the data is streamed
+            saving = copied is False
             try:
                 image_data, image_size = self._get_from_store(req.context,
                                                               copy_from)
@@ -540,15 +559,12 @@ class Controller(controller.BaseController):
         store = self.get_store_or_400(req, scheme)
 
         image_id = image_meta['id']
-        LOG.debug(_("Setting image %s to status 'saving'"), image_id)
-        registry.update_image_metadata(req.context, image_id,
-                                       {'status': 'saving'})
+        if not saving:
+            self._set_saving(req, image_meta)
 
         LOG.debug(_("Uploading image data for image %(image_id)s "
                     "to %(scheme)s store"), locals())
 
-        self.notifier.info("image.prepare", redact_loc(image_meta))
-
         image_meta, location, loc_meta = upload_utils.upload_data_to_store(
             req, image_meta, image_data, store, self.notifier)
 
@@ -556,6 +572,64 @@ class Controller(controller.BaseController):
 
         return location, loc_meta
 
+    def _copy_in_store(self, req, image_meta, copy_from):
+        """
+        Copies the image data at the copy-from location within the backend
+        store the image is added to, when the store holds that location and
+        can copy the data itself, e.g. as an RBD clone or a Swift
+        server-side copy, so that the data is not streamed through Glance.
+
+        :param req: The WSGI/Webob Request object
+        :param image_meta: Mapping of metadata about image
+        :param copy_from: The copy-from location
+
+        :retval The location where the image was stored and its location
+                metadata, (None, None) if the copy failed, or None if the
+                data must be streamed instead, False if the store turned
+                down the copy after the image was set to `saving`
+        """
+        scheme = req.headers.get('x-image-meta-store', CONF.default_store)
+        store = self.get_store_or_400(req, scheme)
+        if not is_in_store(copy_from, store):
+            return None
+
+        image_id = image_meta['id']
+        self._set_saving(req, image_meta)
+
+        try:
+            result = upload_utils.copy_data_in_store(req, image_meta,
+                                                     copy_from, store,
+                                                     self.notifier)
+        except HTTPError:
+            raise
+        except Exception as e:
+            upload_utils.safe_kill(req, image_id)
+            msg = _("Copy from external source failed: %s") % e
+            LOG.debug(msg)
+            return None, None
+        if result is None:
+            LOG.debug(_("Streaming the data of image %(image_id)s from "
+                        "%(scheme)s store") % locals())
+            return False
+
+        image_meta, location, loc_meta = result
+        self.notifier.info('image.upload', redact_loc(image_meta))
+        return location, loc_meta
+
+    def _set_saving(self, req, image_meta):
+        """
+        Sets the image status to `saving` and sends the `image.prepare`
+        notification, before the image data is stored.
+
+        :param req: The WSGI/Webob Request object
+        :param image_meta: Mapping of metadata about image
+        """
+        image_id = image_meta['id']
+        LOG.debug(_("Setting image %s to status 'saving'"), image_id)
+        registry.update_image_metadata(req.context, image_id,
+                                       {'status': 'saving'})
+        self.notifier.info("image.prepare", redact_loc(image_meta))
+
     def _activate(self, req, image_id, location, location_metadata=None):
         """
         Sets the image status to `active` and the image's location
@@ -1057,13 +1131,20 @@ class ImageSerializer(wsgi.JSONResponseSerializer):
         image_meta = result['image_meta']
 
         image_iter = result['image_iterator']
+        image_range = result.get('image_range')
         # image_meta['size'] should be an int, but could possibly be a str
         expected_size = int(image_meta['size'])
+        if image_range is not None:
+            expected_size = image_range[1]
         response.app_iter = common.size_checked_iter(
                 response, image_meta, expected_size, image_iter, self.notifier)
         # Using app_iter blanks content-length, so we set it here...
         response.headers['Content-Length'] = str(image_meta['size'])
         response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
+        if image_range is not None:
+            common.set_range_headers(response, image_range[0],
+                                     image_range[1], image_meta['size'])
 
         self._inject_image_meta_headers(response, image_meta)
         self._inject_location_header(response, image_meta)
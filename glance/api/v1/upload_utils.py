@@ -80,6 +80,54 @@ def upload_data_to_store(req, image_meta, image_data, store, notifier):
 
     Upload image data to the store and cleans up on error.
     """
+    def add(remaining):
+        data = image_data
+        if remaining is not None:
+            data = utils.LimitingReader(data, remaining)
+        return glance.store.store_add_to_backend(
+            image_meta['id'],
+            utils.CooperativeReader(data),
+            image_meta['size'],
+            store)
+
+    return _store_data(req, image_meta, add, notifier)
+
+
+def copy_data_in_store(req, image_meta, copy_from, store, notifier):
+    """
+    Copy image data the specified store already holds within the store.
+
+    Copies the data at the copy-from location of an image to the store
+    without streaming it through the API server, when the store holds that
+    location and can copy it, and cleans up on error. Returns None if the
+    data must be streamed instead.
+    """
+    def copy(remaining):
+        if (image_meta.get('size') and
+                image_meta['size'] > CONF.image_size_cap):
+            raise exception.ImageSizeLimitExceeded()
+        return glance.store.store_copy_to_backend(
+            copy_from, image_meta['id'], image_meta.get('size') or 0, store)
+
+    if not glance.store.is_in_store(copy_from, store):
+        return None
+    if not image_meta.get('size'):
+        image_meta['size'] = glance.store.get_size_from_backend(req.context,
+                                                                copy_from)
+    return _store_data(req, image_meta, copy, notifier)
+
+
+def _store_data(req, image_meta, store_data, notifier):
+    """
+    Stores image data with the supplied function, and records its size
+    and checksum.
+
+    :param store_data: Function storing the image data, given the number
+                       of bytes left in the quota of the owner, or None,
+                       returning the same as
+                       `glance.store.store_add_to_backend` or None if the
+                       data was not stored
+    """
     image_id = image_meta['id']
 
     db_api = glance.db.get_api()
@@ -88,17 +136,11 @@ def upload_data_to_store(req, image_meta, image_data, store, notifier):
     try:
         remaining = glance.api.common.check_quota(
             req.context, image_size, db_api, image_id=image_id)
-        if remaining is not None:
-            image_data = utils.LimitingReader(image_data, remaining)
 
-        (location,
-         size,
-         checksum,
-         locations_metadata) = glance.store.store_add_to_backend(
-             image_meta['id'],
-             utils.CooperativeReader(image_data),
-             image_meta['size'],
-             store)
+        result = store_data(remaining)
+        if result is None:
+            return None
+        location, size, checksum, locations_metadata = result
 
         try:
             # recheck the quota in case there were simultaneous uploads that
@@ -129,7 +171,12 @@ def upload_data_to_store(req, image_meta, image_data, store, notifier):
         # Verify any supplied size/checksum value matches size/checksum
         # returned from store when adding image
         _kill_mismatched(image_meta, 'size', size)
-        _kill_mismatched(image_meta, 'checksum', checksum)
+        if checksum is None:
+            # The store copied the data without reading it, so a supplied
+            # checksum is kept as it is, as for an external location
+            checksum = image_meta.get('checksum')
+        else:
+            _kill_mismatched(image_meta, 'checksum', checksum)
 
         # Update the database with the checksum returned
         # from the backend store
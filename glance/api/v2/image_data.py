@@ -132,6 +132,10 @@ class ImageDataController(object):
         if not image.locations:
             reason = _("No image data could be found")
             raise webob.exc.HTTPNotFound(reason)
+
+        # The range is applied by the serializer, but it has to be checked
+        # here as errors raised while serializing never reach the client
+        glance.api.common.get_requested_range(req, image.size, image.checksum)
         return image
 
 
@@ -149,6 +153,20 @@ class RequestDeserializer(wsgi.JSONRequestDeserializer):
 class ResponseSerializer(wsgi.JSONResponseSerializer):
     def download(self, response, image):
         response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['Accept-Ranges'] = 'bytes'
+        image_range = None
+        if response.request is not None:
+            image_range = glance.api.common.get_requested_range(
+                response.request, image.size, image.checksum)
+        if image_range is not None:
+            offset, length = image_range
+            response.app_iter = iter(image.get_data(offset=offset,
+                                                    length=length))
+            # Content-MD5 would describe the whole image, not the range sent
+            glance.api.common.set_range_headers(response, offset, length,
+                                                image.size)
+            return
+
         # NOTE(markwash): filesystem store (and maybe others?) cause a problem
         # with the caching middleware if they are not wrapped in an iterator
         # very strange
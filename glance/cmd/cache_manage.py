@@ -37,6 +37,7 @@ if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
 import glance.image_cache.client
 from glance.common import exception
 from glance.common import utils
+from glance.openstack.common import jsonutils
 from glance.openstack.common import timeutils
 from glance.version import version_info as version
 
@@ -140,12 +141,80 @@ List all images currently queued for caching"""
         print pretty_table.make_row(image)
 
 
+@catch_error('show cache statistics')
+def show_stats(options, args):
+    """
+%(prog)s stats [options]
+
+Show the counters of image cache activity of all API workers and cache
+tools, optionally as JSON with --format json"""
+    client = get_client(options)
+    stats = client.get_cache_stats()
+
+    if options.format == 'json':
+        print jsonutils.dumps(stats, sort_keys=True)
+        return SUCCESS
+
+    pretty_table = utils.PrettyTable()
+    pretty_table.add_column(24, label="Counter")
+    pretty_table.add_column(20, label="Value", just="r")
+
+    print pretty_table.make_header()
+
+    for name, value in sorted(stats['counters'].items()):
+        if isinstance(value, float):
+            value = "%.2f" % value
+        print pretty_table.make_row(name, value)
+
+    print
+    print "Cache size: %d of %d bytes" % (stats['cache_size'],
+                                          stats['max_size'])
+    if stats['hit_ratio'] is not None:
+        print "Hit ratio: %.1f%%" % (stats['hit_ratio'] * 100)
+    if stats['fill_throughput'] is not None:
+        print "Fill throughput: %d bytes/s" % stats['fill_throughput']
+
+    if stats.get('partitions'):
+        pretty_table = utils.PrettyTable()
+        pretty_table.add_column(44, label="Partition")
+        pretty_table.add_column(14, label="Size", just="r")
+        pretty_table.add_column(14, label="Reserved", just="r")
+        pretty_table.add_column(14, label="Max", just="r")
+
+        print
+        print pretty_table.make_header()
+
+        for name, partition in sorted(stats['partitions'].items()):
+            print pretty_table.make_row(name, partition['size'],
+                                        partition['reserved_size'],
+                                        partition['max_size'])
+
+
+@catch_error('reset cache statistics')
+def reset_stats(options, args):
+    """
+%(prog)s reset-stats [options]
+
+Sets the counters of image cache activity to 0"""
+    if (not options.force and
+            not user_confirm("Reset cache statistics?", default=False)):
+        return SUCCESS
+
+    client = get_client(options)
+    client.reset_cache_stats()
+
+    if options.verbose:
+        print "Reset cache statistics"
+
+    return SUCCESS
+
+
 @catch_error('queue the specified image for caching')
 def queue_image(options, args):
     """
 %(prog)s queue-image <IMAGE_ID> [options]
 
-Queues an image for caching"""
+Queues an image for caching, optionally with a --priority"""
     try:
         image_id = args.pop()
     except IndexError:
@@ -159,7 +228,7 @@ Queues an image for caching"""
         return SUCCESS
 
     client = get_client(options)
-    client.queue_image_for_caching(image_id)
+    client.queue_image_for_caching(image_id, priority=options.priority)
 
     if options.verbose:
         print "Queued image %(image_id)s for caching" % locals()
@@ -319,6 +388,16 @@ def create_options(parser):
                       default=False, action="store_true",
                       help="Prevent select actions from requesting "
                            "user confirmation")
+    parser.add_option('--priority', dest="priority", metavar="PRIORITY",
+                      type=int, default=None,
+                      help="Priority to queue an image with. Images with "
+                           "a higher priority are prefetched first. "
+                           "Default: 0")
+    parser.add_option('--format', dest="format", metavar="FORMAT",
+                      type="choice", choices=["table", "json"],
+                      default="table",
+                      help="Output format of the stats command, table or "
+                           "json. Default: %default")
 
     parser.add_option('--os-auth-token',
                       dest='os_auth_token',
@@ -428,6 +507,8 @@ def lookup_command(parser, command_name):
     CACHE_COMMANDS = {
         'list-cached': list_cached,
         'list-queued': list_queued,
+        'stats': show_stats,
+        'reset-stats': reset_stats,
         'queue-image': queue_image,
         'delete-cached-image': delete_cached_image,
         'delete-all-cached-images': delete_all_cached_images,
@@ -482,6 +563,10 @@ Commands:
 
     list-queued                 List all images currently queued for caching
 
+    stats                       Show cache hit ratio, traffic and fill counters
+
+    reset-stats                 Sets the cache statistics counters to 0
+
     queue-image                 Queue an image for caching
 
     delete-cached-image         Purges an image from the cache
@@ -20,7 +20,8 @@
 Glance Image Cache Pre-fetcher
 
 This is meant to be run from the command line after queueing
-images to be pretched.
+images to be pretched, or as a daemon that keeps fetching images
+as they are queued.
 """
 
 import os
@@ -34,13 +35,27 @@ possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
 if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
     sys.path.insert(0, possible_topdir)
 
+from oslo.config import cfg
+
 from glance.common import config
 from glance.image_cache import prefetcher
 from glance.openstack.common import log
 import glance.store
 
+CONF = cfg.CONF
+
 
 def main():
+    CONF.register_cli_opt(
+        cfg.BoolOpt('daemon',
+                    short='D',
+                    default=False,
+                    help='Run as a long-running process. When not '
+                         'specified (the default) prefetch the images in '
+                         'the queue once and then exit. When specified do '
+                         'not exit and keep prefetching images as they are '
+                         'queued.'))
+
     try:
         config.parse_cache_args()
         log.setup('glance')
@@ -49,7 +64,10 @@ def main():
         glance.store.verify_default_store()
 
         app = prefetcher.Prefetcher()
-        app.run()
+        if CONF.daemon:
+            app.run_daemon()
+        else:
+            app.run()
     except RuntimeError as e:
         sys.exit("ERROR: %s" % e)
 
@@ -232,6 +232,11 @@ class StoreAddNotSupported(GlanceException):
     message = _("Adding images to this store is not supported.")
 
 
+class StoreCopyNotSupported(GlanceException):
+    message = _("Copying this image data within the store is not "
+                "supported.")
+
+
 class StoreAddDisabled(GlanceException):
     message = _("Configuration for store failed. Adding images to this "
                 "store is disabled.")
@@ -285,5 +290,14 @@ class ImageSizeLimitExceeded(GlanceException):
     message = _("The provided image is too large.")
 
 
+class ImageCacheFillFailed(GlanceException):
+    message = _("Caching of image %(image_id)s failed: %(reason)s")
+
+
+class ImageCacheBlockInvalid(GlanceException):
+    message = _("Block %(block)d of cached image %(image_id)s is invalid: "
+                "%(reason)s")
+
+
 class RPCError(GlanceException):
     message = _("%(cls)s exception was raised in the last rpc call: %(val)s")
@@ -0,0 +1,313 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+I/O strategy for image files that are read or written once, from start to
+end, such as the files of the filesystem store and of the image cache.
+
+Space for a file being written is reserved up front when its size is known,
+so that a multi-GB image is laid out in few extents and a full disk is found
+before any data is written. The kernel is told that the file is read
+sequentially, and the pages of a large image are dropped from the page cache
+shortly behind the data being written or read, so that streaming one image
+does not push everything else out of memory.
+
+The system calls used are only available on Linux. Elsewhere, or on
+filesystems that do not support them, files are read and written as before.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import os
+import sys
+
+from eventlet import tpool
+from oslo.config import cfg
+
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+fileio_opts = [
+    cfg.BoolOpt('image_file_preallocate', default=True,
+                help=_('Reserve the disk space of an image file before '
+                       'writing it, when the size of the image is known.')),
+    cfg.BoolOpt('image_file_drop_cache', default=True,
+                help=_('Drop the data of large image files streamed to or '
+                       'from disk from the page cache as it is written or '
+                       'read.')),
+    cfg.IntOpt('image_file_bytes_per_sync', default=64 * 1024 * 1024,
+               help=_('The number of bytes of an image file that are '
+                      'written or read before they are dropped from the '
+                      'page cache. Files smaller than this stay cached.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(fileio_opts)
+
+FALLOC_FL_KEEP_SIZE = 1
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+# _IOW(0x94, 9, int), cloning a whole file on Btrfs, XFS and others
+FICLONE = 0x40049409
+
+_libc = None
+
+
+def _get_libc():
+    """Returns the C library, or None if its calls are not available."""
+    global _libc
+    if _libc is None:
+        _libc = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                args = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                        ctypes.c_int]
+                libc.fallocate64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                             ctypes.c_int64, ctypes.c_int64]
+                libc.posix_fadvise64.argtypes = args
+                libc.sync_file_range.argtypes = args
+                _libc = libc
+            except (AttributeError, OSError) as e:
+                LOG.debug(_("Image file I/O hints are not available: %s"), e)
+    return _libc or None
+
+
+def preallocate(fd, length):
+    """
+    Reserves the disk space for the first length bytes of a file, without
+    changing the size of the file. Returns True if the space was reserved.
+
+    :param fd: File descriptor
+    :param length: Number of bytes to reserve
+    :raises IOError with errno ENOSPC if there is not enough free space
+    """
+    libc = _get_libc()
+    if libc is None or length <= 0:
+        return False
+    if libc.fallocate64(fd, FALLOC_FL_KEEP_SIZE, 0, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.ENOSPC, errno.EFBIG):
+        raise IOError(err, os.strerror(err))
+    # Most likely a filesystem without fallocate support
+    return False
+
+
+def fadvise(fd, offset, length, advice):
+    """
+    Gives the kernel advice on how a range of a file will be accessed.
+    Returns True if the advice was taken.
+
+    :param fd: File descriptor
+    :param offset: Offset of the range
+    :param length: Length of the range, 0 meaning to the end of the file
+    :param advice: One of the POSIX_FADV_* constants
+    """
+    libc = _get_libc()
+    if libc is None:
+        return False
+    return libc.posix_fadvise64(fd, offset, length, advice) == 0
+
+
+def advise_sequential(f):
+    """
+    Tells the kernel that a file will be read from start to end, so that
+    it reads further ahead. Objects without a file descriptor are ignored.
+
+    :param f: File object
+    """
+    try:
+        fd = f.fileno()
+    except (AttributeError, IOError, ValueError):
+        return False
+    return fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+
+def clone(src_fd, dst_fd):
+    """
+    Makes a file share the data of another file on the same filesystem,
+    copy-on-write, instead of copying it. Returns True if the file was
+    cloned, or False if the filesystem does not support it.
+
+    :param src_fd: File descriptor of the file to clone
+    :param dst_fd: File descriptor of an empty file opened for writing
+    """
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except IOError as e:
+        if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                       errno.EXDEV, errno.ENOSYS):
+            return False
+        raise
+
+
+def _sync_range(fd, offset, length, flags):
+    """
+    Starts or waits for the writeback of a range of a file. Returns True
+    if sync_file_range was available and succeeded.
+    """
+    libc = _get_libc()
+    if libc is None:
+        return False
+    return libc.sync_file_range(fd, offset, length, flags) == 0
+
+
+class OnePassFile(object):
+
+    """
+    Wraps a file object that is read or written once, from start to end.
+
+    Once more than image_file_bytes_per_sync bytes have been written, the
+    data written so far is dropped from the page cache in steps of that
+    size. Writeback of each step is started when it is written, and the
+    step before it is waited for and dropped, since the kernel only drops
+    pages that are clean. Data read is dropped the same way. Files smaller
+    than a step are left alone.
+    """
+
+    def __init__(self, f, size=None, drop_cache=None):
+        """
+        :param f: File object, which is closed with this object
+        :param size: Number of bytes that will be written, if known
+        :param drop_cache: Whether to drop the data from the page cache,
+                           defaults to image_file_drop_cache
+        """
+        self.f = f
+        self.name = getattr(f, 'name', None)
+        self.fd = f.fileno()
+        if drop_cache is None:
+            drop_cache = CONF.image_file_drop_cache
+        self.drop_cache = drop_cache
+        self.step = CONF.image_file_bytes_per_sync
+        self.pos = f.tell()
+        # Start of the data that has not been dropped yet
+        self.start = self.pos
+        self.dropped = False
+        # Step of written data whose writeback was started
+        self.flushing = None
+        self.preallocated = 0
+        self.writing = 'r' not in getattr(f, 'mode', 'w')
+        try:
+            if not self.writing:
+                advise_sequential(f)
+            elif size and CONF.image_file_preallocate:
+                if preallocate(self.fd, self.pos + size):
+                    self.preallocated = self.pos + size
+        except Exception:
+            f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.close()
+
+    def fileno(self):
+        return self.fd
+
+    def tell(self):
+        return self.pos
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.pos += len(data)
+        if self.drop_cache and self.pos - self.start >= self.step:
+            fadvise(self.fd, self.start, self.pos - self.start,
+                    POSIX_FADV_DONTNEED)
+            self.start = self.pos
+            self.dropped = True
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.f.seek(offset, whence)
+        self.pos = self.start = self.f.tell()
+
+    def write(self, data):
+        self.f.write(data)
+        self.pos += len(data)
+        if self.drop_cache and self.pos - self.start >= self.step:
+            self.f.flush()
+            if not _sync_range(self.fd, self.start, self.pos - self.start,
+                               SYNC_FILE_RANGE_WRITE):
+                # Without sync_file_range the data could only be written
+                # back a step at a time by flushing the whole file, which
+                # costs more than keeping the pages cached
+                self._drop_flushing()
+                self.drop_cache = False
+                return
+            self._drop_flushing()
+            self.flushing = (self.start, self.pos - self.start)
+            self.start = self.pos
+            self.dropped = True
+
+    def _drop_flushing(self):
+        if self.flushing is not None:
+            offset, length = self.flushing
+            # Waiting for the writeback of a whole step can take a while,
+            # so it is done in a native thread to keep the other
+            # greenthreads running
+            if tpool.execute(_sync_range, self.fd, offset, length,
+                             SYNC_FILE_RANGE_WAIT_BEFORE |
+                             SYNC_FILE_RANGE_WRITE |
+                             SYNC_FILE_RANGE_WAIT_AFTER):
+                fadvise(self.fd, offset, length, POSIX_FADV_DONTNEED)
+            self.flushing = None
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        """
+        Closes the file. Space reserved beyond the data written is given
+        back, and the rest of a large file is dropped from the page cache.
+        """
+        if self.f.closed:
+            return
+        try:
+            if self.writing:
+                self.f.flush()
+                if self.preallocated > self.pos:
+                    # The stream ended early. Truncating to the current
+                    # size frees the blocks reserved beyond it.
+                    os.ftruncate(self.fd, self.pos)
+                if self.dropped:
+                    self._drop_flushing()
+                    self.flushing = (self.start, self.pos - self.start)
+                    self._drop_flushing()
+            elif self.dropped:
+                fadvise(self.fd, self.start, 0, POSIX_FADV_DONTNEED)
+        finally:
+            self.f.close()
+
+    @property
+    def closed(self):
+        return self.f.closed
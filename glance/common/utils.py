@@ -90,6 +90,30 @@ def chunkiter(fp, chunk_size=65536):
             break
 
 
+def range_iter(iter, offset, length=None):
+    """
+    Return an iterator which yields only the `length` bytes starting at
+    `offset` of the data from another iterator of chunks.
+
+    :param iter: an iterator to wrap
+    :param offset: number of bytes to skip
+    :param length: number of bytes to yield, or None for all the rest
+    """
+    for chunk in iter:
+        if offset >= len(chunk):
+            offset -= len(chunk)
+            continue
+        if offset:
+            chunk = chunk[offset:]
+            offset = 0
+        if length is not None:
+            if len(chunk) >= length:
+                yield chunk[:length]
+                return
+            length -= len(chunk)
+        yield chunk
+
+
 def cooperative_iter(iter):
     """
     Return an iterator which schedules after each
@@ -40,6 +40,12 @@ import routes.middleware
 import webob.dec
 import webob.exc
 
+try:
+    import sendfile
+    SENDFILE_SUPPORTED = True
+except ImportError:
+    SENDFILE_SUPPORTED = False
+
 from glance.common import exception
 from glance.common import utils
 import glance.openstack.common.log as os_logging
@@ -86,6 +92,8 @@ CONF.register_opts(bind_opts)
 CONF.register_opts(socket_opts)
 CONF.register_opts(eventlet_opts)
 
+LOG = os_logging.getLogger(__name__)
+
 
 class WritableLogger(object):
     """A thin wrapper that responds to `write` and logs."""
@@ -324,6 +332,7 @@ class Server(object):
                                  self.application,
                                  log=WritableLogger(self.logger),
                                  custom_pool=self.pool,
+                                 protocol=HttpProtocol,
                                  debug=False)
         except socket.error as err:
             if err[0] != errno.EINVAL:
@@ -334,7 +343,120 @@ class Server(object):
         """Start a WSGI server in a new green thread."""
         self.logger.info(_("Starting single process server"))
         eventlet.wsgi.server(sock, application, custom_pool=self.pool,
-                             log=WritableLogger(self.logger), debug=False)
+                             log=WritableLogger(self.logger),
+                             protocol=HttpProtocol, debug=False)
+
+
+class FileWrapper(object):
+    """
+    The wsgi.file_wrapper offered to applications by HttpProtocol.
+
+    Iterating over the wrapper yields the file in chunks, which is how it
+    is sent when the server cannot use sendfile(2) for the connection.
+    """
+
+    def __init__(self, filelike, blksize=65536):
+        self.filelike = filelike
+        self.blksize = blksize
+        self.bytes_sent = 0
+
+    def __iter__(self):
+        for chunk in utils.chunkiter(self.filelike, self.blksize):
+            self.bytes_sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        if hasattr(self.filelike, 'close'):
+            self.filelike.close()
+
+    def sendfile(self, sock, count):
+        """
+        Send count bytes of the file, from its current position, to a
+        plain socket with sendfile(2), so the data never passes through
+        userspace.
+
+        :param sock: The (green) socket of the client connection
+        :param count: Number of bytes to send
+        :returns: Number of bytes sent, which is less than count if the
+                  file turned out to be shorter
+        """
+        in_fd = self.filelike.fileno()
+        out_fd = sock.fileno()
+        start = 0
+        if hasattr(self.filelike, 'tell'):
+            start = self.filelike.tell()
+        while self.bytes_sent < count:
+            try:
+                sent = sendfile.sendfile(out_fd, in_fd,
+                                         start + self.bytes_sent,
+                                         count - self.bytes_sent)
+            except OSError as err:
+                if err.errno != errno.EAGAIN:
+                    raise
+                eventlet.hubs.trampoline(out_fd, write=True)
+                continue
+            if sent == 0:
+                break
+            self.bytes_sent += sent
+            # Don't starve other green threads when the client keeps up
+            eventlet.sleep(0)
+        return self.bytes_sent
+
+
+class HttpProtocol(eventlet.wsgi.HttpProtocol):
+    """
+    Offers wsgi.file_wrapper to applications on plain TCP connections and
+    sends responses made of a FileWrapper with sendfile(2). Responses
+    without a Content-Length fall back to being iterated as usual.
+    """
+
+    def get_environ(self):
+        env = eventlet.wsgi.HttpProtocol.get_environ(self)
+        if SENDFILE_SUPPORTED and not hasattr(self.connection,
+                                              'do_handshake'):
+            env['wsgi.file_wrapper'] = FileWrapper
+        return env
+
+    def handle_one_response(self):
+        self.application = self._sendfile_application(self.application)
+        eventlet.wsgi.HttpProtocol.handle_one_response(self)
+
+    def _sendfile_application(self, application):
+        def wrapped(environ, start_response):
+            response = {}
+
+            def capture_start_response(status, headers, exc_info=None):
+                response['headers'] = headers
+                response['write'] = start_response(status, headers, exc_info)
+                return response['write']
+
+            result = application(environ, capture_start_response)
+            if not isinstance(result, FileWrapper) or 'write' not in response:
+                return result
+
+            length = None
+            for name, value in response['headers']:
+                if name.lower() == 'content-length':
+                    length = int(value)
+            if length is None:
+                return result
+
+            try:
+                # Writing an empty body sends the status line and headers
+                response['write']('')
+                self.wfile.flush()
+                sent = result.sendfile(self.connection, length)
+            finally:
+                result.close()
+
+            if sent < length:
+                msg = _("File ended after sending %(sent)d of %(length)d "
+                        "bytes, closing the connection")
+                LOG.error(msg % {'sent': sent, 'length': length})
+                self.close_connection = 1
+            return []
+
+        return wrapped
 
 
 class Middleware(object):
@@ -20,11 +20,21 @@ LRU Cache for Image Data
 """
 
 import hashlib
+import os
+import time
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import exception
+from glance.common import fileio
 from glance.common import utils
+from glance.image_cache import admission
+from glance.image_cache import memory
+from glance.image_cache import metadata
+from glance.image_cache import partitions
+from glance.image_cache import policies
+from glance.image_cache import stats
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
 
@@ -40,11 +50,39 @@ image_cache_opts = [
                       'cache without being accessed')),
     cfg.StrOpt('image_cache_dir',
                help=_('Base directory that the Image Cache uses.')),
+    cfg.StrOpt('image_cache_eviction_policy', default='lru',
+               help=_('The policy used to choose which images to remove '
+                      'when pruning the cache. One of lru, lfu, gdsf '
+                      '(GreedyDual-Size-Frequency) or arc (Adaptive '
+                      'Replacement Cache).')),
+    cfg.IntOpt('image_cache_follow_timeout', default=60,
+               help=_('The number of seconds a request streaming an image '
+                      'that another request is writing to the cache waits '
+                      'for new data before giving up on the cache fill. '
+                      'Fills that have written no data for longer are '
+                      'not followed, and the image is read from the '
+                      'store instead.')),
+    cfg.IntOpt('image_cache_read_chunk_size', default=64 * 1024,
+               help=_('The size in bytes of the chunks in which cached '
+                      'image files are read.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(image_cache_opts)
 
+# Number of images removed from the cache per driver call when pruning
+PRUNE_BATCH_SIZE = 100
+
+# Directory of image_cache_dir, and file in it, keeping the state of the
+# eviction policy between prunes. The file is kept out of the shard
+# directories, whose regular files are taken for cached images.
+POLICY_STATE_DIR = 'policy'
+POLICY_STATE_FILE = 'eviction_policy.json'
+
+# Seconds to wait between checks for new data when following a cache fill
+FOLLOW_POLL_INTERVAL = 0.1
+FOLLOW_CHUNKSIZE = 64 * 1024
+
 
 class ImageCache(object):
 
@@ -52,6 +90,11 @@ class ImageCache(object):
 
     def __init__(self):
         self.init_driver()
+        self.init_memory_tier()
+        self.init_metadata()
+        self.init_partitions()
+        self.init_admission_filter()
+        self.init_stats()
 
     def init_driver(self):
         """
@@ -92,6 +135,65 @@ class ImageCache(object):
             self.driver = self.driver_class()
             self.driver.configure()
 
+    def init_memory_tier(self):
+        """
+        Create the in-memory tier in front of the driver, if configured
+        """
+        self.memory = None
+        if CONF.image_cache_memory_size > 0:
+            self.memory = memory.MemoryTier(
+                CONF.image_cache_memory_size,
+                CONF.image_cache_memory_eviction_policy)
+
+    def init_metadata(self):
+        """
+        Create the store of the metadata of cached images, if configured
+        """
+        self.metadata = None
+        if CONF.image_cache_metadata_ttl > 0:
+            self.metadata = metadata.ImageMetadataCache(
+                os.path.join(CONF.image_cache_dir, 'metadata'),
+                CONF.image_cache_metadata_ttl)
+
+    def init_partitions(self):
+        """
+        Create the record of the partition of each cached image, if any
+        partition has a reserved or maximum share
+        """
+        self.partitions = None
+        if partitions.is_enabled():
+            self.partitions = partitions.CachePartitions(
+                os.path.join(CONF.image_cache_dir, 'partitions'),
+                CONF.image_cache_public_reserved_share,
+                CONF.image_cache_tenant_max_share,
+                CONF.image_cache_tenant_max_shares)
+
+    def init_admission_filter(self):
+        """
+        Create the filter deciding which images are written to the cache
+        """
+        self.admission = admission.AdmissionFilter(
+            CONF.image_cache_admission_min_requests,
+            CONF.image_cache_admission_window,
+            CONF.image_cache_admission_max_image_size,
+            CONF.image_cache_admission_disk_formats)
+
+    def init_stats(self):
+        """
+        Create the counters of cache activity, which also poll the
+        counters of the memory tier and the admission filter
+        """
+        self.stats = stats.CacheStats(os.path.join(CONF.image_cache_dir,
+                                                   'stats'))
+        if self.memory is not None:
+            self.stats.add_source('memory_', self._get_memory_counters)
+        self.stats.add_source('admission_', self.admission.get_stats)
+
+    def _get_memory_counters(self):
+        memory_stats = self.memory.get_stats()
+        return dict((key, memory_stats[key])
+                    for key in ('hits', 'misses', 'evictions'))
+
     def is_cached(self, image_id):
         """
         Returns True if the image with the supplied ID has its image
@@ -101,6 +203,52 @@ class ImageCache(object):
         """
         return self.driver.is_cached(image_id)
 
+    def is_being_cached(self, image_id):
+        """
+        Returns True if the image with supplied id is currently
+        in the process of having its image file cached.
+
+        :param image_id: Image ID
+        """
+        return self.driver.is_being_cached(image_id)
+
+    def is_fill_active(self, image_id):
+        """
+        Returns True if the image with supplied id is being cached by a
+        request that has written data to the cache within the last
+        image_cache_follow_timeout seconds. The fill of a request that
+        died is left behind until the cache is cleaned, and is not
+        active.
+
+        :param image_id: Image ID
+        """
+        if not self.is_being_cached(image_id):
+            return False
+        last_write = self.driver.get_fill_mtime(image_id)
+        if last_write is None:
+            return False
+        return time.time() - last_write <= CONF.image_cache_follow_timeout
+
+    def is_partly_cached(self, image_id):
+        """
+        Returns True if only some of the data of the image with the
+        supplied ID is cached.
+
+        :param image_id: Image ID
+        """
+        return self.driver.is_partly_cached(image_id)
+
+    def is_range_cached(self, image_id, offset, length):
+        """
+        Returns True if a range of the data of a partly cached image can
+        be read from the cache.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte of the range
+        :param length: Number of bytes in the range
+        """
+        return self.driver.is_range_cached(image_id, offset, length)
+
     def is_queued(self, image_id):
         """
         Returns True if the image identifier is in our cache queue.
@@ -134,6 +282,12 @@ class ImageCache(object):
         Removes all cached image files and any attributes about the images
         and returns the number of cached image files that were deleted.
         """
+        if self.memory is not None:
+            self.memory.clear()
+        if self.metadata is not None:
+            self.metadata.delete_all()
+        if self.partitions is not None:
+            self.partitions.delete_all()
         return self.driver.delete_all_cached_images()
 
     def delete_cached_image(self, image_id):
@@ -142,6 +296,12 @@ class ImageCache(object):
 
         :param image_id: Image ID
         """
+        if self.memory is not None:
+            self.memory.remove(image_id)
+        if self.metadata is not None:
+            self.metadata.delete(image_id)
+        if self.partitions is not None:
+            self.partitions.delete(image_id)
         self.driver.delete_cached_image(image_id)
 
     def delete_all_queued_images(self):
@@ -164,55 +324,254 @@ class ImageCache(object):
         Removes all cached image files above the cache's maximum
         size. Returns a tuple containing the total number of cached
         files removed and the total size of all pruned image files.
+
+        The driver is asked once for the records of all cached images,
+        which are ranked by the configured eviction policy to build a plan
+        that frees just enough space to get back under the maximum size.
+        The planned images are then removed in batches. Drivers that cache
+        images in blocks return records of, and evict, single blocks. When
+        the cache is spread over several shard directories, each shard is
+        pruned to its share of the maximum size. When the cache is
+        partitioned, partitions above their maximum share are pruned first,
+        and partitions within their reserved share are left alone.
+
+        The state the policy learns, such as the ghost lists of ARC, is
+        kept in image_cache_dir from one prune to the next.
         """
         max_size = CONF.image_cache_max_size
         current_size = self.driver.get_cache_size()
-        if max_size > current_size:
+        shards = self.driver.get_shards()
+        states = policies.read_states(self._get_policy_state_path(),
+                                      CONF.image_cache_eviction_policy)
+        if self.partitions is not None:
+            plan = self._plan_partitioned_eviction(shards, current_size,
+                                                   max_size, states)
+            if not plan:
+                LOG.debug(_("Image cache partitions are within their "
+                            "limits, skipping prune..."))
+                return (0, 0)
+        elif len(shards) > 1:
+            plan = self._plan_sharded_eviction(shards, max_size,
+                                               states=states)
+            if not plan:
+                LOG.debug(_("Image cache shards have free space, skipping "
+                            "prune..."))
+                return (0, 0)
+        elif max_size > current_size:
             LOG.debug(_("Image cache has free space, skipping prune..."))
             return (0, 0)
+        else:
+            overage = current_size - max_size
+            LOG.debug(_("Image cache currently %(overage)d bytes over max "
+                        "size. Starting prune to max size of %(max_size)d ")
+                      % locals())
 
-        overage = current_size - max_size
-        LOG.debug(_("Image cache currently %(overage)d bytes over max "
-                    "size. Starting prune to max size of %(max_size)d ") %
-                  locals())
+            plan = self._plan_eviction(current_size, max_size,
+                                       states=states)
+        self._save_policy_states(states)
 
         total_bytes_pruned = 0
         total_files_pruned = 0
-        entry = self.driver.get_least_recently_accessed()
-        while entry and current_size > max_size:
-            image_id, size = entry
-            LOG.debug(_("Pruning '%(image_id)s' to free %(size)d bytes"),
-                      {'image_id': image_id, 'size': size})
-            self.driver.delete_cached_image(image_id)
-            total_bytes_pruned = total_bytes_pruned + size
-            total_files_pruned = total_files_pruned + 1
-            current_size = current_size - size
-            entry = self.driver.get_least_recently_accessed()
-
-        LOG.debug(_("Pruning finished pruning. "
-                    "Pruned %(total_files_pruned)d and "
-                    "%(total_bytes_pruned)d.") % locals())
+        for start in xrange(0, len(plan), PRUNE_BATCH_SIZE):
+            batch = plan[start:start + PRUNE_BATCH_SIZE]
+            for key, size in batch:
+                LOG.debug(_("Pruning '%(key)s' to free %(size)d bytes"),
+                          {'key': key, 'size': size})
+            image_ids = self.driver.evict([k for k, s in batch])
+            for image_id in image_ids:
+                if self.memory is not None:
+                    self.memory.remove(image_id)
+                if self.metadata is not None:
+                    self.metadata.delete(image_id)
+            total_bytes_pruned += sum([s for i, s in batch])
+            total_files_pruned += len(batch)
+
+        self.stats.incr('evictions', total_files_pruned)
+        self.stats.incr('evicted_bytes', total_bytes_pruned)
+        # The pruner usually runs from cron and exits straight after
+        self.stats.flush()
+
+        LOG.info(_("Pruned %(total_files_pruned)d cached images, freeing "
+                   "%(total_bytes_pruned)d bytes. Image cache is now "
+                   "%(new_size)d bytes, max size is %(max_size)d bytes."),
+                 {'total_files_pruned': total_files_pruned,
+                  'total_bytes_pruned': total_bytes_pruned,
+                  'new_size': current_size - total_bytes_pruned,
+                  'max_size': max_size})
         return total_files_pruned, total_bytes_pruned
 
+    def _get_policy_state_path(self):
+        return os.path.join(CONF.image_cache_dir, POLICY_STATE_DIR,
+                            POLICY_STATE_FILE)
+
+    def _save_policy_states(self, states):
+        try:
+            utils.safe_mkdirs(os.path.join(CONF.image_cache_dir,
+                                           POLICY_STATE_DIR))
+            policies.write_states(self._get_policy_state_path(),
+                                  CONF.image_cache_eviction_policy, states)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Unable to save the state of the image cache "
+                       "eviction policy: %s"), e)
+
+    def _plan_eviction(self, current_size, max_size, records=None,
+                       may_evict=None, states=None, scope='cache'):
+        """
+        Returns the ordered list of (image_id, size) tuples that must be
+        evicted to bring the cache from current_size to at most max_size.
+
+        :param records: Eviction records to choose from, by default all
+                        those of the driver
+        :param may_evict: Optional function of an eviction key and size
+                          returning False for keys that must be kept
+        :param states: Optional dict of scope names to policy states,
+                       from which the policy state of scope is restored
+                       and to which it is saved
+        :param scope: Name of the part of the cache being planned for
+        """
+        if records is None:
+            records = self.driver.get_eviction_records()
+        policy = policies.get_policy(CONF.image_cache_eviction_policy,
+                                     max_size)
+        if states is not None:
+            policy.set_state(states.get(scope, {}))
+        policy.load(records)
+
+        plan = []
+        while current_size > max_size and len(policy):
+            image_id, size = policy.evict()
+            if may_evict is not None and not may_evict(image_id, size):
+                policy.forget(image_id)
+                continue
+            plan.append((image_id, size))
+            current_size -= size
+        if states is not None:
+            states[scope] = policy.get_state()
+        return plan
+
+    def _plan_sharded_eviction(self, shards, max_size, records=None,
+                               may_evict=None, states=None):
+        """
+        Returns the eviction plan of a cache spread over several shard
+        directories, bringing each shard to at most its share of max_size
+        in proportion to its weight.
+
+        :param shards: List of (directory, weight) tuples of the shards
+        :param records: Eviction records to choose from, by default all
+                        those of the driver
+        :param may_evict: Optional function of an eviction key and size
+                          returning False for keys that must be kept
+        :param states: Optional dict of scope names to policy states
+        """
+        if records is None:
+            records = self.driver.get_eviction_records()
+        shard_records = {}
+        for record in records:
+            shard = self.driver.get_eviction_shard(record['image_id'])
+            shard_records.setdefault(shard, []).append(record)
+
+        total_weight = sum([weight for shard, weight in shards])
+        plan = []
+        for shard, weight in shards:
+            records = shard_records.get(shard, [])
+            shard_size = sum([record['size'] for record in records])
+            shard_max_size = int(max_size * weight / total_weight)
+            if shard_size <= shard_max_size:
+                continue
+            LOG.debug(_("Image cache shard %(shard)s currently %(overage)d "
+                        "bytes over its max size of %(max_size)d"),
+                      {'shard': shard,
+                       'overage': shard_size - shard_max_size,
+                       'max_size': shard_max_size})
+            plan.extend(self._plan_eviction(shard_size, shard_max_size,
+                                            records, may_evict, states,
+                                            shard))
+        return plan
+
+    def _plan_partitioned_eviction(self, shards, current_size, max_size,
+                                   states=None):
+        """
+        Returns the eviction plan of a partitioned cache. Partitions using
+        more than their maximum size are first brought within it. The
+        cache, or each of its shards, is then brought within its maximum
+        size without evicting from partitions that use no more than their
+        reserved size.
+
+        :param shards: List of (directory, weight) tuples of the shards
+        :param current_size: Current size of the cache
+        :param max_size: Maximum size of the cache
+        :param states: Optional dict of scope names to policy states
+        """
+        records = self.driver.get_eviction_records()
+        usage = self.partitions.get_usage(records,
+                                          self.driver.get_eviction_image_id,
+                                          max_size)
+
+        partition_records = {}
+        for record in records:
+            partition = usage.get_partition(record['image_id'])
+            partition_records.setdefault(partition, []).append(record)
+
+        plan = []
+        for partition, records_of_partition in partition_records.items():
+            overage = usage.get_overage(partition)
+            if not overage:
+                continue
+            size = sum([record['size'] for record in records_of_partition])
+            LOG.debug(_("Image cache partition %(partition)s currently "
+                        "%(overage)d bytes over its max size"),
+                      {'partition': partition, 'overage': overage})
+            partition_plan = self._plan_eviction(
+                size, size - overage, records_of_partition, states=states,
+                scope='partition:%s' % partition)
+            for key, size in partition_plan:
+                usage.evicted(key, size)
+            plan.extend(partition_plan)
+
+        evicted = set([key for key, size in plan])
+        records = [record for record in records
+                   if record['image_id'] not in evicted]
+        if len(shards) > 1:
+            plan.extend(self._plan_sharded_eviction(shards, max_size,
+                                                    records,
+                                                    usage.may_evict,
+                                                    states))
+        else:
+            current_size -= sum([size for key, size in plan])
+            if current_size > max_size:
+                plan.extend(self._plan_eviction(current_size, max_size,
+                                                records, usage.may_evict,
+                                                states))
+        return plan
+
     def clean(self, stall_time=None):
         """
         Cleans up any invalid or incomplete cached images. The cache driver
         decides what that means...
         """
         self.driver.clean(stall_time)
+        if self.partitions is not None:
+            for image_id in self.partitions.get_all():
+                if not (self.driver.is_cached(image_id) or
+                        self.driver.is_partly_cached(image_id) or
+                        self.driver.is_being_cached(image_id)):
+                    self.partitions.delete(image_id)
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
-        If the image already exists in the queue or has already been
-        cached, we return False, True otherwise
+        If the image has already been cached, or is already in the queue
+        with the same or a higher priority, we return False, True
+        otherwise
 
         :param image_id: Image ID
+        :param priority: Images with a higher priority are fetched first
         """
-        return self.driver.queue_image(image_id)
+        return self.driver.queue_image(image_id, priority)
 
-    def get_caching_iter(self, image_id, image_checksum, image_iter):
+    def get_caching_iter(self, image_id, image_checksum, image_iter,
+                         image_meta=None):
         """
         Returns an iterator that caches the contents of an image
         while the image contents are read through the supplied
@@ -222,24 +581,58 @@ class ImageCache(object):
         :param image_checksum: checksum expected to be generated while
                                iterating over image data
         :param image_iter: Iterator that will read image contents
-        """
+        :param image_meta: Optional dict with the size and disk_format of
+                           the image, used for admission to the cache,
+                           and its owner and is_public flag or
+                           visibility, used to partition the cache
+
+        If the image is already being written to the cache by another
+        request, the returned iterator streams the data from that cache
+        fill instead, and only falls back to image_iter if the fill fails.
+        A fill that has made no progress for image_cache_follow_timeout
+        seconds is not followed at all.
+        Images turned away by the admission filter are not cached.
+        """
+        return self._get_caching_iter(image_id, image_checksum, image_iter,
+                                      image_meta, admit=True)
+
+    def _get_caching_iter(self, image_id, image_checksum, image_iter,
+                          image_meta=None, admit=False):
         if not self.driver.is_cacheable(image_id):
+            if self.is_fill_active(image_id):
+                self.stats.incr('follow_hits')
+                return self.follow_caching_iter(image_id, image_iter)
+            return image_iter
+
+        if admit and not self.admission.admit(image_id, image_meta):
             return image_iter
 
         LOG.debug(_("Tee'ing image '%s' into cache"), image_id)
 
-        return self.cache_tee_iter(image_id, image_iter, image_checksum)
+        image_size = image_meta.get('size') if image_meta else None
+        return self.cache_tee_iter(image_id, image_iter, image_checksum,
+                                   image_size,
+                                   partitions.get_partition(image_meta))
 
-    def cache_tee_iter(self, image_id, image_iter, image_checksum):
+    def cache_tee_iter(self, image_id, image_iter, image_checksum,
+                       image_size=None, partition=None):
         try:
             current_checksum = hashlib.md5()
 
-            with self.driver.open_for_write(image_id) as cache_file:
+            claimed = False
+            with self.driver.open_for_write(image_id,
+                                            image_size) as cache_file:
+                claimed = True
+                if partition is not None and self.partitions is not None:
+                    self._set_partition(image_id, partition)
+                started = time.time()
+                fill_bytes = 0
                 for chunk in image_iter:
                     try:
                         cache_file.write(chunk)
                     finally:
                         current_checksum.update(chunk)
+                        fill_bytes += len(chunk)
                         yield chunk
                 cache_file.flush()
 
@@ -249,21 +642,122 @@ class ImageCache(object):
                             "caching of image '%s'." % image_id)
                     raise exception.GlanceException(msg)
 
+            self.stats.incr('fills')
+            self.stats.incr('fill_bytes', fill_bytes)
+            self.stats.incr('fill_seconds', time.time() - started)
+        except exception.Duplicate:
+            if claimed:
+                raise
+            # Another request started caching the image after we checked,
+            # so stream its cache fill rather than the image twice
+            for chunk in self.follow_caching_iter(image_id, image_iter):
+                yield chunk
         except exception.GlanceException as e:
             # image_iter has given us bad, (size_checked_iter has found a
             # bad length), or corrupt data (checksum is wrong).
             LOG.exception(e)
+            self.stats.incr('fill_failures')
             raise
         except Exception as e:
             LOG.exception(_("Exception encountered while tee'ing "
                             "image '%s' into cache: %s. Continuing "
                             "with response.") % (image_id, e))
+            self.stats.incr('fill_failures')
 
             # If no checksum provided continue responding even if
             # caching failed.
             for chunk in image_iter:
                 yield chunk
 
+    def _set_partition(self, image_id, partition):
+        try:
+            self.partitions.set(image_id, partition)
+        except (IOError, OSError) as e:
+            LOG.warn(_("Unable to record the partition of image "
+                       "%(image_id)s: %(error)s"),
+                     {'image_id': image_id, 'error': e})
+
+    def follow_caching_iter(self, image_id, image_iter=None):
+        """
+        Returns an iterator over the data of an image that another request
+        is currently writing to the cache, following the cache file as it
+        grows until the fill completes.
+
+        If the fill fails or stalls, the remaining data is read from
+        image_iter when one is supplied. Otherwise ImageCacheFillFailed is
+        raised, ending the response early.
+
+        :param image_id: Image ID
+        :param image_iter: Optional iterator that will read image contents
+                           from the image store
+        """
+        sent = 0
+        try:
+            for chunk in self._follow_cache_fill(image_id):
+                sent += len(chunk)
+                yield chunk
+        except exception.ImageCacheFillFailed as e:
+            if image_iter is None:
+                LOG.error(e)
+                raise
+            LOG.warn(_("%(error)s. Continuing from the image store at "
+                       "offset %(sent)d."), {'error': e, 'sent': sent})
+            for chunk in image_iter:
+                if sent >= len(chunk):
+                    sent -= len(chunk)
+                    continue
+                yield chunk[sent:]
+                sent = 0
+        else:
+            if hasattr(image_iter, 'close'):
+                image_iter.close()
+
+    def _follow_cache_fill(self, image_id):
+        fill = self.driver.open_fill(image_id)
+        if fill is None:
+            # The fill finished before we could attach to it
+            if not self.driver.is_cached(image_id):
+                reason = _("the image is no longer being cached")
+                raise exception.ImageCacheFillFailed(image_id=image_id,
+                                                     reason=reason)
+            with self.driver.open_for_read(image_id) as cache_file:
+                for chunk in utils.chunkiter(cache_file, FOLLOW_CHUNKSIZE):
+                    yield chunk
+            return
+
+        LOG.debug(_("Following cache fill of image '%s'"), image_id)
+        try:
+            last_progress = time.time()
+            while True:
+                chunk = fill.read(FOLLOW_CHUNKSIZE)
+                if chunk:
+                    last_progress = time.time()
+                    yield chunk
+                    continue
+
+                if not self.driver.is_being_cached(image_id):
+                    if not self.driver.is_cached(image_id):
+                        reason = _("the request caching it failed")
+                        raise exception.ImageCacheFillFailed(
+                            image_id=image_id, reason=reason)
+                    # The file was committed while we were reading it, so
+                    # anything left in it is the end of the image
+                    chunk = fill.read(FOLLOW_CHUNKSIZE)
+                    while chunk:
+                        yield chunk
+                        chunk = fill.read(FOLLOW_CHUNKSIZE)
+                    return
+
+                stalled = time.time() - last_progress
+                if stalled > CONF.image_cache_follow_timeout:
+                    reason = (_("no data was written for %d seconds") %
+                              stalled)
+                    raise exception.ImageCacheFillFailed(image_id=image_id,
+                                                         reason=reason)
+                eventlet.sleep(FOLLOW_POLL_INTERVAL)
+        finally:
+            fill.close()
+
     def cache_image_iter(self, image_id, image_iter, image_checksum=None):
         """
         Cache an image with supplied iterator.
@@ -277,8 +771,9 @@ class ImageCache(object):
         if not self.driver.is_cacheable(image_id):
             return False
 
-        for chunk in self.get_caching_iter(image_id, image_checksum,
-                                           image_iter):
+        # Images cached on request bypass the admission filter
+        for chunk in self._get_caching_iter(image_id, image_checksum,
+                                            image_iter):
             pass
         return True
 
@@ -308,6 +803,168 @@ class ImageCache(object):
         """
         return self.driver.open_for_read(image_id)
 
+    def get_cached_iter(self, image_id, offset=0, length=None):
+        """
+        Returns an iterator over the data of a cached image, served from
+        the memory tier when it holds the data and from the cache file
+        otherwise. Reading the start of an image from its file puts the
+        image, or its first bytes, in the memory tier.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte to return
+        :param length: Number of bytes to return, None for all the rest
+        """
+        memory_iter = self.get_memory_iter(image_id, offset, length)
+        if memory_iter is not None:
+            return memory_iter
+        return self._read_cache_file(image_id, offset, length)
+
+    def get_memory_iter(self, image_id, offset=0, length=None,
+                        partial=True):
+        """
+        Returns an iterator over the data of a cached image served from
+        the memory tier, or None if the tier is disabled or does not hold
+        the data.
+
+        Images small enough to be held whole are loaded into the tier on
+        a miss. When partial is True and only the first bytes of an image
+        are held, those are served from memory and the rest of the range
+        from the cache file.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte to return
+        :param length: Number of bytes to return, None for all the rest
+        :param partial: Whether to serve ranges only partly held in memory
+        """
+        if self.memory is None:
+            return None
+
+        if partial:
+            end = offset + 1
+        elif length is not None:
+            end = offset + length
+        else:
+            end = None
+
+        entry = self.memory.get(image_id, end)
+        if entry is not None:
+            self.driver.record_hit(image_id)
+            return self._memory_iter(image_id, entry[0], entry[1], offset,
+                                     length)
+
+        if image_id in self.memory:
+            # Only the first bytes of a large image are held
+            return None
+        image_size = self.get_image_size(image_id)
+        if image_size > CONF.image_cache_memory_max_image_size:
+            return None
+        with self.open_for_read(image_id) as cache_file:
+            data = cache_file.read()
+        self.memory.put(image_id, data, len(data))
+        return self._memory_iter(image_id, data, len(data), offset, length)
+
+    def _memory_iter(self, image_id, data, image_size, offset, length):
+        end = len(data) if length is None else min(offset + length,
+                                                   len(data))
+        for start in xrange(offset, end, FOLLOW_CHUNKSIZE):
+            yield data[start:min(start + FOLLOW_CHUNKSIZE, end)]
+
+        stop = image_size if length is None else min(offset + length,
+                                                     image_size)
+        if end < stop:
+            # Only the start of the image is held, read the rest from disk
+            remaining = None if length is None else stop - end
+            chunks = self._read_cache_file(image_id, end, remaining,
+                                           count_hit=False)
+            for chunk in chunks:
+                yield chunk
+
+    def _read_cache_file(self, image_id, offset=0, length=None,
+                         count_hit=True):
+        prefix = None
+        if (self.memory is not None and offset == 0 and
+                CONF.image_cache_memory_prefix_size > 0 and
+                image_id not in self.memory):
+            prefix = []
+            prefix_size = CONF.image_cache_memory_prefix_size
+
+        if count_hit:
+            context = self.open_for_read(image_id)
+        else:
+            context = self.driver.open_image_file(image_id)
+
+        with context as cache_file:
+            fileio.advise_sequential(cache_file)
+            if offset:
+                cache_file.seek(offset)
+            chunks = utils.chunkiter(cache_file,
+                                     CONF.image_cache_read_chunk_size)
+            if length is not None:
+                chunks = utils.range_iter(chunks, 0, length)
+            held = 0
+            for chunk in chunks:
+                if prefix is not None:
+                    prefix.append(chunk[:prefix_size - held])
+                    held += len(prefix[-1])
+                    if held >= prefix_size:
+                        self.memory.put(image_id, ''.join(prefix),
+                                        self.get_image_size(image_id))
+                        prefix = None
+                yield chunk
+
+    def get_partial_iter(self, image_id, offset, length):
+        """
+        Returns an iterator over a range of the data of a partly cached
+        image, which is_range_cached() must have found to be cached.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte to return
+        :param length: Number of bytes to return
+        """
+        return self._read_cache_file(image_id, offset, length)
+
+    def get_memory_stats(self):
+        """
+        Returns the counters of the memory tier, or None if it is
+        disabled.
+        """
+        if self.memory is None:
+            return None
+        return self.memory.get_stats()
+
+    def get_stats(self):
+        """
+        Returns the counters of cache activity of all processes using the
+        cache, the hit ratio and fill throughput derived from them, and
+        the current size of the cache.
+        """
+        counters = self.stats.get_totals()
+        result = {
+            'counters': counters,
+            'cache_size': self.get_cache_size(),
+            'max_size': CONF.image_cache_max_size,
+        }
+        result.update(stats.summarize(counters))
+        if self.partitions is not None:
+            usage = self.partitions.get_usage(
+                self.driver.get_eviction_records(),
+                self.driver.get_eviction_image_id,
+                CONF.image_cache_max_size)
+            result['partitions'] = usage.get_report()
+        return result
+
+    def reset_stats(self):
+        """
+        Sets the counters of cache activity of all processes to 0.
+        """
+        self.stats.reset()
+
+    def get_admission_stats(self):
+        """
+        Returns the counters of the decisions of the admission filter.
+        """
+        return self.admission.get_stats()
+
     def get_image_size(self, image_id):
         """
         Return the size of the image file for an image with supplied
@@ -319,8 +976,8 @@ class ImageCache(object):
 
     def get_queued_images(self):
         """
-        Returns a list of image IDs that are in the queue. The
-        list should be sorted by the time the image ID was inserted
-        into the queue.
+        Returns a list of image IDs that are in the queue. The list is
+        sorted by priority, highest first, and then by the time the
+        image ID was inserted into the queue.
         """
         return self.driver.get_queued_images()
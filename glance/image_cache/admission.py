@@ -0,0 +1,181 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Admission control for the image cache.
+
+Before an image missing from the cache is written to it, the admission
+filter decides whether it is worth caching at all. Images can be kept out
+by size, by disk format, or until they have been requested a number of
+times. Requests are counted in a small count-min sketch, as in TinyLFU,
+whose counters are halved every window so that old requests fade out.
+"""
+
+import hashlib
+import time
+
+from oslo.config import cfg
+
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+admission_opts = [
+    cfg.IntOpt('image_cache_admission_min_requests', default=1,
+               help=_('The number of requests for an image within '
+                      'image_cache_admission_window seconds after which it '
+                      'is written to the cache. 1 caches images on their '
+                      'first request.')),
+    cfg.IntOpt('image_cache_admission_window', default=3600,
+               help=_('Seconds after which the request counts used for '
+                      'admission to the cache are halved.')),
+    cfg.IntOpt('image_cache_admission_max_image_size', default=0,
+               help=_('Images larger than this size in bytes are never '
+                      'written to the cache. 0 means no limit.')),
+    cfg.DictOpt('image_cache_admission_disk_formats', default={},
+                help=_('The number of requests needed to cache images of '
+                       'a disk format, overriding '
+                       'image_cache_admission_min_requests, e.g. '
+                       'iso:3,raw:1. Images of a disk format mapped to 0 '
+                       'are never written to the cache.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(admission_opts)
+
+SKETCH_DEPTH = 4
+SKETCH_WIDTH = 4096
+# Counts above this add nothing to admission decisions
+SKETCH_MAX_COUNT = 255
+
+
+class FrequencySketch(object):
+
+    """
+    Count-min sketch estimating how often each key has been seen.
+
+    Each key is counted in one counter of every row, chosen by a different
+    slice of the key's hash. Estimates never undercount a key, and only
+    overcount it when all its counters are shared with other keys.
+    """
+
+    def __init__(self, width=SKETCH_WIDTH, depth=SKETCH_DEPTH):
+        self.width = width
+        self.rows = [[0] * width for i in xrange(depth)]
+
+    def _indexes(self, key):
+        digest = hashlib.md5(key).hexdigest()
+        for i in xrange(len(self.rows)):
+            yield int(digest[i * 8:i * 8 + 8], 16) % self.width
+
+    def add(self, key):
+        """Counts key once more and returns its new estimated count."""
+        counts = []
+        for row, index in zip(self.rows, self._indexes(key)):
+            if row[index] < SKETCH_MAX_COUNT:
+                row[index] += 1
+            counts.append(row[index])
+        return min(counts)
+
+    def estimate(self, key):
+        """Returns the estimated count of key."""
+        return min([row[index]
+                    for row, index in zip(self.rows, self._indexes(key))])
+
+    def halve(self):
+        """Halves every count."""
+        for row in self.rows:
+            for index in xrange(self.width):
+                row[index] >>= 1
+
+
+class AdmissionFilter(object):
+
+    """
+    Decides which images missing from the cache are written to it.
+
+    The filter keeps counters of its decisions. Like the memory tier it
+    never yields to other green threads, so one filter can be shared by
+    all the requests of an API worker.
+    """
+
+    def __init__(self, min_requests=1, window=3600, max_image_size=0,
+                 disk_formats=None):
+        self.min_requests = min_requests
+        self.window = window
+        self.max_image_size = max_image_size
+        self.disk_formats = {}
+        for disk_format, count in (disk_formats or {}).items():
+            try:
+                self.disk_formats[disk_format] = int(count)
+            except ValueError:
+                LOG.warn(_("Ignoring invalid image cache admission count "
+                           "'%(count)s' for disk format %(disk_format)s"),
+                         {'count': count, 'disk_format': disk_format})
+        self.sketch = FrequencySketch()
+        self.window_start = time.time()
+        self.admitted = 0
+        self.rejected_size = 0
+        self.rejected_disk_format = 0
+        self.rejected_frequency = 0
+
+    def _age(self):
+        now = time.time()
+        while now - self.window_start >= self.window > 0:
+            self.sketch.halve()
+            self.window_start += self.window
+
+    def admit(self, image_id, image_meta=None):
+        """
+        Counts a request for an image that is not cached and returns True
+        if the image should now be written to the cache.
+
+        :param image_id: Image ID
+        :param image_meta: Optional dict that may hold the size and
+                           disk_format of the image
+        """
+        image_meta = image_meta or {}
+        size = image_meta.get('size')
+        if self.max_image_size and size and size > self.max_image_size:
+            self.rejected_size += 1
+            return False
+
+        min_requests = self.disk_formats.get(image_meta.get('disk_format'),
+                                             self.min_requests)
+        if min_requests < 1:
+            self.rejected_disk_format += 1
+            return False
+
+        if min_requests > 1:
+            self._age()
+            if self.sketch.add(image_id) < min_requests:
+                self.rejected_frequency += 1
+                LOG.debug(_("Not caching image '%s' until it is requested "
+                            "more often"), image_id)
+                return False
+
+        self.admitted += 1
+        return True
+
+    def get_stats(self):
+        """Returns the counters of admission decisions."""
+        return {
+            'admitted': self.admitted,
+            'rejected_size': self.rejected_size,
+            'rejected_disk_format': self.rejected_disk_format,
+            'rejected_frequency': self.rejected_frequency,
+        }
@@ -40,6 +40,21 @@ class CacheClient(base_client.BaseClient):
         data = json.loads(res.read())['cached_images']
         return data
 
+    def get_cache_stats(self):
+        """
+        Returns the counters of image cache activity
+        """
+        res = self.do_request("GET", "/cache_stats")
+        data = json.loads(res.read())['cache_stats']
+        return data
+
+    def reset_cache_stats(self):
+        """
+        Resets the counters of image cache activity
+        """
+        self.do_request("DELETE", "/cache_stats")
+        return True
+
     def get_queued_images(self, **kwargs):
         """
         Returns a list of images queued for caching
@@ -57,11 +72,17 @@ class CacheClient(base_client.BaseClient):
         num_deleted = data['num_deleted']
         return num_deleted
 
-    def queue_image_for_caching(self, image_id):
+    def queue_image_for_caching(self, image_id, priority=None):
         """
         Queue an image for prefetching into cache
+
+        :param priority: Images with a higher priority are fetched first
         """
-        self.do_request("PUT", "/queued_images/%s" % image_id)
+        params = {}
+        if priority is not None:
+            params['priority'] = priority
+        self.do_request("PUT", "/queued_images/%s" % image_id,
+                        params=params)
         return True
 
     def delete_queued_image(self, image_id):
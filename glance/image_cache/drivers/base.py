@@ -19,21 +19,53 @@
 Base attribute driver class
 """
 
+import errno
+import io
 import os.path
+import shutil
 
 from oslo.config import cfg
 
 from glance.common import exception
 from glance.common import utils
+from glance.image_cache import peers
 import glance.openstack.common.log as logging
 
 LOG = logging.getLogger(__name__)
 
+shard_opts = [
+    cfg.ListOpt('image_cache_shard_dirs', default=[],
+                help=_('Directories, usually on separate disks, that the '
+                       'files of cached images are spread over. Each may be '
+                       'followed by a colon and a capacity weight, e.g. '
+                       '/mnt/disk1:2,/mnt/disk2:1. Images are placed by '
+                       'consistent hashing and each directory is pruned to '
+                       'its share of image_cache_max_size. When empty, '
+                       'image files are kept in image_cache_dir.')),
+]
+
 CONF = cfg.CONF
+CONF.register_opts(shard_opts)
+
+# Suffix of the copy of an image being moved to another shard directory
+MOVING_SUFFIX = '.moving'
 
 
 class Driver(object):
 
+    # Whether each cached image is a single file that can be handed to
+    # sendfile(2)
+    whole_files = True
+
+    # Cache statuses whose files are spread over the shard directories,
+    # and those of them holding the data of cached images
+    shard_statuses = ('active', 'incomplete', 'invalid')
+    data_statuses = ('active', )
+
+    # (directory, weight) tuples of the shard directories, set by
+    # set_paths()
+    shards = []
+
     def configure(self):
         """
         Configure the driver to use the stored configuration options
@@ -63,11 +95,143 @@ class Driver(object):
         self.invalid_dir = os.path.join(self.base_dir, 'invalid')
         self.queue_dir = os.path.join(self.base_dir, 'queue')
 
+        self.shards = self._parse_shard_dirs()
+        self._shard_ring = peers.HashRing(
+            [path for path, weight in self.shards],
+            weights=dict(self.shards))
+
         dirs = [self.incomplete_dir, self.invalid_dir, self.queue_dir]
+        for status in self.shard_statuses:
+            dirs.extend(self.get_shard_dirs(status))
 
         for path in dirs:
             utils.safe_mkdirs(path)
 
+    def _parse_shard_dirs(self):
+        """
+        Returns the list of (directory, weight) tuples of the shard
+        directories in image_cache_shard_dirs, or of image_cache_dir alone
+        if none are configured.
+        """
+        shards = []
+        for entry in CONF.image_cache_shard_dirs:
+            path, weight = entry, 1.0
+            if ':' in entry:
+                path, weight = entry.rsplit(':', 1)
+                try:
+                    weight = float(weight)
+                except ValueError:
+                    weight = 0
+            if weight <= 0:
+                msg = (_("Invalid weight in image_cache_shard_dirs entry "
+                         "'%s'") % entry)
+                LOG.error(msg)
+                driver = self.__class__.__module__
+                raise exception.BadDriverConfiguration(driver_name=driver,
+                                                       reason=msg)
+            shards.append((os.path.abspath(path), weight))
+        return shards or [(self.base_dir, 1.0)]
+
+    def get_shards(self):
+        """
+        Returns the list of (directory, weight) tuples of the directories
+        the files of cached images are spread over.
+        """
+        return self.shards
+
+    def get_shard_dirs(self, cache_status='active'):
+        """
+        Returns the directories holding files in a cache status on every
+        shard.
+
+        :param cache_status: Status of the images in the cache
+        """
+        return [self._get_status_dir(path, cache_status)
+                for path, weight in self.shards]
+
+    @staticmethod
+    def _get_status_dir(shard_dir, cache_status):
+        if cache_status == 'active':
+            return shard_dir
+        return os.path.join(shard_dir, cache_status)
+
+    def get_owner_shard(self, image_id):
+        """
+        Returns the shard directory that an image is placed on.
+
+        :param image_id: Image ID
+        """
+        if len(self.shards) == 1:
+            return self.shards[0][0]
+        return self._shard_ring.get_nodes(str(image_id))[0]
+
+    def get_shard_dir(self, image_id):
+        """
+        Returns the shard directory holding the files of an image. Until
+        they are moved by rebalance_shard(), the files of an image left on
+        another shard by a change of image_cache_shard_dirs are used where
+        they are.
+
+        :param image_id: Image ID
+        """
+        owner = self.get_owner_shard(image_id)
+        if len(self.shards) == 1 or self._has_image_data(owner, image_id):
+            return owner
+        for path, weight in self.shards:
+            if path != owner and self._has_image_data(path, image_id):
+                return path
+        return owner
+
+    def _has_image_data(self, shard_dir, image_id):
+        for status in self.data_statuses:
+            path = os.path.join(self._get_status_dir(shard_dir, status),
+                                str(image_id))
+            if os.path.exists(path):
+                return True
+        return False
+
+    def get_eviction_shard(self, key):
+        """
+        Returns the shard directory holding the unit of data with the
+        supplied eviction key.
+
+        :param key: Key from get_eviction_records()
+        """
+        return self.get_shard_dir(key)
+
+    def rebalance_shard(self, image_id, cache_status='active'):
+        """
+        Moves the file or directory of an image in a cache status to the
+        shard that owns the image, if it was left on another shard by a
+        change of image_cache_shard_dirs. The data is copied next to its
+        new place first, so readers never see a partial copy. Returns
+        True if the image was moved.
+
+        :param image_id: Image ID
+        :param cache_status: Status of the image in the cache
+        """
+        path = self.get_image_filepath(image_id, cache_status)
+        owner = self.get_owner_shard(image_id)
+        dest = os.path.join(self._get_status_dir(owner, cache_status),
+                            str(image_id))
+        if path == dest or not os.path.exists(path):
+            return False
+
+        LOG.debug(_("Moving cached image '%(path)s' to '%(dest)s'"),
+                  {'path': path, 'dest': dest})
+        copy_path = os.path.join(self._get_status_dir(owner, 'incomplete'),
+                                 str(image_id) + MOVING_SUFFIX)
+        if os.path.isdir(path):
+            shutil.rmtree(copy_path, ignore_errors=True)
+            shutil.copytree(path, copy_path)
+            os.rename(copy_path, dest)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            shutil.copy2(path, copy_path)
+            os.rename(copy_path, dest)
+            os.unlink(path)
+        return True
+
     def get_cache_size(self):
         """
         Returns the total size in bytes of the image cache.
@@ -149,13 +313,60 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def queue_image(self, image_id):
+    def queue_image(self, image_id, priority=0):
         """
         Puts an image identifier in a queue for caching. Return True
         on successful add to the queue, False otherwise...
 
+        :param image_id: Image ID
+        :param priority: Images with a higher priority are fetched first
+        """
+
+    def _add_to_queue(self, image_id, priority):
+        """
+        Writes the queue file for an image, or raises the priority of an
+        image that is already queued. Returns True if the queue changed.
+
+        :param image_id: Image ID
+        :param priority: Priority to queue the image with
+        """
+        current = self.get_queued_priority(image_id)
+        if current is not None and priority <= current:
+            msg = _("Not queueing image '%s'. Already queued.") % image_id
+            LOG.warn(msg)
+            return False
+
+        path = self.get_image_filepath(image_id, 'queue')
+        if current is None:
+            LOG.debug(_("Queueing image '%(image_id)s' with priority "
+                        "%(priority)d."), locals())
+        else:
+            LOG.debug(_("Raising priority of queued image '%(image_id)s' "
+                        "from %(current)d to %(priority)d."), locals())
+
+        # The queue file holds the priority of the image
+        with open(path, 'w') as f:
+            f.write('%d' % priority)
+        return True
+
+    def get_queued_priority(self, image_id):
+        """
+        Returns the priority an image was queued with, or None if the
+        image is not queued.
+
         :param image_id: Image ID
         """
+        path = self.get_image_filepath(image_id, 'queue')
+        try:
+            with open(path) as f:
+                data = f.read().strip()
+        except IOError:
+            return None
+        try:
+            return int(data)
+        except ValueError:
+            # Queued by a release that did not record priorities
+            return 0
 
     def clean(self, stall_time=None):
         """
@@ -171,15 +382,119 @@ class Driver(object):
         """
         raise NotImplementedError
 
-    def open_for_write(self, image_id):
+    def delete_cached_images(self, image_ids):
+        """
+        Removes a batch of cached image files and any attributes about
+        the images
+
+        :param image_ids: List of Image IDs
+        """
+        for image_id in image_ids:
+            self.delete_cached_image(image_id)
+
+    def get_eviction_records(self):
+        """
+        Returns the records of the units of data the cache can evict, in
+        the format of get_cached_images(). The 'image_id' of each record
+        is the key to pass to evict(). By default images are evicted
+        whole.
+        """
+        return self.get_cached_images()
+
+    def evict(self, keys):
+        """
+        Removes the units of data with the supplied eviction keys, and
+        returns the IDs of the images whose cached data changed.
+
+        :param keys: List of keys from get_eviction_records()
+        """
+        self.delete_cached_images(keys)
+        return keys
+
+    def get_eviction_image_id(self, key):
+        """
+        Returns the ID of the image the unit of data with the supplied
+        eviction key belongs to.
+
+        :param key: Key from get_eviction_records()
+        """
+        return key
+
+    def is_partly_cached(self, image_id):
+        """
+        Returns True if only some of the data of an image is cached, in
+        which case is_range_cached() tells which ranges can be read.
+
+        :param image_id: Image ID
+        """
+        return False
+
+    def is_range_cached(self, image_id, offset, length):
+        """
+        Returns True if a range of the data of a partly cached image can
+        be read from the cache.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte of the range
+        :param length: Number of bytes in the range
+        """
+        return False
+
+    def open_for_write(self, image_id, image_size=None):
         """
         Open a file for writing the image file for an image
         with supplied identifier.
 
+        Only one writer may fill an image at a time; drivers must claim the
+        image atomically and raise `exception.Duplicate` if another writer
+        already holds it.
+
         :param image_id: Image ID
+        :param image_size: Size of the image, if known
         """
         raise NotImplementedError
 
+    def open_fill(self, image_id):
+        """
+        Returns a file-like object reading the data written so far by the
+        request caching an image. Reads return an empty string when they
+        catch up with the writer. Returns None if the image is not being
+        cached.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'incomplete')
+        try:
+            return io.open(path, 'rb', buffering=0)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def get_fill_mtime(self, image_id):
+        """
+        Returns the time data was last written by the request caching an
+        image, or None if the image is not being cached.
+
+        :param image_id: Image ID
+        """
+        path = self.get_image_filepath(image_id, 'incomplete')
+        try:
+            return os.path.getmtime(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+    def open_image_file(self, image_id):
+        """
+        Returns a file-like object reading the data of a cached image
+        without recording a hit on it.
+
+        :param image_id: Image ID
+        """
+        return open(self.get_image_filepath(image_id), 'rb')
+
     def open_for_read(self, image_id):
         """
         Open and yield file for reading the image file for an image
@@ -189,6 +504,16 @@ class Driver(object):
         """
         raise NotImplementedError
 
+    def record_hit(self, image_id, now=None):
+        """
+        Records a hit on a cached image that was served without going
+        through open_for_read.
+
+        :param image_id: Image ID
+        :param now: Time of the access, defaults to the current time
+        """
+        raise NotImplementedError
+
     def get_image_filepath(self, image_id, cache_status='active'):
         """
         This crafts an absolute path to a specific entry
@@ -196,9 +521,11 @@ class Driver(object):
         :param image_id: Image ID
         :param cache_status: Status of the image in the cache
         """
-        if cache_status == 'active':
-            return os.path.join(self.base_dir, str(image_id))
-        return os.path.join(self.base_dir, cache_status, str(image_id))
+        base_dir = self.base_dir
+        if cache_status in self.shard_statuses:
+            base_dir = self.get_shard_dir(image_id)
+        return os.path.join(self._get_status_dir(base_dir, cache_status),
+                            str(image_id))
 
     def get_image_size(self, image_id):
         """
@@ -212,8 +539,21 @@ class Driver(object):
 
     def get_queued_images(self):
         """
-        Returns a list of image IDs that are in the queue. The
-        list should be sorted by the time the image ID was inserted
-        into the queue.
-        """
-        raise NotImplementedError
+        Returns a list of image IDs that are in the queue. The list is
+        sorted by priority, highest first, and then by the time the
+        image ID was inserted into the queue.
+        """
+        items = []
+        for fname in os.listdir(self.queue_dir):
+            path = os.path.join(self.queue_dir, fname)
+            priority = self.get_queued_priority(fname)
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                # Removed from the queue while we were looking
+                continue
+            if priority is not None:
+                items.append((-priority, mtime, fname))
+
+        items.sort()
+        return [image_id for (priority, mtime, image_id) in items]
@@ -0,0 +1,914 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Cache driver that stores images as fixed-size blocks, using SQLite to
+store information about the cached blocks
+"""
+
+from __future__ import absolute_import
+from contextlib import contextmanager
+import errno
+import hashlib
+import os
+import shutil
+import time
+
+from oslo.config import cfg
+import sqlite3
+
+from glance.common import exception
+from glance.common import utils
+from glance.image_cache.drivers import sqlite
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+blocks_opts = [
+    cfg.IntOpt('image_cache_block_size', default=4 * 1024 * 1024,
+               help=_('The size in bytes of the blocks the blocks image '
+                      'cache driver splits images into.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(blocks_opts)
+
+# Blocks read together share an access time. Ranking each block this many
+# seconds older than the block before it makes eviction take the tail of
+# an image before its head.
+BLOCK_AGE_STEP = 1e-6
+
+READ_CHUNKSIZE = 64 * 1024
+
+
+class Driver(sqlite.Driver):
+
+    """
+    Cache driver that splits images into blocks of image_cache_block_size
+    bytes. Each block is stored in a file of its own and its MD5 checksum
+    is recorded in the cache database, next to the records the sqlite
+    driver keeps.
+
+    Blocks are stored as soon as they are full and are kept when a cache
+    fill is abandoned, so an image may be partly cached and ranges of it
+    read before the rest arrives. An image counts as cached once all of
+    its blocks are. Blocks are checked against their checksum when they
+    are read, and are evicted one at a time.
+    """
+
+    whole_files = False
+
+    shard_statuses = sqlite.Driver.shard_statuses + ('blocks', )
+    data_statuses = ('blocks', )
+
+    def configure(self):
+        """
+        Configure the driver to use the stored configuration options
+        Any store that needs special configuration should implement
+        this method. If the store was not able to successfully configure
+        itself, it should raise `exception.BadDriverConfiguration`
+        """
+        # Block hits waiting to be written, as (image_id, block) ->
+        # [hits, last_accessed]. A block of None stands for every block
+        # of the image.
+        self._pending_block_hits = {}
+
+        super(Driver, self).configure()
+
+    def initialize_db(self):
+        super(Driver, self).initialize_db()
+        try:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   factory=sqlite.SqliteConnection)
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS block_images (
+                    image_id TEXT PRIMARY KEY,
+                    image_size INTEGER,
+                    block_size INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS cached_blocks (
+                    image_id TEXT NOT NULL,
+                    block INTEGER NOT NULL,
+                    size INTEGER DEFAULT 0,
+                    checksum TEXT,
+                    last_accessed REAL DEFAULT 0.0,
+                    last_modified REAL DEFAULT 0.0,
+                    hits INTEGER DEFAULT 0,
+                    PRIMARY KEY (image_id, block)
+                );
+            """)
+            conn.commit()
+            conn.close()
+        except sqlite3.DatabaseError as e:
+            msg = _("Failed to initialize the image cache database. "
+                    "Got error: %s") % e
+            LOG.error(msg)
+            raise exception.BadDriverConfiguration(driver_name='blocks',
+                                                   reason=msg)
+
+    def get_block_path(self, image_id, block):
+        """
+        Returns the path of the file of a block of an image
+
+        :param image_id: Image ID
+        :param block: Index of the block in the image
+        """
+        return os.path.join(self.get_image_filepath(image_id, 'blocks'),
+                            str(block))
+
+    def _get_layout(self, image_id):
+        """
+        Returns a tuple of the image size, None if not known yet, and the
+        block size of an image with blocks in the cache, or None.
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_size, block_size
+                             FROM block_images WHERE image_id = ?""",
+                             (image_id, ))
+            row = cur.fetchone()
+            return tuple(row) if row is not None else None
+
+    def get_image_size(self, image_id):
+        """
+        Return the size of an image with blocks in the cache, or None if
+        it is not known.
+
+        :param image_id: Image ID
+        """
+        layout = self._get_layout(image_id)
+        return layout[0] if layout is not None else None
+
+    def get_cached_images(self):
+        """
+        Returns a list of records about cached images, including the
+        images that are only partly cached. The size of each image is the
+        size of its cached blocks.
+        """
+        LOG.debug(_("Gathering cached image entries."))
+        self.flush_hits()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT b.image_id AS image_id,
+                             MAX(COALESCE(c.hits, 0)) AS hits,
+                             MAX(b.last_accessed) AS last_accessed,
+                             MAX(b.last_modified) AS last_modified,
+                             SUM(b.size) AS size,
+                             COUNT(*) AS blocks,
+                             MAX(c.image_id IS NOT NULL) AS complete
+                             FROM cached_blocks b LEFT JOIN cached_images c
+                             ON c.image_id = b.image_id
+                             GROUP BY b.image_id
+                             ORDER BY b.image_id""")
+            cur.row_factory = sqlite.dict_factory
+            records = [r for r in cur]
+        for record in records:
+            record['complete'] = bool(record['complete'])
+        return records
+
+    def is_partly_cached(self, image_id):
+        """
+        Returns True if some, but not all, of the blocks of an image are
+        cached.
+
+        :param image_id: Image ID
+        """
+        if self.is_cached(image_id):
+            return False
+        with self.get_db() as db:
+            cur = db.execute("""SELECT 1 FROM cached_blocks
+                             WHERE image_id = ? LIMIT 1""", (image_id, ))
+            return cur.fetchone() is not None
+
+    def is_range_cached(self, image_id, offset, length):
+        """
+        Returns True if all the blocks holding a range of an image are
+        cached.
+
+        :param image_id: Image ID
+        :param offset: Offset of the first byte of the range
+        :param length: Number of bytes in the range
+        """
+        layout = self._get_layout(image_id)
+        if layout is None or length <= 0:
+            return False
+        block_size = layout[1]
+        first = offset // block_size
+        last = (offset + length - 1) // block_size
+        with self.get_db() as db:
+            cur = db.execute("""SELECT COUNT(*) FROM cached_blocks
+                             WHERE image_id = ? AND block BETWEEN ? AND ?""",
+                             (image_id, first, last))
+            return cur.fetchone()[0] == last - first + 1
+
+    def delete_all_cached_images(self):
+        """
+        Removes all cached blocks and any attributes about the images
+        and returns the number of images that had blocks cached.
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT COUNT(DISTINCT image_id)
+                             FROM cached_blocks""")
+            deleted = cur.fetchone()[0]
+            for blocks_dir in self.get_shard_dirs('blocks'):
+                for fname in os.listdir(blocks_dir):
+                    LOG.debug(_("Deleting cached blocks of image '%s'"),
+                              fname)
+                    shutil.rmtree(os.path.join(blocks_dir, fname),
+                                  ignore_errors=True)
+            db.execute("""DELETE FROM cached_blocks""")
+            db.execute("""DELETE FROM cached_images""")
+            # Images being cached keep the block size they started with
+            db.execute("""DELETE FROM block_images WHERE image_id NOT IN
+                       (SELECT image_id FROM incomplete_images)""")
+            db.execute("""UPDATE cache_size SET total = 0 WHERE id = 0""")
+            self._pending_hits.clear()
+            self._pending_block_hits.clear()
+            db.commit()
+        return deleted
+
+    def delete_cached_image(self, image_id):
+        """
+        Removes all the cached blocks of an image and any attributes
+        about the image
+
+        :param image_id: Image ID
+        """
+        self.delete_cached_images([image_id])
+
+    def delete_cached_images(self, image_ids):
+        """
+        Removes all the cached blocks of a batch of images and any
+        attributes about the images, using a single database transaction
+
+        :param image_ids: List of Image IDs
+        """
+        with self.get_db() as db:
+            for image_id in image_ids:
+                self._delete_blocks(db, image_id)
+            db.commit()
+
+    def _delete_blocks(self, db, image_id, blocks=None):
+        """
+        Removes blocks of an image and their records, and deducts their
+        sizes from the cache size total. The image is no longer cached in
+        full afterwards. The caller must commit.
+
+        :param db: Database connection
+        :param image_id: Image ID
+        :param blocks: Indexes of the blocks to remove, None for all
+        """
+        cur = db.execute("""SELECT block, size FROM cached_blocks
+                         WHERE image_id = ?""", (image_id, ))
+        rows = [(row[0], row[1]) for row in cur.fetchall()
+                if blocks is None or row[0] in blocks]
+        for block, size in rows:
+            sqlite.delete_cached_file(self.get_block_path(image_id, block))
+            self._pending_block_hits.pop((image_id, block), None)
+        db.executemany("""DELETE FROM cached_blocks
+                       WHERE image_id = ? AND block = ?""",
+                       [(image_id, block) for block, size in rows])
+        db.execute("""UPDATE cache_size SET total = total - ?
+                   WHERE id = 0""", (sum([size for b, size in rows]), ))
+        db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
+                   (image_id, ))
+        self._pending_hits.pop(image_id, None)
+        self._pending_block_hits.pop((image_id, None), None)
+
+        cur = db.execute("""SELECT 1 FROM cached_blocks
+                         WHERE image_id = ? LIMIT 1""", (image_id, ))
+        if cur.fetchone() is None:
+            db.execute("""DELETE FROM block_images WHERE image_id = ?
+                       AND image_id NOT IN
+                       (SELECT image_id FROM incomplete_images)""",
+                       (image_id, ))
+            try:
+                os.rmdir(self.get_image_filepath(image_id, 'blocks'))
+            except OSError:
+                pass
+
+    def get_eviction_records(self):
+        """
+        Returns a record for each cached block, whose key is made of the
+        image ID and the index of the block.
+        """
+        self.flush_hits()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, block, hits, last_accessed,
+                             last_modified, size FROM cached_blocks""")
+            return [{'image_id': '%s/%d' % (row['image_id'], row['block']),
+                     'hits': row['hits'],
+                     'last_accessed': (row['last_accessed'] -
+                                       row['block'] * BLOCK_AGE_STEP),
+                     'last_modified': row['last_modified'],
+                     'size': row['size']} for row in cur]
+
+    def evict(self, keys):
+        """
+        Removes the cached blocks with the supplied keys, and returns the
+        IDs of the images they belonged to.
+
+        :param keys: List of keys from get_eviction_records()
+        """
+        blocks = {}
+        for key in keys:
+            image_id, block = key.rsplit('/', 1)
+            blocks.setdefault(image_id, []).append(int(block))
+        with self.get_db() as db:
+            for image_id, indexes in blocks.iteritems():
+                self._delete_blocks(db, image_id, indexes)
+            db.commit()
+        return blocks.keys()
+
+    def get_eviction_image_id(self, key):
+        """
+        Returns the ID of the image of the cached block with the supplied
+        eviction key.
+
+        :param key: Key from get_eviction_records()
+        """
+        return key.rsplit('/', 1)[0]
+
+    def get_eviction_shard(self, key):
+        """
+        Returns the shard directory holding the cached block with the
+        supplied eviction key.
+
+        :param key: Key from get_eviction_records()
+        """
+        return self.get_shard_dir(self.get_eviction_image_id(key))
+
+    def rebalance(self):
+        """
+        Moves the blocks of images left on another shard directory by a
+        change of image_cache_shard_dirs to the shard that owns them now.
+        Returns the number of images moved.
+        """
+        if len(self.get_shards()) == 1:
+            return 0
+        with self.get_db() as db:
+            cur = db.execute("""SELECT DISTINCT image_id
+                             FROM cached_blocks""")
+            image_ids = [row[0] for row in cur]
+        return self._rebalance_images(image_ids, 'blocks')
+
+    def reconcile(self):
+        """
+        Brings the database back in line with the blocks directories.
+
+        Records of blocks whose file has gone are removed, as are block
+        files without a record, since their checksum is unknown. Images
+        missing some of their blocks are no longer cached in full, and the
+        running cache size total is recomputed from the records.
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, block FROM cached_blocks""")
+            known = set([(row[0], row[1]) for row in cur.fetchall()])
+            present = set()
+            for blocks_dir in self.get_shard_dirs('blocks'):
+                for image_id in os.listdir(blocks_dir):
+                    image_dir = os.path.join(blocks_dir, image_id)
+                    if not os.path.isdir(image_dir):
+                        continue
+                    for fname in os.listdir(image_dir):
+                        if fname.isdigit():
+                            present.add((image_id, int(fname)))
+
+            for image_id, block in known - present:
+                LOG.info(_("Removing cache record for missing block "
+                           "%(block)d of image '%(image_id)s'"),
+                         {'block': block, 'image_id': image_id})
+            db.executemany("""DELETE FROM cached_blocks
+                           WHERE image_id = ? AND block = ?""",
+                           list(known - present))
+
+            for image_id, block in present - known:
+                path = self.get_block_path(image_id, block)
+                LOG.info(_("Removing untracked cache block file %s"), path)
+                os.unlink(path)
+
+            cur = db.execute("""SELECT c.image_id, b.image_size, b.block_size,
+                             (SELECT COUNT(*) FROM cached_blocks k
+                              WHERE k.image_id = c.image_id)
+                             FROM cached_images c LEFT JOIN block_images b
+                             ON b.image_id = c.image_id""")
+            broken = []
+            for image_id, image_size, block_size, count in cur.fetchall():
+                if (image_size is None or block_size is None or
+                        count != (image_size + block_size - 1) // block_size):
+                    LOG.info(_("Image '%s' is no longer cached in full"),
+                             image_id)
+                    broken.append((image_id, ))
+            db.executemany("""DELETE FROM cached_images WHERE image_id = ?""",
+                           broken)
+
+            db.execute("""DELETE FROM block_images
+                       WHERE image_id NOT IN
+                       (SELECT image_id FROM cached_blocks)
+                       AND image_id NOT IN
+                       (SELECT image_id FROM incomplete_images)""")
+            db.execute("""UPDATE cache_size
+                       SET total = (SELECT COALESCE(SUM(size), 0)
+                                    FROM cached_blocks)
+                       WHERE id = 0""")
+            db.commit()
+
+    def delete_stalled_files(self, older_than):
+        """
+        Removes any incomplete block files older than a supplied modified
+        time, and gives up the claims of cache fills that have not stored
+        a block since then.
+
+        :param older_than: Files written to on or before this timestemp
+                           will be deleted.
+        """
+        super(Driver, self).delete_stalled_files(older_than)
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id FROM incomplete_images
+                             WHERE started < ?""", (older_than, ))
+            stalled = [(row[0], ) for row in cur.fetchall()]
+            for (image_id, ) in stalled:
+                LOG.info(_("Giving up stalled cache fill of image '%s'"),
+                         image_id)
+            db.executemany("""DELETE FROM incomplete_images
+                           WHERE image_id = ?""", stalled)
+            db.commit()
+
+    def get_least_recently_accessed(self):
+        """
+        Return a tuple containing the image_id and size of the least recently
+        accessed image with cached blocks, or None if no blocks are cached.
+        """
+        self.flush_hits()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id, SUM(size) FROM cached_blocks
+                             GROUP BY image_id
+                             ORDER BY MAX(last_accessed) LIMIT 1""")
+            row = cur.fetchone()
+            return (row[0], row[1]) if row is not None else None
+
+    @contextmanager
+    def open_for_write(self, image_id, image_size=None):
+        """
+        Open a writer that stores the data of an image in blocks.
+
+        Blocks are stored as soon as they are full and can be read by
+        other requests straight away. Blocks that are already cached with
+        the same checksum are not written again. If the data turns out to
+        be bad, the blocks this writer stored are removed again, while a
+        fill abandoned for any other reason keeps them.
+
+        :param image_id: Image ID
+        :param image_size: Size of the image, if known
+        :raises `glance.common.exception.Duplicate` if the image is
+                already being cached
+        """
+        block_size = CONF.image_cache_block_size
+        with self.get_db() as db:
+            self._claim(db, image_id)
+            cur = db.execute("""SELECT image_size, block_size
+                             FROM block_images WHERE image_id = ?""",
+                             (image_id, ))
+            row = cur.fetchone()
+            if row is not None:
+                # Blocks that are already cached fix the block size
+                block_size = row['block_size']
+                image_size = image_size or row['image_size']
+            db.execute("""INSERT OR REPLACE INTO block_images
+                       (image_id, image_size, block_size) VALUES (?, ?, ?)""",
+                       (image_id, image_size, block_size))
+            db.commit()
+
+        writer = BlockWriter(self, image_id, block_size)
+        committed = False
+        try:
+            yield writer
+            writer.close()
+            self._commit_image(image_id, writer.size, block_size)
+            committed = True
+        except exception.GlanceException as e:
+            LOG.debug(_("Fetch of image '%(image_id)s' failed (%(e)s), "
+                        "removing the %(count)d blocks it stored"),
+                      {'image_id': image_id, 'e': e,
+                       'count': len(writer.stored)})
+            with self.get_db() as db:
+                self._delete_blocks(db, image_id, writer.stored)
+                db.commit()
+            raise
+        finally:
+            if not committed:
+                self._release(image_id)
+
+    def store_block(self, image_id, block, data):
+        """
+        Stores a block of an image, unless it is already cached with the
+        same checksum. Returns True if the block was written.
+
+        :param image_id: Image ID
+        :param block: Index of the block in the image
+        :param data: Data of the block
+        """
+        checksum = hashlib.md5(data).hexdigest()
+        path = self.get_block_path(image_id, block)
+        with self.get_db() as db:
+            cur = db.execute("""SELECT checksum FROM cached_blocks
+                             WHERE image_id = ? AND block = ?""",
+                             (image_id, block))
+            row = cur.fetchone()
+        if (row is not None and row['checksum'] == checksum and
+                os.path.exists(path)):
+            return False
+
+        incomplete_path = self.get_image_filepath(image_id, 'incomplete')
+        with open(incomplete_path, 'wb') as block_file:
+            block_file.write(data)
+        utils.safe_mkdirs(os.path.dirname(path))
+        os.rename(incomplete_path, path)
+
+        now = time.time()
+        with self.get_db() as db:
+            cur = db.execute("""SELECT size FROM cached_blocks
+                             WHERE image_id = ? AND block = ?""",
+                             (image_id, block))
+            row = cur.fetchone()
+            replaced = row[0] if row is not None else 0
+            db.execute("""INSERT OR REPLACE INTO cached_blocks
+                       (image_id, block, size, checksum, last_accessed,
+                        last_modified, hits)
+                       VALUES (?, ?, ?, ?, 0, ?, 0)""",
+                       (image_id, block, len(data), checksum, now))
+            db.execute("""UPDATE cache_size SET total = total + ?
+                       WHERE id = 0""", (len(data) - replaced, ))
+            # A fill that keeps storing blocks is not stalled
+            db.execute("""UPDATE incomplete_images SET started = ?
+                       WHERE image_id = ?""", (now, image_id))
+            db.commit()
+        return True
+
+    def _commit_image(self, image_id, image_size, block_size):
+        """
+        Records that all the blocks of an image have been stored.
+        """
+        num_blocks = (image_size + block_size - 1) // block_size
+        with self.get_db() as db:
+            # Make sure that we "pop" the image from the queue...
+            if self.is_queued(image_id):
+                os.unlink(self.get_image_filepath(image_id, 'queue'))
+
+            db.execute("""DELETE FROM incomplete_images
+                       WHERE image_id = ?""", (image_id, ))
+            db.execute("""UPDATE block_images SET image_size = ?
+                       WHERE image_id = ?""", (image_size, image_id))
+            cur = db.execute("""SELECT COUNT(*) FROM cached_blocks
+                             WHERE image_id = ? AND block < ?""",
+                             (image_id, num_blocks))
+            if cur.fetchone()[0] == num_blocks:
+                db.execute("""INSERT OR REPLACE INTO cached_images
+                           (image_id, last_accessed, last_modified, hits, size)
+                           VALUES (?, 0, ?, 0, ?)""",
+                           (image_id, time.time(), image_size))
+            else:
+                LOG.warn(_("Blocks of image '%s' were removed while it was "
+                           "being cached"), image_id)
+            db.commit()
+
+    def _release(self, image_id):
+        """
+        Gives up the claim on an image whose fill did not complete,
+        keeping the blocks it stored.
+        """
+        incomplete_path = self.get_image_filepath(image_id, 'incomplete')
+        if os.path.exists(incomplete_path):
+            os.unlink(incomplete_path)
+        with self.get_db() as db:
+            db.execute("""DELETE FROM incomplete_images
+                       WHERE image_id = ?""", (image_id, ))
+            db.execute("""DELETE FROM block_images WHERE image_id = ?
+                       AND image_id NOT IN
+                       (SELECT image_id FROM cached_blocks)""",
+                       (image_id, ))
+            db.commit()
+
+    @contextmanager
+    def open_for_read(self, image_id):
+        """
+        Open and yield a file-like object reading the blocks of an image
+        with supplied identifier.
+
+        Only the blocks that are actually read have their hit recorded,
+        so ranges that are read often keep their blocks in the cache.
+
+        :param image_id: Image ID
+        """
+        reader = self.open_image_file(image_id)
+        try:
+            yield reader
+        finally:
+            reader.close()
+        super(Driver, self).record_hit(image_id)
+
+    def open_image_file(self, image_id):
+        """
+        Returns a file-like object reading the blocks of an image.
+
+        :param image_id: Image ID
+        """
+        layout = self._get_layout(image_id)
+        if layout is None:
+            raise IOError(errno.ENOENT, os.strerror(errno.ENOENT),
+                          self.get_image_filepath(image_id, 'blocks'))
+        image_size, block_size = layout
+        return BlockReader(self, image_id, block_size, image_size)
+
+    def open_fill(self, image_id):
+        """
+        Returns a file-like object reading the blocks stored so far by
+        the request caching an image, or None if the image is not being
+        cached.
+
+        :param image_id: Image ID
+        """
+        if not self.is_being_cached(image_id):
+            return None
+        layout = self._get_layout(image_id)
+        if layout is None:
+            return None
+        image_size, block_size = layout
+        return BlockReader(self, image_id, block_size, image_size,
+                           follow=True)
+
+    def get_fill_mtime(self, image_id):
+        """
+        Returns the time the request caching an image last stored a
+        block, or None if the image is not being cached.
+
+        :param image_id: Image ID
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT started FROM incomplete_images
+                             WHERE image_id = ?""", (image_id, ))
+            row = cur.fetchone()
+        return row[0] if row is not None else None
+
+    def read_block(self, image_id, block):
+        """
+        Returns the data of a cached block after checking it against its
+        checksum, or None if the block is not cached. A block whose file
+        is missing or does not match its checksum is removed from the
+        cache and `exception.ImageCacheBlockInvalid` raised.
+
+        :param image_id: Image ID
+        :param block: Index of the block in the image
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT checksum FROM cached_blocks
+                             WHERE image_id = ? AND block = ?""",
+                             (image_id, block))
+            row = cur.fetchone()
+        if row is None:
+            return None
+
+        try:
+            with open(self.get_block_path(image_id, block), 'rb') as f:
+                data = f.read()
+        except IOError as e:
+            reason = _("the block file could not be read: %s") % e
+        else:
+            if hashlib.md5(data).hexdigest() == row['checksum']:
+                return data
+            reason = _("the block does not match its checksum")
+
+        LOG.warn(_("Removing invalid block %(block)d of cached image "
+                   "'%(image_id)s': %(reason)s"),
+                 {'block': block, 'image_id': image_id, 'reason': reason})
+        with self.get_db() as db:
+            self._delete_blocks(db, image_id, [block])
+            db.commit()
+        raise exception.ImageCacheBlockInvalid(image_id=image_id,
+                                               block=block, reason=reason)
+
+    def record_hit(self, image_id, now=None):
+        """
+        Buffer a hit on a cached image that was served without reading
+        its blocks, which counts as an access to every block.
+
+        :param image_id: Image ID
+        :param now: Time of the access, defaults to the current time
+        """
+        if now is None:
+            now = time.time()
+        self.record_block_hit(image_id, None, now)
+        super(Driver, self).record_hit(image_id, now)
+
+    def record_block_hit(self, image_id, block, now):
+        """
+        Buffer a hit on a block, which is written out with the next flush
+        of the hits on images.
+
+        :param image_id: Image ID
+        :param block: Index of the block, None for every block
+        :param now: Time of the access
+        """
+        entry = self._pending_block_hits.setdefault((image_id, block),
+                                                    [0, 0.0])
+        entry[0] += 1
+        entry[1] = max(entry[1], now)
+
+    def flush_hits(self):
+        """
+        Write all buffered hits on blocks and on images to the database.
+        Hits that could not be written stay buffered for the next flush.
+
+        :retval Number of images whose hits were written
+        """
+        pending, self._pending_block_hits = self._pending_block_hits, {}
+        if pending:
+            flushed = False
+            try:
+                with self.get_db() as db:
+                    db.executemany("""UPDATE cached_blocks
+                                   SET hits = hits + ?,
+                                       last_accessed = MAX(last_accessed, ?)
+                                   WHERE image_id = ? AND block = ?""",
+                                   [(hits, last_accessed, image_id, block)
+                                    for (image_id, block), (hits,
+                                                            last_accessed)
+                                    in pending.iteritems()
+                                    if block is not None])
+                    db.executemany("""UPDATE cached_blocks
+                                   SET hits = hits + ?,
+                                       last_accessed = MAX(last_accessed, ?)
+                                   WHERE image_id = ?""",
+                                   [(hits, last_accessed, image_id)
+                                    for (image_id, block), (hits,
+                                                            last_accessed)
+                                    in pending.iteritems()
+                                    if block is None])
+                    db.commit()
+                    flushed = True
+            finally:
+                if not flushed:
+                    for key, (hits, last_accessed) in pending.iteritems():
+                        entry = self._pending_block_hits.setdefault(
+                            key, [0, 0.0])
+                        entry[0] += hits
+                        entry[1] = max(entry[1], last_accessed)
+        return super(Driver, self).flush_hits()
+
+    def _get_connection(self):
+        if self._conn_pid not in (None, os.getpid()):
+            # The parent process writes the block hits it buffered
+            self._pending_block_hits = {}
+        return super(Driver, self)._get_connection()
+
+
+class BlockWriter(object):
+
+    """
+    File-like object splitting the data written to it into blocks, each
+    stored as soon as it is full. The last, partial block of an image is
+    stored by close().
+    """
+
+    def __init__(self, driver, image_id, block_size):
+        self.driver = driver
+        self.image_id = image_id
+        self.block_size = block_size
+        self.size = 0
+        # Indexes of the blocks this writer stored
+        self.stored = []
+        self._block = 0
+        self._buffer = []
+        self._buffered = 0
+
+    def write(self, data):
+        offset = 0
+        while offset < len(data):
+            chunk = data[offset:offset + self.block_size - self._buffered]
+            self._buffer.append(chunk)
+            self._buffered += len(chunk)
+            offset += len(chunk)
+            if self._buffered == self.block_size:
+                self._store()
+        self.size += len(data)
+
+    def flush(self):
+        # Full blocks are stored as soon as they are written
+        pass
+
+    def close(self):
+        if self._buffered:
+            self._store()
+
+    def _store(self):
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._buffered = 0
+        if self.driver.store_block(self.image_id, self._block, data):
+            self.stored.append(self._block)
+        self._block += 1
+
+
+class BlockReader(object):
+
+    """
+    File-like object reading the data of an image from its cached blocks.
+
+    Each block is checked against its checksum when it is loaded. A read
+    stops short at a block that is not cached, and a read starting at
+    such a block raises `exception.ImageCacheBlockInvalid`, unless the
+    reader follows a cache fill, in which case it returns an empty
+    string until the block is stored.
+    """
+
+    def __init__(self, driver, image_id, block_size, image_size=None,
+                 follow=False):
+        self.driver = driver
+        self.image_id = image_id
+        self.block_size = block_size
+        self.image_size = image_size
+        self.follow = follow
+        # Every block read through this reader shares the access time
+        self.accessed = time.time()
+        self._pos = 0
+        self._block = None
+        self._data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(READ_CHUNKSIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._pos
+        elif whence == os.SEEK_END:
+            if self.image_size is None:
+                raise IOError(errno.EINVAL, os.strerror(errno.EINVAL))
+            offset += self.image_size
+        self._pos = offset
+
+    def tell(self):
+        return self._pos
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self.image_size is not None and self._pos >= self.image_size:
+                break
+            block, start = divmod(self._pos, self.block_size)
+            data = self._load(block, required=not chunks)
+            if data is None:
+                break
+            if size < 0:
+                chunk = data[start:]
+            else:
+                chunk = data[start:start + size]
+                size -= len(chunk)
+            if not chunk:
+                # The end of the last block of the image
+                break
+            chunks.append(chunk)
+            self._pos += len(chunk)
+        return ''.join(chunks)
+
+    def _load(self, block, required):
+        if block == self._block:
+            return self._data
+        data = self.driver.read_block(self.image_id, block)
+        if data is None:
+            if self.follow or not required:
+                return None
+            reason = _("the block is not cached")
+            raise exception.ImageCacheBlockInvalid(image_id=self.image_id,
+                                                   block=block,
+                                                   reason=reason)
+        if not self.follow:
+            self.driver.record_block_hit(self.image_id, block, self.accessed)
+        self._block = block
+        self._data = data
+        return data
+
+    def close(self):
+        self._block = None
+        self._data = None
@@ -25,11 +25,14 @@ import os
 import stat
 import time
 
+import eventlet
+from eventlet import semaphore
 from eventlet import sleep, timeout
 from oslo.config import cfg
 import sqlite3
 
 from glance.common import exception
+from glance.common import fileio
 from glance.image_cache.drivers import base
 import glance.openstack.common.log as logging
 
@@ -39,6 +42,15 @@ sqlite_opts = [
     cfg.StrOpt('image_cache_sqlite_db', default='cache.db',
                help=_('The path to the sqlite file database that will be '
                       'used for image cache management.')),
+    cfg.FloatOpt('image_cache_sqlite_flush_interval', default=5.0,
+                 help=_('The number of seconds that cache hits are buffered '
+                        'in memory before they are written to the cache '
+                        'database. Set to 0 to record every hit as it '
+                        'happens.')),
+    cfg.IntOpt('image_cache_sqlite_flush_threshold', default=100,
+               help=_('The number of images with buffered cache hits that '
+                      'causes the buffer to be written out before the '
+                      'flush interval has passed.')),
 ]
 
 CONF = cfg.CONF
@@ -73,6 +85,10 @@ class SqliteConnection(sqlite3.Connection):
         return self._timeout(lambda: sqlite3.Connection.execute(
                                         self, *args, **kwargs))
 
+    def executemany(self, *args, **kwargs):
+        return self._timeout(lambda: sqlite3.Connection.executemany(
+                                        self, *args, **kwargs))
+
     def commit(self):
         return self._timeout(lambda: sqlite3.Connection.commit(self))
 
@@ -98,6 +114,16 @@ class Driver(base.Driver):
         """
         super(Driver, self).configure()
 
+        # The connection is opened lazily and reopened in forked children
+        self._conn = None
+        self._conn_pid = None
+        self._conn_lock = semaphore.Semaphore()
+
+        # Hits waiting to be written, as image_id -> [hits, last_accessed]
+        self._pending_hits = {}
+        self._flush_timer = None
+        self._flushing = False
+
         # Create the SQLite database that will hold our cache attributes
         self.initialize_db()
 
@@ -116,7 +142,25 @@ class Driver(base.Driver):
                     hits INTEGER DEFAULT 0,
                     checksum TEXT
                 );
+                CREATE TABLE IF NOT EXISTS incomplete_images (
+                    image_id TEXT PRIMARY KEY,
+                    started REAL DEFAULT 0.0
+                );
+                CREATE TABLE IF NOT EXISTS cache_size (
+                    id INTEGER PRIMARY KEY,
+                    total INTEGER DEFAULT 0
+                );
+                INSERT OR IGNORE INTO cache_size (id, total)
+                    SELECT 0, COALESCE(SUM(size), 0) FROM cached_images;
             """)
+            conn.commit()
+            # WAL lets the cache management tools read the database while
+            # an API worker is writing to it. The mode is stored in the
+            # database file, so it only needs to be set once.
+            mode = conn.execute('PRAGMA journal_mode = WAL').fetchone()[0]
+            if mode.lower() != 'wal':
+                LOG.debug(_("Image cache database is using journal mode "
+                            "'%s'"), mode)
             conn.close()
         except sqlite3.DatabaseError as e:
             msg = _("Failed to initialize the image cache database. "
@@ -128,14 +172,14 @@ class Driver(base.Driver):
     def get_cache_size(self):
         """
         Returns the total size in bytes of the image cache.
+
+        The total is maintained in the database as images are added to
+        and removed from the cache, so no files are examined here.
         """
-        sizes = []
-        for path in self.get_cache_files(self.base_dir):
-            if path == self.db_path:
-                continue
-            file_info = os.stat(path)
-            sizes.append(file_info[stat.ST_SIZE])
-        return sum(sizes)
+        with self.get_db() as db:
+            cur = db.execute("""SELECT total FROM cache_size WHERE id = 0""")
+            row = cur.fetchone()
+            return row[0] if row else 0
 
     def get_hit_count(self, image_id):
         """
@@ -146,6 +190,7 @@ class Driver(base.Driver):
         if not self.is_cached(image_id):
             return 0
 
+        self.flush_hits()
         hits = 0
         with self.get_db() as db:
             cur = db.execute("""SELECT hits FROM cached_images
@@ -159,6 +204,7 @@ class Driver(base.Driver):
         Returns a list of records about cached images.
         """
         LOG.debug(_("Gathering cached image entries."))
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT
                              image_id, hits, last_accessed, last_modified, size
@@ -174,7 +220,10 @@ class Driver(base.Driver):
 
         :param image_id: Image ID
         """
-        return os.path.exists(self.get_image_filepath(image_id))
+        with self.get_db() as db:
+            cur = db.execute("""SELECT 1 FROM cached_images
+                             WHERE image_id = ?""", (image_id, ))
+            return cur.fetchone() is not None
 
     def is_cacheable(self, image_id):
         """
@@ -194,8 +243,10 @@ class Driver(base.Driver):
 
         :param image_id: Image ID
         """
-        path = self.get_image_filepath(image_id, 'incomplete')
-        return os.path.exists(path)
+        with self.get_db() as db:
+            cur = db.execute("""SELECT 1 FROM incomplete_images
+                             WHERE image_id = ?""", (image_id, ))
+            return cur.fetchone() is not None
 
     def is_queued(self, image_id):
         """
@@ -212,10 +263,12 @@ class Driver(base.Driver):
         """
         deleted = 0
         with self.get_db() as db:
-            for path in self.get_cache_files(self.base_dir):
+            for path in self.get_all_cache_files():
                 delete_cached_file(path)
                 deleted += 1
             db.execute("""DELETE FROM cached_images""")
+            db.execute("""UPDATE cache_size SET total = 0 WHERE id = 0""")
+            self._pending_hits.clear()
             db.commit()
         return deleted
 
@@ -228,10 +281,44 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         with self.get_db() as db:
             delete_cached_file(path)
-            db.execute("""DELETE FROM cached_images WHERE image_id = ?""",
-                       (image_id, ))
+            self._delete_entries(db, [image_id])
             db.commit()
 
+    def delete_cached_images(self, image_ids):
+        """
+        Removes a batch of cached image files and any attributes about
+        the images, using a single database transaction
+
+        :param image_ids: List of Image IDs
+        """
+        with self.get_db() as db:
+            for image_id in image_ids:
+                delete_cached_file(self.get_image_filepath(image_id))
+            self._delete_entries(db, image_ids)
+            db.commit()
+
+    def _delete_entries(self, db, image_ids):
+        """
+        Removes the records about the supplied images and deducts their
+        sizes from the cache size total. The caller must commit.
+
+        :param db: Database connection
+        :param image_ids: List of Image IDs
+        """
+        freed = 0
+        for image_id in image_ids:
+            # Hits on a removed image must not carry over to a new copy
+            self._pending_hits.pop(image_id, None)
+            cur = db.execute("""SELECT size FROM cached_images
+                             WHERE image_id = ?""", (image_id, ))
+            row = cur.fetchone()
+            if row is not None:
+                freed += row[0]
+        db.executemany("""DELETE FROM cached_images WHERE image_id = ?""",
+                       [(image_id, ) for image_id in image_ids])
+        db.execute("""UPDATE cache_size SET total = total - ?
+                   WHERE id = 0""", (freed, ))
+
     def delete_all_queued_images(self):
         """
         Removes all queued image files and any attributes about the images
@@ -255,7 +342,8 @@ class Driver(base.Driver):
         """
         Delete any image files in the invalid directory and any
         files in the incomplete directory that are older than a
-        configurable amount of time.
+        configurable amount of time, then reconcile the database
+        with the files actually present in the cache.
         """
         self.delete_invalid_files()
 
@@ -265,12 +353,99 @@ class Driver(base.Driver):
         now = time.time()
         older_than = now - stall_time
         self.delete_stalled_files(older_than)
+        self.reconcile()
+        self.rebalance()
+
+    def rebalance(self):
+        """
+        Moves the files of cached images left on another shard directory
+        by a change of image_cache_shard_dirs to the shard that owns them
+        now. Consistent hashing keeps the number of images to move low.
+        Returns the number of images moved.
+        """
+        if len(self.get_shards()) == 1:
+            return 0
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id FROM cached_images""")
+            image_ids = [row[0] for row in cur]
+        return self._rebalance_images(image_ids, 'active')
+
+    def _rebalance_images(self, image_ids, cache_status):
+        """
+        Moves the files of images to the shards owning them, and returns
+        the number of images moved. Images being cached are left alone.
+
+        :param image_ids: List of Image IDs
+        :param cache_status: Status of the files to move
+        """
+        moved = 0
+        for image_id in image_ids:
+            if self.is_being_cached(image_id):
+                continue
+            try:
+                if self.rebalance_shard(image_id, cache_status):
+                    moved += 1
+            except (IOError, OSError) as e:
+                LOG.warn(_("Failed to move cached image %(image_id)s to "
+                           "its shard directory. Got error: %(e)s"),
+                         {'image_id': image_id, 'e': e})
+        if moved:
+            LOG.info(_("Moved %d cached images to their shard "
+                       "directories"), moved)
+        return moved
+
+    def reconcile(self):
+        """
+        Brings the database back in line with the cache directories.
+
+        Records for cached or incomplete images whose file has gone are
+        removed, cached files without a record are registered, and the
+        running cache size total is recomputed from the records.
+        """
+        with self.get_db() as db:
+            cur = db.execute("""SELECT image_id FROM cached_images""")
+            known = set([row[0] for row in cur])
+            present = set()
+            for path in self.get_all_cache_files():
+                present.add(os.path.basename(path))
+
+            for image_id in known - present:
+                LOG.info(_("Removing cache record for missing image "
+                           "file '%s'"), image_id)
+            db.executemany("""DELETE FROM cached_images WHERE image_id = ?""",
+                           [(image_id, ) for image_id in known - present])
+
+            for image_id in present - known:
+                path = self.get_image_filepath(image_id)
+                file_info = os.stat(path)
+                LOG.info(_("Adding cache record for untracked image "
+                           "file '%s'"), image_id)
+                db.execute("""INSERT INTO cached_images
+                           (image_id, last_accessed, last_modified, hits, size)
+                           VALUES (?, 0, ?, 0, ?)""",
+                           (image_id, file_info[stat.ST_MTIME],
+                            file_info[stat.ST_SIZE]))
+
+            cur = db.execute("""SELECT image_id FROM incomplete_images""")
+            stale = [row[0] for row in cur
+                     if not os.path.exists(
+                         self.get_image_filepath(row[0], 'incomplete'))]
+            db.executemany("""DELETE FROM incomplete_images
+                           WHERE image_id = ?""",
+                           [(image_id, ) for image_id in stale])
+
+            db.execute("""UPDATE cache_size
+                       SET total = (SELECT COALESCE(SUM(size), 0)
+                                    FROM cached_images)
+                       WHERE id = 0""")
+            db.commit()
 
     def get_least_recently_accessed(self):
         """
         Return a tuple containing the image_id and size of the least recently
         accessed cached file, or None if no cached files.
         """
+        self.flush_hits()
         with self.get_db() as db:
             cur = db.execute("""SELECT image_id FROM cached_images
                              ORDER BY last_accessed LIMIT 1""")
@@ -285,12 +460,16 @@ class Driver(base.Driver):
         return image_id, file_info[stat.ST_SIZE]
 
     @contextmanager
-    def open_for_write(self, image_id):
+    def open_for_write(self, image_id, image_size=None):
         """
         Open a file for writing the image file for an image
         with supplied identifier.
 
         :param image_id: Image ID
+        :param image_size: Size of the image, if known, for which disk
+                           space is reserved
+        :raises `glance.common.exception.Duplicate` if the image is
+                already being cached
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
 
@@ -310,10 +489,15 @@ class Driver(base.Driver):
                 filesize = os.path.getsize(final_path)
                 now = time.time()
 
+                self._delete_entries(db, [image_id])
+                db.execute("""DELETE FROM incomplete_images
+                           WHERE image_id = ?""", (image_id, ))
                 db.execute("""INSERT INTO cached_images
                            (image_id, last_accessed, last_modified, hits, size)
                            VALUES (?, 0, ?, 0, ?)""",
                            (image_id, now, filesize))
+                db.execute("""UPDATE cache_size SET total = total + ?
+                           WHERE id = 0""", (filesize, ))
                 db.commit()
 
         def rollback(e):
@@ -326,12 +510,19 @@ class Driver(base.Driver):
                                 "'%(invalid_path)s'") % locals())
                     os.rename(incomplete_path, invalid_path)
 
-                db.execute("""DELETE FROM cached_images
+                self._delete_entries(db, [image_id])
+                db.execute("""DELETE FROM incomplete_images
                            WHERE image_id = ?""", (image_id, ))
                 db.commit()
 
+        # Claim the image so that only one request at a time fills it
+        with self.get_db() as db:
+            self._claim(db, image_id)
+            db.commit()
+
         try:
-            with open(incomplete_path, 'wb') as cache_file:
+            with fileio.OnePassFile(open(incomplete_path, 'wb'),
+                                    image_size) as cache_file:
                 yield cache_file
         except Exception as e:
             rollback(e)
@@ -347,56 +538,169 @@ class Driver(base.Driver):
             if os.path.exists(incomplete_path):
                 rollback('incomplete fetch')
 
+    def _claim(self, db, image_id):
+        """
+        Records that an image is being cached. The caller must commit.
+
+        :param db: Database connection
+        :param image_id: Image ID
+        :raises `glance.common.exception.Duplicate` if the image is
+                already being cached
+        """
+        try:
+            db.execute("""INSERT INTO incomplete_images
+                       (image_id, started) VALUES (?, ?)""",
+                       (image_id, time.time()))
+        except sqlite3.IntegrityError:
+            msg = _("Image '%s' is already being cached") % image_id
+            raise exception.Duplicate(msg)
+
     @contextmanager
     def open_for_read(self, image_id):
         """
         Open and yield file for reading the image file for an image
         with supplied identifier.
 
+        The hit is buffered in memory and written to the database later
+        by flush_hits(), so reading from the cache does not wait on the
+        database.
+
         :param image_id: Image ID
         """
         path = self.get_image_filepath(image_id)
         with open(path, 'rb') as cache_file:
             yield cache_file
-        now = time.time()
-        with self.get_db() as db:
-            db.execute("""UPDATE cached_images
-                       SET hits = hits + 1, last_accessed = ?
-                       WHERE image_id = ?""",
-                       (now, image_id))
-            db.commit()
+        self.record_hit(image_id)
 
-    @contextmanager
-    def get_db(self):
+    def record_hit(self, image_id, now=None):
         """
-        Returns a context manager that produces a database connection that
-        self-closes and calls rollback if an error occurs while using the
-        database connection
-        """
-        conn = sqlite3.connect(self.db_path, check_same_thread=False,
-                               factory=SqliteConnection)
-        conn.row_factory = sqlite3.Row
-        conn.text_factory = str
-        conn.execute('PRAGMA synchronous = NORMAL')
-        conn.execute('PRAGMA count_changes = OFF')
-        conn.execute('PRAGMA temp_store = MEMORY')
+        Buffer a hit on a cached image. The buffer is flushed in the
+        background once image_cache_sqlite_flush_interval seconds have
+        passed, or straight away when it holds
+        image_cache_sqlite_flush_threshold images.
+
+        :param image_id: Image ID
+        :param now: Time of the access, defaults to the current time
+        """
+        if now is None:
+            now = time.time()
+        entry = self._pending_hits.setdefault(image_id, [0, 0.0])
+        entry[0] += 1
+        entry[1] = max(entry[1], now)
+
+        interval = CONF.image_cache_sqlite_flush_interval
+        if interval <= 0:
+            self.flush_hits()
+        elif len(self._pending_hits) >= \
+                CONF.image_cache_sqlite_flush_threshold:
+            if not self._flushing:
+                self._cancel_flush_timer()
+                eventlet.spawn_n(self._flush_in_background)
+        elif self._flush_timer is None:
+            self._flush_timer = eventlet.spawn_after(
+                interval, self._flush_in_background)
+
+    def _cancel_flush_timer(self):
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+
+    def _flush_in_background(self):
+        self._flush_timer = None
         try:
-            yield conn
-        except sqlite3.DatabaseError as e:
-            msg = _("Error executing SQLite call. Got error: %s") % e
-            LOG.error(msg)
-            conn.rollback()
+            self.flush_hits()
+        except Exception as e:
+            LOG.error(_("Failed to write image cache hits. Got error: %s"),
+                      e)
+
+    def flush_hits(self):
+        """
+        Write all buffered hits to the database in a single transaction.
+        Hits that could not be written stay buffered for the next flush.
+
+        :retval Number of images whose hits were written
+        """
+        self._cancel_flush_timer()
+        if not self._pending_hits:
+            return 0
+
+        pending, self._pending_hits = self._pending_hits, {}
+        self._flushing = True
+        flushed = False
+        try:
+            with self.get_db() as db:
+                db.executemany("""UPDATE cached_images
+                               SET hits = hits + ?,
+                                   last_accessed = MAX(last_accessed, ?)
+                               WHERE image_id = ?""",
+                               [(hits, last_accessed, image_id)
+                                for image_id, (hits, last_accessed)
+                                in pending.iteritems()])
+                db.commit()
+                flushed = True
         finally:
-            conn.close()
+            self._flushing = False
+            if not flushed:
+                for image_id, (hits, last_accessed) in pending.iteritems():
+                    entry = self._pending_hits.setdefault(image_id, [0, 0.0])
+                    entry[0] += hits
+                    entry[1] = max(entry[1], last_accessed)
+        return len(pending) if flushed else 0
 
-    def queue_image(self, image_id):
+    @contextmanager
+    def get_db(self):
+        """
+        Returns a context manager that produces the database connection
+        of this process and calls rollback if an error occurs while using
+        the database connection. The connection is kept open between calls
+        and used by one caller at a time.
+        """
+        with self._conn_lock:
+            conn = self._get_connection()
+            try:
+                yield conn
+            except sqlite3.DatabaseError as e:
+                msg = _("Error executing SQLite call. Got error: %s") % e
+                LOG.error(msg)
+                conn.rollback()
+            except Exception:
+                conn.rollback()
+                raise
+
+    def _get_connection(self):
+        """
+        Returns the persistent connection to the cache database, opening
+        a new one if there is none yet or the process has forked since.
+        """
+        pid = os.getpid()
+        if self._conn_pid != pid:
+            if self._conn_pid is not None:
+                # Forked from a process that already used the database.
+                # Its connection must not be shared and its buffered hits
+                # are the parent's to write.
+                self._pending_hits = {}
+                self._flush_timer = None
+            conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                                   factory=SqliteConnection)
+            conn.row_factory = sqlite3.Row
+            conn.text_factory = str
+            conn.execute('PRAGMA synchronous = NORMAL')
+            conn.execute('PRAGMA count_changes = OFF')
+            conn.execute('PRAGMA temp_store = MEMORY')
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
-        If the image already exists in the queue or has already been
-        cached, we return False, True otherwise
+        If the image has already been cached, or is already in the queue
+        with the same or a higher priority, we return False, True
+        otherwise
 
         :param image_id: Image ID
+        :param priority: Images with a higher priority are fetched first
         """
         if self.is_cached(image_id):
             msg = _("Not queueing image '%s'. Already cached.") % image_id
@@ -409,26 +713,16 @@ class Driver(base.Driver):
             LOG.warn(msg)
             return False
 
-        if self.is_queued(image_id):
-            msg = _("Not queueing image '%s'. Already queued.") % image_id
-            LOG.warn(msg)
-            return False
-
-        path = self.get_image_filepath(image_id, 'queue')
-
-        # Touch the file to add it to the queue
-        with open(path, "w") as f:
-            pass
-
-        return True
+        return self._add_to_queue(image_id, priority)
 
     def delete_invalid_files(self):
         """
         Removes any invalid cache entries
         """
-        for path in self.get_cache_files(self.invalid_dir):
-            os.unlink(path)
-            LOG.info(_("Removed invalid cache file %s"), path)
+        for invalid_dir in self.get_shard_dirs('invalid'):
+            for path in self.get_cache_files(invalid_dir):
+                os.unlink(path)
+                LOG.info(_("Removed invalid cache file %s"), path)
 
     def delete_stalled_files(self, older_than):
         """
@@ -438,31 +732,17 @@ class Driver(base.Driver):
         :param older_than: Files written to on or before this timestemp
                            will be deleted.
         """
-        for path in self.get_cache_files(self.incomplete_dir):
-            if os.path.getmtime(path) < older_than:
-                try:
-                    os.unlink(path)
-                    LOG.info(_("Removed stalled cache file %s"), path)
-                except Exception as e:
-                    msg = (_("Failed to delete file %(path)s. "
-                             "Got error: %(e)s") %
-                           dict(path=path, e=e))
-                    LOG.warn(msg)
-
-    def get_queued_images(self):
-        """
-        Returns a list of image IDs that are in the queue. The
-        list should be sorted by the time the image ID was inserted
-        into the queue.
-        """
-        files = [f for f in self.get_cache_files(self.queue_dir)]
-        items = []
-        for path in files:
-            mtime = os.path.getmtime(path)
-            items.append((mtime, os.path.basename(path)))
-
-        items.sort()
-        return [image_id for (mtime, image_id) in items]
+        for incomplete_dir in self.get_shard_dirs('incomplete'):
+            for path in self.get_cache_files(incomplete_dir):
+                if os.path.getmtime(path) < older_than:
+                    try:
+                        os.unlink(path)
+                        LOG.info(_("Removed stalled cache file %s"), path)
+                    except Exception as e:
+                        msg = (_("Failed to delete file %(path)s. "
+                                 "Got error: %(e)s") %
+                               dict(path=path, e=e))
+                        LOG.warn(msg)
 
     def get_cache_files(self, basepath):
         """
@@ -472,7 +752,16 @@ class Driver(base.Driver):
         """
         for fname in os.listdir(basepath):
             path = os.path.join(basepath, fname)
-            if path != self.db_path and os.path.isfile(path):
+            # Skip the database and its journal files
+            if not path.startswith(self.db_path) and os.path.isfile(path):
+                yield path
+
+    def get_all_cache_files(self):
+        """
+        Returns the files of cached images on every shard directory
+        """
+        for shard_dir in self.get_shard_dirs():
+            for path in self.get_cache_files(shard_dir):
                 yield path
 
 
@@ -65,6 +65,7 @@ from oslo.config import cfg
 import xattr
 
 from glance.common import exception
+from glance.common import fileio
 from glance.image_cache.drivers import base
 import glance.openstack.common.log as logging
 
@@ -94,7 +95,10 @@ class Driver(base.Driver):
 
         # We do a quick attempt to write a user xattr to a temporary file
         # to check that the filesystem is even enabled to support xattrs
-        image_cache_dir = self.base_dir
+        for image_cache_dir in self.get_shard_dirs():
+            self._check_xattr_support(image_cache_dir)
+
+    def _check_xattr_support(self, image_cache_dir):
         fake_image_filepath = os.path.join(image_cache_dir, 'checkme')
         with open(fake_image_filepath, 'wb') as fake_file:
             fake_file.write("XXX")
@@ -121,7 +125,7 @@ class Driver(base.Driver):
         Returns the total size in bytes of the image cache.
         """
         sizes = []
-        for path in get_all_regular_files(self.base_dir):
+        for path in self.get_all_cache_files():
             file_info = os.stat(path)
             sizes.append(file_info[stat.ST_SIZE])
         return sum(sizes)
@@ -144,7 +148,7 @@ class Driver(base.Driver):
         """
         LOG.debug(_("Gathering cached image entries."))
         entries = []
-        for path in get_all_regular_files(self.base_dir):
+        for path in self.get_all_cache_files():
             image_id = os.path.basename(path)
 
             entry = {}
@@ -202,7 +206,7 @@ class Driver(base.Driver):
         Removes all cached image files and any attributes about the images
         """
         deleted = 0
-        for path in get_all_regular_files(self.base_dir):
+        for path in self.get_all_cache_files():
             delete_cached_file(path)
             deleted += 1
         return deleted
@@ -241,7 +245,7 @@ class Driver(base.Driver):
         accessed cached file, or None if no cached files.
         """
         stats = []
-        for path in get_all_regular_files(self.base_dir):
+        for path in self.get_all_cache_files():
             file_info = os.stat(path)
             stats.append((file_info[stat.ST_ATIME],  # access time
                           file_info[stat.ST_SIZE],   # size in bytes
@@ -254,12 +258,16 @@ class Driver(base.Driver):
         return os.path.basename(stats[0][2]), stats[0][1]
 
     @contextmanager
-    def open_for_write(self, image_id):
+    def open_for_write(self, image_id, image_size=None):
         """
         Open a file for writing the image file for an image
         with supplied identifier.
 
         :param image_id: Image ID
+        :param image_size: Size of the image, if known, for which disk
+                           space is reserved
+        :raises `glance.common.exception.Duplicate` if the image is
+                already being cached
         """
         incomplete_path = self.get_image_filepath(image_id, 'incomplete')
 
@@ -291,8 +299,18 @@ class Driver(base.Driver):
                         "'%(invalid_path)s'") % locals())
             os.rename(incomplete_path, invalid_path)
 
+        # Claim the image so that only one request at a time fills it
+        try:
+            fd = os.open(incomplete_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            msg = _("Image '%s' is already being cached") % image_id
+            raise exception.Duplicate(msg)
+
         try:
-            with open(incomplete_path, 'wb') as cache_file:
+            with fileio.OnePassFile(os.fdopen(fd, 'wb'),
+                                    image_size) as cache_file:
                 yield cache_file
         except Exception as e:
             rollback(e)
@@ -322,14 +340,30 @@ class Driver(base.Driver):
         path = self.get_image_filepath(image_id)
         inc_xattr(path, 'hits', 1)
 
-    def queue_image(self, image_id):
+    def record_hit(self, image_id, now=None):
+        """
+        Records a hit on a cached image that was served without reading
+        its file, bumping its access time as a read would have.
+
+        :param image_id: Image ID
+        :param now: Time of the access, defaults to the current time
+        """
+        path = self.get_image_filepath(image_id)
+        if now is None:
+            now = time.time()
+        inc_xattr(path, 'hits', 1)
+        os.utime(path, (now, os.path.getmtime(path)))
+
+    def queue_image(self, image_id, priority=0):
         """
         This adds a image to be cache to the queue.
 
-        If the image already exists in the queue or has already been
-        cached, we return False, True otherwise
+        If the image has already been cached, or is already in the queue
+        with the same or a higher priority, we return False, True
+        otherwise
 
         :param image_id: Image ID
+        :param priority: Images with a higher priority are fetched first
         """
         if self.is_cached(image_id):
             msg = _("Not queueing image '%s'. Already cached.") % image_id
@@ -342,34 +376,7 @@ class Driver(base.Driver):
             LOG.warn(msg)
             return False
 
-        if self.is_queued(image_id):
-            msg = _("Not queueing image '%s'. Already queued.") % image_id
-            LOG.warn(msg)
-            return False
-
-        path = self.get_image_filepath(image_id, 'queue')
-        LOG.debug(_("Queueing image '%s'."), image_id)
-
-        # Touch the file to add it to the queue
-        with open(path, "w") as f:
-            pass
-
-        return True
-
-    def get_queued_images(self):
-        """
-        Returns a list of image IDs that are in the queue. The
-        list should be sorted by the time the image ID was inserted
-        into the queue.
-        """
-        files = [f for f in get_all_regular_files(self.queue_dir)]
-        items = []
-        for path in files:
-            mtime = os.path.getmtime(path)
-            items.append((mtime, os.path.basename(path)))
-
-        items.sort()
-        return [image_id for (mtime, image_id) in items]
+        return self._add_to_queue(image_id, priority)
 
     def _reap_old_files(self, dirpath, entry_type, grace=None):
         now = time.time()
@@ -398,7 +405,8 @@ class Driver(base.Driver):
         :param grace: Number of seconds to keep an invalid entry around for
                       debugging purposes. If None, then delete immediately.
         """
-        return self._reap_old_files(self.invalid_dir, 'invalid', grace=grace)
+        return sum([self._reap_old_files(invalid_dir, 'invalid', grace=grace)
+                    for invalid_dir in self.get_shard_dirs('invalid')])
 
     def reap_stalled(self, grace=None):
         """Remove any stalled cache entries
@@ -406,14 +414,16 @@ class Driver(base.Driver):
         :param grace: Number of seconds to keep an invalid entry around for
                       debugging purposes. If None, then delete immediately.
         """
-        return self._reap_old_files(self.incomplete_dir, 'stalled',
-                                    grace=grace)
+        return sum([self._reap_old_files(incomplete_dir, 'stalled',
+                                         grace=grace)
+                    for incomplete_dir in self.get_shard_dirs('incomplete')])
 
     def clean(self, stall_time=None):
         """
         Delete any image files in the invalid directory and any
         files in the incomplete directory that are older than a
-        configurable amount of time.
+        configurable amount of time, then move image files left on
+        another shard directory to the shard that owns them.
         """
         self.reap_invalid()
 
@@ -422,6 +432,26 @@ class Driver(base.Driver):
 
         self.reap_stalled(stall_time)
 
+        if len(self.get_shards()) > 1:
+            for path in list(self.get_all_cache_files()):
+                image_id = os.path.basename(path)
+                if self.is_being_cached(image_id):
+                    continue
+                try:
+                    self.rebalance_shard(image_id)
+                except (IOError, OSError) as e:
+                    LOG.warn(_("Failed to move cached image %(image_id)s "
+                               "to its shard directory. Got error: %(e)s"),
+                             {'image_id': image_id, 'e': e})
+
+    def get_all_cache_files(self):
+        """
+        Returns the files of cached images on every shard directory
+        """
+        for shard_dir in self.get_shard_dirs():
+            for path in get_all_regular_files(shard_dir):
+                yield path
+
 
 def get_all_regular_files(basepath):
     for fname in os.listdir(basepath):
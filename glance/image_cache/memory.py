@@ -0,0 +1,148 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+In-memory tier for the image cache.
+
+The tier holds the whole data of small images and the first bytes of
+larger ones in memory, within a byte budget, and drops entries in the
+order chosen by one of the eviction policies in
+glance.image_cache.policies. It sits in front of the cache driver, which
+remains the record of what is cached.
+"""
+
+from oslo.config import cfg
+
+from glance.image_cache import policies
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+memory_opts = [
+    cfg.IntOpt('image_cache_memory_size', default=0,
+               help=_('The maximum size in bytes of image data each API '
+                      'worker keeps in memory in front of the image cache. '
+                      '0 disables the memory tier.')),
+    cfg.IntOpt('image_cache_memory_max_image_size', default=32 * (1024 ** 2),
+               help=_('Cached images up to this size in bytes are held in '
+                      'memory in full.')),
+    cfg.IntOpt('image_cache_memory_prefix_size', default=4 * (1024 ** 2),
+               help=_('The number of bytes from the start of larger cached '
+                      'images that are held in memory. 0 holds only whole '
+                      'images.')),
+    cfg.StrOpt('image_cache_memory_eviction_policy', default='lru',
+               help=_('The policy used to choose which images to drop from '
+                      'memory. One of lru, lfu, gdsf or arc.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(memory_opts)
+
+
+class MemoryTier(object):
+
+    """
+    Image data held in memory, keyed by image ID.
+
+    Each entry is the image data, or its first bytes, together with the
+    size of the whole image. Entries are immutable strings that readers
+    keep a reference to, so dropping an entry never disturbs a response
+    that is using it. No method yields to other green threads, so a tier
+    can be shared by all the requests of an API worker without locking.
+    """
+
+    def __init__(self, capacity, policy_name='lru'):
+        self.capacity = capacity
+        self.policy_name = policy_name
+        self.policy = policies.get_policy(policy_name, capacity)
+        # image_id -> (data, image_size)
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, image_id):
+        return image_id in self.entries
+
+    def get(self, image_id, end=None):
+        """
+        Returns a tuple of the data held for an image and the size of the
+        whole image, or None if the tier does not hold the image up to
+        end, counting a hit or a miss.
+
+        :param image_id: Image ID
+        :param end: Offset the data must reach, None for the whole image
+        """
+        entry = self.entries.get(image_id)
+        if entry is not None:
+            data, image_size = entry
+            if end is None:
+                end = image_size
+            if len(data) < end:
+                entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.policy.access(image_id)
+        return entry
+
+    def put(self, image_id, data, image_size):
+        """
+        Holds the data of an image, or its first bytes, dropping other
+        entries as needed to stay within capacity. Returns False if the
+        data is larger than the whole tier.
+
+        :param image_id: Image ID
+        :param data: The image data, or the first bytes of it
+        :param image_size: Size of the whole image
+        """
+        if len(data) > self.capacity:
+            return False
+        self.remove(image_id)
+        self.entries[image_id] = (data, image_size)
+        self.policy.add(image_id, len(data))
+        while self.policy.size > self.capacity:
+            victim, size = self.policy.evict()
+            del self.entries[victim]
+            self.evictions += 1
+            LOG.debug(_("Dropped image '%s' from the memory tier"), victim)
+        return True
+
+    def remove(self, image_id):
+        """
+        Drops the data held for an image, if any.
+
+        :param image_id: Image ID
+        """
+        if self.entries.pop(image_id, None) is not None:
+            self.policy.remove(image_id)
+
+    def clear(self):
+        self.entries.clear()
+        self.policy = policies.get_policy(self.policy_name, self.capacity)
+
+    def get_stats(self):
+        """Returns the counters and current usage of the tier."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'images': len(self.entries),
+            'size': self.policy.size,
+            'max_size': self.capacity,
+        }
@@ -0,0 +1,173 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Image metadata kept next to the cached images, so that cache hits can be
+answered without asking the registry.
+
+The metadata the registry or the database returned for a cache hit is
+written to a file of the image in the metadata directory of the cache,
+one entry per API version, and used for image_cache_metadata_ttl seconds.
+A stored entry is only used for a request if the image would be visible
+to it: the image is public or has no owner, the request is made by an
+admin or by the owner, or the registry has let the tenant of the request
+see the image within the last image_cache_metadata_ttl seconds. Any other
+request goes to the registry as before.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+from oslo.config import cfg
+
+from glance.common import utils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+metadata_opts = [
+    cfg.IntOpt('image_cache_metadata_ttl', default=0,
+               help=_('The number of seconds the metadata of a cached '
+                      'image is kept next to it and used to answer cache '
+                      'hits without asking the registry. Changes made '
+                      'through other API nodes may take this long to be '
+                      'seen. 0 asks the registry on every cache hit.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(metadata_opts)
+
+
+class ImageMetadataCache(object):
+
+    """Stores the metadata of cached images in files of a directory."""
+
+    def __init__(self, metadata_dir, ttl):
+        utils.safe_mkdirs(metadata_dir)
+        self.metadata_dir = metadata_dir
+        self.ttl = ttl
+
+    def _get_path(self, image_id):
+        return os.path.join(self.metadata_dir, str(image_id))
+
+    def _read(self, image_id):
+        try:
+            with open(self._get_path(image_id)) as f:
+                return json.load(f)
+        except IOError:
+            return {}
+        except ValueError:
+            LOG.warn(_("Ignoring unreadable cached metadata of image %s"),
+                     image_id)
+            return {}
+
+    def get(self, context, image_id, api_version, now=None):
+        """
+        Returns the stored metadata of an image if it is fresh and the
+        image is visible in the supplied context, and None otherwise.
+
+        :param context: Context of the request
+        :param image_id: Image ID
+        :param api_version: API version the metadata was stored for
+        :param now: Current time, defaults to the current time
+        """
+        if now is None:
+            now = time.time()
+        entry = self._read(image_id).get(api_version)
+        if entry is None or now - entry['stored_at'] > self.ttl:
+            return None
+        if not self._is_visible(context, entry, now):
+            return None
+        return entry['image_meta']
+
+    def _is_visible(self, context, entry, now):
+        image_meta = entry['image_meta']
+        if (context.is_admin or image_meta.get('owner') is None or
+                image_meta.get('is_public') is True):
+            return True
+        if context.owner is None:
+            return False
+        if context.owner == image_meta['owner']:
+            return True
+        verified_at = entry['members'].get(context.owner)
+        return verified_at is not None and now - verified_at <= self.ttl
+
+    def put(self, context, image_id, api_version, image_meta, now=None):
+        """
+        Stores the metadata of an image that the registry returned in
+        the supplied context. The tenant of the context is remembered as
+        able to see the image, until the entry expires.
+
+        :param context: Context the metadata was fetched in
+        :param image_id: Image ID
+        :param api_version: API version the metadata is for
+        :param image_meta: Image metadata, without locations
+        :param now: Current time, defaults to the current time
+        """
+        if image_meta.get('deleted') or image_meta.get('status') != 'active':
+            return
+        if now is None:
+            now = time.time()
+        entries = self._read(image_id)
+
+        members = {}
+        old_entry = entries.get(api_version)
+        if old_entry is not None:
+            members = dict((tenant, verified_at) for tenant, verified_at
+                           in old_entry['members'].iteritems()
+                           if now - verified_at <= self.ttl)
+        if (not context.is_admin and context.owner is not None and
+                context.owner != image_meta.get('owner')):
+            members[context.owner] = now
+
+        entries[api_version] = {'stored_at': now,
+                                'image_meta': image_meta,
+                                'members': members}
+        self._write(image_id, entries)
+
+    def _write(self, image_id, entries):
+        fd, tmp_path = tempfile.mkstemp(dir=self.metadata_dir,
+                                        prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp_path, self._get_path(image_id))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def delete(self, image_id):
+        """
+        Removes the stored metadata of an image.
+
+        :param image_id: Image ID
+        """
+        try:
+            os.unlink(self._get_path(image_id))
+        except OSError:
+            pass
+
+    def delete_all(self):
+        """Removes the stored metadata of every image."""
+        for fname in os.listdir(self.metadata_dir):
+            try:
+                os.unlink(os.path.join(self.metadata_dir, fname))
+            except OSError:
+                pass
@@ -0,0 +1,298 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Partitioning of the image cache by visibility and owner.
+
+Every image written to the cache is assigned to a partition: public
+images, and images without an owner, to the public partition, and other
+images to a partition of their owner. The partition of each cached image
+is kept in a file of the partitions directory of the cache.
+
+The pruner first evicts the images of tenants using more than their
+maximum share of image_cache_max_size, and then, if the cache is still
+too large, only evicts public images while they use more than their
+reserved share. Images cached before partitioning was enabled belong to
+no partition and are evicted as before.
+"""
+
+import os
+import tempfile
+
+from oslo.config import cfg
+
+from glance.common import exception
+from glance.common import utils
+import glance.openstack.common.log as logging
+from glance.openstack.common import strutils
+
+LOG = logging.getLogger(__name__)
+
+partition_opts = [
+    cfg.FloatOpt('image_cache_public_reserved_share', default=0.0,
+                 help=_('The share of image_cache_max_size, from 0 to 1, '
+                        'kept for public images. Public images are only '
+                        'pruned while they use more than this.')),
+    cfg.FloatOpt('image_cache_tenant_max_share', default=1.0,
+                 help=_('The largest share of image_cache_max_size, from 0 '
+                        'to 1, that the private images of one tenant may '
+                        'use.')),
+    cfg.DictOpt('image_cache_tenant_max_shares', default={},
+                help=_('The largest share of image_cache_max_size used by '
+                       'the private images of given tenants, overriding '
+                       'image_cache_tenant_max_share, e.g. '
+                       '<tenant id>:0.5.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(partition_opts)
+
+PUBLIC = 'public'
+TENANT_PREFIX = 'tenant:'
+
+
+def is_enabled():
+    """Returns True if any partition has a reserved or maximum share."""
+    return (CONF.image_cache_public_reserved_share > 0 or
+            CONF.image_cache_tenant_max_share < 1 or
+            bool(CONF.image_cache_tenant_max_shares))
+
+
+def get_partition(image_meta):
+    """
+    Returns the partition of an image, or None if its metadata does not
+    tell it.
+
+    :param image_meta: Dict with the owner of the image and either its
+                       is_public flag (API v1) or visibility (API v2)
+    """
+    if not image_meta:
+        return None
+    if 'visibility' in image_meta:
+        is_public = image_meta['visibility'] == 'public'
+    elif 'is_public' in image_meta:
+        is_public = strutils.bool_from_string(image_meta['is_public'])
+    else:
+        return None
+    owner = image_meta.get('owner')
+    if is_public or not owner:
+        return PUBLIC
+    return TENANT_PREFIX + owner
+
+
+def _parse_share(name, value):
+    try:
+        share = float(value)
+    except (TypeError, ValueError):
+        share = -1
+    if not 0 <= share <= 1:
+        msg = (_("Invalid share %(value)s for %(name)s, it must be a number "
+                 "from 0 to 1") % {'value': value, 'name': name})
+        LOG.error(msg)
+        raise exception.BadDriverConfiguration(driver_name=__name__,
+                                               reason=msg)
+    return share
+
+
+class CachePartitions(object):
+
+    """
+    Keeps the partition of each cached image, and the reserved and maximum
+    share of the cache of each partition.
+    """
+
+    def __init__(self, partitions_dir, public_reserved_share=0.0,
+                 tenant_max_share=1.0, tenant_max_shares=None):
+        """
+        :param partitions_dir: Directory of the partition files
+        :param public_reserved_share: Share of the cache kept for public
+                                      images
+        :param tenant_max_share: Largest share of the cache one tenant
+                                 may use
+        :param tenant_max_shares: Dict of tenant IDs to their largest
+                                  share, overriding tenant_max_share
+        :raises `glance.common.exception.BadDriverConfiguration` if a
+                share is not a number from 0 to 1
+        """
+        utils.safe_mkdirs(partitions_dir)
+        self.partitions_dir = partitions_dir
+        self.public_reserved_share = _parse_share(
+            'image_cache_public_reserved_share', public_reserved_share)
+        self.tenant_max_share = _parse_share(
+            'image_cache_tenant_max_share', tenant_max_share)
+        self.tenant_max_shares = {}
+        for tenant, share in (tenant_max_shares or {}).iteritems():
+            self.tenant_max_shares[TENANT_PREFIX + tenant] = _parse_share(
+                'image_cache_tenant_max_shares', share)
+
+    def get_reserved_size(self, partition, max_size):
+        """
+        Returns the number of bytes of the cache kept for a partition.
+
+        :param partition: Partition name, or None
+        :param max_size: Maximum size of the cache
+        """
+        if partition == PUBLIC:
+            return int(max_size * self.public_reserved_share)
+        return 0
+
+    def get_max_size(self, partition, max_size):
+        """
+        Returns the number of bytes of the cache a partition may use.
+
+        :param partition: Partition name, or None
+        :param max_size: Maximum size of the cache
+        """
+        if partition is None or not partition.startswith(TENANT_PREFIX):
+            return max_size
+        share = self.tenant_max_shares.get(partition, self.tenant_max_share)
+        return int(max_size * share)
+
+    def _get_path(self, image_id):
+        return os.path.join(self.partitions_dir, str(image_id))
+
+    def set(self, image_id, partition):
+        """
+        Records the partition of a cached image.
+
+        :param image_id: Image ID
+        :param partition: Partition name
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.partitions_dir,
+                                        prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(partition)
+            os.rename(tmp_path, self._get_path(image_id))
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def get_all(self):
+        """Returns a dict of image IDs to the partition of the image."""
+        partitions = {}
+        for fname in os.listdir(self.partitions_dir):
+            if fname.startswith('.tmp-'):
+                continue
+            try:
+                with open(self._get_path(fname)) as f:
+                    partitions[fname] = f.read()
+            except IOError:
+                # Deleted while we were listing
+                pass
+        return partitions
+
+    def delete(self, image_id):
+        """
+        Forgets the partition of an image.
+
+        :param image_id: Image ID
+        """
+        try:
+            os.unlink(self._get_path(image_id))
+        except OSError:
+            pass
+
+    def delete_all(self):
+        """Forgets the partition of every image."""
+        for fname in os.listdir(self.partitions_dir):
+            try:
+                os.unlink(self._get_path(fname))
+            except OSError:
+                pass
+
+    def get_usage(self, records, get_image_id, max_size):
+        """
+        Returns a PartitionUsage of the supplied eviction records.
+
+        :param records: Eviction records of the cache driver
+        :param get_image_id: Function returning the image ID of the key
+                             of an eviction record
+        :param max_size: Maximum size of the cache
+        """
+        return PartitionUsage(self, self.get_all(), records, get_image_id,
+                              max_size)
+
+
+class PartitionUsage(object):
+
+    """
+    The space each partition uses in the cache, kept up to date while an
+    eviction plan is made.
+    """
+
+    def __init__(self, partitions, assignments, records, get_image_id,
+                 max_size):
+        self.partitions = partitions
+        self.max_size = max_size
+        self.key_partitions = {}
+        self.sizes = {}
+        for record in records:
+            key = record['image_id']
+            partition = assignments.get(get_image_id(key))
+            self.key_partitions[key] = partition
+            self.sizes[partition] = (self.sizes.get(partition, 0) +
+                                     record['size'])
+
+    def get_partition(self, key):
+        """Returns the partition of an eviction key."""
+        return self.key_partitions.get(key)
+
+    def get_overage(self, partition):
+        """Returns the bytes a partition uses above its maximum size."""
+        max_size = self.partitions.get_max_size(partition, self.max_size)
+        return max(self.sizes.get(partition, 0) - max_size, 0)
+
+    def may_evict(self, key, size):
+        """
+        Returns True, and counts the space as freed, unless evicting the
+        supplied key would take from a partition that uses no more than
+        its reserved size.
+
+        :param key: Eviction key
+        :param size: Size of the data of the key
+        """
+        partition = self.key_partitions.get(key)
+        reserved = self.partitions.get_reserved_size(partition,
+                                                     self.max_size)
+        if self.sizes.get(partition, 0) <= reserved:
+            return False
+        self.evicted(key, size)
+        return True
+
+    def evicted(self, key, size):
+        """Counts the space of an eviction key as freed."""
+        partition = self.key_partitions.get(key)
+        self.sizes[partition] = self.sizes.get(partition, 0) - size
+
+    def get_report(self):
+        """
+        Returns a dict of each partition using the cache to its size,
+        reserved size and maximum size. Images in no partition are
+        reported under 'none'.
+        """
+        report = {}
+        for partition, size in self.sizes.iteritems():
+            report[partition or 'none'] = {
+                'size': size,
+                'reserved_size': self.partitions.get_reserved_size(
+                    partition, self.max_size),
+                'max_size': self.partitions.get_max_size(partition,
+                                                         self.max_size),
+            }
+        return report
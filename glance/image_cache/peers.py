@@ -0,0 +1,210 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Fetching cached images from the image caches of other API nodes.
+
+On a cache miss the cache middleware may ask its peers for the image
+before going to the backend store. Peers are asked with an ordinary v1
+image download carrying the PEER_HEADER header and the auth token of the
+original request. A peer answers such a request only from its own cache
+and replies 404 otherwise, so peer requests never reach a store or
+another peer.
+"""
+
+import bisect
+import hashlib
+import httplib
+import random
+import socket
+import urlparse
+
+from oslo.config import cfg
+
+from glance.common import utils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+peer_opts = [
+    cfg.ListOpt('image_cache_peers', default=[],
+                help=_('URLs of the other API nodes, e.g. '
+                       'http://10.0.0.2:9292, that are asked for an image '
+                       'before reading it from the store on a cache miss. '
+                       'An empty list disables peer fetching.')),
+    cfg.StrOpt('image_cache_peer_self', default=None,
+               help=_('The URL of this node if it is listed in '
+                      'image_cache_peers. It is never asked for images.')),
+    cfg.StrOpt('image_cache_peer_selection', default='all',
+               help=_('Which peers are asked for an image. "all" asks every '
+                      'peer in a random order, "hash" only the peers owning '
+                      'the image on a consistent hash ring of '
+                      'image_cache_peers.')),
+    cfg.IntOpt('image_cache_peer_replicas', default=2,
+               help=_('The number of peers owning each image when '
+                      'image_cache_peer_selection is "hash".')),
+    cfg.FloatOpt('image_cache_peer_timeout', default=5.0,
+                 help=_('Seconds to wait for a peer to connect or send '
+                        'data.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(peer_opts)
+
+PEER_HEADER = 'X-Glance-Cache-Peer'
+
+CHUNKSIZE = 64 * 1024
+
+
+class HashRing(object):
+
+    """
+    Consistent hash ring mapping keys to nodes.
+
+    Each node is placed on the ring at a number of points, so that adding
+    or removing a node only moves the keys next to its points. A node
+    with a weight is placed at that many times the number of points, and
+    owns that many times as many keys.
+    """
+
+    def __init__(self, nodes, points_per_node=100, weights=None):
+        self.nodes = list(nodes)
+        weights = weights or {}
+        self._ring = []
+        for node in self.nodes:
+            points = int(round(points_per_node * weights.get(node, 1)))
+            for i in xrange(max(points, 1)):
+                self._ring.append((self._hash('%s-%d' % (node, i)), node))
+        self._ring.sort()
+        self._hashes = [h for h, node in self._ring]
+
+    @staticmethod
+    def _hash(key):
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def get_nodes(self, key, count=1):
+        """
+        Returns up to count distinct nodes owning key, in ring order.
+
+        :param key: Key to look up
+        :param count: Number of nodes to return
+        """
+        count = min(count, len(self.nodes))
+        chosen = []
+        if not count:
+            return chosen
+        start = bisect.bisect(self._hashes, self._hash(key))
+        for i in xrange(len(self._ring)):
+            node = self._ring[(start + i) % len(self._ring)][1]
+            if node not in chosen:
+                chosen.append(node)
+                if len(chosen) == count:
+                    break
+        return chosen
+
+
+class PeerClient(object):
+
+    """Asks the peer API nodes for images in their caches."""
+
+    def __init__(self):
+        self.peers = [peer.rstrip('/') for peer in CONF.image_cache_peers]
+        self.me = CONF.image_cache_peer_self
+        if self.me:
+            self.me = self.me.rstrip('/')
+        self.ring = None
+        if CONF.image_cache_peer_selection == 'hash':
+            self.ring = HashRing(self.peers)
+        elif CONF.image_cache_peer_selection != 'all':
+            LOG.warn(_("Unknown image_cache_peer_selection '%s', asking "
+                       "all peers"), CONF.image_cache_peer_selection)
+
+    def select_peers(self, image_id):
+        """Returns the peers to ask for an image, in the order to ask."""
+        if self.ring is not None:
+            peers = self.ring.get_nodes(image_id,
+                                        CONF.image_cache_peer_replicas)
+        else:
+            peers = list(self.peers)
+            random.shuffle(peers)
+        return [peer for peer in peers if peer != self.me]
+
+    def _get_connection(self, peer):
+        url = urlparse.urlparse(peer)
+        if url.scheme == 'https':
+            conn_class = httplib.HTTPSConnection
+        else:
+            conn_class = httplib.HTTPConnection
+        return conn_class(url.hostname, url.port,
+                          timeout=CONF.image_cache_peer_timeout), url.path
+
+    def get_image(self, image_id, auth_token=None):
+        """
+        Asks the selected peers in turn for a cached image. Returns a
+        tuple of a dict with the checksum, size and disk_format of the
+        image and an iterator over the image data from the first peer
+        that has it, or None.
+
+        :param image_id: Image ID
+        :param auth_token: Auth token of the request being served
+        """
+        headers = {PEER_HEADER: 'true'}
+        if auth_token:
+            headers['X-Auth-Token'] = auth_token
+
+        for peer in self.select_peers(image_id):
+            conn, path = self._get_connection(peer)
+            try:
+                conn.request('GET', '%s/v1/images/%s' % (path, image_id),
+                             headers=headers)
+                resp = conn.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                LOG.warn(_("Unable to ask peer %(peer)s for image "
+                           "%(image_id)s: %(error)s"),
+                         {'peer': peer, 'image_id': image_id, 'error': e})
+                conn.close()
+                continue
+
+            checksum = resp.getheader('x-image-meta-checksum')
+            if resp.status != httplib.OK or not checksum:
+                conn.close()
+                continue
+
+            LOG.debug(_("Fetching image %(image_id)s from peer %(peer)s"),
+                      {'image_id': image_id, 'peer': peer})
+            try:
+                size = int(resp.getheader('x-image-meta-size'))
+            except (TypeError, ValueError):
+                size = None
+            image_meta = {
+                'checksum': checksum,
+                'size': size,
+                'disk_format': resp.getheader('x-image-meta-disk_format'),
+                'owner': resp.getheader('x-image-meta-owner'),
+                'is_public': resp.getheader('x-image-meta-is_public'),
+            }
+            return image_meta, self._read_image(conn, resp)
+
+        return None
+
+    @staticmethod
+    def _read_image(conn, resp):
+        try:
+            for chunk in utils.chunkiter(resp, CHUNKSIZE):
+                yield chunk
+        finally:
+            conn.close()
@@ -0,0 +1,469 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Eviction policies for the image cache.
+
+A policy models the set of images held in a cache of a given capacity in
+bytes and decides which image should be evicted next. The pruner loads the
+records kept by the cache driver (hits, size and last_accessed) into a
+policy and evicts images in the order it chooses. The same objects can be
+driven access by access, which is how tools/cache_policy_benchmark.py
+replays traces against them.
+
+What a policy learns beyond the records of the driver, such as the ghost
+lists and target size of ARC or the inflation value of GDSF, is saved
+after each prune with write_states() and restored by the next one with
+read_states(), so that the pruner behaves like a long-lived policy.
+"""
+
+import errno
+import heapq
+import itertools
+import json
+import os
+import tempfile
+
+from glance.common.ordereddict import OrderedDict
+from glance.openstack.common import importutils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+_POLICY_ALIASES = {
+    'lru': 'glance.image_cache.policies.LRUPolicy',
+    'lfu': 'glance.image_cache.policies.LFUPolicy',
+    'gdsf': 'glance.image_cache.policies.GDSFPolicy',
+    'arc': 'glance.image_cache.policies.ARCPolicy',
+}
+
+
+def get_policy(name, capacity):
+    """
+    Returns a new eviction policy instance for the supplied policy name,
+    falling back to LRU if the name is unknown.
+
+    :param name: One of the keys of _POLICY_ALIASES
+    :param capacity: Size in bytes the policy should keep the cache within
+    """
+    try:
+        policy_class = importutils.import_class(_POLICY_ALIASES[name])
+    except KeyError:
+        LOG.warn(_("Unknown image cache eviction policy '%s', "
+                   "defaulting to 'lru'."), name)
+        policy_class = LRUPolicy
+    return policy_class(capacity)
+
+
+def read_states(path, name):
+    """
+    Returns a dict of scope names to the states saved by write_states()
+    for the policy with the supplied name, or an empty dict if none were
+    saved, the file cannot be read or it was written by another policy.
+
+    :param path: Path of the state file
+    :param name: Name of the policy
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            LOG.warn(_("Unable to read image cache eviction policy state "
+                       "from %(path)s: %(error)s"), {'path': path, 'error': e})
+        return {}
+    except ValueError as e:
+        LOG.warn(_("Ignoring invalid image cache eviction policy state in "
+                   "%(path)s: %(error)s"), {'path': path, 'error': e})
+        return {}
+    if not isinstance(saved, dict) or saved.get('policy') != name:
+        return {}
+    return saved.get('states', {})
+
+
+def write_states(path, name, states):
+    """
+    Saves the states of the policy with the supplied name, replacing the
+    state file in one step.
+
+    :param path: Path of the state file
+    :param name: Name of the policy
+    :param states: Dict of scope names to the get_state() of a policy
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                    prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'policy': name, 'states': states}, f)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class Policy(object):
+
+    """Base class for image cache eviction policies."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.size = 0
+        self.sizes = {}
+
+    def __contains__(self, image_id):
+        return image_id in self.sizes
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def load(self, entries):
+        """
+        Populate the policy from cache driver records, replaying them in
+        the order they were last accessed.
+
+        :param entries: List of records as returned by
+                        Driver.get_cached_images()
+        """
+        entries = sorted(entries, key=lambda e: (e['last_accessed'],
+                                                 e['image_id']))
+        for entry in entries:
+            self.add(entry['image_id'], entry['size'], hits=entry['hits'])
+
+    def get_state(self):
+        """
+        Returns what the policy has learnt beyond the images it holds, as
+        a dict that can be serialized to JSON.
+        """
+        return {}
+
+    def set_state(self, state):
+        """
+        Restores the state returned by get_state() of an earlier instance
+        of the policy. Must be called before the policy is loaded.
+
+        :param state: Dict returned by get_state()
+        """
+        pass
+
+    def forget(self, image_id):
+        """
+        Drops anything remembered about an image returned by evict() that
+        was not removed from the cache after all.
+
+        :param image_id: Image ID
+        """
+        pass
+
+    def add(self, image_id, size, hits=0):
+        """
+        Record that an image has been placed in the cache.
+
+        :param image_id: Image ID
+        :param size: Size of the image in bytes
+        :param hits: Number of hits the image has already had
+        """
+        self.sizes[image_id] = size
+        self.size += size
+        self._add(image_id, size, hits)
+
+    def access(self, image_id):
+        """
+        Record a cache hit on an image held by the policy.
+
+        :param image_id: Image ID
+        """
+        self._access(image_id)
+
+    def remove(self, image_id):
+        """
+        Forget an image that was removed from the cache by other means.
+
+        :param image_id: Image ID
+        """
+        self.size -= self.sizes.pop(image_id)
+        self._remove(image_id)
+
+    def evict(self):
+        """
+        Choose the next image to evict, forget it and return a tuple
+        containing its image_id and size, or None if the policy is empty.
+        """
+        if not self.sizes:
+            return None
+        image_id = self._victim()
+        size = self.sizes.pop(image_id)
+        self.size -= size
+        return image_id, size
+
+    def _add(self, image_id, size, hits):
+        raise NotImplementedError
+
+    def _access(self, image_id):
+        raise NotImplementedError
+
+    def _remove(self, image_id):
+        raise NotImplementedError
+
+    def _victim(self):
+        """Remove the next victim from the policy's own bookkeeping."""
+        raise NotImplementedError
+
+
+class LRUPolicy(Policy):
+
+    """Evicts the least recently accessed image first."""
+
+    def __init__(self, capacity):
+        super(LRUPolicy, self).__init__(capacity)
+        self.order = OrderedDict()
+
+    def _add(self, image_id, size, hits):
+        self.order[image_id] = True
+
+    def _access(self, image_id):
+        del self.order[image_id]
+        self.order[image_id] = True
+
+    def _remove(self, image_id):
+        del self.order[image_id]
+
+    def _victim(self):
+        image_id = iter(self.order).next()
+        del self.order[image_id]
+        return image_id
+
+
+class _HeapPolicy(Policy):
+
+    """
+    Base class for policies that evict the image with the lowest priority.
+    Entries are invalidated lazily, ties go to the least recently touched.
+    """
+
+    def __init__(self, capacity):
+        super(_HeapPolicy, self).__init__(capacity)
+        self.heap = []
+        self.priorities = {}
+        self.counter = itertools.count()
+
+    def _push(self, image_id, priority):
+        self.priorities[image_id] = priority
+        heapq.heappush(self.heap, (priority, self.counter.next(), image_id))
+
+    def _remove(self, image_id):
+        del self.priorities[image_id]
+
+    def _victim(self):
+        while True:
+            priority, _seq, image_id = heapq.heappop(self.heap)
+            if self.priorities.get(image_id) == priority:
+                del self.priorities[image_id]
+                self._evicted(image_id, priority)
+                return image_id
+
+    def _evicted(self, image_id, priority):
+        pass
+
+
+class LFUPolicy(_HeapPolicy):
+
+    """Evicts the least frequently accessed image first."""
+
+    def __init__(self, capacity):
+        super(LFUPolicy, self).__init__(capacity)
+        self.hits = {}
+
+    def _add(self, image_id, size, hits):
+        self.hits[image_id] = hits
+        self._push(image_id, hits)
+
+    def _access(self, image_id):
+        self.hits[image_id] += 1
+        self._push(image_id, self.hits[image_id])
+
+    def _remove(self, image_id):
+        super(LFUPolicy, self)._remove(image_id)
+        del self.hits[image_id]
+
+    def _evicted(self, image_id, priority):
+        del self.hits[image_id]
+
+
+class GDSFPolicy(_HeapPolicy):
+
+    """
+    GreedyDual-Size-Frequency. An image's priority is the inflation value
+    at its last access plus its access frequency divided by its size, so
+    small, frequently used images are kept in preference to large ones
+    used rarely. The inflation value rises to the priority of each evicted
+    image, which ages out images that are no longer being accessed.
+
+    The saved state holds the inflation value and, for each image held,
+    the inflation value at its last access together with the last_accessed
+    time of its record. An image loaded with the same last_accessed time
+    has not been accessed since, and keeps its old inflation value.
+    """
+
+    def __init__(self, capacity):
+        super(GDSFPolicy, self).__init__(capacity)
+        self.inflation = 0.0
+        self.hits = {}
+        # image_id -> inflation value at the last access of the image
+        self.bases = {}
+        # image_id -> last_accessed time of the loaded records
+        self.accessed = {}
+        # image_id -> [base, last_accessed] restored by set_state()
+        self.saved = {}
+
+    def load(self, entries):
+        for entry in entries:
+            self.accessed[entry['image_id']] = entry['last_accessed']
+        super(GDSFPolicy, self).load(entries)
+
+    def get_state(self):
+        images = dict((image_id, [self.bases[image_id],
+                                  self.accessed.get(image_id)])
+                      for image_id in self.hits)
+        return {'inflation': self.inflation, 'images': images}
+
+    def set_state(self, state):
+        self.inflation = state.get('inflation', 0.0)
+        self.saved = dict(state.get('images', {}))
+
+    def _priority(self, image_id):
+        size = max(self.sizes[image_id], 1)
+        return self.bases[image_id] + float(self.hits[image_id] + 1) / size
+
+    def _add(self, image_id, size, hits):
+        self.hits[image_id] = hits
+        saved = self.saved.pop(image_id, None)
+        if saved is not None and saved[1] == self.accessed.get(image_id):
+            self.bases[image_id] = saved[0]
+        else:
+            self.bases[image_id] = self.inflation
+        self._push(image_id, self._priority(image_id))
+
+    def _access(self, image_id):
+        self.hits[image_id] += 1
+        self.bases[image_id] = self.inflation
+        self._push(image_id, self._priority(image_id))
+
+    def _remove(self, image_id):
+        super(GDSFPolicy, self)._remove(image_id)
+        del self.hits[image_id]
+        del self.bases[image_id]
+
+    def _evicted(self, image_id, priority):
+        del self.hits[image_id]
+        del self.bases[image_id]
+        self.inflation = priority
+
+
+class ARCPolicy(Policy):
+
+    """
+    Adaptive Replacement Cache, measured in bytes rather than entries.
+
+    Images seen once live in T1 and images seen more than once in T2.
+    Evicted images are remembered in the ghost lists B1 and B2, and a
+    later miss on a ghost shifts the target size of T1 towards recency or
+    frequency accordingly. The target size and the ghost lists make up
+    the saved state.
+    """
+
+    def __init__(self, capacity):
+        super(ARCPolicy, self).__init__(capacity)
+        self.target = 0
+        self.lists = dict((name, OrderedDict())
+                          for name in ('t1', 't2', 'b1', 'b2'))
+        self.bytes = dict.fromkeys(self.lists, 0)
+
+    def get_state(self):
+        return {'target': self.target,
+                'b1': self.lists['b1'].items(),
+                'b2': self.lists['b2'].items()}
+
+    def set_state(self, state):
+        self.target = state.get('target', 0)
+        for name in ('b1', 'b2'):
+            for image_id, size in state.get(name, []):
+                self._put(name, image_id, size)
+
+    def forget(self, image_id):
+        for name in ('b1', 'b2'):
+            if image_id in self.lists[name]:
+                self._take(name, image_id)
+
+    def _put(self, name, image_id, size):
+        self.lists[name][image_id] = size
+        self.bytes[name] += size
+
+    def _take(self, name, image_id=None):
+        if image_id is None:
+            image_id, size = self.lists[name].popitem(last=False)
+        else:
+            size = self.lists[name].pop(image_id)
+        self.bytes[name] -= size
+        return image_id, size
+
+    def _add(self, image_id, size, hits):
+        if image_id in self.lists['b1']:
+            ratio = max(1.0, float(self.bytes['b2']) /
+                        max(self.bytes['b1'], 1))
+            self.target = min(self.capacity, self.target + ratio * size)
+            self._take('b1', image_id)
+            self._put('t2', image_id, size)
+        elif image_id in self.lists['b2']:
+            ratio = max(1.0, float(self.bytes['b1']) /
+                        max(self.bytes['b2'], 1))
+            self.target = max(0, self.target - ratio * size)
+            self._take('b2', image_id)
+            self._put('t2', image_id, size)
+        elif hits > 0:
+            # The fill that placed the image in the cache is not counted
+            # as a hit, so any hits mean it has been used more than once
+            self._put('t2', image_id, size)
+        else:
+            self._put('t1', image_id, size)
+
+    def _access(self, image_id):
+        self._remove(image_id)
+        self._put('t2', image_id, self.sizes[image_id])
+
+    def _remove(self, image_id):
+        if image_id in self.lists['t1']:
+            self._take('t1', image_id)
+        else:
+            self._take('t2', image_id)
+
+    def _victim(self):
+        if self.lists['t1'] and (self.bytes['t1'] > self.target or
+                                 not self.lists['t2']):
+            image_id, size = self._take('t1')
+            self._put('b1', image_id, size)
+        else:
+            image_id, size = self._take('t2')
+            self._put('b2', image_id, size)
+
+        while (self.lists['b1'] and
+               self.bytes['t1'] + self.bytes['b1'] > self.capacity):
+            self._take('b1')
+        while (self.lists['b2'] and
+               sum(self.bytes.values()) > 2 * self.capacity):
+            self._take('b2')
+        return image_id
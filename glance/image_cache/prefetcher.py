@@ -19,11 +19,16 @@
 Prefetches images into the Image Cache
 """
 
+import os
+import time
+
 import eventlet
+from oslo.config import cfg
 
 from glance.common import exception
 from glance import context
 from glance.image_cache import base
+from glance.image_cache import partitions
 import glance.openstack.common.log as logging
 import glance.registry.client.v1.api as registry
 import glance.store
@@ -31,6 +36,61 @@ import glance.store
 
 LOG = logging.getLogger(__name__)
 
+prefetcher_opts = [
+    cfg.IntOpt('image_cache_prefetch_workers', default=4,
+               help=_('The number of images the prefetcher fetches into '
+                      'the cache at the same time.')),
+    cfg.IntOpt('image_cache_prefetch_max_rate', default=0,
+               help=_('The combined rate in bytes per second at which the '
+                      'prefetcher reads images from the backend. 0 means '
+                      'no limit.')),
+    cfg.IntOpt('image_cache_prefetch_poll_interval', default=5,
+               help=_('When running as a daemon, the number of seconds '
+                      'the prefetcher waits before looking at an empty '
+                      'queue again.')),
+    cfg.IntOpt('image_cache_prefetch_retry_interval', default=300,
+               help=_('When running as a daemon, the number of seconds '
+                      'before the prefetcher tries again to fetch an image '
+                      'that failed or did not fit in the cache.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(prefetcher_opts)
+CONF.import_opt('image_cache_dir', 'glance.image_cache')
+CONF.import_opt('image_cache_max_size', 'glance.image_cache')
+
+
+class RateLimiter(object):
+
+    """
+    Spaces out reads so that all the green threads sharing the limiter
+    together stay within a rate in bytes per second.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_time = 0
+
+    def consume(self, num_bytes):
+        """
+        Wait until the supplied number of bytes may be read.
+
+        :param num_bytes: Number of bytes about to be read
+        """
+        if self.rate <= 0:
+            return
+        now = time.time()
+        start = max(self.next_time, now)
+        self.next_time = start + float(num_bytes) / self.rate
+        if start > now:
+            eventlet.sleep(start - now)
+
+    def limit(self, data_iter):
+        """Wraps an iterator of chunks so it is read at the limited rate."""
+        for chunk in data_iter:
+            self.consume(len(chunk))
+            yield chunk
+
 
 class Prefetcher(base.CacheApp):
 
@@ -38,6 +98,14 @@ class Prefetcher(base.CacheApp):
         super(Prefetcher, self).__init__()
         registry.configure_registry_client()
         registry.configure_registry_admin_creds()
+        self.limiter = RateLimiter(CONF.image_cache_prefetch_max_rate)
+        # Images a worker has taken from the queue
+        self.claimed = set()
+        # Bytes set aside for images being fetched, by image ID
+        self.reserved = {}
+        # Images not to retry before a given time, when running as a daemon
+        self.deferred = {}
+        self.running = False
 
     def fetch_image_into_cache(self, image_id):
         ctx = context.RequestContext(is_admin=True, show_deleted=True)
@@ -53,18 +121,87 @@ class Prefetcher(base.CacheApp):
             LOG.warn(_("No metadata found for image '%s'"), image_id)
             return False
 
-        location = image_meta['location']
-        image_data, image_size = glance.store.get_from_backend(ctx, location)
-        LOG.debug(_("Caching image '%s'"), image_id)
-        cache_tee_iter = self.cache.cache_tee_iter(image_id, image_data,
-                                                   image_meta['checksum'])
-        # Image is tee'd into cache and checksum verified
-        # as we iterate
-        list(cache_tee_iter)
+        if not self._reserve_space(image_id, image_meta['size'] or 0):
+            return False
+
+        try:
+            location = image_meta['location']
+            image_data, image_size = glance.store.get_from_backend(ctx,
+                                                                   location)
+            LOG.debug(_("Caching image '%s'"), image_id)
+            cache_tee_iter = self.cache.cache_tee_iter(
+                image_id, self.limiter.limit(image_data),
+                image_meta['checksum'], image_meta['size'],
+                partitions.get_partition(image_meta))
+            # Image is tee'd into cache and checksum verified
+            # as we iterate
+            for chunk in cache_tee_iter:
+                pass
+        finally:
+            self.reserved.pop(image_id, None)
         return True
 
-    def run(self):
+    def _reserve_space(self, image_id, size):
+        """
+        Sets space aside for an image about to be fetched, as long as it
+        fits within image_cache_max_size and the free space on the disk
+        of the cache shard the image is placed on, counting the images
+        already being fetched. Returns False if it does not fit.
+
+        :param image_id: Image ID
+        :param size: Size of the image in bytes
+        """
+        in_flight = sum(self.reserved.values())
+        cache_size = self.cache.get_cache_size()
+        if cache_size + in_flight + size > CONF.image_cache_max_size:
+            LOG.warn(_("Not prefetching image '%(image_id)s'. Its %(size)d "
+                       "bytes would take the cache over "
+                       "image_cache_max_size."), locals())
+            return False
 
+        shard = self.cache.driver.get_shard_dir(image_id)
+        in_flight = sum([reserved for other_id, reserved
+                         in self.reserved.iteritems()
+                         if self.cache.driver.get_shard_dir(other_id) ==
+                         shard])
+        stats = os.statvfs(shard)
+        free = stats.f_bavail * stats.f_frsize
+        if in_flight + size > free:
+            LOG.warn(_("Not prefetching image '%(image_id)s'. Its %(size)d "
+                       "bytes do not fit in the %(free)d bytes free in the "
+                       "image cache directory %(shard)s."), locals())
+            return False
+
+        self.reserved[image_id] = size
+        return True
+
+    def _claim_next_image(self, skip=()):
+        """
+        Takes the highest priority queued image that no other worker has
+        taken and that is not in skip, or returns None.
+        """
+        for image_id in self.cache.get_queued_images():
+            if image_id not in self.claimed and image_id not in skip:
+                self.claimed.add(image_id)
+                return image_id
+        return None
+
+    def _fetch(self, image_id):
+        try:
+            return self.fetch_image_into_cache(image_id)
+        except Exception as e:
+            LOG.error(_("Failed to prefetch image '%(image_id)s'. "
+                        "Got error: %(e)s"), locals())
+            return False
+        finally:
+            self.claimed.discard(image_id)
+
+    def run(self):
+        """
+        Fetches the images in the queue, highest priority first, with up
+        to image_cache_prefetch_workers fetches at a time, and returns
+        once every image has been tried.
+        """
         images = self.cache.get_queued_images()
         if not images:
             LOG.debug(_("Nothing to prefetch."))
@@ -73,13 +210,64 @@ class Prefetcher(base.CacheApp):
         num_images = len(images)
         LOG.debug(_("Found %d images to prefetch"), num_images)
 
-        pool = eventlet.GreenPool(num_images)
-        results = pool.imap(self.fetch_image_into_cache, images)
-        successes = sum([1 for r in results if r is True])
-        if successes != num_images:
+        tried = set()
+        results = []
+
+        def worker():
+            while True:
+                image_id = self._claim_next_image(tried)
+                if image_id is None:
+                    return
+                tried.add(image_id)
+                results.append(self._fetch(image_id))
+
+        num_workers = max(min(CONF.image_cache_prefetch_workers,
+                              num_images), 1)
+        pool = eventlet.GreenPool(num_workers)
+        for i in xrange(num_workers):
+            pool.spawn_n(worker)
+        pool.waitall()
+
+        successes = results.count(True)
+        if successes != len(results):
             LOG.error(_("Failed to successfully cache all "
                         "images in queue."))
             return False
 
-        LOG.info(_("Successfully cached all %d images"), num_images)
+        LOG.info(_("Successfully cached all %d images"), successes)
         return True
+
+    def run_daemon(self):
+        """
+        Keeps fetching images as they are queued until stop() is called.
+        Images that fail or do not fit in the cache stay queued and are
+        tried again after image_cache_prefetch_retry_interval seconds.
+        """
+        num_workers = max(CONF.image_cache_prefetch_workers, 1)
+        LOG.info(_("Starting prefetcher daemon with %d workers"),
+                 num_workers)
+        self.running = True
+        pool = eventlet.GreenPool(num_workers)
+        for i in xrange(num_workers):
+            pool.spawn_n(self._daemon_worker)
+        pool.waitall()
+
+    def stop(self):
+        """Makes the daemon workers exit after their current image."""
+        self.running = False
+
+    def _daemon_worker(self):
+        while self.running:
+            now = time.time()
+            for image_id, retry_time in self.deferred.items():
+                if retry_time <= now:
+                    del self.deferred[image_id]
+
+            image_id = self._claim_next_image(self.deferred)
+            if image_id is None:
+                eventlet.sleep(CONF.image_cache_prefetch_poll_interval)
+                continue
+
+            if not self._fetch(image_id):
+                self.deferred[image_id] = (
+                    time.time() + CONF.image_cache_prefetch_retry_interval)
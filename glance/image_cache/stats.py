@@ -0,0 +1,229 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Counters of image cache activity, shared by all the processes using a
+cache directory.
+
+Each process counts events in memory and adds them to a JSON file in the
+cache directory every image_cache_stats_flush_interval seconds, taking an
+exclusive lock on the file while it does. The file therefore holds the
+totals of every API worker, as well as of the pruner, prefetcher and
+other cache tools, since the counters were last reset.
+"""
+
+import collections
+from contextlib import contextmanager
+import errno
+import fcntl
+import json
+import os
+
+import eventlet
+from oslo.config import cfg
+
+from glance.common import utils
+import glance.openstack.common.log as logging
+
+LOG = logging.getLogger(__name__)
+
+stats_opts = [
+    cfg.FloatOpt('image_cache_stats_flush_interval', default=10.0,
+                 help=_('The number of seconds image cache counters are '
+                        'kept in memory before they are added to the '
+                        'counters shared by all processes. Set to 0 to add '
+                        'every event as it happens.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(stats_opts)
+
+STATS_FILE = 'counters.json'
+
+# Seconds to wait before trying again to lock the counters file while
+# another process holds the lock
+LOCK_POLL_INTERVAL = 0.01
+
+
+class CacheStats(object):
+
+    """
+    Counters of one process, flushed to the shared counters file.
+
+    Besides the counters incremented with incr, sources such as the
+    memory tier can be added whose own cumulative counters are polled on
+    every flush, and whose increase since the last flush is added.
+    """
+
+    def __init__(self, stats_dir):
+        utils.safe_mkdirs(stats_dir)
+        self.path = os.path.join(stats_dir, STATS_FILE)
+        self._pending = collections.defaultdict(int)
+        # prefix -> (callable returning counters, last counters seen)
+        self._sources = {}
+        self._flush_timer = None
+        self._pid = os.getpid()
+
+    def add_source(self, prefix, get_counters):
+        """
+        Polls a callable returning a dict of cumulative counters on every
+        flush, counting their increase under names starting with prefix.
+
+        :param prefix: Prefix of the names of the counters
+        :param get_counters: Callable returning a dict of counters
+        """
+        self._sources[prefix] = (get_counters, dict(get_counters()))
+
+    def incr(self, name, value=1):
+        """
+        Adds value to a counter, scheduling a flush of the counters of
+        this process.
+
+        :param name: Name of the counter
+        :param value: Amount to add
+        """
+        self._check_fork()
+        self._pending[name] += value
+
+        interval = CONF.image_cache_stats_flush_interval
+        if interval <= 0:
+            self._flush_in_background()
+        elif self._flush_timer is None:
+            self._flush_timer = eventlet.spawn_after(
+                interval, self._flush_in_background)
+
+    def _check_fork(self):
+        pid = os.getpid()
+        if pid != self._pid:
+            # Counts made before the fork are the parent's to flush
+            self._pid = pid
+            self._pending.clear()
+            self._flush_timer = None
+
+    def _poll_sources(self):
+        for prefix, (get_counters, last) in self._sources.items():
+            current = dict(get_counters())
+            for key, value in current.iteritems():
+                delta = value - last.get(key, 0)
+                if delta > 0:
+                    self._pending[prefix + key] += delta
+            self._sources[prefix] = (get_counters, current)
+
+    def _flush_in_background(self):
+        self._flush_timer = None
+        try:
+            self.flush()
+        except Exception as e:
+            LOG.error(_("Failed to write image cache counters. Got error: "
+                        "%s"), e)
+
+    def flush(self):
+        """
+        Adds the counts of this process to the shared counters. Counts
+        that could not be written are kept for the next flush.
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        self._check_fork()
+        self._poll_sources()
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, collections.defaultdict(int)
+        try:
+            with self._locked_file() as f:
+                totals = self._read(f)
+                for name, value in pending.iteritems():
+                    totals[name] = totals.get(name, 0) + value
+                f.seek(0)
+                f.truncate()
+                json.dump(totals, f)
+        except Exception:
+            for name, value in pending.iteritems():
+                self._pending[name] += value
+            raise
+
+    def get_totals(self):
+        """
+        Returns the counters of all processes, including the counts of
+        this process that have not been flushed yet.
+        """
+        self._check_fork()
+        self._poll_sources()
+        with self._locked_file() as f:
+            totals = self._read(f)
+        for name, value in self._pending.iteritems():
+            totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def reset(self):
+        """Sets every shared counter, and those of this process, to 0."""
+        self._poll_sources()
+        self._pending.clear()
+        with self._locked_file() as f:
+            f.truncate()
+
+    @contextmanager
+    def _locked_file(self):
+        """
+        Opens the shared counters file, holding an exclusive lock on it
+        until the file is closed. The lock is polled for rather than
+        waited on, so that other green threads keep running while another
+        process holds it.
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+') as f:
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        eventlet.sleep(LOCK_POLL_INTERVAL)
+                    elif e.errno != errno.EINTR:
+                        raise
+            # Closing the file releases the lock
+            yield f
+
+    def _read(self, f):
+        data = f.read()
+        if not data:
+            return {}
+        try:
+            return json.loads(data)
+        except ValueError:
+            LOG.warn(_("Resetting unreadable image cache counters file %s"),
+                     self.path)
+            return {}
+
+
+def summarize(counters):
+    """
+    Returns the derived figures for a dict of cache counters: the hit
+    ratio of image requests and the average cache fill throughput in
+    bytes per second. Figures that cannot be computed yet are None.
+    """
+    requests = counters.get('hits', 0) + counters.get('misses', 0)
+    hit_ratio = None
+    if requests:
+        hit_ratio = float(counters.get('hits', 0)) / requests
+    fill_throughput = None
+    if counters.get('fill_seconds'):
+        fill_throughput = (counters.get('fill_bytes', 0) /
+                           counters['fill_seconds'])
+    return {'hit_ratio': hit_ratio, 'fill_throughput': fill_throughput}
@@ -0,0 +1,401 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Queues popular images for prefetching into the Image Cache.
+
+The warmer keeps a popularity score for each image that decays over time.
+Scores are raised by the hits recorded by the local cache driver and by
+the image.send notifications published by the other API nodes. On each
+run the most popular images that fit in the warming budget are put in the
+prefetch queue, so the prefetcher fills the cache before they are asked
+for.
+
+The image.update and image.delete notifications read along the way drop
+the metadata stored next to the cached images, so that changes made
+through other API nodes are seen before image_cache_metadata_ttl runs out.
+"""
+
+import json
+import os
+import socket
+import tempfile
+import time
+
+from oslo.config import cfg
+
+from glance.common import exception
+from glance.common import utils
+from glance import context
+from glance.image_cache import base
+import glance.openstack.common.log as logging
+import glance.registry.client.v1.api as registry
+
+try:
+    import kombu.connection
+    import kombu.entity
+except ImportError:
+    kombu = None
+
+LOG = logging.getLogger(__name__)
+
+warmer_opts = [
+    cfg.IntOpt('image_cache_warm_count', default=20,
+               help=_('The number of most popular images the cache warmer '
+                      'keeps in the image cache.')),
+    cfg.IntOpt('image_cache_warm_max_bytes', default=0,
+               help=_('The combined size in bytes of the popular images '
+                      'the cache warmer keeps in the image cache. 0 means '
+                      'image_cache_max_size.')),
+    cfg.FloatOpt('image_cache_warm_min_score', default=2.0,
+                 help=_('The popularity score an image needs before the '
+                        'cache warmer queues it. Each request adds 1 to the '
+                        'score of an image.')),
+    cfg.FloatOpt('image_cache_warm_half_life', default=24.0,
+                 help=_('The number of hours after which a request counts '
+                        'for half as much towards the popularity of an '
+                        'image.')),
+    cfg.IntOpt('image_cache_warm_priority', default=-1,
+               help=_('The priority the cache warmer queues images with. '
+                      'Images queued by hand have priority 0.')),
+    cfg.BoolOpt('image_cache_warm_from_notifications', default=True,
+                help=_('Whether the cache warmer reads the image.send '
+                       'notifications of other API nodes. Only used when '
+                       'notifier_strategy is rabbit.')),
+    cfg.StrOpt('image_cache_warm_queue', default=None,
+               help=_('The name of the message queue the cache warmer '
+                      'reads image.send notifications from. Defaults to '
+                      'glance_cache_warmer.<hostname>.')),
+    cfg.IntOpt('image_cache_warm_max_notifications', default=10000,
+               help=_('The most notifications the cache warmer reads in '
+                      'one run.')),
+]
+
+CONF = cfg.CONF
+CONF.register_opts(warmer_opts)
+CONF.import_opt('image_cache_dir', 'glance.image_cache')
+CONF.import_opt('image_cache_max_size', 'glance.image_cache')
+CONF.import_opt('notifier_strategy', 'glance.notifier')
+
+# Scores below this are forgotten so the popularity file stays small
+_MIN_KEPT_SCORE = 0.01
+
+
+def get_sent_images(messages, hostname):
+    """
+    Returns the IDs of the images sent by API nodes other than hostname,
+    one per image.send notification. Our own sends are left out as they
+    are already counted by the local cache hits.
+
+    :param messages: Decoded notification messages
+    :param hostname: Publisher ID of this node
+    """
+    image_ids = []
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        if message.get('event_type') != 'image.send':
+            continue
+        if message.get('publisher_id') == hostname:
+            continue
+        payload = message.get('payload') or {}
+        if payload.get('image_id'):
+            image_ids.append(payload['image_id'])
+    return image_ids
+
+
+def get_changed_images(messages):
+    """
+    Returns the IDs of the images updated or deleted according to
+    image.update and image.delete notifications.
+
+    :param messages: Decoded notification messages
+    """
+    image_ids = set()
+    for message in messages:
+        if not isinstance(message, dict):
+            continue
+        if message.get('event_type') not in ('image.update', 'image.delete'):
+            continue
+        payload = message.get('payload') or {}
+        if payload.get('id'):
+            image_ids.add(payload['id'])
+    return image_ids
+
+
+class Popularity(object):
+
+    """
+    Exponentially decaying request counts for images, persisted as JSON.
+
+    Each request adds 1 to the score of an image and scores halve every
+    half_life seconds, so an image requested n times a half-life settles
+    at a score of about 1.44 * n.
+    """
+
+    def __init__(self, path, half_life):
+        self.path = path
+        self.half_life = half_life
+        # image_id -> [score, time the score was last decayed]
+        self.scores = {}
+        # image_id -> hits the local cache reported on the last run
+        self.hits = {}
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except IOError:
+            return
+        except ValueError:
+            LOG.warn(_("Ignoring unreadable popularity file %s"), self.path)
+            return
+        self.scores = data.get('scores', {})
+        self.hits = data.get('hits', {})
+
+    def save(self):
+        """Writes the scores out, replacing the file atomically."""
+        now = time.time()
+        for image_id in self.scores.keys():
+            if self.score(image_id, now) < _MIN_KEPT_SCORE:
+                del self.scores[image_id]
+
+        dirname = os.path.dirname(self.path)
+        fd, tmp_path = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'scores': self.scores, 'hits': self.hits}, f)
+        os.rename(tmp_path, self.path)
+
+    def _decay(self, score, then, now):
+        if self.half_life <= 0 or now <= then:
+            return score
+        return score * 0.5 ** ((now - then) / self.half_life)
+
+    def score(self, image_id, now=None):
+        """
+        Returns the current popularity score of an image.
+
+        :param image_id: Image ID
+        :param now: Time to compute the score at, defaults to now
+        """
+        if now is None:
+            now = time.time()
+        score, then = self.scores.get(image_id, (0.0, now))
+        return self._decay(score, then, now)
+
+    def record(self, image_id, count=1, now=None):
+        """
+        Adds requests to the score of an image.
+
+        :param image_id: Image ID
+        :param count: Number of requests
+        :param now: Time of the requests, defaults to now
+        """
+        if now is None:
+            now = time.time()
+        self.scores[image_id] = [self.score(image_id, now) + count, now]
+
+    def forget(self, image_id):
+        self.scores.pop(image_id, None)
+        self.hits.pop(image_id, None)
+
+    def record_cache_hits(self, cached_images, now=None):
+        """
+        Adds the hits the local cache recorded since the last run.
+
+        :param cached_images: Records as returned by
+                              ImageCache.get_cached_images()
+        :param now: Time of the hits, defaults to now
+        """
+        hits = {}
+        for entry in cached_images:
+            image_id = entry['image_id']
+            hits[image_id] = entry['hits']
+            new_hits = entry['hits'] - self.hits.get(image_id, 0)
+            if new_hits < 0:
+                # Evicted and cached again since the last run
+                new_hits = entry['hits']
+            if new_hits:
+                self.record(image_id, new_hits, now)
+        self.hits = hits
+
+    def ranked(self, min_score=0.0, now=None):
+        """
+        Returns the IDs of the images scoring at least min_score, most
+        popular first.
+        """
+        if now is None:
+            now = time.time()
+        scored = [(self.score(image_id, now), image_id)
+                  for image_id in self.scores]
+        scored = [(-score, image_id) for score, image_id in scored
+                  if score >= min_score]
+        scored.sort()
+        return [image_id for score, image_id in scored]
+
+
+class SendNotificationListener(object):
+
+    """
+    Reads image.send notifications from a queue of our own that is bound
+    to the rabbit notification exchange, so every API node publishing to
+    the exchange is heard without taking messages from other consumers.
+    """
+
+    def __init__(self):
+        if kombu is None:
+            raise ImportError(_("kombu is required to read notifications"))
+        CONF.import_opt('rabbit_notification_topic',
+                        'glance.notifier.notify_kombu')
+        self.hostname = socket.gethostname()
+        self.queue_name = (CONF.image_cache_warm_queue or
+                           'glance_cache_warmer.%s' % self.hostname)
+
+    def _connect(self):
+        return kombu.connection.BrokerConnection(
+            hostname=CONF.rabbit_host,
+            port=CONF.rabbit_port,
+            userid=CONF.rabbit_userid,
+            password=CONF.rabbit_password,
+            virtual_host=CONF.rabbit_virtual_host,
+            ssl=CONF.rabbit_use_ssl)
+
+    def read_messages(self, limit):
+        """
+        Takes up to limit notifications off the queue and returns their
+        decoded bodies.
+        """
+        connection = self._connect()
+        try:
+            channel = connection.channel()
+            exchange = kombu.entity.Exchange(
+                name=CONF.rabbit_notification_exchange,
+                type='topic',
+                durable=CONF.rabbit_durable_queues)
+            queue = kombu.entity.Queue(
+                name=self.queue_name,
+                exchange=exchange,
+                routing_key='%s.info' % CONF.rabbit_notification_topic,
+                durable=True,
+                auto_delete=False,
+                channel=channel)
+            queue.declare()
+
+            messages = []
+            while len(messages) < limit:
+                message = queue.get()
+                if message is None:
+                    break
+                messages.append(message.payload)
+                message.ack()
+            return messages
+        finally:
+            connection.close()
+
+
+class Warmer(base.CacheApp):
+
+    def __init__(self):
+        super(Warmer, self).__init__()
+        registry.configure_registry_client()
+        registry.configure_registry_admin_creds()
+
+        warmer_dir = os.path.join(CONF.image_cache_dir, 'warmer')
+        utils.safe_mkdirs(warmer_dir)
+        self.popularity = Popularity(
+            os.path.join(warmer_dir, 'popularity.json'),
+            CONF.image_cache_warm_half_life * 3600)
+
+        self.listener = None
+        if (CONF.image_cache_warm_from_notifications and
+                CONF.notifier_strategy == 'rabbit'):
+            try:
+                self.listener = SendNotificationListener()
+            except ImportError as e:
+                LOG.warn(_("Not reading image.send notifications: %s"), e)
+
+    def learn(self, now=None):
+        """Updates the popularity scores from the cache and notifications."""
+        self.popularity.record_cache_hits(self.cache.get_cached_images(),
+                                          now)
+        if self.listener is None:
+            return
+
+        try:
+            messages = self.listener.read_messages(
+                CONF.image_cache_warm_max_notifications)
+        except Exception as e:
+            LOG.warn(_("Unable to read image.send notifications. "
+                       "Got error: %s"), e)
+            return
+        for image_id in get_sent_images(messages, self.listener.hostname):
+            self.popularity.record(image_id, now=now)
+        if self.cache.metadata is not None:
+            for image_id in get_changed_images(messages):
+                self.cache.metadata.delete(image_id)
+
+    def queue_popular_images(self, now=None):
+        """
+        Queues the most popular images that fit in the warming budget and
+        are not cached yet. Images already cached count towards the
+        budget. Returns the number of images queued.
+        """
+        budget = CONF.image_cache_warm_max_bytes or CONF.image_cache_max_size
+        ctx = context.RequestContext(is_admin=True, show_deleted=True)
+
+        chosen = 0
+        used = 0
+        queued = 0
+        for image_id in self.popularity.ranked(CONF.image_cache_warm_min_score,
+                                               now):
+            if chosen >= CONF.image_cache_warm_count:
+                break
+
+            cached = self.cache.is_cached(image_id)
+            if cached:
+                size = self.cache.get_image_size(image_id)
+            else:
+                try:
+                    image_meta = registry.get_image_metadata(ctx, image_id)
+                except exception.NotFound:
+                    self.popularity.forget(image_id)
+                    continue
+                if image_meta['status'] != 'active':
+                    continue
+                size = image_meta['size'] or 0
+
+            if used + size > budget:
+                continue
+            used += size
+            chosen += 1
+
+            if cached or self.cache.is_queued(image_id):
+                continue
+            if self.cache.queue_image(image_id,
+                                      CONF.image_cache_warm_priority):
+                queued += 1
+
+        return queued
+
+    def run(self):
+        self.popularity.load()
+        now = time.time()
+        self.learn(now)
+        queued = self.queue_popular_images(now)
+        self.popularity.save()
+        LOG.info(_("Queued %d popular images for prefetching"), queued)
+        return queued
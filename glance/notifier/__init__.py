@@ -177,13 +177,18 @@ class ImageProxy(glance.domain.proxy.Image):
             'receiver_user_id': self.context.user,
         }
 
-    def get_data(self):
+    def get_data(self, offset=0, length=None):
         sent = 0
-        for chunk in self.image.get_data():
+        for chunk in self.image.get_data(offset=offset, length=length):
             yield chunk
             sent += len(chunk)
 
-        if sent != self.image.size:
+        expected = self.image.size
+        if expected is not None:
+            expected = max(expected - offset, 0)
+        if length is not None:
+            expected = length
+        if sent != expected:
             notify = self.notifier.error
         else:
             notify = self.notifier.info
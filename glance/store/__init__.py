@@ -223,14 +223,17 @@ def get_store_from_uri(context, uri, loc=None):
     return store
 
 
-def get_from_backend(context, uri, **kwargs):
-    """Yields chunks of data from backend specified by uri"""
+def get_from_backend(context, uri, offset=0, length=None, **kwargs):
+    """
+    Yields chunks of data from backend specified by uri, optionally only
+    `length` bytes of it starting at `offset`
+    """
 
     loc = location.get_location_from_uri(uri)
     store = get_store_from_uri(context, uri, loc)
 
     try:
-        return store.get(loc)
+        return store.get(loc, offset=offset, length=length)
     except NotImplementedError:
         raise exception.StoreGetNotSupported
 
@@ -331,6 +334,11 @@ def store_add_to_backend(image_id, data, size, store):
              the storage systems metadata dictionary for the location
     """
     (location, size, checksum, metadata) = store.add(image_id, data, size)
+    _check_store_metadata(store, metadata)
+    return (location, size, checksum, metadata)
+
+
+def _check_store_metadata(store, metadata):
     if metadata is not None:
         if type(metadata) != dict:
             msg = (_("The storage driver %s returned invalid metadata %s"
@@ -346,7 +354,48 @@ def store_add_to_backend(image_id, data, size, store):
                      (str(store), str(metadata), str(e)))
             LOG.error(e_msg)
             raise BackendException(e_msg)
-    return (location, size, checksum, metadata)
+
+
+def is_in_store(uri, store):
+    """
+    Returns True if a URI is a location of the same kind of backend as a
+    store, so that the store may be able to copy its data itself.
+
+    :param uri: Location to check
+    :param store: The store the data would be copied to
+    """
+    scheme = uri[0:uri.find('/') - 1]
+    return scheme in store.get_schemes()
+
+
+def store_copy_to_backend(uri, image_id, size, store):
+    """
+    A wrapper around a call to the copy() method of a store, which copies
+    image data the backend of the store holds at a URI within the backend,
+    without reading it through Glance.
+
+    :param uri: The location of the image data to copy
+    :param image_id: The image the data is copied to
+    :param size: The length of the data in bytes, or 0 if not known
+    :param store: The store to which the data is being copied
+    :return: The same as store_add_to_backend, except that the checksum
+             is None if the store does not know it, or None if the store
+             cannot copy the data itself and it must be streamed instead
+    """
+    if not is_in_store(uri, store):
+        return None
+    loc = location.get_location_from_uri(uri)
+    try:
+        (location_uri, size, checksum, metadata) = store.copy(loc, image_id,
+                                                              size)
+    except (NotImplementedError, exception.StoreCopyNotSupported) as e:
+        LOG.debug(_("Store %(store)s cannot copy the data of image "
+                    "%(image_id)s itself: %(e)s") %
+                  {'store': store.__class__.__module__,
+                   'image_id': image_id, 'e': e})
+        return None
+    _check_store_metadata(store, metadata)
+    return (location_uri, size, checksum, metadata)
 
 
 def add_to_backend(context, scheme, image_id, data, size):
@@ -647,14 +696,16 @@ class ImageProxy(glance.domain.proxy.Image):
         self.image.checksum = checksum
         self.image.status = 'active'
 
-    def get_data(self):
+    def get_data(self, offset=0, length=None):
         if not self.image.locations:
             raise exception.NotFound(_("No image data could be found"))
         err = None
         for loc in self.image.locations:
             try:
                 data, size = self.store_api.get_from_backend(self.context,
-                                                             loc['url'])
+                                                             loc['url'],
+                                                             offset=offset,
+                                                             length=length)
 
                 return data
             except Exception as e:
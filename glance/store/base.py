@@ -18,15 +18,96 @@
 
 """Base class for all storage backends"""
 
+import collections
+
+import eventlet
+
 from glance.common import exception
 from glance.common import utils
 from glance.openstack.common import importutils
 import glance.openstack.common.log as logging
 from glance.openstack.common import strutils
+import glance.store
 
 LOG = logging.getLogger(__name__)
 
 
+def get_range_header(offset, length=None):
+    """
+    Returns the value of an HTTP Range header asking for `length` bytes
+    starting at `offset`, or for everything from `offset` onwards if
+    `length` is None.
+    """
+    if length is None:
+        return 'bytes=%d-' % offset
+    return 'bytes=%d-%d' % (offset, offset + length - 1)
+
+
+def get_ranges(get_range, offset, size, range_size, concurrency):
+    """
+    Yields size bytes of an object, starting at offset, in ranges of
+    range_size bytes. Up to concurrency ranges are downloaded at a time,
+    each in its own greenthread, and are yielded in order as each one
+    completes, so that no more than concurrency ranges are buffered
+    however far the downloads get ahead of the reader. The downloads
+    still running are stopped if the reader stops early.
+
+    :param get_range: Function of an offset and a length returning the
+                      data of that range of the object
+    :param offset: Offset of the first byte to yield
+    :param size: Number of bytes to yield
+    :param range_size: Size of the ranges in bytes
+    :param concurrency: Number of ranges to download at a time
+    :raises `glance.store.BackendException` if a range is shorter than
+            asked for
+    """
+    end = offset + size
+    pending = collections.deque()
+    try:
+        while offset < end or pending:
+            while offset < end and len(pending) < concurrency:
+                length = min(range_size, end - offset)
+                pending.append((offset, length,
+                                eventlet.spawn(get_range, offset, length)))
+                offset += length
+            range_offset, length, thread = pending.popleft()
+            data = thread.wait()
+            if len(data) != length:
+                msg = (_("Got %(got)d bytes at offset %(offset)d instead "
+                         "of %(length)d") %
+                       {'got': len(data), 'offset': range_offset,
+                        'length': length})
+                raise glance.store.BackendException(msg)
+            yield data
+    finally:
+        for range_offset, length, thread in pending:
+            thread.kill()
+
+
+def read_parts(image_file, part_size):
+    """
+    Yields the data of an image in parts of part_size bytes, the last of
+    which may be shorter.
+
+    :param image_file: The image data, as a file-like object or iterator
+    :param part_size: Size of the parts in bytes
+    """
+    part = []
+    part_len = 0
+    for chunk in utils.chunkreadable(image_file):
+        while chunk:
+            data = chunk[:part_size - part_len]
+            chunk = chunk[len(data):]
+            part.append(data)
+            part_len += len(data)
+            if part_len == part_size:
+                yield ''.join(part)
+                part = []
+                part_len = 0
+    if part:
+        yield ''.join(part)
+
+
 def _exception_to_unicode(exc):
     try:
         return unicode(exc)
@@ -93,7 +174,7 @@ class Store(object):
         """
         pass
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -101,6 +182,10 @@ class Store(object):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end.
+                       When a range is requested the generator only yields
+                       that range, and its size is returned as image_size
         :raises `glance.exception.NotFound` if image does not exist
         """
         raise NotImplementedError
@@ -141,6 +226,33 @@ class Store(object):
         """
         raise NotImplementedError
 
+    def copy(self, location, image_id, image_size):
+        """
+        Copies image data the backend storage system already holds to a
+        new image with the supplied identifier, within the backend, without
+        reading the data through Glance, and returns a tuple like that of
+        `add`.
+
+        :param location `glance.store.location.Location` object of the
+                        image data to copy, supplied from
+                        glance.store.location.get_location_from_uri()
+        :param image_id: The opaque image identifier of the copy
+        :param image_size: The size of the image data, in bytes, or 0 if
+                           it is not known
+
+        :retval tuple of URL in backing store, bytes copied, checksum
+                or None if the store does not know it without reading
+                the data, and a dictionary with storage system specific
+                information
+        :raises `glance.common.exception.StoreCopyNotSupported` if the
+                store cannot copy the data at this location itself, e.g.
+                because it is in another cluster, in which case nothing
+                was written
+        :raises `glance.exception.NotFound` if the image data does not
+                exist
+        """
+        raise NotImplementedError
+
     def delete(self, location):
         """
         Takes a `glance.store.location.Location` object that indicates
@@ -28,6 +28,7 @@ import urlparse
 from oslo.config import cfg
 
 from glance.common import exception
+from glance.common import fileio
 from glance.common import utils
 import glance.openstack.common.log as logging
 import glance.store
@@ -44,7 +45,10 @@ filesystem_opts = [
                help=_("The path to a file which contains the "
                       "metadata to be returned with any location "
                       "associated with this store.  The file must "
-                      "contain a valid JSON dict."))]
+                      "contain a valid JSON dict.")),
+    cfg.IntOpt('filesystem_store_chunk_size',
+               help=_('The size in bytes of the chunks in which image '
+                      'files are read and written. Defaults to 65536.'))]
 
 CONF = cfg.CONF
 CONF.register_opts(filesystem_opts)
@@ -87,16 +91,25 @@ class ChunkedFile(object):
 
     CHUNKSIZE = 65536
 
-    def __init__(self, filepath):
+    def __init__(self, filepath, offset=0, length=None, chunk_size=None):
         self.filepath = filepath
-        self.fp = open(self.filepath, 'rb')
+        self.fp = fileio.OnePassFile(open(self.filepath, 'rb'))
+        self.length = length
+        self.chunk_size = chunk_size or ChunkedFile.CHUNKSIZE
+        if offset:
+            self.fp.seek(offset)
 
     def __iter__(self):
         """Return an iterator over the image file"""
         try:
             if self.fp:
-                while True:
-                    chunk = self.fp.read(ChunkedFile.CHUNKSIZE)
+                remaining = self.length
+                while remaining is None or remaining > 0:
+                    size = self.chunk_size
+                    if remaining is not None:
+                        size = min(size, remaining)
+                        remaining -= size
+                    chunk = self.fp.read(size)
                     if chunk:
                         yield chunk
                     else:
@@ -185,7 +198,7 @@ class Store(glance.store.base.Store):
                             'returned to the client.') % str(ex))
             return {}
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -193,12 +206,18 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         filepath, filesize = self._resolve_location(location)
         msg = _("Found image at %s. Returning in ChunkedFile.") % filepath
         LOG.debug(msg)
-        return (ChunkedFile(filepath), filesize)
+        size = max(filesize - offset, 0)
+        if length is not None:
+            size = min(size, length)
+        return (ChunkedFile(filepath, offset, length,
+                            CONF.filesystem_store_chunk_size), size)
 
     def get_size(self, location):
         """
@@ -266,10 +285,11 @@ class Store(glance.store.base.Store):
 
         checksum = hashlib.md5()
         bytes_written = 0
+        chunk_size = (CONF.filesystem_store_chunk_size or
+                      ChunkedFile.CHUNKSIZE)
         try:
-            with open(filepath, 'wb') as f:
-                for buf in utils.chunkreadable(image_file,
-                                               ChunkedFile.CHUNKSIZE):
+            with fileio.OnePassFile(open(filepath, 'wb'), image_size) as f:
+                for buf in utils.chunkreadable(image_file, chunk_size):
                     bytes_written += len(buf)
                     checksum.update(buf)
                     f.write(buf)
@@ -291,6 +311,69 @@ class Store(glance.store.base.Store):
                     "checksum %(checksum_hex)s") % locals())
         return ('file://%s' % filepath, bytes_written, checksum_hex, metadata)
 
+    def copy(self, location, image_id, image_size):
+        """
+        Copies an image file of the store to a new image file without
+        reading its data, and returns a tuple containing information
+        about the copy, whose checksum is None.
+
+        The copy is a reflink sharing the data of the source copy-on-write
+        if the filesystem supports it, and a hard link otherwise. Image
+        files are never modified, so the two images may share the file.
+
+        :param location `glance.store.location.Location` object of an
+                        image file in filesystem_store_datadir
+        :param image_id: The opaque image identifier of the copy
+        :param image_size: The size of the image data, in bytes
+
+        :raises `glance.common.exception.StoreCopyNotSupported` if the file
+                is not an image file of the store
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        """
+        src_path, filesize = self._resolve_location(location)
+        if not os.path.samefile(os.path.dirname(src_path), self.datadir):
+            raise exception.StoreCopyNotSupported(
+                _("The file is not an image file of the store."))
+
+        filepath = os.path.join(self.datadir, str(image_id))
+        try:
+            fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+                         0o644)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                raise exception.Duplicate(_("Image file %s already exists!")
+                                          % filepath)
+            raise
+
+        try:
+            with open(src_path, 'rb') as src:
+                cloned = fileio.clone(src.fileno(), fd)
+        except Exception:
+            os.close(fd)
+            self._delete_partial(filepath, image_id)
+            raise
+        os.close(fd)
+
+        if not cloned:
+            os.unlink(filepath)
+            try:
+                os.link(src_path, filepath)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    raise exception.Duplicate(
+                        _("Image file %s already exists!") % filepath)
+                # E.g. EPERM where hard links to the file are not allowed
+                msg = (_("Unable to link %(src_path)s to %(filepath)s: "
+                         "%(e)s") % locals())
+                LOG.debug(msg)
+                raise exception.StoreCopyNotSupported(msg)
+
+        LOG.debug(_("%(method)s %(src_path)s to %(filepath)s") %
+                  {'method': 'Cloned' if cloned else 'Linked',
+                   'src_path': src_path, 'filepath': filepath})
+        return ('file://%s' % filepath, filesize, None, self._get_metadata())
+
     @staticmethod
     def _delete_partial(filepath, id):
         try:
@@ -120,7 +120,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -128,10 +128,28 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         image = self._get_file(location)
-        return (image, image.length)
+        if not offset and length is None:
+            return (image, image.length)
+
+        size = max(image.length - offset, 0)
+        if length is not None:
+            size = min(size, length)
+        image.seek(offset)
+        return (self._read_range(image, size), size)
+
+    @staticmethod
+    def _read_range(image, size):
+        while size > 0:
+            chunk = image.read(min(size, image.chunk_size))
+            if not chunk:
+                break
+            size -= len(chunk)
+            yield chunk
 
     def get_size(self, location):
         """
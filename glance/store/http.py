@@ -19,6 +19,7 @@ import httplib
 import urlparse
 
 from glance.common import exception
+from glance.common import utils
 import glance.openstack.common.log as logging
 import glance.store.base
 import glance.store.location
@@ -112,7 +113,7 @@ class Store(glance.store.base.Store):
 
     """An implementation of the HTTP(S) Backend Adapter"""
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -120,8 +121,24 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         """
-        conn, resp, content_length = self._query(location, 'GET')
+        headers = {}
+        if offset or length is not None:
+            headers['Range'] = glance.store.base.get_range_header(offset,
+                                                                  length)
+        conn, resp, content_length = self._query(location, 'GET', headers)
+
+        if headers and resp.status != httplib.PARTIAL_CONTENT:
+            # The server ignored the Range header, so skip to the range
+            # in the full response ourselves
+            iterator = http_response_iterator(conn, resp, self.CHUNKSIZE)
+            content_length = max(content_length - offset, 0)
+            if length is not None:
+                content_length = min(content_length, length)
+            return (utils.range_iter(iterator, offset, length),
+                    content_length)
 
         iterator = http_response_iterator(conn, resp, self.CHUNKSIZE)
 
@@ -150,13 +167,13 @@ class Store(glance.store.base.Store):
         except Exception:
             return 0
 
-    def _query(self, location, verb, depth=0):
+    def _query(self, location, verb, headers=None, depth=0):
         if depth > MAX_REDIRECTS:
             raise exception.MaxRedirectsExceeded(redirects=MAX_REDIRECTS)
         loc = location.store_location
         conn_class = self._get_conn_class(loc)
         conn = conn_class(loc.netloc)
-        conn.request(verb, loc.path, "", {})
+        conn.request(verb, loc.path, "", headers or {})
         resp = conn.getresponse()
 
         # Check for bad status codes
@@ -176,7 +193,7 @@ class Store(glance.store.base.Store):
                                      uri=location_header,
                                      image_id=location.image_id,
                                      store_specs=location.store_specs)
-            return self._query(new_loc, verb, depth + 1)
+            return self._query(new_loc, verb, headers, depth + 1)
         content_length = int(resp.getheader('content-length', 0))
         return (conn, resp, content_length)
 
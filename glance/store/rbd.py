@@ -20,10 +20,15 @@
 from __future__ import absolute_import
 from __future__ import with_statement
 
+import collections
+import contextlib
 import hashlib
 import math
+import os
+import threading
 import urllib
 
+from eventlet import tpool
 from oslo.config import cfg
 
 from glance.common import exception
@@ -45,6 +50,8 @@ DEFAULT_CONFFILE = ''  # librados will locate the default conf file
 DEFAULT_USER = None    # let librados decide based on the Ceph conf file
 DEFAULT_CHUNKSIZE = 4  # in MiB
 DEFAULT_SNAPNAME = 'snap'
+DEFAULT_IOCTX_POOL_SIZE = 8
+DEFAULT_AIO_QUEUE_DEPTH = 4
 
 LOG = logging.getLogger(__name__)
 
@@ -60,12 +67,220 @@ rbd_opts = [
                       'using cephx.)')),
     cfg.StrOpt('rbd_store_ceph_conf', default=DEFAULT_CONFFILE,
                help=_('Ceph configuration file path.')),
+    cfg.IntOpt('rbd_store_ioctx_pool_size', default=DEFAULT_IOCTX_POOL_SIZE,
+               help=_('The number of idle I/O contexts of the RADOS pool '
+                      'kept open for reuse by later requests.')),
+    cfg.IntOpt('rbd_store_aio_queue_depth', default=DEFAULT_AIO_QUEUE_DEPTH,
+               help=_('The number of chunks of an image read or written '
+                      'asynchronously at a time. With 1, or if librbd does '
+                      'not support asynchronous I/O, one chunk is read or '
+                      'written at a time.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(rbd_opts)
 
 
+class Cluster(object):
+
+    """
+    A connection to a Ceph cluster kept open for the life of a process,
+    with a pool of I/O contexts of its RADOS pools, so that requests do
+    not each go through the monitor handshake, authentication and OSD map
+    fetch of a new connection.
+
+    The connection is made on first use, and again in a forked process,
+    which cannot use the connection of its parent. An I/O context is taken
+    out of the pool for the duration of an operation. If an operation
+    fails with a RADOS error, the connection is dropped, and the next
+    operation connects again; the old connection is shut down once the
+    operations still using it are done. librados is thread safe, and the
+    state of the pool is guarded by a lock that is never held across a
+    call that could switch greenthreads, so the pool may be used both
+    from greenthreads and from native threads such as those of
+    eventlet.tpool.
+    """
+
+    def __init__(self, conf_file, user):
+        self.conf_file = conf_file
+        self.user = user
+        self.lock = threading.Lock()
+        self.pid = None
+        self.conn = None
+        self.fsid = None
+        # Incremented whenever the connection is dropped
+        self.generation = 0
+        # Idle I/O contexts of the current connection, by RADOS pool
+        self.ioctxs = {}
+        # [connection, number of operations using it], by generation
+        self.users = {}
+
+    def _connect(self):
+        conn = rados.Rados(conffile=self.conf_file, rados_id=self.user)
+        conn.connect()
+        return conn
+
+    def _acquire(self):
+        """
+        Returns the connection, connecting first if needed, and its
+        generation, and counts an operation using it.
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                # The connection, if any, belongs to the parent process
+                self.conn = None
+                self.ioctxs = {}
+                self.users = {}
+                self.generation += 1
+            if self.conn is None:
+                self.conn = self._connect()
+                self.pid = os.getpid()
+            generation = self.generation
+            self.users.setdefault(generation, [self.conn, 0])[1] += 1
+            return self.conn, generation
+
+    def _release(self, generation, pool=None, ioctx=None):
+        """
+        Counts an operation as done with a connection, and puts its I/O
+        context, if any, back in the pool.
+        """
+        shutdown = None
+        with self.lock:
+            user = self.users[generation]
+            user[1] -= 1
+            if generation == self.generation:
+                if ioctx is not None:
+                    idle = self.ioctxs.setdefault(pool, [])
+                    if len(idle) < CONF.rbd_store_ioctx_pool_size:
+                        idle.append(ioctx)
+                        ioctx = None
+            elif not user[1]:
+                shutdown = user[0]
+                del self.users[generation]
+        self._close(ioctx, shutdown)
+
+    def _reset(self, generation):
+        """Drops the connection of a generation after an error."""
+        with self.lock:
+            if generation != self.generation:
+                return
+            idle = self.ioctxs
+            self.conn = None
+            self.ioctxs = {}
+            self.generation += 1
+        LOG.warn(_("Dropping the connection to the Ceph cluster after an "
+                   "error"))
+        for ioctxs in idle.values():
+            for ioctx in ioctxs:
+                self._close(ioctx)
+
+    def _close(self, ioctx=None, conn=None):
+        try:
+            if ioctx is not None:
+                ioctx.close()
+            if conn is not None:
+                conn.shutdown()
+        except Exception:
+            LOG.exception(_("Failed to close a connection to the Ceph "
+                            "cluster"))
+
+    @contextlib.contextmanager
+    def open_ioctx(self, pool):
+        """
+        Yields an I/O context of a RADOS pool, and puts it back in the pool
+        afterwards.
+
+        :param pool: Name of the RADOS pool
+        """
+        conn, generation = self._acquire()
+        ioctx = None
+        try:
+            with self.lock:
+                idle = self.ioctxs.get(pool) if (
+                    generation == self.generation) else None
+                if idle:
+                    ioctx = idle.pop()
+            if ioctx is None:
+                ioctx = conn.open_ioctx(pool)
+            yield ioctx
+        except (rados.Error, getattr(rbd, 'IOError', rados.Error)) as e:
+            if not isinstance(e, rados.ObjectNotFound):
+                self._reset(generation)
+            raise
+        finally:
+            self._release(generation, pool, ioctx)
+
+    def get_fsid(self):
+        """Returns the fsid of the cluster, if librados can tell it."""
+        if self.fsid is None:
+            conn, generation = self._acquire()
+            try:
+                if hasattr(conn, 'get_fsid'):
+                    self.fsid = conn.get_fsid()
+            except rados.Error:
+                self._reset(generation)
+                raise
+            finally:
+                self._release(generation)
+        return self.fsid
+
+
+def _execute(func, *args, **kwargs):
+    """
+    Runs a blocking librbd call in a native thread, so that the call does
+    not block the other greenthreads of the process.
+    """
+    return tpool.execute(func, *args, **kwargs)
+
+
+def _wait_for_aio(completion, image_name, offset, length):
+    """
+    Waits for an asynchronous read or write of an image to complete, and
+    returns its return value.
+
+    :raises `glance.store.BackendException` if the I/O failed
+    """
+    _execute(completion.wait_for_complete_and_cb)
+    ret = completion.get_return_value()
+    if ret < 0:
+        msg = (_("I/O of %(length)d bytes at offset %(offset)d of RBD image "
+                 "%(image)s failed with error %(ret)d") %
+               {'length': length, 'offset': offset, 'image': image_name,
+                'ret': ret})
+        LOG.error(msg)
+        raise glance.store.BackendException(msg)
+    return ret
+
+
+def _drain_aio(pending):
+    """
+    Waits for the asynchronous I/O still in flight after an error, since an
+    image must not be closed, nor its buffers freed, before it completes.
+    """
+    while pending:
+        completion = pending.popleft()[0]
+        try:
+            _execute(completion.wait_for_complete_and_cb)
+        except Exception:
+            LOG.exception(_("Failed to wait for asynchronous RBD I/O"))
+
+
+# Clusters by Ceph configuration file and RADOS user
+_clusters = {}
+_clusters_lock = threading.Lock()
+
+
+def get_cluster(conf_file, user):
+    """
+    Returns the `Cluster` of a Ceph configuration file and RADOS user.
+    """
+    with _clusters_lock:
+        key = (conf_file, user)
+        if key not in _clusters:
+            _clusters[key] = Cluster(conf_file, user)
+        return _clusters[key]
+
+
 class StoreLocation(glance.store.location.StoreLocation):
     """
     Class describing a RBD URI. This is of the form:
@@ -133,32 +348,77 @@ class ImageIterator(object):
     Reads data from an RBD image, one chunk at a time.
     """
 
-    def __init__(self, name, store):
+    def __init__(self, name, store, offset=0, length=None):
         self.name = name
         self.pool = store.pool
-        self.user = store.user
-        self.conf_file = store.conf_file
+        self.cluster = store.get_cluster()
         self.chunk_size = store.chunk_size
+        self.queue_depth = CONF.rbd_store_aio_queue_depth
+        self.offset = offset
+        self.length = length
 
     def __iter__(self):
         try:
-            with rados.Rados(conffile=self.conf_file,
-                             rados_id=self.user) as conn:
-                with conn.open_ioctx(self.pool) as ioctx:
-                    with rbd.Image(ioctx, self.name) as image:
-                        img_info = image.stat()
-                        size = img_info['size']
-                        bytes_left = size
-                        while bytes_left > 0:
-                            length = min(self.chunk_size, bytes_left)
-                            data = image.read(size - bytes_left, length)
-                            bytes_left -= len(data)
-                            yield data
-                        raise StopIteration()
+            with self.cluster.open_ioctx(self.pool) as ioctx:
+                with _execute(rbd.Image, ioctx, self.name) as image:
+                    img_info = _execute(image.stat)
+                    size = img_info['size']
+                    if self.length is not None:
+                        size = min(size, self.offset + self.length)
+                    if self.queue_depth > 1 and hasattr(image, 'aio_read'):
+                        chunks = self._read_aio(image, size)
+                    else:
+                        chunks = self._read(image, size)
+                    for chunk in chunks:
+                        yield chunk
+                    raise StopIteration()
         except rbd.ImageNotFound:
             raise exception.NotFound(
                 _('RBD image %s does not exist') % self.name)
 
+    def _read(self, image, size):
+        bytes_left = size - self.offset
+        while bytes_left > 0:
+            length = min(self.chunk_size, bytes_left)
+            data = _execute(image.read, size - bytes_left, length)
+            bytes_left -= len(data)
+            yield data
+
+    def _read_aio(self, image, size):
+        """
+        Reads chunks of the image with up to rbd_store_aio_queue_depth
+        asynchronous reads in flight, and yields them in order.
+        """
+        pending = collections.deque()
+        offset = self.offset
+        try:
+            while pending or offset < size:
+                while len(pending) < self.queue_depth and offset < size:
+                    length = min(self.chunk_size, size - offset)
+                    result = []
+
+                    def oncomplete(completion, data, result=result):
+                        result.append(data)
+
+                    completion = image.aio_read(offset, length, oncomplete)
+                    pending.append((completion, offset, length, result))
+                    offset += length
+                completion, start, length, result = pending[0]
+                _wait_for_aio(completion, self.name, start, length)
+                pending.popleft()
+                data = result[0] if result else ''
+                if len(data) != length:
+                    msg = (_("Expected %(length)d bytes at offset "
+                             "%(offset)d of RBD image %(image)s, got "
+                             "%(got)d") %
+                           {'length': length, 'offset': start,
+                            'image': self.name, 'got': len(data)})
+                    LOG.error(msg)
+                    raise glance.store.BackendException(msg)
+                yield data
+        finally:
+            _drain_aio(pending)
+
 
 class Store(glance.store.base.Store):
     """An implementation of the RBD backend adapter."""
@@ -189,7 +449,11 @@ class Store(glance.store.base.Store):
             raise exception.BadStoreConfiguration(store_name='rbd',
                                                   reason=reason)
 
-    def get(self, location):
+    def get_cluster(self):
+        """Returns the `Cluster` of the configured Ceph cluster."""
+        return get_cluster(self.conf_file, self.user)
+
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -197,10 +461,15 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        return (ImageIterator(loc.image, self), self.get_size(location))
+        size = max(self.get_size(location) - offset, 0)
+        if length is not None:
+            size = min(size, length)
+        return (ImageIterator(loc.image, self, offset, length), size)
 
     def get_size(self, location):
         """
@@ -212,18 +481,16 @@ class Store(glance.store.base.Store):
         :raises `glance.exception.NotFound` if image does not exist
         """
         loc = location.store_location
-        with rados.Rados(conffile=self.conf_file,
-                         rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                try:
-                    with rbd.Image(ioctx, loc.image,
-                                   snapshot=loc.snapshot) as image:
-                        img_info = image.stat()
-                        return img_info['size']
-                except rbd.ImageNotFound:
-                    msg = _('RBD image %s does not exist') % loc.get_uri()
-                    LOG.debug(msg)
-                    raise exception.NotFound(msg)
+        with self.get_cluster().open_ioctx(self.pool) as ioctx:
+            try:
+                with rbd.Image(ioctx, loc.image,
+                               snapshot=loc.snapshot) as image:
+                    img_info = image.stat()
+                    return img_info['size']
+            except rbd.ImageNotFound:
+                msg = _('RBD image %s does not exist') % loc.get_uri()
+                LOG.debug(msg)
+                raise exception.NotFound(msg)
 
     def _create_image(self, fsid, ioctx, image_name, size, order):
         """
@@ -259,28 +526,27 @@ class Store(glance.store.base.Store):
         :raises NotFound if image does not exist;
                 InUseByStore if image is in use or snapshot unprotect failed
         """
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            with conn.open_ioctx(self.pool) as ioctx:
-                if snapshot_name:
-                    with rbd.Image(ioctx, image_name) as image:
-                        try:
-                            image.unprotect_snap(snapshot_name)
-                        except rbd.ImageBusy:
-                            log_msg = _("snapshot %s@%s could not be "
-                                        "unprotected because it is in use")
-                            LOG.debug(log_msg % (image_name, snapshot_name))
-                            raise exception.InUseByStore()
-                        image.remove_snap(snapshot_name)
-                try:
-                    rbd.RBD().remove(ioctx, image_name)
-                except rbd.ImageNotFound:
-                    raise exception.NotFound(
-                        _("RBD image %s does not exist") % image_name)
-                except rbd.ImageBusy:
-                    log_msg = _("image %s could not be removed "
-                                "because it is in use")
-                    LOG.debug(log_msg % image_name)
-                    raise exception.InUseByStore()
+        with self.get_cluster().open_ioctx(self.pool) as ioctx:
+            if snapshot_name:
+                with rbd.Image(ioctx, image_name) as image:
+                    try:
+                        image.unprotect_snap(snapshot_name)
+                    except rbd.ImageBusy:
+                        log_msg = _("snapshot %s@%s could not be "
+                                    "unprotected because it is in use")
+                        LOG.debug(log_msg % (image_name, snapshot_name))
+                        raise exception.InUseByStore()
+                    image.remove_snap(snapshot_name)
+            try:
+                rbd.RBD().remove(ioctx, image_name)
+            except rbd.ImageNotFound:
+                raise exception.NotFound(
+                    _("RBD image %s does not exist") % image_name)
+            except rbd.ImageBusy:
+                log_msg = _("image %s could not be removed "
+                            "because it is in use")
+                LOG.debug(log_msg % image_name)
+                raise exception.InUseByStore()
 
     def add(self, image_id, image_file, image_size):
         """
@@ -299,37 +565,134 @@ class Store(glance.store.base.Store):
         """
         checksum = hashlib.md5()
         image_name = str(image_id)
-        with rados.Rados(conffile=self.conf_file, rados_id=self.user) as conn:
-            fsid = None
-            if hasattr(conn, 'get_fsid'):
-                fsid = conn.get_fsid()
-            with conn.open_ioctx(self.pool) as ioctx:
-                order = int(math.log(self.chunk_size, 2))
-                LOG.debug('creating image %s with order %d', image_name, order)
+        cluster = self.get_cluster()
+        fsid = cluster.get_fsid()
+        with cluster.open_ioctx(self.pool) as ioctx:
+            order = int(math.log(self.chunk_size, 2))
+            LOG.debug('creating image %s with order %d', image_name, order)
+            try:
+                loc = self._create_image(fsid, ioctx, image_name,
+                                         image_size, order)
+            except rbd.ImageExists:
+                raise exception.Duplicate(
+                    _('RBD image %s already exists') % image_id)
+            try:
+                with _execute(rbd.Image, ioctx, image_name) as image:
+                    chunks = utils.chunkreadable(image_file,
+                                                 self.chunk_size)
+                    if (CONF.rbd_store_aio_queue_depth > 1 and
+                            hasattr(image, 'aio_write')):
+                        self._write_aio(image, image_name, chunks, checksum)
+                    else:
+                        offset = 0
+                        for chunk in chunks:
+                            offset += _execute(image.write, chunk, offset)
+                            checksum.update(chunk)
+                    if loc.snapshot:
+                        image.create_snap(loc.snapshot)
+                        image.protect_snap(loc.snapshot)
+            except:
+                # Note(zhiyan): clean up already received data when
+                # error occurs such as ImageSizeLimitExceeded exception.
+                with excutils.save_and_reraise_exception():
+                    self._delete_image(loc.image, loc.snapshot)
+
+        return (loc.get_uri(), image_size, checksum.hexdigest(), {})
+
+    def copy(self, location, image_id, image_size):
+        """
+        Copies an RBD image of the cluster by cloning its protected
+        snapshot, copy-on-write, and returns a tuple containing
+        information about the clone, whose checksum is None.
+
+        The clone depends on the snapshot it was cloned from, so the
+        source image cannot be deleted until the clone has been deleted
+        or flattened.
+
+        :param location `glance.store.location.Location` object of an
+                        image snapshot in the Ceph cluster of the store
+        :param image_id: The opaque image identifier of the clone
+        :param image_size: The size of the image data, in bytes
+
+        :raises `glance.common.exception.StoreCopyNotSupported` if the
+                image is in another cluster or has no snapshot to clone
+        :raises `glance.common.exception.Duplicate` if the image already
+                existed
+        """
+        source = location.store_location
+        cluster = self.get_cluster()
+        fsid = cluster.get_fsid()
+        if (not fsid or source.fsid != fsid or not source.snapshot or
+                not hasattr(rbd, 'RBD_FEATURE_LAYERING')):
+            raise exception.StoreCopyNotSupported(
+                _("The image is not a snapshot in the Ceph cluster of the "
+                  "store."))
+
+        image_name = str(image_id)
+        with cluster.open_ioctx(source.pool) as parent_ioctx:
+            with cluster.open_ioctx(self.pool) as ioctx:
+                LOG.debug('cloning image %s from %s/%s@%s', image_name,
+                          source.pool, source.image, source.snapshot)
                 try:
-                    loc = self._create_image(fsid, ioctx, image_name,
-                                             image_size, order)
+                    _execute(rbd.RBD().clone, parent_ioctx, source.image,
+                             source.snapshot, ioctx, image_name,
+                             features=rbd.RBD_FEATURE_LAYERING)
                 except rbd.ImageExists:
                     raise exception.Duplicate(
                         _('RBD image %s already exists') % image_id)
+                except rbd.ImageNotFound:
+                    raise exception.NotFound(
+                        _('RBD image %s does not exist') % source.get_uri())
+                except rbd.InvalidArgument:
+                    # The snapshot is not protected
+                    raise exception.StoreCopyNotSupported(
+                        _("The snapshot of the image is not protected."))
+                snapshot = None
                 try:
-                    with rbd.Image(ioctx, image_name) as image:
-                        offset = 0
-                        chunks = utils.chunkreadable(image_file,
-                                                     self.chunk_size)
-                        for chunk in chunks:
-                            offset += image.write(chunk, offset)
-                            checksum.update(chunk)
-                        if loc.snapshot:
-                            image.create_snap(loc.snapshot)
-                            image.protect_snap(loc.snapshot)
-                except:
-                    # Note(zhiyan): clean up already received data when
-                    # error occurs such as ImageSizeLimitExceeded exception.
+                    with _execute(rbd.Image, ioctx, image_name) as image:
+                        size = _execute(image.stat)['size']
+                        image.create_snap(DEFAULT_SNAPNAME)
+                        snapshot = DEFAULT_SNAPNAME
+                        image.protect_snap(DEFAULT_SNAPNAME)
+                except Exception:
                     with excutils.save_and_reraise_exception():
-                        self._delete_image(loc.image, loc.snapshot)
+                        self._delete_image(image_name, snapshot)
 
-        return (loc.get_uri(), image_size, checksum.hexdigest(), {})
+        loc = StoreLocation({'fsid': fsid,
+                             'pool': self.pool,
+                             'image': image_name,
+                             'snapshot': DEFAULT_SNAPNAME})
+        return (loc.get_uri(), size, None, {})
+
+    def _write_aio(self, image, image_name, chunks, checksum):
+        """
+        Writes chunks of image data to an RBD image with up to
+        rbd_store_aio_queue_depth asynchronous writes in flight.
+
+        :param image: Open `rbd.Image`
+        :param image_name: Image's name
+        :param chunks: Iterator of the chunks of image data
+        :param checksum: Checksum updated with the data written
+        """
+        queue_depth = CONF.rbd_store_aio_queue_depth
+        pending = collections.deque()
+        offset = 0
+        try:
+            for chunk in chunks:
+                checksum.update(chunk)
+                if len(pending) >= queue_depth:
+                    completion, start, length, data = pending.popleft()
+                    _wait_for_aio(completion, image_name, start, length)
+                completion = image.aio_write(chunk, offset,
+                                             lambda completion: None)
+                # The chunk is kept until the write completes
+                pending.append((completion, offset, len(chunk), chunk))
+                offset += len(chunk)
+            while pending:
+                completion, start, length, data = pending.popleft()
+                _wait_for_aio(completion, image_name, start, length)
+        finally:
+            _drain_aio(pending)
 
     def delete(self, location):
         """
@@ -17,16 +17,20 @@
 
 """Storage backend for S3 or Storage Servers that follow the S3 Protocol"""
 
+import base64
 import hashlib
 import httplib
 import re
+import StringIO
 import tempfile
 import urlparse
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import exception
 from glance.common import utils
+from glance.openstack.common import excutils
 import glance.openstack.common.log as logging
 import glance.store
 import glance.store.base
@@ -34,6 +38,14 @@ import glance.store.location
 
 LOG = logging.getLogger(__name__)
 
+DEFAULT_LARGE_OBJECT_SIZE = 100  # 100M
+DEFAULT_LARGE_OBJECT_CHUNK_SIZE = 10  # 10M
+DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE = 5  # 5M
+DEFAULT_UPLOAD_BUFFER_SIZE = 100  # 100M
+DEFAULT_DOWNLOAD_RANGE_SIZE = 8  # 8M
+DEFAULT_DOWNLOAD_CONCURRENCY = 4
+ONE_MB = 1024 * 1024
+
 s3_opts = [
     cfg.StrOpt('s3_store_host',
                help=_('The host where the S3 server is listening.')),
@@ -53,11 +65,38 @@ s3_opts = [
     cfg.StrOpt('s3_store_bucket_url_format', default='subdomain',
                help=_('The S3 calling format used to determine the bucket. '
                       'Either subdomain or path can be used.')),
+    cfg.IntOpt('s3_store_large_object_size',
+               default=DEFAULT_LARGE_OBJECT_SIZE,
+               help=_('The size, in MB, from which images are streamed to '
+                      'S3 with a multipart upload rather than staged in '
+                      's3_store_object_buffer_dir. Images of unknown size '
+                      'are always streamed.')),
+    cfg.IntOpt('s3_store_large_object_chunk_size',
+               default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE,
+               help=_('The size, in MB, of the parts of a multipart upload. '
+                      'S3 requires at least 5.')),
+    cfg.IntOpt('s3_store_upload_buffer_size',
+               default=DEFAULT_UPLOAD_BUFFER_SIZE,
+               help=_('The memory, in MB, that one multipart upload may use '
+                      'for the parts it is uploading. As many parts are '
+                      'uploaded in parallel as fit in it.')),
+    cfg.IntOpt('s3_store_download_range_size',
+               default=DEFAULT_DOWNLOAD_RANGE_SIZE,
+               help=_('The size, in MB, of the byte ranges in which images '
+                      'larger than it are downloaded from S3.')),
+    cfg.IntOpt('s3_store_download_concurrency',
+               default=DEFAULT_DOWNLOAD_CONCURRENCY,
+               help=_('The number of byte ranges of one image that are '
+                      'downloaded from S3 at a time. Set to 1 to download '
+                      'images in a single stream.')),
 ]
 
 CONF = cfg.CONF
 CONF.register_opts(s3_opts)
 
+# S3 connections by credentials and host, see get_connection
+_connections = {}
+
 
 class StoreLocation(glance.store.location.StoreLocation):
 
@@ -219,6 +258,15 @@ class Store(glance.store.base.Store):
     def get_schemes(self):
         return ('s3', 's3+http', 's3+https')
 
+    def configure(self):
+        """
+        Configure the Store to use the stored configuration options
+        Any store that needs special configuration should implement
+        this method.
+        """
+        self.download_range_size = CONF.s3_store_download_range_size * ONE_MB
+        self.download_concurrency = CONF.s3_store_download_concurrency
+
     def configure_add(self):
         """
         Configure the Store to use the stored configuration options
@@ -248,6 +296,17 @@ class Store(glance.store.base.Store):
 
         self.s3_store_object_buffer_dir = CONF.s3_store_object_buffer_dir
 
+        chunk_size = CONF.s3_store_large_object_chunk_size
+        if chunk_size < DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE:
+            reason = (_("s3_store_large_object_chunk_size must be at least "
+                        "%d MB") % DEFAULT_LARGE_OBJECT_MIN_CHUNK_SIZE)
+            LOG.error(reason)
+            raise exception.BadStoreConfiguration(store_name="s3",
+                                                  reason=reason)
+        self.large_object_size = CONF.s3_store_large_object_size * ONE_MB
+        self.large_object_chunk_size = chunk_size * ONE_MB
+        self.upload_buffer_size = CONF.s3_store_upload_buffer_size * ONE_MB
+
     def _option_get(self, param):
         result = getattr(CONF, param)
         if not result:
@@ -258,7 +317,7 @@ class Store(glance.store.base.Store):
                                                   reason=reason)
         return result
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a tuple of generator
@@ -266,18 +325,47 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
+
+        Images larger than ``s3_store_download_range_size`` are downloaded
+        as several byte ranges at a time.
         """
         key = self._retrieve_key(location)
 
         key.BufferSize = self.CHUNKSIZE
 
+        size = max(key.size - offset, 0)
+        if length is not None:
+            size = min(size, length)
+        if (self.download_concurrency > 1 and
+                0 < self.download_range_size < size):
+            ranges = glance.store.base.get_ranges(
+                lambda offset, length: _get_range(key, offset, length),
+                offset, size, self.download_range_size,
+                self.download_concurrency)
+
+            class RangeIndexable(glance.store.Indexable):
+                def another(self):
+                    try:
+                        return self.wrapped.next()
+                    except StopIteration:
+                        return ''
+
+            return (RangeIndexable(ranges, size), size)
+
+        if offset or length is not None:
+            # Let S3 send only the requested range of the object
+            key.open_read(headers={
+                'Range': glance.store.base.get_range_header(offset, length)})
+
         class ChunkedIndexable(glance.store.Indexable):
             def another(self):
                 return (self.wrapped.fp.read(ChunkedFile.CHUNKSIZE)
                         if self.wrapped.fp else None)
 
-        return (ChunkedIndexable(ChunkedFile(key), key.size), key.size)
+        return (ChunkedIndexable(ChunkedFile(key), size), size)
 
     def get_size(self, location):
         """
@@ -296,12 +384,7 @@ class Store(glance.store.base.Store):
 
     def _retrieve_key(self, location):
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
+        s3_conn = get_connection(loc)
         bucket_obj = get_bucket(s3_conn, loc.bucket)
 
         key = get_key(bucket_obj, loc.key)
@@ -339,9 +422,11 @@ class Store(glance.store.base.Store):
             <S3_HOST> = ``s3_store_host``
             <BUCKET> = ``s3_store_bucket``
             <ID> = The id of the image being added
-        """
-        from boto.s3.connection import S3Connection
 
+        Images smaller than ``s3_store_large_object_size`` are staged in a
+        temporary file, while larger images, and those of unknown size, are
+        streamed with a multipart upload.
+        """
         loc = StoreLocation({'scheme': self.scheme,
                              'bucket': self.bucket,
                              'key': image_id,
@@ -349,10 +434,7 @@ class Store(glance.store.base.Store):
                              'accesskey': self.access_key,
                              'secretkey': self.secret_key})
 
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
+        s3_conn = get_connection(loc)
 
         create_bucket_if_missing(self.bucket, s3_conn)
 
@@ -378,6 +460,23 @@ class Store(glance.store.base.Store):
                                          'obj_name': obj_name})
         LOG.debug(msg)
 
+        if image_size and image_size < self.large_object_size:
+            size, checksum_hex = self._add_singlepart(
+                bucket_obj, obj_name, image_file, _sanitize(loc.get_uri()))
+        else:
+            size, checksum_hex = self._add_multipart(
+                bucket_obj, obj_name, image_file, _sanitize(loc.get_uri()))
+
+        LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
+                    "with checksum %(checksum_hex)s") % locals())
+
+        return (loc.get_uri(), size, checksum_hex, {})
+
+    def _add_singlepart(self, bucket_obj, obj_name, image_file, uri):
+        """
+        Uploads an image to S3 from a temporary file, and returns the
+        number of bytes written and the checksum of the image.
+        """
         key = bucket_obj.new_key(obj_name)
 
         # We need to wrap image_file, which is a reference to the
@@ -393,7 +492,7 @@ class Store(glance.store.base.Store):
         # writing the tempfile, so we don't need to call key.compute_md5()
 
         msg = _("Writing request body file to temporary file "
-                "for %s") % _sanitize(loc.get_uri())
+                "for %s") % uri
         LOG.debug(msg)
 
         tmpdir = self.s3_store_object_buffer_dir
@@ -404,19 +503,80 @@ class Store(glance.store.base.Store):
             temp_file.write(chunk)
         temp_file.flush()
 
-        msg = (_("Uploading temporary file to S3 for %s") %
-               _sanitize(loc.get_uri()))
+        msg = _("Uploading temporary file to S3 for %s") % uri
         LOG.debug(msg)
 
         # OK, now upload the data into the key
         key.set_contents_from_file(open(temp_file.name, 'r+b'), replace=False)
-        size = key.size
-        checksum_hex = checksum.hexdigest()
-
-        LOG.debug(_("Wrote %(size)d bytes to S3 key named %(obj_name)s "
-                    "with checksum %(checksum_hex)s") % locals())
+        return key.size, checksum.hexdigest()
 
-        return (loc.get_uri(), size, checksum_hex, {})
+    def _add_multipart(self, bucket_obj, obj_name, image_file, uri):
+        """
+        Streams an image to S3 with a multipart upload, without staging it
+        on disk, and returns the number of bytes written and the checksum
+        of the image.
+
+        The image is read in parts of large_object_chunk_size bytes, which
+        are uploaded in parallel, as many at a time as fit in
+        upload_buffer_size along with the part being read. The checksum is
+        computed as the parts are read. If any part fails, the multipart
+        upload is aborted so that S3 does not keep the parts already
+        uploaded. An image that fits in a single part is uploaded with a
+        plain PUT instead.
+        """
+        chunk_size = self.large_object_chunk_size
+        parts = glance.store.base.read_parts(image_file, chunk_size)
+        data = next(parts, '')
+        checksum = hashlib.md5(data)
+        if len(data) < chunk_size:
+            key = bucket_obj.new_key(obj_name)
+            key.set_contents_from_file(StringIO.StringIO(data),
+                                       replace=False, md5=_get_md5(data))
+            return len(data), checksum.hexdigest()
+
+        concurrency = max(self.upload_buffer_size // chunk_size - 1, 1)
+        LOG.debug(_("Streaming %(uri)s to S3 in parts of %(chunk_size)d "
+                    "bytes, %(concurrency)d at a time"), locals())
+        mpu = bucket_obj.initiate_multipart_upload(obj_name)
+        pool = eventlet.GreenPool(concurrency)
+        errors = []
+
+        def upload_part(part_num, data):
+            try:
+                mpu.upload_part_from_file(StringIO.StringIO(data), part_num,
+                                          md5=_get_md5(data), size=len(data))
+            except Exception as e:
+                errors.append(e)
+                LOG.error(_("Failed to upload part %(part_num)d of "
+                            "%(uri)s: %(e)s"),
+                          {'part_num': part_num, 'uri': uri, 'e': e})
+
+        size = 0
+        part_num = 0
+        try:
+            while data and not errors:
+                part_num += 1
+                size += len(data)
+                # Blocks until one of the parts being uploaded is done
+                pool.spawn_n(upload_part, part_num, data)
+                data = next(parts, '')
+                checksum.update(data)
+            pool.waitall()
+            if errors:
+                msg = (_("Failed to upload %(uri)s to S3: %(error)s") %
+                       {'uri': uri, 'error': errors[0]})
+                raise glance.store.BackendException(msg)
+            mpu.complete_upload()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                LOG.error(_("Aborting multipart upload of %s"), uri)
+                pool.waitall()
+                try:
+                    mpu.cancel_upload()
+                except Exception as e:
+                    LOG.error(_("Failed to abort multipart upload of "
+                                "%(uri)s: %(e)s"), locals())
+        return size, checksum.hexdigest()
 
     def delete(self, location):
         """
@@ -429,11 +589,7 @@ class Store(glance.store.base.Store):
         :raises NotFound if image does not exist
         """
         loc = location.store_location
-        from boto.s3.connection import S3Connection
-        s3_conn = S3Connection(loc.accesskey, loc.secretkey,
-                               host=loc.s3serviceurl,
-                               is_secure=(loc.scheme == 's3+https'),
-                               calling_format=get_calling_format())
+        s3_conn = get_connection(loc)
         bucket_obj = get_bucket(s3_conn, loc.bucket)
 
         # Close the key when we're through.
@@ -450,6 +606,53 @@ class Store(glance.store.base.Store):
         return key.delete()
 
 
+def _get_range(key, offset, length):
+    """
+    Returns length bytes of an S3 object starting at offset.
+
+    A new key is used for each range, as a key reads one response at a
+    time.
+    """
+    range_key = key.bucket.new_key(key.name)
+    headers = {'Range': glance.store.base.get_range_header(offset, length)}
+    return range_key.get_contents_as_string(headers=headers)
+
+
+def _get_md5(data):
+    """
+    Returns the MD5 of data in the (hex digest, base64 digest) form boto
+    takes, so that it is not computed again.
+    """
+    md5 = hashlib.md5(data)
+    return md5.hexdigest(), base64.b64encode(md5.digest())
+
+
+def get_connection(loc):
+    """
+    Returns a ``boto.s3.connection.S3Connection`` for the credentials and
+    host of a location.
+
+    Connections are kept for the life of the process and shared by all
+    requests, so that the HTTP connections boto keeps open in them are
+    reused rather than a new one being set up for every request.
+
+    :param loc: `glance.store.s3.StoreLocation` object
+    """
+    from boto.s3.connection import S3Connection
+
+    is_secure = loc.scheme == 's3+https'
+    conn_key = (loc.accesskey, loc.secretkey, loc.s3serviceurl, is_secure,
+                CONF.s3_store_bucket_url_format)
+    conn = _connections.get(conn_key)
+    if conn is None:
+        conn = S3Connection(loc.accesskey, loc.secretkey,
+                            host=loc.s3serviceurl,
+                            is_secure=is_secure,
+                            calling_format=get_calling_format())
+        _connections[conn_key] = conn
+    return conn
+
+
 def get_bucket(conn, bucket_id):
     """
     Get a bucket from an s3 connection
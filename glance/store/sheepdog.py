@@ -160,12 +160,17 @@ class ImageIterator(object):
     Reads data from an Sheepdog image, one chunk at a time.
     """
 
-    def __init__(self, image):
+    def __init__(self, image, offset=0, length=None):
         self.image = image
+        self.offset = offset
+        self.length = length
 
     def __iter__(self):
         image = self.image
-        total = left = image.get_size()
+        total = image.get_size()
+        if self.length is not None:
+            total = min(total, self.offset + self.length)
+        left = total - self.offset
         while left > 0:
             length = min(image.chunk_size, left)
             data = image.read(total - left, length)
@@ -208,7 +213,7 @@ class Store(glance.store.base.Store):
             raise exception.BadStoreConfiguration(store_name='sheepdog',
                                                   reason=reason)
 
-    def get(self, location):
+    def get(self, location, offset=0, length=None):
         """
         Takes a `glance.store.location.Location` object that indicates
         where to find the image file, and returns a generator for reading
@@ -216,6 +221,8 @@ class Store(glance.store.base.Store):
 
         :param location `glance.store.location.Location` object, supplied
                         from glance.store.location.get_location_from_uri()
+        :param offset: Offset of the first byte to read
+        :param length: Number of bytes to read, or None to read to the end
         :raises `glance.exception.NotFound` if image does not exist
         """
 
@@ -225,7 +232,10 @@ class Store(glance.store.base.Store):
         if not image.exist():
             raise exception.NotFound(_("Sheepdog image %s does not exist")
                                      % image.name)
-        return (ImageIterator(image), image.get_size())
+        size = max(image.get_size() - offset, 0)
+        if length is not None:
+            size = min(size, length)
+        return (ImageIterator(image, offset, length), size)
 
     def get_size(self, location):
         """
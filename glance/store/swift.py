@@ -21,15 +21,19 @@ from __future__ import absolute_import
 
 import hashlib
 import httplib
+import json
 import math
 import urllib
 import urlparse
 
+import eventlet
 from oslo.config import cfg
 
 from glance.common import auth
 from glance.common import exception
+from glance.openstack.common import excutils
 import glance.openstack.common.log as logging
+from glance.openstack.common import strutils
 import glance.store
 import glance.store.base
 import glance.store.location
@@ -91,6 +95,22 @@ swift_opts = [
                default=DEFAULT_LARGE_OBJECT_CHUNK_SIZE,
                help=_('The amount of data written to a temporary disk buffer '
                       'during the process of chunking the image file.')),
+    cfg.IntOpt('swift_store_large_object_buffer_size', default=0,
+               help=_('The memory, in MB, that one upload or download of a '
+                      'large object may use to transfer several segments '
+                      'at a time. As many segments are transferred in '
+                      'parallel as fit in it, counting the one being read '
+                      'from or sent to the client. With room for fewer than '
+                      'two segments, segments are transferred one after '
+                      'another.')),
+    cfg.BoolOpt('swift_store_use_slo', default=False,
+                help=_('Whether to write large objects with a Static Large '
+                       'Object manifest listing their segments, rather than '
+                       'a Dynamic Large Object manifest.')),
+    cfg.IntOpt('swift_store_max_idle_connections', default=10,
+               help=_('The number of idle connections to a Swift account '
+                      'kept open for reuse by later requests. Set to 0 to '
+                      'close connections after each request.')),
     cfg.BoolOpt('swift_store_create_container_on_put', default=False,
                 help=_('A boolean value that determines if we create the '
                        'container if it does not exist.')),
@@ -113,6 +133,60 @@ CONF = cfg.CONF
 CONF.register_opts(swift_opts)
 
 
+class ConnectionPool(object):
+
+    """
+    Idle connections to Swift accounts, and the latest auth token of each
+    account, shared by all the requests of a process.
+
+    Connections are kept by the credentials and endpoint they were made
+    for. A swiftclient connection makes one request at a time over a
+    persistent HTTP connection, so a connection is taken out of the pool
+    for a request and only put back once the response has been read.
+    Connections taken out get the latest token of their account, so that
+    only the first request of the process authenticates. When the token
+    expires, Swift answers 401 and swiftclient authenticates again with
+    the credentials of the connection and retries the request, and the
+    new token is kept when the connection is put back.
+    """
+
+    def __init__(self):
+        self.idle = {}
+        self.tokens = {}
+
+    def get(self, key, create):
+        """
+        Returns an idle connection, or a new one.
+
+        :param key: Credentials and endpoint of the connection
+        :param create: Function returning a new connection
+        """
+        idle = self.idle.get(key)
+        connection = idle.pop() if idle else create()
+        if key in self.tokens:
+            connection.url, connection.token = self.tokens[key]
+        return connection
+
+    def put(self, key, connection):
+        """
+        Puts back a connection whose response has been read.
+
+        :param key: Credentials and endpoint of the connection
+        :param connection: The connection
+        """
+        if connection.token:
+            self.tokens[key] = (connection.url, connection.token)
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < CONF.swift_store_max_idle_connections:
+            idle.append(connection)
+
+
+_connection_pool = ConnectionPool()
+
+# (connection pool key, container) of the containers known to exist
+_known_containers = set()
+
+
 class StoreLocation(glance.store.location.StoreLocation):
 
     """
@@ -266,6 +340,9 @@ class BaseStore(glance.store.base.Store):
         self.large_object_size = _obj_size * ONE_MB
         _chunk_size = self._option_get('swift_store_large_object_chunk_size')
         self.large_object_chunk_size = _chunk_size * ONE_MB
+        _buffer_size = CONF.swift_store_large_object_buffer_size
+        self.large_object_buffer_size = _buffer_size * ONE_MB
+        self.use_slo = CONF.swift_store_use_slo
         self.admin_tenants = CONF.swift_store_admin_tenants
         self.region = CONF.swift_store_region
         self.service_type = CONF.swift_store_service_type
@@ -274,15 +351,97 @@ class BaseStore(glance.store.base.Store):
         self.insecure = CONF.swift_store_auth_insecure
         self.ssl_compression = CONF.swift_store_ssl_compression
 
-    def get(self, location, connection=None):
+    def _get_concurrency(self):
+        """
+        Returns the number of segments of a large object to transfer at a
+        time, besides the one being read from or sent to the client, or 0
+        to transfer segments one after another.
+        """
+        return max(self.large_object_buffer_size //
+                   self.large_object_chunk_size - 1, 0)
+
+    def _get_pool_key(self, location):
+        """
+        Returns the key of the connections to the account of a location
+        in the connection pool, or None if they are not pooled.
+        """
+        return None
+
+    def _get_pooled_connection(self, location):
+        """
+        Returns a connection to the account of a location, reusing an idle
+        connection of the process if there is one.
+        """
+        key = self._get_pool_key(location)
+        if key is None:
+            return self.get_connection(location)
+        return _connection_pool.get(key,
+                                    lambda: self.get_connection(location))
+
+    def _release_connection(self, location, connection):
+        """
+        Puts a connection from _get_pooled_connection back in the pool once
+        the response of its last request has been read. Connections whose
+        request failed are not put back.
+        """
+        key = self._get_pool_key(location)
+        if key is not None:
+            _connection_pool.put(key, connection)
+
+    def _release_after(self, location, connection, resp_body):
+        """
+        Yields the chunks of a response body, and releases the connection
+        it is read from once it has been read to the end.
+        """
+        for chunk in resp_body:
+            yield chunk
+        self._release_connection(location, connection)
+
+    def get(self, location, connection=None, offset=0, length=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._get_pooled_connection(location)
+
+        class ResponseIndexable(glance.store.Indexable):
+            def another(self):
+                try:
+                    return self.wrapped.next()
+                except StopIteration:
+                    return ''
+
+        concurrency = self._get_concurrency()
+        if concurrency:
+            # Download large objects as ranges of the size of a segment,
+            # several at a time
+            try:
+                resp_headers = connection.head_object(
+                        container=location.container, obj=location.obj)
+            except swiftclient.ClientException as e:
+                if e.http_status == httplib.NOT_FOUND:
+                    msg = _("Swift could not find image at URI.")
+                    raise exception.NotFound(msg)
+                else:
+                    raise
+            size = int(resp_headers.get('content-length', 0)) - offset
+            size = max(size, 0)
+            if length is not None:
+                size = min(size, length)
+            if size > self.large_object_chunk_size:
+                ranges = self._get_ranges(location, connection, offset, size,
+                                          concurrency, pooled)
+                return (ResponseIndexable(ranges, size), size)
+
+        kwargs = {}
+        if offset or length is not None:
+            # Let swift send only the requested range of the object
+            kwargs['headers'] = {
+                'Range': glance.store.base.get_range_header(offset, length)}
 
         try:
             resp_headers, resp_body = connection.get_object(
                     container=location.container, obj=location.obj,
-                    resp_chunk_size=self.CHUNKSIZE)
+                    resp_chunk_size=self.CHUNKSIZE, **kwargs)
         except swiftclient.ClientException as e:
             if e.http_status == httplib.NOT_FOUND:
                 msg = _("Swift could not find image at URI.")
@@ -290,26 +449,72 @@ class BaseStore(glance.store.base.Store):
             else:
                 raise
 
-        class ResponseIndexable(glance.store.Indexable):
-            def another(self):
-                try:
-                    return self.wrapped.next()
-                except StopIteration:
-                    return ''
-
+        if pooled:
+            resp_body = self._release_after(location, connection, resp_body)
         length = int(resp_headers.get('content-length', 0))
         return (ResponseIndexable(resp_body, length), length)
 
     def get_size(self, location, connection=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._get_pooled_connection(location)
         try:
             resp_headers = connection.head_object(
                     container=location.container, obj=location.obj)
-            return int(resp_headers.get('content-length', 0))
+            size = int(resp_headers.get('content-length', 0))
         except Exception:
             return 0
+        if pooled:
+            self._release_connection(location, connection)
+        return size
+
+    def _get_ranges(self, location, connection, offset, size, concurrency,
+                    pooled=False):
+        """
+        Yields size bytes of an object starting at offset, downloaded as
+        ranges of large_object_chunk_size bytes, concurrency of them at a
+        time, each on a connection of its own. The connections are put in
+        the connection pool once all the ranges have been read, including
+        the supplied one if pooled is True.
+        """
+        connections = [connection]
+
+        def get_range(offset, length):
+            if connections:
+                conn = connections.pop()
+            else:
+                conn = self._get_worker_connection(location, connection)
+            try:
+                headers = {'Range': glance.store.base.get_range_header(
+                    offset, length)}
+                resp_headers, data = conn.get_object(
+                    container=location.container, obj=location.obj,
+                    headers=headers)
+                return data
+            finally:
+                connections.append(conn)
+
+        for data in glance.store.base.get_ranges(
+                get_range, offset, size, self.large_object_chunk_size,
+                concurrency):
+            yield data
+        for conn in connections:
+            if pooled or conn is not connection:
+                self._release_connection(location, conn)
+
+    def _get_worker_connection(self, location, connection):
+        """
+        Returns a connection to the account of a location for one of the
+        concurrent requests of a transfer. Unless it already has one, it
+        uses the token of the supplied connection, so that it does not
+        authenticate again.
+        """
+        worker = self._get_pooled_connection(location)
+        if not worker.token:
+            worker.url = connection.url
+            worker.token = connection.token
+        return worker
 
     def _option_get(self, param):
         result = getattr(CONF, param)
@@ -332,10 +537,15 @@ class BaseStore(glance.store.base.Store):
 
     def add(self, image_id, image_file, image_size, connection=None):
         location = self.create_location(image_id)
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._get_pooled_connection(location)
 
-        self._create_container_if_missing(location.container, connection)
+        container_key = (self._get_pool_key(location), location.container)
+        if container_key not in _known_containers:
+            self._create_container_if_missing(location.container, connection)
+            if container_key[0] is not None:
+                _known_containers.add(container_key)
 
         LOG.debug(_("Adding image object '%(obj_name)s' "
                     "to Swift") % dict(obj_name=location.obj))
@@ -348,7 +558,6 @@ class BaseStore(glance.store.base.Store):
                                                  content_length=image_size)
             else:
                 # Write the image into Swift in chunks.
-                chunk_id = 1
                 if image_size > 0:
                     total_chunks = str(int(
                         math.ceil(float(image_size) /
@@ -362,72 +571,39 @@ class BaseStore(glance.store.base.Store):
                     total_chunks = '?'
 
                 checksum = hashlib.md5()
-                written_chunks = []
-                combined_chunks_size = 0
-                while True:
-                    chunk_size = self.large_object_chunk_size
-                    if image_size == 0:
-                        content_length = None
+                # (name, etag, size) of each segment written
+                segments = []
+                try:
+                    if self._get_concurrency():
+                        self._put_segments_parallel(location, image_file,
+                                                    checksum, segments,
+                                                    connection)
                     else:
-                        left = image_size - combined_chunks_size
-                        if left == 0:
-                            break
-                        if chunk_size > left:
-                            chunk_size = left
-                        content_length = chunk_size
-
-                    chunk_name = "%s-%05d" % (location.obj, chunk_id)
-                    reader = ChunkReader(image_file, checksum, chunk_size)
-                    try:
-                        chunk_etag = connection.put_object(
-                            location.container, chunk_name, reader,
-                            content_length=content_length)
-                        written_chunks.append(chunk_name)
-                    except Exception:
+                        self._put_segments(location, image_file, image_size,
+                                           total_chunks, checksum, segments,
+                                           connection)
+
+                    # In the case we have been given an unknown image size,
+                    # set the size to the total size of the combined chunks.
+                    if image_size == 0:
+                        image_size = sum(size for name, etag, size
+                                         in segments)
+
+                    self._put_manifest(location, segments, connection)
+                except Exception:
+                    with excutils.save_and_reraise_exception():
                         # Delete orphaned segments from swift backend
                         LOG.exception(_("Error during chunked upload to "
                                         "backend, deleting stale chunks"))
-                        self._delete_stale_chunks(connection,
-                                                  location.container,
-                                                  written_chunks)
-                        raise
-
-                    bytes_read = reader.bytes_read
-                    msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
-                            "%(total_chunks)s) of length %(bytes_read)d "
-                            "to Swift returning MD5 of content: "
-                            "%(chunk_etag)s")
-                    LOG.debug(msg % locals())
-
-                    if bytes_read == 0:
-                        # Delete the last chunk, because it's of zero size.
-                        # This will happen if size == 0.
-                        LOG.debug(_("Deleting final zero-length chunk"))
-                        connection.delete_object(location.container,
-                                                 chunk_name)
-                        break
-
-                    chunk_id += 1
-                    combined_chunks_size += bytes_read
-
-                # In the case we have been given an unknown image size,
-                # set the size to the total size of the combined chunks.
-                if image_size == 0:
-                    image_size = combined_chunks_size
-
-                # Now we write the object manifest and return the
-                # manifest's etag...
-                manifest = "%s/%s-" % (location.container, location.obj)
-                headers = {'ETag': hashlib.md5("").hexdigest(),
-                           'X-Object-Manifest': manifest}
+                        self._delete_stale_chunks(
+                            connection, location.container,
+                            [name for name, etag, size in segments])
 
                 # The ETag returned for the manifest is actually the
                 # MD5 hash of the concatenated checksums of the strings
                 # of each chunk...so we ignore this result in favour of
                 # the MD5 of the entire image file contents, so that
                 # users can verify the image file contents accordingly
-                connection.put_object(location.container, location.obj,
-                                      None, headers=headers)
                 obj_etag = checksum.hexdigest()
 
             # NOTE: We return the user and key here! Have to because
@@ -436,8 +612,13 @@ class BaseStore(glance.store.base.Store):
             # the location attribute from GET /images/<ID> and
             # GET /images/details
 
+            if pooled:
+                self._release_connection(location, connection)
             return (location.get_uri(), image_size, obj_etag, {})
         except swiftclient.ClientException as e:
+            if e.http_status == httplib.NOT_FOUND:
+                # The container may have been deleted
+                _known_containers.discard(container_key)
             if e.http_status == httplib.CONFLICT:
                 raise exception.Duplicate(_("Swift already has an image at "
                                             "this location"))
@@ -446,10 +627,224 @@ class BaseStore(glance.store.base.Store):
             LOG.error(msg)
             raise glance.store.BackendException(msg)
 
+    def copy(self, location, image_id, image_size, connection=None):
+        """
+        Copies an object of the account of the store to a new image object
+        with a server-side COPY, and returns a tuple containing
+        information about the copy.
+
+        Large objects are not copied, since Swift would either copy their
+        manifest, sharing the segments with the source, or concatenate the
+        segments into an object that may exceed its maximum object size.
+
+        :raises `glance.common.exception.StoreCopyNotSupported` if the
+                object is in another account or is a large object
+        """
+        source = location.store_location
+        location = self.create_location(image_id)
+        if (source.swift_url.rstrip('/') !=
+                location.swift_url.rstrip('/') or
+                source.user != location.user or
+                source.key != location.key):
+            raise exception.StoreCopyNotSupported(
+                _("The object is in another Swift account."))
+
+        pooled = not connection
+        if pooled:
+            connection = self._get_pooled_connection(location)
+        try:
+            headers = connection.head_object(source.container, source.obj)
+        except swiftclient.ClientException as e:
+            if e.http_status == httplib.NOT_FOUND:
+                msg = _("Swift could not find image at URI.")
+                raise exception.NotFound(msg)
+            raise
+        size = int(headers.get('content-length', 0))
+        if (headers.get('x-object-manifest') or
+                strutils.bool_from_string(
+                    headers.get('x-static-large-object')) or
+                size >= self.large_object_size):
+            if pooled:
+                self._release_connection(location, connection)
+            raise exception.StoreCopyNotSupported(
+                _("The object is a large object."))
+
+        container_key = (self._get_pool_key(location), location.container)
+        if container_key not in _known_containers:
+            self._create_container_if_missing(location.container, connection)
+            if container_key[0] is not None:
+                _known_containers.add(container_key)
+
+        LOG.debug(_("Copying object '%(src)s' to image object '%(obj)s' in "
+                    "Swift") % {'src': source.obj, 'obj': location.obj})
+        copy_from = '/%s/%s' % (urllib.quote(source.container),
+                                urllib.quote(source.obj))
+        try:
+            obj_etag = connection.put_object(
+                location.container, location.obj, None,
+                headers={'X-Copy-From': copy_from})
+        except swiftclient.ClientException as e:
+            if e.http_status == httplib.NOT_FOUND:
+                _known_containers.discard(container_key)
+            if e.http_status == httplib.CONFLICT:
+                raise exception.Duplicate(_("Swift already has an image at "
+                                            "this location"))
+            msg = (_("Failed to copy object in Swift.\n"
+                     "Got error from Swift: %(e)s") % locals())
+            LOG.error(msg)
+            raise glance.store.BackendException(msg)
+
+        if pooled:
+            self._release_connection(location, connection)
+        return (location.get_uri(), size, obj_etag, {})
+
+    def _put_segments(self, location, image_file, image_size, total_chunks,
+                      checksum, segments, connection):
+        """
+        Writes an image to Swift as segments of large_object_chunk_size
+        bytes, one after another, streaming each segment from the client.
+
+        :param checksum: MD5 updated with the data of the image
+        :param segments: List the (name, etag, size) of each segment
+                         written is appended to
+        """
+        chunk_id = 1
+        combined_chunks_size = 0
+        while True:
+            chunk_size = self.large_object_chunk_size
+            if image_size == 0:
+                content_length = None
+            else:
+                left = image_size - combined_chunks_size
+                if left == 0:
+                    break
+                if chunk_size > left:
+                    chunk_size = left
+                content_length = chunk_size
+
+            chunk_name = "%s-%05d" % (location.obj, chunk_id)
+            reader = ChunkReader(image_file, checksum, chunk_size)
+            chunk_etag = connection.put_object(
+                location.container, chunk_name, reader,
+                content_length=content_length)
+
+            bytes_read = reader.bytes_read
+            msg = _("Wrote chunk %(chunk_name)s (%(chunk_id)d/"
+                    "%(total_chunks)s) of length %(bytes_read)d "
+                    "to Swift returning MD5 of content: "
+                    "%(chunk_etag)s")
+            LOG.debug(msg % locals())
+
+            if bytes_read == 0:
+                # Delete the last chunk, because it's of zero size.
+                # This will happen if size == 0.
+                LOG.debug(_("Deleting final zero-length chunk"))
+                connection.delete_object(location.container,
+                                         chunk_name)
+                break
+
+            segments.append((chunk_name, chunk_etag, bytes_read))
+            chunk_id += 1
+            combined_chunks_size += bytes_read
+
+    def _put_segments_parallel(self, location, image_file, checksum,
+                               segments, connection):
+        """
+        Writes an image to Swift as segments of large_object_chunk_size
+        bytes. Each segment is read into memory and written by a
+        greenthread of its own with a connection of its own, so that
+        several segments are written at a time while the next one is
+        read from the client.
+
+        :param checksum: MD5 updated with the data of the image
+        :param segments: List the (name, etag, size) of each segment
+                         written is appended to, in order once all of
+                         them are written
+        """
+        concurrency = self._get_concurrency()
+        pool = eventlet.GreenPool(concurrency)
+        connections = [connection]
+        errors = []
+
+        def put_segment(chunk_name, data):
+            if connections:
+                conn = connections.pop()
+            else:
+                conn = self._get_worker_connection(location, connection)
+            try:
+                chunk_etag = conn.put_object(location.container, chunk_name,
+                                             data, content_length=len(data))
+                segments.append((chunk_name, chunk_etag, len(data)))
+                LOG.debug(_("Wrote chunk %(chunk_name)s of length "
+                            "%(length)d to Swift returning MD5 of content: "
+                            "%(chunk_etag)s") %
+                          {'chunk_name': chunk_name, 'length': len(data),
+                           'chunk_etag': chunk_etag})
+            except Exception as e:
+                LOG.error(_("Failed to write chunk %(chunk_name)s to "
+                            "Swift: %(e)s") % locals())
+                errors.append(e)
+            finally:
+                connections.append(conn)
+
+        LOG.debug(_("Writing chunks of %(obj)s to Swift %(concurrency)d "
+                    "at a time") % {'obj': location.obj,
+                                    'concurrency': concurrency})
+        try:
+            chunk_id = 1
+            for data in glance.store.base.read_parts(
+                    image_file, self.large_object_chunk_size):
+                if errors:
+                    break
+                checksum.update(data)
+                chunk_name = "%s-%05d" % (location.obj, chunk_id)
+                # Blocks until one of the chunks being written is done
+                pool.spawn_n(put_segment, chunk_name, data)
+                chunk_id += 1
+            pool.waitall()
+        except Exception:
+            with excutils.save_and_reraise_exception():
+                pool.waitall()
+        if errors:
+            raise errors[0]
+        for conn in connections:
+            if conn is not connection:
+                self._release_connection(location, conn)
+        # Chunk names sort in the order of the chunks
+        segments.sort()
+
+    def _put_manifest(self, location, segments, connection):
+        """
+        Writes the manifest of a large object. This is a Static Large
+        Object manifest listing the segments if swift_store_use_slo is
+        set, or else a Dynamic Large Object manifest of the prefix of
+        their names.
+
+        :param segments: List of the (name, etag, size) of the segments
+        """
+        if self.use_slo and segments:
+            manifest = [{'path': '/%s/%s' % (location.container, name),
+                         'etag': etag,
+                         'size_bytes': size}
+                        for name, etag, size in segments]
+            connection.put_object(location.container, location.obj,
+                                  json.dumps(manifest),
+                                  query_string='multipart-manifest=put')
+            return
+
+        # Now we write the object manifest and return the
+        # manifest's etag...
+        manifest = "%s/%s-" % (location.container, location.obj)
+        headers = {'ETag': hashlib.md5("").hexdigest(),
+                   'X-Object-Manifest': manifest}
+        connection.put_object(location.container, location.obj,
+                              None, headers=headers)
+
     def delete(self, location, connection=None):
         location = location.store_location
-        if not connection:
-            connection = self.get_connection(location)
+        pooled = not connection
+        if pooled:
+            connection = self._get_pooled_connection(location)
 
         try:
             # We request the manifest for the object. If one exists,
@@ -457,10 +852,13 @@ class BaseStore(glance.store.base.Store):
             # and we need to delete all the chunks as well as the
             # manifest.
             manifest = None
+            static_manifest = False
             try:
                 headers = connection.head_object(
                         location.container, location.obj)
                 manifest = headers.get('x-object-manifest')
+                static_manifest = strutils.bool_from_string(
+                    headers.get('x-static-large-object'))
             except swiftclient.ClientException as e:
                 if e.http_status != httplib.NOT_FOUND:
                     raise
@@ -477,8 +875,15 @@ class BaseStore(glance.store.base.Store):
                     connection.delete_object(obj_container,
                                              segment['name'])
 
-            # Delete object (or, in segmented case, the manifest)
-            connection.delete_object(location.container, location.obj)
+            # Delete object (or, in segmented case, the manifest). Swift
+            # deletes the segments of a static manifest along with it.
+            kwargs = {}
+            if static_manifest:
+                kwargs['query_string'] = 'multipart-manifest=delete'
+            connection.delete_object(location.container, location.obj,
+                                     **kwargs)
+            if pooled:
+                self._release_connection(location, connection)
 
         except swiftclient.ClientException as e:
             if e.http_status == httplib.NOT_FOUND:
@@ -530,6 +935,12 @@ class SingleTenantStore(BaseStore):
         super(SingleTenantStore, self).configure()
         self.auth_version = self._option_get('swift_store_auth_version')
 
+    def _get_pool_key(self, location):
+        return (location.swift_url, location.user, location.key,
+                self.auth_version, self.region, self.endpoint_type,
+                self.service_type, self.snet, self.insecure,
+                self.ssl_compression)
+
     def configure_add(self):
         self.auth_address = self._option_get('swift_store_auth_address')
         if self.auth_address.startswith('http://'):
@@ -13,8 +13,10 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import testtools
+import StringIO
 
+import stubout
+import testtools
 import webob
 
 import glance.api.common
@@ -130,6 +132,85 @@ class TestSizeCheckedIter(testtools.TestCase):
         self.assertEqual('E', checked_image.next())
         self.assertRaises(exception.GlanceException, checked_image.next)
 
+    def test_file_wrapper_passed_through(self):
+        resp = self._get_webob_response()
+        resp.request.environ['eventlet.posthooks'] = []
+        meta = self._get_image_metadata()
+        wrapper = wsgi.FileWrapper(StringIO.StringIO('ABCD'))
+        sent = []
+
+        def fake_send_notification(bytes_written, expected_size, image_meta,
+                                   request, notifier):
+            sent.append((bytes_written, expected_size))
+
+        stubs = stubout.StubOutForTesting()
+        self.addCleanup(stubs.UnsetAll)
+        stubs.Set(glance.api.common, 'image_send_notification',
+                  fake_send_notification)
+
+        checked_image = glance.api.common.size_checked_iter(
+                resp, meta, 4, wrapper, None)
+        self.assertTrue(checked_image is wrapper)
+        self.assertEqual(['ABCD'], list(checked_image))
+
+        hooks = resp.request.environ['eventlet.posthooks']
+        self.assertEqual(1, len(hooks))
+        hook, args, kwargs = hooks[0]
+        hook(resp.request.environ, *args, **kwargs)
+        self.assertEqual([(4, 4)], sent)
+
+
+class TestGetRequestedRange(testtools.TestCase):
+    def _get_range(self, headers, image_size=10, checksum='abc'):
+        request = webob.Request.blank('/', headers=headers)
+        return glance.api.common.get_requested_range(request, image_size,
+                                                     checksum)
+
+    def test_no_range(self):
+        self.assertEqual(None, self._get_range({}))
+
+    def test_range(self):
+        self.assertEqual((2, 3), self._get_range({'Range': 'bytes=2-4'}))
+
+    def test_open_ended_range(self):
+        self.assertEqual((6, 4), self._get_range({'Range': 'bytes=6-'}))
+
+    def test_range_beyond_end_is_truncated(self):
+        self.assertEqual((6, 4), self._get_range({'Range': 'bytes=6-100'}))
+
+    def test_suffix_range(self):
+        self.assertEqual((7, 3), self._get_range({'Range': 'bytes=-3'}))
+
+    def test_multiple_ranges_ignored(self):
+        self.assertEqual(None, self._get_range({'Range': 'bytes=0-1,5-6'}))
+
+    def test_malformed_range_ignored(self):
+        self.assertEqual(None, self._get_range({'Range': 'lines=1-2'}))
+
+    def test_unknown_size_ignored(self):
+        self.assertEqual(None, self._get_range({'Range': 'bytes=2-4'},
+                                               image_size=None))
+
+    def test_if_range_matches(self):
+        headers = {'Range': 'bytes=2-4', 'If-Range': '"abc"'}
+        self.assertEqual((2, 3), self._get_range(headers))
+
+    def test_if_range_does_not_match(self):
+        headers = {'Range': 'bytes=2-4', 'If-Range': 'def'}
+        self.assertEqual(None, self._get_range(headers))
+
+    def test_unsatisfiable_range(self):
+        exc = self.assertRaises(webob.exc.HTTPRequestRangeNotSatisfiable,
+                                self._get_range, {'Range': 'bytes=10-20'})
+        self.assertEqual('bytes */10', exc.headers['Content-Range'])
+
+    def test_set_range_headers(self):
+        response = webob.Response()
+        glance.api.common.set_range_headers(response, 2, 3, 10)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('bytes 2-4/10', response.headers['Content-Range'])
+        self.assertEqual('3', response.headers['Content-Length'])
+
 
 class TestMalformedRequest(test_utils.BaseTestCase):
     def setUp(self):
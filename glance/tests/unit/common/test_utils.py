@@ -118,6 +118,16 @@ class TestUtils(test_utils.BaseTestCase):
 
         self.assertRaises(exception.ImageSizeLimitExceeded, _consume_all_read)
 
+    def test_range_iter(self):
+        chunks = ['abc', 'def', 'ghi']
+        self.assertEqual(['c', 'd'],
+                         list(utils.range_iter(iter(chunks), 2, 2)))
+        self.assertEqual(['ef', 'ghi'],
+                         list(utils.range_iter(iter(chunks), 4)))
+        self.assertEqual(['def', 'g'],
+                         list(utils.range_iter(iter(chunks), 3, 4)))
+        self.assertEqual([], list(utils.range_iter(iter(chunks), 9)))
+
     def test_get_meta_from_headers(self):
         resp = webob.Response()
         resp.headers = {"x-image-meta-name": 'test'}
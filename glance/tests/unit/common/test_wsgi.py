@@ -15,12 +15,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
 import socket
+import StringIO
+import tempfile
 import time
 
 import datetime
+import eventlet.green.httplib
 import eventlet.patcher
+import eventlet.wsgi
 import httplib2
+import testtools
 import webob
 
 from glance.common import exception
@@ -257,6 +263,110 @@ class ServerTest(test_utils.BaseTestCase):
         self.assertTrue(isinstance(actual, eventlet.greenpool.GreenPool))
 
 
+class FileWrapperTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(FileWrapperTest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'x' * 100000)
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def test_iterates_in_chunks(self):
+        wrapper = wsgi.FileWrapper(StringIO.StringIO('abcde'), 2)
+        self.assertEqual(['ab', 'cd', 'e'], list(wrapper))
+        self.assertEqual(5, wrapper.bytes_sent)
+
+    @testtools.skipUnless(wsgi.SENDFILE_SUPPORTED, 'sendfile not available')
+    def test_sendfile(self):
+        server, client = eventlet.green.socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+
+        received = []
+
+        def reader():
+            while True:
+                data = client.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+
+        reader_thread = eventlet.spawn(reader)
+        with open(self.path, 'rb') as image_file:
+            wrapper = wsgi.FileWrapper(image_file)
+            self.assertEqual(70000, wrapper.sendfile(server, 70000))
+        server.shutdown(socket.SHUT_WR)
+        reader_thread.wait()
+        self.assertEqual(70000, len(''.join(received)))
+
+    @testtools.skipUnless(wsgi.SENDFILE_SUPPORTED, 'sendfile not available')
+    def test_sendfile_short_file(self):
+        server, client = eventlet.green.socket.socketpair()
+        self.addCleanup(server.close)
+        self.addCleanup(client.close)
+        eventlet.spawn(client.recv, 200000)
+        with open(self.path, 'rb') as image_file:
+            wrapper = wsgi.FileWrapper(image_file)
+            self.assertEqual(100000, wrapper.sendfile(server, 200000))
+
+
+class HttpProtocolTest(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(HttpProtocolTest, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, 'x' * 100000)
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+        self.sendfile_calls = []
+        if wsgi.SENDFILE_SUPPORTED:
+            real_sendfile = wsgi.FileWrapper.sendfile
+
+            def counting_sendfile(wrapper, sock, count):
+                self.sendfile_calls.append(count)
+                return real_sendfile(wrapper, sock, count)
+
+            self.stubs.Set(wsgi.FileWrapper, 'sendfile', counting_sendfile)
+
+    def _get(self, headers):
+        def application(environ, start_response):
+            start_response('200 OK', headers)
+            image_file = open(self.path, 'rb')
+            if 'wsgi.file_wrapper' in environ:
+                return environ['wsgi.file_wrapper'](image_file)
+            return utils.chunkiter(image_file)
+
+        sock = eventlet.listen(('127.0.0.1', 0))
+        self.addCleanup(sock.close)
+        server = eventlet.spawn(eventlet.wsgi.server, sock, application,
+                                protocol=wsgi.HttpProtocol,
+                                log=wsgi.WritableLogger(wsgi.LOG))
+        self.addCleanup(server.kill)
+
+        conn = eventlet.green.httplib.HTTPConnection(
+            '127.0.0.1', sock.getsockname()[1])
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    @testtools.skipUnless(wsgi.SENDFILE_SUPPORTED, 'sendfile not available')
+    def test_file_wrapper_sent_with_sendfile(self):
+        response, body = self._get([('Content-Length', '100000')])
+        self.assertEqual(200, response.status)
+        self.assertEqual('x' * 100000, body)
+        self.assertEqual([100000], self.sendfile_calls)
+
+    def test_file_wrapper_without_content_length_is_iterated(self):
+        response, body = self._get([])
+        self.assertEqual(200, response.status)
+        self.assertEqual('x' * 100000, body)
+        self.assertEqual([], self.sendfile_calls)
+
+
 class TestHelpers(test_utils.BaseTestCase):
 
     def test_headers_are_unicode(self):
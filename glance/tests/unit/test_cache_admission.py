@@ -0,0 +1,129 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import StringIO
+import time
+
+from glance import image_cache
+from glance.image_cache import admission
+from glance.tests import utils as test_utils
+
+FIXTURE_DATA = '*' * 1024
+
+
+class TestFrequencySketch(test_utils.BaseTestCase):
+
+    def test_add_and_estimate(self):
+        sketch = admission.FrequencySketch()
+        self.assertEqual(0, sketch.estimate('a'))
+        self.assertEqual(1, sketch.add('a'))
+        self.assertEqual(2, sketch.add('a'))
+        self.assertEqual(2, sketch.estimate('a'))
+        self.assertEqual(0, sketch.estimate('b'))
+
+    def test_halve(self):
+        sketch = admission.FrequencySketch()
+        for i in xrange(5):
+            sketch.add('a')
+        sketch.halve()
+        self.assertEqual(2, sketch.estimate('a'))
+
+    def test_counts_are_capped(self):
+        sketch = admission.FrequencySketch(width=1, depth=1)
+        for i in xrange(admission.SKETCH_MAX_COUNT + 10):
+            sketch.add('a')
+        self.assertEqual(admission.SKETCH_MAX_COUNT, sketch.estimate('a'))
+
+
+class TestAdmissionFilter(test_utils.BaseTestCase):
+
+    def test_admit_everything_by_default(self):
+        admission_filter = admission.AdmissionFilter()
+        self.assertTrue(admission_filter.admit('a'))
+        self.assertTrue(admission_filter.admit('b', {'size': 10 ** 12}))
+        self.assertEqual(2, admission_filter.get_stats()['admitted'])
+
+    def test_admit_after_min_requests(self):
+        admission_filter = admission.AdmissionFilter(min_requests=3)
+        self.assertFalse(admission_filter.admit('a'))
+        self.assertFalse(admission_filter.admit('a'))
+        self.assertTrue(admission_filter.admit('a'))
+        stats = admission_filter.get_stats()
+        self.assertEqual(1, stats['admitted'])
+        self.assertEqual(2, stats['rejected_frequency'])
+
+    def test_old_requests_fade_out(self):
+        admission_filter = admission.AdmissionFilter(min_requests=3,
+                                                     window=60)
+        now = time.time()
+        self.stubs.Set(time, 'time', lambda: now)
+        admission_filter.admit('a')
+        admission_filter.admit('a')
+        now += 60
+        self.assertFalse(admission_filter.admit('a'))
+        self.assertTrue(admission_filter.admit('a'))
+
+    def test_max_image_size(self):
+        admission_filter = admission.AdmissionFilter(max_image_size=100)
+        self.assertTrue(admission_filter.admit('a', {'size': 100}))
+        self.assertTrue(admission_filter.admit('b', {'size': None}))
+        self.assertFalse(admission_filter.admit('c', {'size': 101}))
+        self.assertEqual(1, admission_filter.get_stats()['rejected_size'])
+
+    def test_disk_formats(self):
+        admission_filter = admission.AdmissionFilter(
+            min_requests=2, disk_formats={'iso': '0', 'raw': '1',
+                                          'qcow2': 'x'})
+        self.assertFalse(admission_filter.admit('a', {'disk_format': 'iso'}))
+        self.assertTrue(admission_filter.admit('b', {'disk_format': 'raw'}))
+        self.assertFalse(admission_filter.admit('c',
+                                                {'disk_format': 'qcow2'}))
+        self.assertTrue(admission_filter.admit('c',
+                                               {'disk_format': 'qcow2'}))
+        stats = admission_filter.get_stats()
+        self.assertEqual(1, stats['rejected_disk_format'])
+        self.assertEqual(1, stats['rejected_frequency'])
+
+
+class TestImageCacheAdmission(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestImageCacheAdmission, self).setUp()
+        self.config(image_cache_driver='sqlite',
+                    image_cache_dir=self.test_dir,
+                    image_cache_admission_min_requests=2)
+        self.cache = image_cache.ImageCache()
+
+    def test_get_caching_iter_applies_admission(self):
+        data = ''.join(self.cache.get_caching_iter('a', None,
+                                                   iter([FIXTURE_DATA])))
+        self.assertEqual(FIXTURE_DATA, data)
+        self.assertFalse(self.cache.is_cached('a'))
+
+        data = ''.join(self.cache.get_caching_iter('a', None,
+                                                   iter([FIXTURE_DATA])))
+        self.assertEqual(FIXTURE_DATA, data)
+        self.assertTrue(self.cache.is_cached('a'))
+
+        stats = self.cache.get_admission_stats()
+        self.assertEqual(1, stats['admitted'])
+        self.assertEqual(1, stats['rejected_frequency'])
+
+    def test_cache_image_file_bypasses_admission(self):
+        self.assertTrue(self.cache.cache_image_file(
+            'a', StringIO.StringIO(FIXTURE_DATA)))
+        self.assertTrue(self.cache.is_cached('a'))
@@ -0,0 +1,132 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import StringIO
+
+from glance import context
+from glance import image_cache
+from glance.image_cache import metadata
+from glance.tests import utils as test_utils
+
+
+def _image_meta(**kwargs):
+    image_meta = {'id': 'image', 'status': 'active', 'deleted': False,
+                  'owner': 'owner', 'is_public': False, 'size': 1024,
+                  'checksum': 'abc'}
+    image_meta.update(kwargs)
+    return image_meta
+
+
+class TestImageMetadataCache(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestImageMetadataCache, self).setUp()
+        self.metadata = metadata.ImageMetadataCache(
+            os.path.join(self.test_dir, 'metadata'), 60)
+        self.owner = context.RequestContext(tenant='owner')
+        self.member = context.RequestContext(tenant='member')
+        self.other = context.RequestContext(tenant='other')
+        self.admin = context.RequestContext(tenant='admin', is_admin=True)
+
+    def test_put_get(self):
+        self.assertEqual(None, self.metadata.get(self.owner, 'image', 'v1'))
+        self.metadata.put(self.owner, 'image', 'v1', _image_meta(), now=0)
+        self.assertEqual(_image_meta(),
+                         self.metadata.get(self.owner, 'image', 'v1', now=1))
+        self.assertEqual(None, self.metadata.get(self.owner, 'image', 'v2',
+                                                 now=1))
+
+    def test_entries_expire(self):
+        self.metadata.put(self.owner, 'image', 'v1', _image_meta(), now=0)
+        self.assertEqual(None, self.metadata.get(self.owner, 'image', 'v1',
+                                                 now=61))
+
+    def test_private_image_visibility(self):
+        self.metadata.put(self.owner, 'image', 'v1', _image_meta(), now=0)
+        self.assertEqual(None, self.metadata.get(self.member, 'image', 'v1',
+                                                 now=1))
+        self.assertNotEqual(None, self.metadata.get(self.admin, 'image',
+                                                    'v1', now=1))
+
+        # The registry let the member see the image
+        self.metadata.put(self.member, 'image', 'v1', _image_meta(), now=2)
+        self.assertNotEqual(None, self.metadata.get(self.member, 'image',
+                                                    'v1', now=3))
+        self.assertEqual(None, self.metadata.get(self.other, 'image', 'v1',
+                                                 now=3))
+
+        # Refreshing the entry does not extend what the member was allowed
+        self.metadata.put(self.owner, 'image', 'v1', _image_meta(), now=50)
+        self.assertNotEqual(None, self.metadata.get(self.member, 'image',
+                                                    'v1', now=60))
+        self.assertEqual(None, self.metadata.get(self.member, 'image', 'v1',
+                                                 now=63))
+        self.assertNotEqual(None, self.metadata.get(self.owner, 'image',
+                                                    'v1', now=63))
+
+    def test_public_image_visibility(self):
+        self.metadata.put(self.owner, 'image', 'v1',
+                          _image_meta(is_public=True), now=0)
+        self.assertNotEqual(None, self.metadata.get(self.other, 'image',
+                                                    'v1', now=1))
+
+    def test_inactive_images_are_not_stored(self):
+        self.metadata.put(self.admin, 'image', 'v1',
+                          _image_meta(deleted=True), now=0)
+        self.metadata.put(self.admin, 'image', 'v2',
+                          _image_meta(status='queued'), now=0)
+        self.assertEqual(None, self.metadata.get(self.admin, 'image', 'v1',
+                                                 now=1))
+        self.assertEqual(None, self.metadata.get(self.admin, 'image', 'v2',
+                                                 now=1))
+
+    def test_delete(self):
+        self.metadata.put(self.owner, 'image', 'v1', _image_meta(), now=0)
+        self.metadata.put(self.owner, 'other', 'v1', _image_meta(), now=0)
+        self.metadata.delete('image')
+        self.assertEqual(None, self.metadata.get(self.owner, 'image', 'v1',
+                                                 now=1))
+        self.metadata.delete_all()
+        self.assertEqual(None, self.metadata.get(self.owner, 'other', 'v1',
+                                                 now=1))
+
+
+class TestImageCacheMetadata(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestImageCacheMetadata, self).setUp()
+        self.config(image_cache_driver='sqlite',
+                    image_cache_dir=self.test_dir,
+                    image_cache_metadata_ttl=60)
+        self.cache = image_cache.ImageCache()
+        self.context = context.RequestContext(tenant='owner')
+
+    def test_deleting_image_drops_metadata(self):
+        self.cache.cache_image_file('image', StringIO.StringIO('*' * 1024))
+        self.cache.metadata.put(self.context, 'image', 'v1', _image_meta())
+        self.cache.delete_cached_image('image')
+        self.assertEqual(None, self.cache.metadata.get(self.context, 'image',
+                                                       'v1'))
+
+    def test_pruning_image_drops_metadata(self):
+        self.config(image_cache_max_size=0)
+        self.cache.cache_image_file('image', StringIO.StringIO('*' * 1024))
+        self.cache.metadata.put(self.context, 'image', 'v1', _image_meta())
+        self.cache.prune()
+        self.assertEqual(None, self.cache.metadata.get(self.context, 'image',
+                                                       'v1'))
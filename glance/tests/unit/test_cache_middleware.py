@@ -13,12 +13,20 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import contextlib
+import StringIO
+
 import stubout
 import testtools
 import webob
 
 import glance.api.middleware.cache
+import glance.image_cache
+import glance.image_cache.drivers.base
+import glance.image_cache.metadata
+import glance.image_cache.peers
 from glance.common import exception
+from glance.common import wsgi
 from glance import context
 import glance.db.sqlalchemy.api as db
 import glance.registry.client.v1.api as registry
@@ -80,10 +88,21 @@ class TestCacheMiddlewareRequestStashCacheInfo(testtools.TestCase):
         self.assertEqual(out, None)
 
 
+class FakeCacheStats(object):
+    def __init__(self):
+        self.counters = {}
+
+    def incr(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
 class ChecksumTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
         class DummyCache(object):
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            stats = FakeCacheStats()
+
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 image_meta=None):
                 self.image_checksum = image_checksum
 
         self.cache = DummyCache()
@@ -126,14 +145,19 @@ class ProcessRequestTestCacheFilter(glance.api.middleware.cache.CacheFilter):
     def __init__(self):
         self.serializer = FakeImageSerializer()
 
-        class DummyCache(object):
+        class DummyCache(glance.image_cache.ImageCache):
             def __init__(self):
                 self.deleted_images = []
+                self.driver = glance.image_cache.drivers.base.Driver()
+                self.memory = None
+                self.metadata = None
+                self.stats = FakeCacheStats()
 
             def is_cached(self, image_id):
                 return True
 
-            def get_caching_iter(self, image_id, image_checksum, app_iter):
+            def get_caching_iter(self, image_id, image_checksum, app_iter,
+                                 image_meta=None):
                 pass
 
             def delete_cached_image(self, image_id):
@@ -189,6 +213,190 @@ class TestCacheMiddlewareProcessRequest(utils.BaseTestCase):
         cache_filter.process_request(request)
         self.assertTrue(image_id in cache_filter.cache.deleted_images)
 
+    def test_process_request_passes_cache_fill_through(self):
+        """
+        Test that a request for an image that is being cached is passed
+        on, so that the cache fill is followed with the image from the
+        store to fall back on, and is not counted as a miss.
+        """
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.is_cached = lambda image_id: False
+        cache_filter.cache.is_fill_active = lambda image_id: True
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertFalse('misses' in cache_filter.cache.stats.counters)
+
+    def test_process_request_peer_not_sent_to_store(self):
+        """
+        Test that a peer asking for an image that is being cached is
+        turned away rather than passed on to the store.
+        """
+        image_id = 'test1'
+        headers = {glance.image_cache.peers.PEER_HEADER: '1'}
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers=headers)
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.is_cached = lambda image_id: False
+        cache_filter.cache.is_fill_active = lambda image_id: True
+        resp = cache_filter.process_request(request)
+        self.assertTrue(isinstance(resp, webob.exc.HTTPNotFound))
+
+    def test_process_request_uses_file_wrapper(self):
+        """
+        Test that a cache hit is handed to the server's wsgi.file_wrapper
+        and that the hit is recorded when the server closes it.
+        """
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return image_iterator
+
+        reads = []
+
+        @contextlib.contextmanager
+        def fake_open_for_read(image_id):
+            yield StringIO.StringIO('abc')
+            reads.append(image_id)
+
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+        request.environ['wsgi.file_wrapper'] = wsgi.FileWrapper
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.open_for_read = fake_open_for_read
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        wrapper = cache_filter.process_request(request)
+        self.assertTrue(isinstance(wrapper, wsgi.FileWrapper))
+        self.assertEqual(['abc'], list(wrapper))
+        self.assertEqual([], reads)
+        wrapper.close()
+        self.assertEqual([image_id], reads)
+
+    def test_process_request_range(self):
+        """
+        Test that a range request for a cached image is served from the
+        requested offset of the cached file.
+        """
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return (request.environ['api.cache.image_range'],
+                    list(image_iterator))
+
+        @contextlib.contextmanager
+        def fake_open_for_read(image_id):
+            yield StringIO.StringIO('0123456789')
+
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=2-5'})
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.open_for_read = fake_open_for_read
+        cache_filter.cache.get_image_size = lambda image_id: 10
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        image_range, data = cache_filter.process_request(request)
+        self.assertEqual((2, 4), image_range)
+        self.assertEqual('2345', ''.join(data))
+
+    def test_process_request_range_with_file_wrapper(self):
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return image_iterator
+
+        @contextlib.contextmanager
+        def fake_open_for_read(image_id):
+            yield StringIO.StringIO('0123456789')
+
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=-3'})
+        request.environ['wsgi.file_wrapper'] = wsgi.FileWrapper
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.open_for_read = fake_open_for_read
+        cache_filter.cache.get_image_size = lambda image_id: 10
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        wrapper = cache_filter.process_request(request)
+        self.assertEqual('789', ''.join(wrapper))
+
+    def test_process_request_range_of_partly_cached_image(self):
+        """
+        Test that a range request for an image that is only partly cached
+        is served from the cache when the range is cached.
+        """
+        def fake_process_v1_request(request, image_id, image_iterator):
+            return (request.environ['api.cache.image_range'],
+                    list(image_iterator))
+
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=2-5'})
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache = cache_filter.cache
+        cache.is_cached = lambda image_id: False
+        cache.is_partly_cached = lambda image_id: True
+        cache.is_range_cached = lambda image_id, offset, length: offset == 2
+        cache.get_image_size = lambda image_id: 10
+        cache.get_partial_iter = (lambda image_id, offset, length:
+                                  iter(['2345']))
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       fake_process_v1_request)
+        self.assertEqual(((2, 4), ['2345']),
+                         cache_filter.process_request(request))
+
+        cache.is_being_cached = lambda image_id: False
+        request.headers['Range'] = 'bytes=0-5'
+        self.assertEqual(None, cache_filter.process_request(request))
+
+    def test_process_request_if_range_not_served_from_cache(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      headers={'Range': 'bytes=2-5',
+                                               'If-Range': 'abc'})
+        cache_filter = ProcessRequestTestCacheFilter()
+        self.assertEqual(None, cache_filter.process_request(request))
+
+    def test_process_request_not_cached(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.is_cached = lambda image_id: False
+        cache_filter.cache.is_being_cached = lambda image_id: False
+        self.assertEqual(None, cache_filter.process_request(request))
+
+    def test_count_bytes_served_coerces_size(self):
+        request = webob.Request.blank('/v1/images/test1')
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter._count_bytes_served(request, '10')
+        cache_filter._count_bytes_served(request, 5)
+        cache_filter._count_bytes_served(request, None)
+        cache_filter._count_bytes_served(request, 'unknown')
+        self.assertEqual(15,
+                         cache_filter.cache.stats.counters['bytes_from_cache'])
+
+    def test_process_request_counts_hits_and_misses(self):
+        image_id = 'test1'
+        request = webob.Request.blank('/v1/images/%s' % image_id)
+
+        cache_filter = ProcessRequestTestCacheFilter()
+        self.stubs.Set(cache_filter, '_process_v1_request',
+                       lambda request, image_id, image_iterator: True)
+        cache_filter.cache.get_image_size = lambda image_id: 10
+        cache_filter.cache.get_cached_iter = (lambda image_id, offset, length:
+                                              iter(['0123456789']))
+        self.assertEqual(True, cache_filter.process_request(request))
+        cache_filter.cache.is_cached = lambda image_id: False
+        cache_filter.cache.is_being_cached = lambda image_id: False
+        self.assertEqual(None, cache_filter.process_request(request))
+
+        counters = cache_filter.cache.stats.counters
+        self.assertEqual(1, counters['hits'])
+        self.assertEqual(1, counters['misses'])
+
     def test_v1_process_request_image_fetch(self):
 
         def fake_get_image_metadata(context, image_id):
@@ -208,6 +416,42 @@ class TestCacheMiddlewareProcessRequest(utils.BaseTestCase):
             request, image_id, dummy_img_iterator)
         self.assertEqual(True, actual)
 
+    def test_v1_process_request_uses_stored_metadata(self):
+        calls = []
+
+        def fake_get_image_metadata(context, image_id):
+            calls.append(image_id)
+            return {'id': image_id, 'is_public': True, 'deleted': False,
+                    'status': 'active', 'size': 20, 'owner': 'owner',
+                    'location': 'file:///some/path'}
+
+        image_id = 'test1'
+        cache_filter = ProcessRequestTestCacheFilter()
+        cache_filter.cache.metadata = (
+            glance.image_cache.metadata.ImageMetadataCache(self.test_dir, 60))
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+
+        for i in range(2):
+            request = webob.Request.blank('/v1/images/%s' % image_id)
+            request.context = context.RequestContext()
+            self.assertTrue(cache_filter._process_v1_request(
+                request, image_id, iter([])))
+        self.assertEqual([image_id], calls)
+        self.assertEqual(1, cache_filter.cache.stats.counters[
+                         'metadata_hits'])
+        stored = cache_filter.cache.metadata.get(request.context, image_id,
+                                                 'v1')
+        self.assertFalse('location' in stored)
+
+        # Changing the image drops the stored metadata
+        request = webob.Request.blank('/v1/images/%s' % image_id,
+                                      method='PUT')
+        request.context = context.RequestContext()
+        self.assertEqual(None, cache_filter.process_request(request))
+        self.assertEqual(None, cache_filter.cache.metadata.get(
+                         request.context, image_id, 'v1'))
+
     def test_v1_remove_location_image_fetch(self):
 
         class CheckNoLocationDataSerializer(object):
@@ -334,6 +578,13 @@ class TestProcessResponse(utils.BaseTestCase):
         actual = cache_filter.get_status_code(resp)
         self.assertEqual(200, actual)
 
+    def test_process_GET_response_partial_content_not_cached(self):
+        cache_filter = ProcessRequestTestCacheFilter()
+        resp = webob.Response(status=206, app_iter=iter(['23']))
+        actual = cache_filter._process_GET_response(resp, 'test1')
+        self.assertEqual(resp, actual)
+        self.assertEqual(['23'], list(actual.app_iter))
+
     def test_process_response(self):
         def fake_fetch_request_info():
             return ('test1', 'GET')
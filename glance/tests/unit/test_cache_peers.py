@@ -0,0 +1,224 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import socket
+import StringIO
+
+import webob
+
+from glance.api.middleware import cache
+from glance import context
+from glance.image_cache import peers
+import glance.registry.client.v1.api as registry
+from glance.tests import utils as test_utils
+
+FIXTURE_DATA = '*' * 1024
+
+
+class FakeResponse(object):
+    def __init__(self, webob_response):
+        self.status = webob_response.status_int
+        self.headers = webob_response.headers
+        self.body = StringIO.StringIO(''.join(webob_response.app_iter))
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, size=-1):
+        return self.body.read(size)
+
+
+class FakeConnection(object):
+    """Sends requests straight to the WSGI application of a peer."""
+
+    def __init__(self, app, log):
+        self.app = app
+        self.log = log
+        self.response = None
+        self.closed = False
+
+    def request(self, method, path, headers=None):
+        if self.app is None:
+            raise socket.error('connection refused')
+        self.log.append((method, path, headers))
+        request = webob.Request.blank(path, headers=headers)
+        request.context = context.RequestContext()
+        self.response = FakeResponse(request.get_response(self.app))
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        self.closed = True
+
+
+class TestHashRing(test_utils.BaseTestCase):
+
+    def test_get_nodes(self):
+        ring = peers.HashRing(['a', 'b', 'c'])
+        nodes = ring.get_nodes('image', 2)
+        self.assertEqual(2, len(nodes))
+        self.assertEqual(2, len(set(nodes)))
+        self.assertEqual(nodes, ring.get_nodes('image', 2))
+        self.assertEqual(3, len(ring.get_nodes('image', 5)))
+        self.assertEqual([], peers.HashRing([]).get_nodes('image'))
+
+    def test_removing_node_only_moves_its_keys(self):
+        ring = peers.HashRing(['a', 'b', 'c'])
+        smaller = peers.HashRing(['a', 'b'])
+        keys = ['image-%d' % i for i in xrange(300)]
+        for key in keys:
+            owner = ring.get_nodes(key)[0]
+            if owner != 'c':
+                self.assertEqual(owner, smaller.get_nodes(key)[0])
+        owners = [ring.get_nodes(key)[0] for key in keys]
+        for node in ('a', 'b', 'c'):
+            self.assertTrue(owners.count(node) > 50)
+
+    def test_weights(self):
+        ring = peers.HashRing(['a', 'b'], weights={'a': 3})
+        owners = [ring.get_nodes('image-%d' % i)[0] for i in xrange(300)]
+        self.assertTrue(owners.count('a') > 2 * owners.count('b'))
+
+
+class TestPeerClient(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPeerClient, self).setUp()
+        self.config(image_cache_peers=['http://a:9292', 'http://b:9292',
+                                       'http://c:9292/'],
+                    image_cache_peer_self='http://c:9292')
+
+    def test_select_all_peers(self):
+        client = peers.PeerClient()
+        self.assertEqual(['http://a:9292', 'http://b:9292'],
+                         sorted(client.select_peers('image')))
+
+    def test_select_peers_by_hash(self):
+        self.config(image_cache_peer_selection='hash',
+                    image_cache_peer_replicas=1)
+        client = peers.PeerClient()
+        owner = client.ring.get_nodes('image')[0]
+        if owner == 'http://c:9292':
+            self.assertEqual([], client.select_peers('image'))
+        else:
+            self.assertEqual([owner], client.select_peers('image'))
+
+    def test_get_image_asks_peers_in_turn(self):
+        def fake_app(environ, start_response):
+            start_response('404 Not Found', [])
+            return ['']
+
+        def good_app(environ, start_response):
+            start_response('200 OK', [('x-image-meta-checksum', 'abc'),
+                                      ('x-image-meta-size', '1024'),
+                                      ('x-image-meta-disk_format', 'raw'),
+                                      ('x-image-meta-owner', 'tenant1'),
+                                      ('x-image-meta-is_public', 'False')])
+            return [FIXTURE_DATA]
+
+        log = []
+        apps = {'http://a:9292': FakeConnection(None, log),
+                'http://b:9292': FakeConnection(fake_app, log),
+                'http://d:9292': FakeConnection(good_app, log)}
+        self.config(image_cache_peers=['http://a:9292', 'http://b:9292',
+                                       'http://d:9292'])
+        client = peers.PeerClient()
+        client.select_peers = lambda image_id: sorted(apps)
+        client._get_connection = lambda peer: (apps[peer], '')
+
+        image_meta, image_iter = client.get_image('image', 'token')
+        self.assertEqual({'checksum': 'abc', 'size': 1024,
+                          'disk_format': 'raw', 'owner': 'tenant1',
+                          'is_public': 'False'}, image_meta)
+        self.assertEqual(FIXTURE_DATA, ''.join(image_iter))
+        self.assertTrue(all(conn.closed for conn in apps.values()))
+        self.assertEqual(2, len(log))
+        method, path, headers = log[0]
+        self.assertEqual('/v1/images/image', path)
+        self.assertEqual('token', headers['X-Auth-Token'])
+        self.assertEqual('true', headers[peers.PEER_HEADER])
+
+        client.select_peers = lambda image_id: ['http://a:9292']
+        self.assertEqual(None, client.get_image('image'))
+
+
+class TestCacheFilterPeers(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestCacheFilterPeers, self).setUp()
+        self.checksum = hashlib.md5(FIXTURE_DATA).hexdigest()
+
+        def fake_get_image_metadata(context, image_id):
+            return {'id': image_id, 'deleted': False, 'is_public': True,
+                    'size': len(FIXTURE_DATA), 'checksum': self.checksum}
+
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+
+        def store_app(environ, start_response):
+            raise AssertionError('the store was asked for the image')
+
+        self.config(image_cache_driver='sqlite',
+                    image_cache_dir=os.path.join(self.test_dir, 'peer'))
+        self.peer = cache.CacheFilter(store_app)
+
+        self.config(image_cache_dir=os.path.join(self.test_dir, 'local'),
+                    image_cache_peers=['http://peer:9292'])
+        self.local = cache.CacheFilter(store_app)
+        self.log = []
+        self.local.peers._get_connection = lambda peer: (
+            FakeConnection(self.peer, self.log), '')
+
+    def _get(self, path='/v1/images/image', headers=None):
+        request = webob.Request.blank(path, headers=headers)
+        request.context = context.RequestContext()
+        return self.local.process_request(request)
+
+    def test_miss_is_filled_from_peer(self):
+        self.peer.cache.cache_image_file('image',
+                                         StringIO.StringIO(FIXTURE_DATA))
+
+        response = self._get()
+        self.assertEqual(FIXTURE_DATA, ''.join(response.app_iter))
+        self.assertEqual(1, len(self.log))
+        self.assertTrue(self.local.cache.is_cached('image'))
+
+    def test_peer_without_image_falls_back_to_store(self):
+        self.assertEqual(None, self._get())
+        self.assertEqual(1, len(self.log))
+        self.assertFalse(self.local.cache.is_cached('image'))
+
+    def test_peer_data_with_bad_checksum_is_not_cached(self):
+        self.checksum = 'bad'
+        self.peer.cache.cache_image_file('image',
+                                         StringIO.StringIO(FIXTURE_DATA))
+
+        response = self._get()
+        self.assertRaises(Exception, ''.join, response.app_iter)
+        self.assertFalse(self.local.cache.is_cached('image'))
+
+    def test_peer_requests_are_not_passed_on(self):
+        response = self._get(headers={peers.PEER_HEADER: 'true'})
+        self.assertEqual(404, response.status_int)
+        self.assertEqual([], self.log)
+
+    def test_ranged_miss_does_not_ask_peers(self):
+        self.assertEqual(None, self._get(headers={'Range': 'bytes=0-9'}))
+        self.assertEqual([], self.log)
@@ -0,0 +1,176 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+
+from glance.image_cache import policies
+from glance.tests import utils as test_utils
+
+
+def _entry(image_id, size, hits, last_accessed):
+    return {'image_id': image_id, 'size': size, 'hits': hits,
+            'last_accessed': last_accessed, 'last_modified': 0}
+
+
+def _drain(policy):
+    victims = []
+    entry = policy.evict()
+    while entry is not None:
+        victims.append(entry[0])
+        entry = policy.evict()
+    return victims
+
+
+class TestGetPolicy(test_utils.BaseTestCase):
+
+    def test_known_policies(self):
+        self.assertTrue(isinstance(policies.get_policy('lru', 10),
+                                   policies.LRUPolicy))
+        self.assertTrue(isinstance(policies.get_policy('lfu', 10),
+                                   policies.LFUPolicy))
+        self.assertTrue(isinstance(policies.get_policy('gdsf', 10),
+                                   policies.GDSFPolicy))
+        self.assertTrue(isinstance(policies.get_policy('arc', 10),
+                                   policies.ARCPolicy))
+
+    def test_unknown_policy_defaults_to_lru(self):
+        policy = policies.get_policy('bogus', 10)
+        self.assertTrue(isinstance(policy, policies.LRUPolicy))
+
+
+class TestPolicies(test_utils.BaseTestCase):
+
+    def test_lru_order(self):
+        policy = policies.LRUPolicy(100)
+        policy.load([_entry('c', 1, 9, 3), _entry('a', 1, 0, 1),
+                     _entry('b', 1, 5, 2)])
+        policy.access('a')
+        self.assertEqual(['b', 'c', 'a'], _drain(policy))
+
+    def test_lfu_order(self):
+        policy = policies.LFUPolicy(100)
+        policy.load([_entry('a', 1, 3, 1), _entry('b', 1, 1, 2),
+                     _entry('c', 1, 2, 3)])
+        policy.access('b')
+        policy.access('b')
+        self.assertEqual(['c', 'a', 'b'], _drain(policy))
+
+    def test_gdsf_prefers_small_frequent_images(self):
+        policy = policies.GDSFPolicy(100)
+        policy.load([_entry('small', 10, 4, 1), _entry('big', 100, 4, 2),
+                     _entry('tiny', 1, 0, 3)])
+        self.assertEqual(['big', 'small', 'tiny'], _drain(policy))
+
+    def test_gdsf_inflation_ages_entries(self):
+        policy = policies.GDSFPolicy(100)
+        policy.add('old', 1, hits=3)
+        policy.add('victim', 1, hits=5)
+        policy.evict()
+        self.assertEqual(4.0, policy.inflation)
+        # A newcomer with few hits now outranks the stale popular entry
+        policy.evict()
+        policy.add('victim', 1, hits=5)
+        policy.add('new', 1, hits=0)
+        self.assertEqual(('new', 1), policy.evict())
+
+    def test_arc_evicts_scanned_images_first(self):
+        policy = policies.ARCPolicy(4)
+        policy.load([_entry('hot', 1, 10, 1), _entry('scan1', 1, 0, 2),
+                     _entry('scan2', 1, 0, 3)])
+        self.assertEqual(['scan1', 'scan2', 'hot'], _drain(policy))
+
+    def test_arc_ghost_hit_adapts_target(self):
+        policy = policies.ARCPolicy(4)
+        policy.add('a', 1)
+        policy.add('b', 1)
+        self.assertEqual(('a', 1), policy.evict())
+        self.assertEqual(0, policy.target)
+        policy.add('a', 1)
+        self.assertEqual(1, policy.target)
+        # T1 now fits within its target, so T2 gives up space first
+        self.assertEqual(['a', 'b'], _drain(policy))
+
+    def test_remove_and_size_tracking(self):
+        for name in ('lru', 'lfu', 'gdsf', 'arc'):
+            policy = policies.get_policy(name, 100)
+            policy.add('a', 10)
+            policy.add('b', 20)
+            policy.access('a')
+            self.assertEqual(30, policy.size)
+            self.assertTrue('a' in policy)
+            policy.remove('a')
+            self.assertFalse('a' in policy)
+            self.assertEqual(20, policy.size)
+            self.assertEqual(['b'], _drain(policy))
+            self.assertEqual(0, policy.size)
+            self.assertEqual(0, len(policy))
+
+    def test_arc_state_keeps_ghosts_between_loads(self):
+        policy = policies.ARCPolicy(4)
+        policy.load([_entry('a', 1, 0, 1), _entry('b', 1, 0, 2)])
+        self.assertEqual(('a', 1), policy.evict())
+        state = json.loads(json.dumps(policy.get_state()))
+
+        # The image evicted by the last prune was cached again since
+        policy = policies.ARCPolicy(4)
+        policy.set_state(state)
+        policy.load([_entry('b', 1, 0, 2), _entry('a', 1, 0, 3)])
+        self.assertEqual(1, policy.target)
+        # T1 now fits within its target, so T2 gives up space first
+        self.assertEqual(['a', 'b'], _drain(policy))
+
+    def test_arc_forget_drops_ghost(self):
+        policy = policies.ARCPolicy(4)
+        policy.add('a', 1)
+        policy.evict()
+        policy.forget('a')
+        self.assertEqual([], policy.get_state()['b1'])
+
+    def test_gdsf_state_keeps_inflation_between_loads(self):
+        state = {'inflation': 5.0, 'images': {'old': [0.0, 1]}}
+        policy = policies.GDSFPolicy(100)
+        policy.set_state(state)
+        policy.load([_entry('old', 1, 1, 1), _entry('new', 1, 0, 3)])
+        self.assertEqual(['old', 'new'], _drain(policy))
+
+        # An image accessed since the state was saved is not aged
+        policy = policies.GDSFPolicy(100)
+        policy.set_state(state)
+        policy.load([_entry('old', 1, 1, 4), _entry('new', 1, 0, 3)])
+        self.assertEqual({'inflation': 5.0,
+                          'images': {'old': [5.0, 4], 'new': [5.0, 3]}},
+                         policy.get_state())
+        self.assertEqual(['new', 'old'], _drain(policy))
+
+
+class TestPolicyStates(test_utils.BaseTestCase):
+
+    def test_write_and_read_states(self):
+        path = os.path.join(self.test_dir, 'policy.json')
+        self.assertEqual({}, policies.read_states(path, 'arc'))
+        policies.write_states(path, 'arc', {'cache': {'target': 3}})
+        self.assertEqual({'cache': {'target': 3}},
+                         policies.read_states(path, 'arc'))
+        # The state of one policy means nothing to another
+        self.assertEqual({}, policies.read_states(path, 'gdsf'))
+
+    def test_invalid_state_file_is_ignored(self):
+        path = os.path.join(self.test_dir, 'policy.json')
+        with open(path, 'w') as f:
+            f.write('{not json')
+        self.assertEqual({}, policies.read_states(path, 'arc'))
@@ -0,0 +1,150 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fcntl
+import hashlib
+import os
+import StringIO
+
+from glance.common import exception
+from glance import image_cache
+from glance.image_cache import stats
+from glance.tests import utils as test_utils
+
+FIXTURE_DATA = '*' * 1024
+
+
+class TestCacheStats(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestCacheStats, self).setUp()
+        self.config(image_cache_stats_flush_interval=60)
+        self.stats_dir = os.path.join(self.test_dir, 'stats')
+
+    def test_counts_are_shared_by_processes(self):
+        first = stats.CacheStats(self.stats_dir)
+        second = stats.CacheStats(self.stats_dir)
+        first.incr('hits')
+        first.incr('hits')
+        second.incr('hits')
+        second.incr('misses', 3)
+
+        self.assertEqual({'hits': 2}, first.get_totals())
+        first.flush()
+        self.assertEqual({'hits': 3, 'misses': 3}, second.get_totals())
+        second.flush()
+        self.assertEqual({'hits': 3, 'misses': 3}, first.get_totals())
+
+    def test_flush_every_event(self):
+        self.config(image_cache_stats_flush_interval=0)
+        first = stats.CacheStats(self.stats_dir)
+        first.incr('hits')
+        self.assertEqual({'hits': 1},
+                         stats.CacheStats(self.stats_dir).get_totals())
+
+    def test_sources_are_polled(self):
+        counters = {'hits': 1}
+        cache_stats = stats.CacheStats(self.stats_dir)
+        cache_stats.add_source('memory_', lambda: counters)
+        counters['hits'] = 4
+        cache_stats.flush()
+        counters['hits'] = 5
+        self.assertEqual({'memory_hits': 4}, cache_stats.get_totals())
+
+    def test_reset(self):
+        cache_stats = stats.CacheStats(self.stats_dir)
+        cache_stats.incr('hits')
+        cache_stats.flush()
+        cache_stats.incr('misses')
+        cache_stats.reset()
+        self.assertEqual({}, cache_stats.get_totals())
+
+    def test_flush_yields_while_file_is_locked(self):
+        cache_stats = stats.CacheStats(self.stats_dir)
+        cache_stats.incr('hits')
+        holder = open(cache_stats.path, 'a')
+        fcntl.flock(holder, fcntl.LOCK_EX)
+        sleeps = []
+
+        def fake_sleep(seconds):
+            # Another green thread runs while the lock is held elsewhere
+            sleeps.append(seconds)
+            holder.close()
+
+        self.stubs.Set(stats.eventlet, 'sleep', fake_sleep)
+        cache_stats.flush()
+        self.assertEqual([stats.LOCK_POLL_INTERVAL], sleeps)
+        self.assertEqual({'hits': 1}, cache_stats.get_totals())
+
+    def test_unreadable_file_is_reset(self):
+        cache_stats = stats.CacheStats(self.stats_dir)
+        with open(cache_stats.path, 'w') as f:
+            f.write('{')
+        cache_stats.incr('hits')
+        cache_stats.flush()
+        self.assertEqual({'hits': 1}, cache_stats.get_totals())
+
+    def test_summarize(self):
+        self.assertEqual({'hit_ratio': None, 'fill_throughput': None},
+                         stats.summarize({}))
+        summary = stats.summarize({'hits': 3, 'misses': 1,
+                                   'fill_bytes': 100, 'fill_seconds': 2.0})
+        self.assertEqual(0.75, summary['hit_ratio'])
+        self.assertEqual(50.0, summary['fill_throughput'])
+
+
+class TestImageCacheStats(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestImageCacheStats, self).setUp()
+        self.config(image_cache_driver='sqlite',
+                    image_cache_dir=self.test_dir,
+                    image_cache_max_size=1024)
+        self.cache = image_cache.ImageCache()
+
+    def test_fills_and_evictions_are_counted(self):
+        self.cache.cache_image_file('a', StringIO.StringIO(FIXTURE_DATA))
+        self.cache.cache_image_file('b', StringIO.StringIO(FIXTURE_DATA))
+        self.cache.prune()
+
+        result = self.cache.get_stats()
+        counters = result['counters']
+        self.assertEqual(2, counters['fills'])
+        self.assertEqual(2048, counters['fill_bytes'])
+        self.assertEqual(1, counters['evictions'])
+        self.assertEqual(1024, counters['evicted_bytes'])
+        self.assertEqual(1024, result['cache_size'])
+        self.assertEqual(1024, result['max_size'])
+        self.assertEqual(None, result['hit_ratio'])
+
+    def test_fill_failures_are_counted(self):
+        checksum = hashlib.md5('bad').hexdigest()
+        caching_iter = self.cache.get_caching_iter('a', checksum,
+                                                   iter([FIXTURE_DATA]))
+        self.assertRaises(exception.GlanceException, list, caching_iter)
+        self.assertEqual(1, self.cache.get_stats()['counters']
+                         ['fill_failures'])
+
+    def test_admission_counters_are_included(self):
+        list(self.cache.get_caching_iter('a', None, iter([FIXTURE_DATA])))
+        self.assertEqual(1, self.cache.get_stats()['counters']
+                         ['admission_admitted'])
+
+    def test_reset_stats(self):
+        self.cache.cache_image_file('a', StringIO.StringIO(FIXTURE_DATA))
+        self.cache.reset_stats()
+        self.assertEqual({}, self.cache.get_stats()['counters'])
@@ -16,6 +16,7 @@
 
 import testtools
 import webob
+import webob.exc
 
 from glance.api import cached_images
 from glance.api import policy
@@ -44,6 +45,8 @@ class FakeCache(image_cache.ImageCache):
     def __init__(self):
         self.init_driver()
         self.deleted_images = []
+        self.queued_images = []
+        self.stats_reset = False
 
     def init_driver(self):
         pass
@@ -57,7 +60,14 @@ class FakeCache(image_cache.ImageCache):
     def get_queued_images(self):
         return {'test': 'passed'}
 
-    def queue_image(self, image_id):
+    def get_stats(self):
+        return {'counters': {'hits': 1}, 'hit_ratio': 1.0}
+
+    def reset_stats(self):
+        self.stats_reset = True
+
+    def queue_image(self, image_id, priority=0):
+        self.queued_images.append((image_id, priority))
         return 'pass'
 
     def delete_queued_image(self, image_id):
@@ -100,10 +110,37 @@ class TestCachedImages(testtools.TestCase):
         result = self.controller.get_queued_images(req)
         self.assertEqual({'queued_images': {'test': 'passed'}}, result)
 
+    def test_get_stats(self):
+        req = webob.Request.blank('')
+        req.context = 'test'
+        result = self.controller.get_stats(req)
+        self.assertEqual({'cache_stats': {'counters': {'hits': 1},
+                                          'hit_ratio': 1.0}}, result)
+
+    def test_reset_stats(self):
+        req = webob.Request.blank('')
+        req.context = 'test'
+        self.controller.reset_stats(req)
+        self.assertTrue(self.controller.cache.stats_reset)
+
     def test_queue_image(self):
         req = webob.Request.blank('')
         req.context = 'test'
         self.controller.queue_image(req, image_id='test1')
+        self.assertEqual([('test1', 0)], self.controller.cache.queued_images)
+
+    def test_queue_image_with_priority(self):
+        req = webob.Request.blank('?priority=10')
+        req.context = 'test'
+        self.controller.queue_image(req, image_id='test1')
+        self.assertEqual([('test1', 10)],
+                         self.controller.cache.queued_images)
+
+    def test_queue_image_with_bad_priority(self):
+        req = webob.Request.blank('?priority=high')
+        req.context = 'test'
+        self.assertRaises(webob.exc.HTTPBadRequest,
+                          self.controller.queue_image, req, image_id='test1')
 
     def test_delete_queued_image(self):
         req = webob.Request.blank('')
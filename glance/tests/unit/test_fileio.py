@@ -0,0 +1,128 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+
+from glance.common import fileio
+from glance.tests import utils as test_utils
+
+
+class TestOnePassFile(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestOnePassFile, self).setUp()
+        self.path = os.path.join(self.test_dir, 'image')
+        self.advice = []
+        self.preallocated = []
+
+        def fake_fadvise(fd, offset, length, advice):
+            self.advice.append((offset, length, advice))
+            return True
+
+        def fake_preallocate(fd, length):
+            self.preallocated.append(length)
+            return True
+
+        self.stubs.Set(fileio, 'fadvise', fake_fadvise)
+        self.stubs.Set(fileio, 'preallocate', fake_preallocate)
+        self.stubs.Set(fileio, '_sync_range',
+                       lambda fd, offset, length, flags: True)
+
+    def _write(self, chunks, size=None):
+        with fileio.OnePassFile(open(self.path, 'wb'), size) as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def test_write_preallocates(self):
+        self._write(['*' * 10] * 3, 30)
+        self.assertEqual([30], self.preallocated)
+        self.assertEqual('*' * 30, open(self.path).read())
+
+    def test_write_without_size(self):
+        self._write(['*' * 10] * 3)
+        self.assertEqual([], self.preallocated)
+
+    def test_preallocate_disabled(self):
+        self.config(image_file_preallocate=False)
+        self._write(['*' * 10] * 3, 30)
+        self.assertEqual([], self.preallocated)
+
+    def test_short_write_is_truncated(self):
+        truncated = []
+        self.stubs.Set(os, 'ftruncate',
+                       lambda fd, length: truncated.append(length))
+        self._write(['*' * 10] * 3, 100)
+        self.assertEqual([30], truncated)
+        self.assertEqual(30, os.path.getsize(self.path))
+
+    def test_write_drops_cache(self):
+        self.config(image_file_bytes_per_sync=20)
+        self._write(['*' * 10] * 5)
+        self.assertEqual([(0, 20, fileio.POSIX_FADV_DONTNEED),
+                          (20, 20, fileio.POSIX_FADV_DONTNEED),
+                          (40, 10, fileio.POSIX_FADV_DONTNEED)],
+                         self.advice)
+        self.assertEqual('*' * 50, open(self.path).read())
+
+    def test_write_waits_for_writeback_in_native_thread(self):
+        executed = []
+
+        def fake_execute(func, *args):
+            executed.append(args[1:])
+            return func(*args)
+
+        self.stubs.Set(fileio.tpool, 'execute', fake_execute)
+        self.config(image_file_bytes_per_sync=20)
+        self._write(['*' * 10] * 5)
+        wait = (fileio.SYNC_FILE_RANGE_WAIT_BEFORE |
+                fileio.SYNC_FILE_RANGE_WRITE |
+                fileio.SYNC_FILE_RANGE_WAIT_AFTER)
+        self.assertEqual([(0, 20, wait), (20, 20, wait), (40, 10, wait)],
+                         executed)
+
+    def test_write_keeps_cache_without_sync_range(self):
+        self.config(image_file_bytes_per_sync=20)
+        self.stubs.Set(fileio, '_sync_range',
+                       lambda fd, offset, length, flags: False)
+        self._write(['*' * 10] * 5)
+        self.assertEqual([], self.advice)
+        self.assertEqual('*' * 50, open(self.path).read())
+
+    def test_small_write_keeps_cache(self):
+        self.config(image_file_bytes_per_sync=100)
+        self._write(['*' * 10] * 5)
+        self.assertEqual([], self.advice)
+
+    def test_drop_cache_disabled(self):
+        self.config(image_file_bytes_per_sync=20, image_file_drop_cache=False)
+        self._write(['*' * 10] * 5)
+        self.assertEqual([], self.advice)
+
+    def test_read(self):
+        self.config(image_file_bytes_per_sync=20)
+        self._write(['0123456789'] * 5)
+        del self.advice[:]
+
+        with fileio.OnePassFile(open(self.path, 'rb')) as f:
+            f.seek(5)
+            data = f.read(30)
+            self.assertEqual('56789' + '0123456789' * 2 + '01234', data)
+            self.assertEqual(15, len(f.read()))
+        self.assertEqual([(0, 0, fileio.POSIX_FADV_SEQUENTIAL),
+                          (5, 30, fileio.POSIX_FADV_DONTNEED),
+                          (35, 0, fileio.POSIX_FADV_DONTNEED)],
+                         self.advice)
@@ -27,6 +27,7 @@ import StringIO
 import mox
 
 from glance.common import exception
+from glance.common import fileio
 from glance.openstack.common import uuidutils
 from glance.store.filesystem import Store, ChunkedFile
 from glance.store.location import get_location_from_uri
@@ -74,6 +75,38 @@ class TestStore(base.IsolatedUnitTest):
         self.assertEqual(expected_data, data)
         self.assertEqual(expected_num_chunks, num_chunks)
 
+    def test_get_range(self):
+        """Test retrieving a byte range of an image"""
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        image_file = StringIO.StringIO(file_contents)
+        self.store.add(image_id, image_file, len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=5, length=8)
+        self.assertEqual(8, image_size)
+        self.assertEqual("00000rem", "".join(image_file))
+
+        (image_file, image_size) = self.store.get(loc, offset=15)
+        self.assertEqual(4, image_size)
+        self.assertEqual("nder", "".join(image_file))
+
+    def test_get_chunk_size(self):
+        """Test that filesystem_store_chunk_size sets the chunk size"""
+        self.config(filesystem_store_chunk_size=4)
+        image_id = uuidutils.generate_uuid()
+        file_contents = "chunk00000remainder"
+        image_file = StringIO.StringIO(file_contents)
+        self.store.add(image_id, image_file, len(file_contents))
+
+        uri = "file:///%s/%s" % (self.test_dir, image_id)
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc)
+        chunks = list(image_file)
+        self.assertEqual(5, len(chunks))
+        self.assertEqual(file_contents, "".join(chunks))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a file that doesn't exist
@@ -220,6 +253,24 @@ class TestStore(base.IsolatedUnitTest):
         """
         self._do_test_add_write_failure(errno.ENOSPC, exception.StorageFull)
 
+    def test_add_preallocation_failure(self):
+        """
+        Tests that failing to reserve the space of an image raises
+        StorageFull before any data is written
+        """
+        image_id = uuidutils.generate_uuid()
+        path = os.path.join(self.test_dir, image_id)
+        image_file = StringIO.StringIO("*" * 1024)
+
+        def fake_preallocate(fd, length):
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+
+        self.stubs.Set(fileio, 'preallocate', fake_preallocate)
+        self.assertRaises(exception.StorageFull,
+                          self.store.add,
+                          image_id, image_file, 1024)
+        self.assertFalse(os.path.exists(path))
+
     def test_add_file_too_big(self):
         """
         Tests that adding an excessively large image file
@@ -294,3 +345,69 @@ class TestStore(base.IsolatedUnitTest):
         self.assertRaises(exception.NotFound,
                           self.store.delete,
                           loc)
+
+    def _add_image(self, contents):
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum, _ = self.store.add(
+            image_id, StringIO.StringIO(contents), len(contents))
+        return get_location_from_uri(location)
+
+    def test_copy_clone(self):
+        """Test copying an image file as a reflink"""
+        cloned = []
+
+        def fake_clone(src_fd, dst_fd):
+            cloned.append((src_fd, dst_fd))
+            os.write(dst_fd, os.read(src_fd, 100))
+            return True
+
+        self.stubs.Set(fileio, 'clone', fake_clone)
+        src_loc = self._add_image("chunk00000remainder")
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum, _ = self.store.copy(src_loc, image_id, 0)
+        path = os.path.join(self.test_dir, image_id)
+        self.assertEqual("file://%s" % path, location)
+        self.assertEqual(19, size)
+        self.assertEqual(None, checksum)
+        self.assertEqual(1, len(cloned))
+        self.assertEqual("chunk00000remainder", open(path).read())
+        self.assertNotEqual(os.stat(src_loc.store_location.path).st_ino,
+                            os.stat(path).st_ino)
+
+    def test_copy_hard_link(self):
+        """Test copying an image file as a hard link without reflinks"""
+        self.stubs.Set(fileio, 'clone', lambda src_fd, dst_fd: False)
+        src_loc = self._add_image("chunk00000remainder")
+        image_id = uuidutils.generate_uuid()
+        location, size, checksum, _ = self.store.copy(src_loc, image_id, 0)
+        path = os.path.join(self.test_dir, image_id)
+        self.assertEqual(19, size)
+        self.assertEqual(os.stat(src_loc.store_location.path).st_ino,
+                         os.stat(path).st_ino)
+
+        # Deleting either image leaves the data of the other
+        self.store.delete(src_loc)
+        self.assertEqual("chunk00000remainder", open(path).read())
+
+    def test_copy_already_existing(self):
+        """Test copying an image file to an existing image"""
+        src_loc = self._add_image("chunk00000remainder")
+        dst_loc = self._add_image("other")
+        image_id = os.path.basename(dst_loc.store_location.path)
+        self.assertRaises(exception.Duplicate,
+                          self.store.copy, src_loc, image_id, 0)
+        self.assertEqual("other", open(dst_loc.store_location.path).read())
+
+    def test_copy_outside_datadir(self):
+        """Test files outside of the store directory are not copied"""
+        src_dir = os.path.join(self.test_dir, 'other')
+        os.mkdir(src_dir)
+        src_path = os.path.join(src_dir, 'image')
+        with open(src_path, 'w') as f:
+            f.write('data')
+        src_loc = get_location_from_uri("file://%s" % src_path)
+        image_id = uuidutils.generate_uuid()
+        self.assertRaises(exception.StoreCopyNotSupported,
+                          self.store.copy, src_loc, image_id, 0)
+        self.assertFalse(os.path.exists(os.path.join(self.test_dir,
+                                                     image_id)))
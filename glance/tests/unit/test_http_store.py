@@ -106,6 +106,22 @@ class TestHttpStore(base.StoreClearingUnitTest):
         chunks = [c for c in image_file]
         self.assertEqual(chunks, expected_returns)
 
+    def test_http_get_range(self):
+        range_resp = utils.FakeHTTPResponse(status=206, data='a teapot')
+        FAKE_RESPONSE_STACK.append(range_resp)
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=5, length=8)
+        self.assertEqual(image_size, 8)
+        self.assertEqual('a teapot', ''.join(image_file))
+
+    def test_http_get_range_not_supported_by_server(self):
+        uri = "http://netloc/path/to/file.tar.gz"
+        loc = get_location_from_uri(uri)
+        (image_file, image_size) = self.store.get(loc, offset=5, length=8)
+        self.assertEqual(image_size, 8)
+        self.assertEqual('a teapot', ''.join(image_file))
+
     def test_http_get_redirect(self):
         # Add two layers of redirects to the response stack, which will
         # return the default 200 OK with the expected data after resolving
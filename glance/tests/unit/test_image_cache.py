@@ -23,11 +23,17 @@ import StringIO
 import tempfile
 import time
 
+import eventlet
 import fixtures
+from oslo.config import cfg
 import stubout
 
 from glance.common import exception
+from glance.common import utils
 from glance import image_cache
+from glance.image_cache.drivers import base
+from glance.image_cache import partitions
+from glance.image_cache import policies
 #NOTE(bcwaldon): This is imported to load the registry config options
 import glance.registry
 import glance.store.filesystem as fs_store
@@ -35,6 +41,9 @@ import glance.store.s3 as s3_store
 from glance.tests import utils as test_utils
 from glance.tests.utils import skip_if_disabled, xattr_writes_supported
 
+CONF = cfg.CONF
+CONF.import_opt('image_cache_block_size', 'glance.image_cache.drivers.blocks')
+
 FIXTURE_LENGTH = 1024
 FIXTURE_DATA = '*' * FIXTURE_LENGTH
 
@@ -242,6 +251,36 @@ class ImageCacheTestCase(object):
         self.assertEqual(0, self.cache.get_cache_size())
         self.assertFalse(self.cache.is_cached('xxx'))
 
+    @skip_if_disabled
+    def test_prune_returns_totals(self):
+        """
+        Test that pruning reports the number of files and bytes it removed
+        """
+        for x in xrange(0, 8):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        self.assertEqual((3, 3 * 1024), self.cache.prune())
+        self.assertEqual(5 * 1024, self.cache.get_cache_size())
+        self.assertEqual((0, 0), self.cache.prune())
+
+    @skip_if_disabled
+    def test_delete_cached_images(self):
+        """
+        Test that a batch of cached images can be removed at once
+        """
+        for x in xrange(0, 3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        self.cache.driver.delete_cached_images(['0', '2'])
+
+        self.assertFalse(self.cache.is_cached(0))
+        self.assertTrue(self.cache.is_cached(1))
+        self.assertFalse(self.cache.is_cached(2))
+        self.assertEqual(['1'], [i['image_id'] for i in
+                                 self.cache.get_cached_images()])
+
     @skip_if_disabled
     def test_queue(self):
         """
@@ -282,6 +321,29 @@ class ImageCacheTestCase(object):
         self.assertEqual(self.cache.get_queued_images(),
                          ['0', '1', '2'])
 
+    def test_queue_priority(self):
+        """
+        Test that queued images are ordered by priority and that queueing
+        an image again can only raise its priority
+        """
+        self.assertTrue(self.cache.queue_image('bulk'))
+        self.assertTrue(self.cache.queue_image('urgent', priority=10))
+        self.assertTrue(self.cache.queue_image('later', priority=-1))
+        self.assertEqual(['urgent', 'bulk', 'later'],
+                         self.cache.get_queued_images())
+
+        self.assertFalse(self.cache.queue_image('urgent', priority=5))
+        self.assertTrue(self.cache.queue_image('later', priority=20))
+        self.assertEqual(20, self.cache.driver.get_queued_priority('later'))
+        self.assertEqual(['later', 'urgent', 'bulk'],
+                         self.cache.get_queued_images())
+
+        # Queue files written without a priority count as priority 0
+        path = self.cache.driver.get_image_filepath('old', 'queue')
+        open(path, 'w').close()
+        self.assertEqual(0, self.cache.driver.get_queued_priority('old'))
+        self.assertEqual(None, self.cache.driver.get_queued_priority('none'))
+
     def test_open_for_write_good(self):
         """
         Test to see if open_for_write works in normal case
@@ -403,6 +465,135 @@ class ImageCacheTestCase(object):
         self.assertFalse(os.path.exists(incomplete_file_path))
         self.assertTrue(os.path.exists(invalid_file_path))
 
+    def test_open_for_write_is_exclusive(self):
+        """
+        Test that only one writer at a time can fill an image
+        """
+        image_id = '1'
+        with self.cache.driver.open_for_write(image_id) as cache_file:
+            cache_file.write('a')
+            self.assertRaises(exception.Duplicate,
+                              self.cache.driver.open_for_write(
+                                  image_id).__enter__)
+        self.assertTrue(self.cache.is_cached(image_id))
+
+    def _start_cache_fill(self, image_id, data):
+        leader = self.cache.get_caching_iter(image_id, None, iter(data))
+        self.assertEqual(data[0], leader.next())
+        self.assertTrue(self.cache.is_being_cached(image_id))
+        return leader
+
+    def test_caching_iter_follows_cache_fill(self):
+        """
+        Test that a request for an image that is being cached streams the
+        cache fill instead of its own image iterator
+        """
+        image_id = '1'
+        data = ['a' * 65536, 'b' * 65536, 'c' * 65536]
+        leader = self._start_cache_fill(image_id, data)
+
+        backend = StringIO.StringIO(''.join(data))
+        follower = self.cache.get_caching_iter(image_id, None,
+                                               utils.chunkiter(backend))
+        self.assertEqual(data[0], follower.next())
+
+        self.assertEqual(data[1:], list(leader))
+        self.assertEqual(''.join(data[1:]), ''.join(follower))
+        self.assertTrue(self.cache.is_cached(image_id))
+        # The follower never read from its own image iterator
+        self.assertEqual(0, backend.tell())
+
+    def test_cache_tee_iter_follows_after_losing_claim(self):
+        """
+        Test that a writer that loses the race to claim an image follows
+        the winning cache fill
+        """
+        image_id = '1'
+        data = ['a' * 65536, 'b' * 65536]
+        leader = self._start_cache_fill(image_id, data)
+
+        follower = self.cache.cache_tee_iter(image_id, iter(data), None)
+        self.assertEqual(data[0], follower.next())
+        list(leader)
+        self.assertEqual(data[1:], list(follower))
+
+    def test_follower_falls_back_when_cache_fill_fails(self):
+        """
+        Test that followers continue from their own image iterator at the
+        right offset when the cache fill they follow fails
+        """
+        def faulty_backend():
+            yield 'a' * 65536
+            raise exception.GlanceException('Backend failure')
+
+        image_id = '1'
+        leader = self.cache.get_caching_iter(image_id, None, faulty_backend())
+        leader.next()
+
+        data = ['a' * 65536, 'b' * 1000, 'c' * 65536]
+        follower = self.cache.get_caching_iter(image_id, None, iter(data))
+        self.assertEqual('a' * 65536, follower.next())
+
+        self.assertRaises(exception.GlanceException, list, leader)
+        self.assertEqual(''.join(data[1:]), ''.join(follower))
+        self.assertFalse(self.cache.is_cached(image_id))
+
+    def test_follower_without_fallback_sees_failure(self):
+        """
+        Test that a failure of the cache fill is raised to followers that
+        have no other source for the image
+        """
+        def faulty_backend():
+            yield 'a' * 65536
+            raise exception.GlanceException('Backend failure')
+
+        image_id = '1'
+        leader = self.cache.get_caching_iter(image_id, None, faulty_backend())
+        leader.next()
+
+        follower = self.cache.follow_caching_iter(image_id)
+        self.assertEqual('a' * 65536, follower.next())
+        self.assertRaises(exception.GlanceException, list, leader)
+        self.assertRaises(exception.ImageCacheFillFailed, follower.next)
+
+    def test_follower_gives_up_on_stalled_cache_fill(self):
+        """
+        Test that followers stop waiting for a cache fill that makes no
+        progress
+        """
+        self.config(image_cache_follow_timeout=0)
+        self.stubs.Set(image_cache, 'FOLLOW_POLL_INTERVAL', 0.01)
+        image_id = '1'
+        leader = self._start_cache_fill(image_id, ['a' * 65536, 'b'])
+
+        follower = self.cache.follow_caching_iter(image_id)
+        follower.next()
+        self.assertRaises(exception.ImageCacheFillFailed, follower.next)
+        list(leader)
+
+    def test_dead_cache_fill_not_followed(self):
+        """
+        Test that a cache fill that has written nothing for longer than
+        the follow timeout is taken for dead, and the image read from
+        the store instead
+        """
+        self.config(image_cache_follow_timeout=60)
+        image_id = '1'
+        leader = self._start_cache_fill(image_id, ['a' * 65536, 'b'])
+        self.assertTrue(self.cache.is_fill_active(image_id))
+        self.assertTrue(self.cache.driver.get_fill_mtime(image_id) <=
+                        time.time())
+
+        last_write = time.time() - 120
+        self.stubs.Set(self.cache.driver, 'get_fill_mtime',
+                       lambda image_id: last_write)
+        self.assertFalse(self.cache.is_fill_active(image_id))
+
+        data = ['c' * 65536, 'd']
+        follower = self.cache.get_caching_iter(image_id, None, iter(data))
+        self.assertEqual(data, list(follower))
+        list(leader)
+
     def test_gate_caching_iter_good_checksum(self):
         image = "12345678990abcdefghijklmnop"
         image_id = 123
@@ -545,6 +736,475 @@ class TestImageCacheSqlite(test_utils.BaseTestCase,
                     image_cache_max_size=1024 * 5)
         self.cache = image_cache.ImageCache()
 
+    def test_cache_size_tracked_in_db(self):
+        """
+        Test that the cache size and cache state come from the database
+        and are only reconciled with the filesystem by clean()
+        """
+        for x in xrange(0, 3):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        os.unlink(os.path.join(self.cache_dir, '0'))
+        self.assertEqual(3 * 1024, self.cache.get_cache_size())
+        self.assertTrue(self.cache.is_cached(0))
+
+        self.cache.clean()
+
+        self.assertEqual(2 * 1024, self.cache.get_cache_size())
+        self.assertFalse(self.cache.is_cached(0))
+
+    def test_clean_registers_untracked_files(self):
+        """
+        Test that clean() adds records for cache files the database
+        does not know about
+        """
+        with open(os.path.join(self.cache_dir, 'untracked'), 'wb') as f:
+            f.write(FIXTURE_DATA)
+
+        self.assertFalse(self.cache.is_cached('untracked'))
+        self.assertEqual(0, self.cache.get_cache_size())
+
+        self.cache.clean()
+
+        self.assertTrue(self.cache.is_cached('untracked'))
+        self.assertEqual(1024, self.cache.get_cache_size())
+
+    def test_is_being_cached_tracked_in_db(self):
+        """
+        Test that an image being written is recorded as such until the
+        write commits or rolls back
+        """
+        self.assertFalse(self.cache.driver.is_being_cached('1'))
+        with self.cache.driver.open_for_write('1') as cache_file:
+            self.assertTrue(self.cache.driver.is_being_cached('1'))
+            self.assertFalse(self.cache.driver.is_cacheable('1'))
+            cache_file.write(FIXTURE_DATA)
+        self.assertFalse(self.cache.driver.is_being_cached('1'))
+        self.assertEqual(1024, self.cache.get_cache_size())
+
+        try:
+            with self.cache.driver.open_for_write('2') as cache_file:
+                raise IOError
+        except IOError:
+            pass
+        self.assertFalse(self.cache.driver.is_being_cached('2'))
+        self.assertEqual(1024, self.cache.get_cache_size())
+
+    def test_hits_are_buffered_until_flushed(self):
+        """
+        Test that hits are kept in memory and written to the database
+        in one batch
+        """
+        self.config(image_cache_sqlite_flush_interval=60,
+                    image_cache_sqlite_flush_threshold=100)
+        for x in xrange(0, 2):
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(x, FIXTURE_FILE))
+
+        driver = self.cache.driver
+        for x in xrange(0, 3):
+            with driver.open_for_read(0):
+                pass
+        with driver.open_for_read(1):
+            pass
+
+        with driver.get_db() as db:
+            cur = db.execute("""SELECT SUM(hits) FROM cached_images""")
+            self.assertEqual(0, cur.fetchone()[0])
+
+        self.assertEqual(2, driver.flush_hits())
+        self.assertEqual(0, driver.flush_hits())
+        self.assertEqual(3, self.cache.get_hit_count(0))
+        self.assertEqual(1, self.cache.get_hit_count(1))
+
+    def test_queries_see_buffered_hits(self):
+        """
+        Test that reading hit counts and access times writes out the
+        buffered hits first
+        """
+        self.config(image_cache_sqlite_flush_interval=60)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+
+        self.cache.driver.record_hit('0', now=100.0)
+        self.cache.driver.record_hit('0', now=50.0)
+
+        entries = self.cache.get_cached_images()
+        self.assertEqual(2, entries[0]['hits'])
+        self.assertEqual(100.0, entries[0]['last_accessed'])
+
+    def test_flush_threshold_flushes_in_background(self):
+        self.config(image_cache_sqlite_flush_interval=60,
+                    image_cache_sqlite_flush_threshold=1)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+
+        self.cache.driver.record_hit('0')
+        self.assertEqual(1, len(self.cache.driver._pending_hits))
+        eventlet.sleep(0)
+
+        self.assertEqual({}, self.cache.driver._pending_hits)
+
+    def test_flush_interval_zero_writes_every_hit(self):
+        self.config(image_cache_sqlite_flush_interval=0)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+
+        with self.cache.driver.open_for_read('0'):
+            pass
+
+        self.assertEqual({}, self.cache.driver._pending_hits)
+        with self.cache.driver.get_db() as db:
+            cur = db.execute("""SELECT hits FROM cached_images""")
+            self.assertEqual(1, cur.fetchone()[0])
+
+    def test_deleted_image_drops_buffered_hits(self):
+        self.config(image_cache_sqlite_flush_interval=60)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+        self.cache.driver.record_hit('0')
+
+        self.cache.delete_cached_image('0')
+
+        self.assertEqual({}, self.cache.driver._pending_hits)
+
+    def test_failed_flush_keeps_hits(self):
+        self.config(image_cache_sqlite_flush_interval=60)
+        FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+        self.assertTrue(self.cache.cache_image_file('0', FIXTURE_FILE))
+        driver = self.cache.driver
+        driver.record_hit('0')
+
+        with driver.get_db() as db:
+            db.execute("""DROP TABLE cached_images""")
+        self.assertEqual(0, driver.flush_hits())
+        self.assertEqual(1, driver._pending_hits['0'][0])
+
+    def test_connection_is_reused_in_wal_mode(self):
+        driver = self.cache.driver
+        with driver.get_db() as db:
+            first = db
+            mode = db.execute("""PRAGMA journal_mode""").fetchone()[0]
+        with driver.get_db() as db:
+            self.assertTrue(db is first)
+        self.assertEqual('wal', mode.lower())
+
+
+class TestImageCacheBlocks(test_utils.BaseTestCase,
+                           ImageCacheTestCase):
+
+    """Tests image caching when images are cached in blocks"""
+
+    def setUp(self):
+        super(TestImageCacheBlocks, self).setUp()
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.config(image_cache_dir=self.cache_dir,
+                    image_cache_driver='blocks',
+                    image_cache_block_size=1024,
+                    image_cache_max_size=1024 * 5)
+        self.cache = image_cache.ImageCache()
+        self.data = ['a' * 1024, 'b' * 1024, 'c' * 1000]
+
+    def _cache_image(self, image_id):
+        caching_iter = self.cache.get_caching_iter(image_id, None,
+                                                   iter(self.data))
+        self.assertEqual(self.data, list(caching_iter))
+        self.assertTrue(self.cache.is_cached(image_id))
+
+    def test_open_for_write_with_exception(self):
+        image_id = '1'
+        try:
+            with self.cache.driver.open_for_write(image_id) as cache_file:
+                raise IOError
+        except IOError:
+            pass
+        self.assertFalse(self.cache.is_cached(image_id))
+        self.assertFalse(self.cache.is_being_cached(image_id))
+        incomplete_file_path = os.path.join(self.cache_dir,
+                                            'incomplete', image_id)
+        self.assertFalse(os.path.exists(incomplete_file_path))
+
+    def test_caching_iterator_falloffend(self):
+        caching_iter = self.cache.get_caching_iter('1', None,
+                                                   iter(self.data))
+        self.assertEqual(self.data[0], caching_iter.next())
+        caching_iter.close()
+        self.assertFalse(self.cache.is_cached('1'))
+        self.assertFalse(self.cache.is_being_cached('1'))
+
+    def test_abandoned_fill_keeps_blocks(self):
+        """
+        Test that the blocks stored by a fill that does not complete stay
+        cached and can be read, and that a later fill completes the image
+        """
+        image_id = '1'
+        caching_iter = self.cache.get_caching_iter(
+            image_id, None, iter(self.data), image_meta={'size': 3048})
+        caching_iter.next()
+        caching_iter.next()
+        caching_iter.close()
+
+        self.assertFalse(self.cache.is_cached(image_id))
+        self.assertFalse(self.cache.is_being_cached(image_id))
+        self.assertTrue(self.cache.is_partly_cached(image_id))
+        self.assertTrue(self.cache.is_range_cached(image_id, 0, 2048))
+        self.assertFalse(self.cache.is_range_cached(image_id, 1024, 1025))
+        self.assertEqual(3048, self.cache.get_image_size(image_id))
+        self.assertEqual(2048, self.cache.get_cache_size())
+        self.assertEqual('a' * 24 + 'b' * 1000,
+                         ''.join(self.cache.get_partial_iter(image_id, 1000,
+                                                             1024)))
+
+        self._cache_image(image_id)
+        self.assertFalse(self.cache.is_partly_cached(image_id))
+        self.assertEqual(3048, self.cache.get_cache_size())
+
+    def test_bad_data_removes_stored_blocks(self):
+        checksum = hashlib.md5('bad').hexdigest()
+        caching_iter = self.cache.get_caching_iter('1', checksum,
+                                                   iter(self.data))
+        self.assertRaises(exception.GlanceException, list, caching_iter)
+        self.assertFalse(self.cache.is_partly_cached('1'))
+        self.assertEqual(0, self.cache.get_cache_size())
+
+    def test_prune_evicts_cold_blocks(self):
+        """
+        Test that pruning removes the blocks of an image that are not
+        read, keeping those that are
+        """
+        self.config(image_cache_max_size=2048)
+        self._cache_image('1')
+        with self.cache.open_for_read('1') as cache_file:
+            self.assertEqual(self.data[0], cache_file.read(1024))
+
+        self.assertEqual((1, 1000), self.cache.prune())
+        self.assertFalse(self.cache.is_cached('1'))
+        self.assertTrue(self.cache.is_range_cached('1', 0, 2048))
+        self.assertEqual(2048, self.cache.get_cache_size())
+
+    def test_tail_blocks_are_evicted_first(self):
+        self.config(image_cache_max_size=1024)
+        self._cache_image('1')
+        with self.cache.open_for_read('1') as cache_file:
+            self.assertEqual(''.join(self.data), cache_file.read())
+
+        self.assertEqual((2, 2024), self.cache.prune())
+        self.assertTrue(self.cache.is_range_cached('1', 0, 1024))
+
+    def test_corrupt_block_is_removed(self):
+        self._cache_image('1')
+        with open(self.cache.driver.get_block_path('1', 1), 'wb') as f:
+            f.write('x' * 1024)
+
+        def read():
+            with self.cache.open_for_read('1') as cache_file:
+                return cache_file.read()
+
+        self.assertRaises(exception.ImageCacheBlockInvalid, read)
+        self.assertFalse(self.cache.is_cached('1'))
+        self.assertFalse(self.cache.is_range_cached('1', 1024, 1))
+        self.assertEqual(2024, self.cache.get_cache_size())
+
+    def test_clean_reconciles_blocks(self):
+        self._cache_image('1')
+        os.unlink(self.cache.driver.get_block_path('1', 2))
+
+        self.cache.clean()
+
+        self.assertFalse(self.cache.is_cached('1'))
+        self.assertTrue(self.cache.is_range_cached('1', 0, 2048))
+        self.assertEqual(2048, self.cache.get_cache_size())
+
+
+class TestImageCacheShards(test_utils.BaseTestCase):
+
+    """Tests an image cache spread over several shard directories"""
+
+    def setUp(self):
+        super(TestImageCacheShards, self).setUp()
+        self.cache_dir = self.useFixture(fixtures.TempDir()).path
+        self.shard_dirs = [self.useFixture(fixtures.TempDir()).path
+                           for i in xrange(3)]
+        self._configure(self.shard_dirs[:2])
+        self.image_ids = ['image-%d' % i for i in xrange(20)]
+
+    def _configure(self, shard_dirs):
+        self.config(image_cache_dir=self.cache_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_shard_dirs=shard_dirs,
+                    image_cache_max_size=1024 * 20)
+        self.cache = image_cache.ImageCache()
+
+    def _cache_images(self):
+        for image_id in self.image_ids:
+            FIXTURE_FILE = StringIO.StringIO(FIXTURE_DATA)
+            self.assertTrue(self.cache.cache_image_file(image_id,
+                                                        FIXTURE_FILE))
+
+    def _read(self, image_id):
+        with self.cache.open_for_read(image_id) as cache_file:
+            return cache_file.read()
+
+    def test_images_are_placed_by_hash(self):
+        self._cache_images()
+
+        owners = set()
+        for image_id in self.image_ids:
+            owner = self.cache.driver.get_owner_shard(image_id)
+            owners.add(owner)
+            self.assertTrue(os.path.exists(os.path.join(owner, image_id)))
+            self.assertFalse(os.path.exists(os.path.join(self.cache_dir,
+                                                         image_id)))
+            self.assertEqual(FIXTURE_DATA, self._read(image_id))
+        self.assertEqual(set(self.shard_dirs[:2]), owners)
+        self.assertEqual(20 * 1024, self.cache.get_cache_size())
+
+    def test_prune_runs_per_shard(self):
+        self._cache_images()
+        self.config(image_cache_max_size=1024 * 8)
+
+        counts = {}
+        for image_id in self.image_ids:
+            owner = self.cache.driver.get_owner_shard(image_id)
+            counts[owner] = counts.get(owner, 0) + 1
+        pruned = sum([max(count - 4, 0) for count in counts.values()])
+
+        self.assertEqual((pruned, pruned * 1024), self.cache.prune())
+        for shard_dir in self.shard_dirs[:2]:
+            remaining = [image_id for image_id in self.image_ids
+                         if os.path.exists(os.path.join(shard_dir,
+                                                        image_id))]
+            self.assertEqual(min(counts[shard_dir], 4), len(remaining))
+
+    def test_shard_weights(self):
+        self._configure(['%s:3' % self.shard_dirs[0], self.shard_dirs[1]])
+        self.image_ids = ['image-%d' % i for i in xrange(200)]
+        owners = [self.cache.driver.get_owner_shard(image_id)
+                  for image_id in self.image_ids]
+        self.assertTrue(owners.count(self.shard_dirs[0]) >
+                        2 * owners.count(self.shard_dirs[1]))
+
+    def test_adding_shard_moves_few_images(self):
+        self._cache_images()
+        before = dict([(image_id, self.cache.driver.get_owner_shard(image_id))
+                       for image_id in self.image_ids])
+
+        self._configure(self.shard_dirs)
+        for image_id in self.image_ids:
+            self.assertTrue(self.cache.is_cached(image_id))
+            self.assertEqual(FIXTURE_DATA, self._read(image_id))
+
+        self.cache.clean()
+
+        moved = 0
+        for image_id in self.image_ids:
+            owner = self.cache.driver.get_owner_shard(image_id)
+            if owner != before[image_id]:
+                self.assertEqual(self.shard_dirs[2], owner)
+                self.assertFalse(os.path.exists(
+                    os.path.join(before[image_id], image_id)))
+                moved += 1
+            self.assertTrue(os.path.exists(os.path.join(owner, image_id)))
+            self.assertEqual(FIXTURE_DATA, self._read(image_id))
+        self.assertTrue(0 < moved < len(self.image_ids))
+        self.assertEqual(20 * 1024, self.cache.get_cache_size())
+
+    def test_invalid_weight(self):
+        self.config(image_cache_shard_dirs=['%s:x' % self.shard_dirs[0]])
+        driver = base.Driver()
+        self.assertRaises(exception.BadDriverConfiguration,
+                          driver.set_paths)
+
+
+class TestImageCachePartitions(test_utils.BaseTestCase):
+
+    """Tests an image cache partitioned by visibility and owner"""
+
+    def setUp(self):
+        super(TestImageCachePartitions, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 10,
+                    image_cache_public_reserved_share=0.5,
+                    image_cache_tenant_max_share=0.3)
+        self.cache = image_cache.ImageCache()
+
+    def _cache(self, image_id, owner, is_public=False):
+        image_meta = {'size': FIXTURE_LENGTH, 'disk_format': 'raw',
+                      'owner': owner, 'is_public': is_public}
+        list(self.cache.get_caching_iter(image_id, None,
+                                         iter([FIXTURE_DATA]), image_meta))
+        self.assertTrue(self.cache.is_cached(image_id))
+
+    def test_get_partition(self):
+        self.assertEqual('public', partitions.get_partition(
+            {'owner': 'a', 'is_public': 'True'}))
+        self.assertEqual('public', partitions.get_partition(
+            {'owner': None, 'is_public': False}))
+        self.assertEqual('tenant:a', partitions.get_partition(
+            {'owner': 'a', 'is_public': 'False'}))
+        self.assertEqual('tenant:a', partitions.get_partition(
+            {'owner': 'a', 'visibility': 'private'}))
+        self.assertEqual('public', partitions.get_partition(
+            {'owner': 'a', 'visibility': 'public'}))
+        self.assertEqual(None, partitions.get_partition({'size': 1}))
+
+    def test_tenant_over_max_share_is_pruned(self):
+        for i in xrange(5):
+            self._cache('a-%d' % i, 'a')
+        self._cache('b-0', 'b')
+
+        self.assertEqual((2, 2048), self.cache.prune())
+        cached = [i for i in xrange(5) if self.cache.is_cached('a-%d' % i)]
+        self.assertEqual(3, len(cached))
+        self.assertTrue(self.cache.is_cached('b-0'))
+
+    def test_tenant_max_share_override(self):
+        self.config(image_cache_tenant_max_shares={'a': '0.1'})
+        self.cache = image_cache.ImageCache()
+        for i in xrange(3):
+            self._cache('a-%d' % i, 'a')
+            self._cache('b-%d' % i, 'b')
+
+        self.assertEqual((2, 2048), self.cache.prune())
+        for i in xrange(3):
+            self.assertTrue(self.cache.is_cached('b-%d' % i))
+
+    def test_public_reserved_share_is_kept(self):
+        for i in xrange(5):
+            self._cache('public-%d' % i, 'a', is_public=True)
+        for tenant in ('b', 'c', 'd'):
+            for i in xrange(3):
+                self._cache('%s-%d' % (tenant, i), tenant)
+
+        self.assertEqual((4, 4096), self.cache.prune())
+        for i in xrange(5):
+            self.assertTrue(self.cache.is_cached('public-%d' % i))
+        self.assertEqual(1024 * 10, self.cache.get_cache_size())
+
+    def test_stats_report_partitions(self):
+        self._cache('public-0', 'a', is_public=True)
+        self._cache('a-0', 'a')
+        self._cache('a-1', 'a')
+
+        report = self.cache.get_stats()['partitions']
+        self.assertEqual({'size': 1024, 'reserved_size': 1024 * 5,
+                          'max_size': 1024 * 10}, report['public'])
+        self.assertEqual({'size': 2048, 'reserved_size': 0,
+                          'max_size': 1024 * 3}, report['tenant:a'])
+
+    def test_deleting_image_drops_partition(self):
+        self._cache('a-0', 'a')
+        self.assertEqual({'a-0': 'tenant:a'}, self.cache.partitions.get_all())
+        self.cache.delete_cached_image('a-0')
+        self.assertEqual({}, self.cache.partitions.get_all())
+
+    def test_invalid_share(self):
+        self.config(image_cache_tenant_max_share=1.5)
+        self.assertRaises(exception.BadDriverConfiguration,
+                          image_cache.ImageCache)
+
 
 class TestImageCacheNoDep(test_utils.BaseTestCase):
 
@@ -552,6 +1212,7 @@ class TestImageCacheNoDep(test_utils.BaseTestCase):
         super(TestImageCacheNoDep, self).setUp()
 
         self.driver = None
+        self.config(image_cache_dir=self.test_dir)
 
         def init_driver(self2):
             self2.driver = self.driver
@@ -601,3 +1262,130 @@ class TestImageCacheNoDep(test_utils.BaseTestCase):
 
         caching_iter = cache.get_caching_iter('dummy_id', None, iter(data))
         self.assertEqual(list(caching_iter), data)
+
+    def test_prune_scans_driver_once(self):
+
+        class PlanningDriver(base.Driver):
+
+            def __init__(self):
+                self.entries = [('a', 4), ('b', 3), ('c', 2), ('d', 1)]
+                self.scans = 0
+                self.deleted = []
+
+            def get_cache_size(self):
+                return sum([size for image_id, size in self.entries])
+
+            def get_cached_images(self):
+                self.scans += 1
+                return [{'image_id': image_id, 'size': size, 'hits': 0,
+                         'last_accessed': i}
+                        for i, (image_id, size) in enumerate(self.entries)]
+
+            def delete_cached_images(self, image_ids):
+                self.deleted.extend(image_ids)
+
+        self.driver = PlanningDriver()
+        self.config(image_cache_max_size=5)
+        cache = image_cache.ImageCache()
+
+        self.assertEqual((2, 7), cache.prune())
+        self.assertEqual(1, self.driver.scans)
+        self.assertEqual(['a', 'b'], self.driver.deleted)
+
+    def test_prune_deletes_in_batches(self):
+
+        class BatchDriver(base.Driver):
+
+            def __init__(self):
+                self.batches = []
+
+            def get_cache_size(self):
+                return 250
+
+            def get_cached_images(self):
+                return [{'image_id': str(i), 'size': 1, 'hits': 0,
+                         'last_accessed': i} for i in xrange(250)]
+
+            def delete_cached_images(self, image_ids):
+                self.batches.append(len(image_ids))
+
+        self.driver = BatchDriver()
+        self.config(image_cache_max_size=0)
+        self.stubs.Set(image_cache, 'PRUNE_BATCH_SIZE', 100)
+        cache = image_cache.ImageCache()
+
+        self.assertEqual((250, 250), cache.prune())
+        self.assertEqual([100, 100, 50], self.driver.batches)
+
+    def test_prune_keeps_policy_state(self):
+
+        class GhostDriver(base.Driver):
+
+            def __init__(self):
+                self.entries = [('a', 0), ('b', 5), ('c', 5)]
+                self.deleted = []
+
+            def get_cache_size(self):
+                return len(self.entries)
+
+            def get_cached_images(self):
+                return [{'image_id': image_id, 'size': 1, 'hits': hits,
+                         'last_accessed': i}
+                        for i, (image_id, hits) in enumerate(self.entries)]
+
+            def delete_cached_images(self, image_ids):
+                self.deleted.extend(image_ids)
+                self.entries = [(image_id, hits)
+                                for image_id, hits in self.entries
+                                if image_id not in image_ids]
+
+        self.driver = GhostDriver()
+        self.config(image_cache_max_size=2,
+                    image_cache_eviction_policy='arc')
+        image_cache.ImageCache().prune()
+        self.assertEqual(['a'], self.driver.deleted)
+
+        # 'a' is cached again, and is found in the ghost list of the last
+        # prune rather than taken for an image seen once
+        self.driver.entries.append(('a', 0))
+        self.driver.deleted = []
+        image_cache.ImageCache().prune()
+        self.assertEqual(['b'], self.driver.deleted)
+        states = policies.read_states(
+            os.path.join(self.test_dir, image_cache.POLICY_STATE_DIR,
+                         image_cache.POLICY_STATE_FILE),
+            'arc')
+        self.assertEqual(1, states['cache']['target'])
+
+    def test_prune_uses_configured_policy(self):
+
+        class PolicyDriver(base.Driver):
+
+            def __init__(self):
+                self.deleted = []
+
+            def get_cache_size(self):
+                return 1100
+
+            def get_cached_images(self):
+                # 'big' is the most recently used, but was only hit once
+                return [{'image_id': 'small', 'size': 100, 'hits': 50,
+                         'last_accessed': 1},
+                        {'image_id': 'big', 'size': 1000, 'hits': 1,
+                         'last_accessed': 2}]
+
+            def delete_cached_images(self, image_ids):
+                self.deleted.extend(image_ids)
+
+        self.driver = PolicyDriver()
+        self.config(image_cache_max_size=1000)
+
+        self.config(image_cache_eviction_policy='lru')
+        image_cache.ImageCache().prune()
+        self.assertEqual(['small'], self.driver.deleted)
+
+        for policy in ('lfu', 'gdsf'):
+            self.driver.deleted = []
+            self.config(image_cache_eviction_policy=policy)
+            image_cache.ImageCache().prune()
+            self.assertEqual(['big'], self.driver.deleted)
@@ -0,0 +1,164 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import StringIO
+
+from glance import image_cache
+from glance.image_cache import memory
+from glance.image_cache import policies
+from glance.tests import utils as test_utils
+
+
+class TestMemoryTier(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestMemoryTier, self).setUp()
+        self.tier = memory.MemoryTier(10)
+
+    def test_get_counts_hits_and_misses(self):
+        self.assertEqual(None, self.tier.get('a'))
+        self.assertTrue(self.tier.put('a', 'abc', 3))
+        self.assertEqual(('abc', 3), self.tier.get('a'))
+        stats = self.tier.get_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['images'])
+        self.assertEqual(3, stats['size'])
+
+    def test_get_prefix(self):
+        self.tier.put('a', 'abc', 100)
+        self.assertEqual(None, self.tier.get('a'))
+        self.assertEqual(('abc', 100), self.tier.get('a', 3))
+        self.assertEqual(None, self.tier.get('a', 4))
+
+    def test_put_evicts_to_capacity(self):
+        self.tier.put('a', '*' * 4, 4)
+        self.tier.put('b', '*' * 4, 4)
+        self.tier.get('a')
+        self.tier.put('c', '*' * 4, 4)
+        self.assertTrue('a' in self.tier)
+        self.assertFalse('b' in self.tier)
+        self.assertTrue('c' in self.tier)
+        self.assertEqual(1, self.tier.get_stats()['evictions'])
+        self.assertEqual(8, self.tier.get_stats()['size'])
+
+    def test_put_larger_than_capacity(self):
+        self.assertFalse(self.tier.put('a', '*' * 11, 11))
+        self.assertFalse('a' in self.tier)
+
+    def test_remove_and_clear(self):
+        self.tier.put('a', 'abc', 3)
+        self.tier.put('b', 'abc', 3)
+        self.tier.remove('a')
+        self.tier.remove('unknown')
+        self.assertFalse('a' in self.tier)
+        self.assertEqual(3, self.tier.get_stats()['size'])
+        self.tier.clear()
+        self.assertEqual(0, self.tier.get_stats()['images'])
+        self.assertEqual(0, self.tier.get_stats()['size'])
+
+    def test_clear_keeps_policy(self):
+        self.config(image_cache_memory_eviction_policy='lru')
+        tier = memory.MemoryTier(10, 'lfu')
+        tier.clear()
+        self.assertTrue(isinstance(tier.policy, policies.LFUPolicy))
+
+
+class TestImageCacheMemoryTier(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestImageCacheMemoryTier, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 100,
+                    image_cache_memory_size=1024 * 10,
+                    image_cache_memory_max_image_size=1024,
+                    image_cache_memory_prefix_size=100)
+        self.cache = image_cache.ImageCache()
+
+    def _cache_image(self, image_id, data):
+        self.assertTrue(self.cache.cache_image_file(
+            image_id, StringIO.StringIO(data)))
+
+    def test_disabled_by_default(self):
+        self.config(image_cache_memory_size=0)
+        cache = image_cache.ImageCache()
+        self.assertEqual(None, cache.memory)
+        self.assertEqual(None, cache.get_memory_stats())
+        self._cache_image('a', 'abc')
+        self.assertEqual(None, cache.get_memory_iter('a'))
+        self.assertEqual('abc', ''.join(cache.get_cached_iter('a')))
+
+    def test_small_image_served_from_memory(self):
+        data = ''.join(chr(i % 256) for i in xrange(1000))
+        self._cache_image('a', data)
+
+        self.assertEqual(data, ''.join(self.cache.get_cached_iter('a')))
+        self.assertTrue('a' in self.cache.memory)
+        self.assertEqual(data[10:30],
+                         ''.join(self.cache.get_cached_iter('a', 10, 20)))
+        self.assertEqual(data[990:],
+                         ''.join(self.cache.get_cached_iter('a', 990)))
+
+        stats = self.cache.get_memory_stats()
+        self.assertEqual(2, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(3, self.cache.driver.get_hit_count('a'))
+
+    def test_whole_image_not_read_from_disk(self):
+        self._cache_image('a', 'abc')
+        self.assertEqual('abc', ''.join(self.cache.get_cached_iter('a')))
+
+        # The cache file may be pruned while the image is held in memory
+        os.unlink(self.cache.driver.get_image_filepath('a'))
+        self.assertEqual('abc', ''.join(self.cache.get_cached_iter('a')))
+        self.assertEqual('c', ''.join(self.cache.get_cached_iter('a', 2)))
+
+    def test_prefix_of_large_image(self):
+        data = ''.join(chr(i % 256) for i in xrange(2048))
+        self._cache_image('big', data)
+
+        self.assertEqual(None, self.cache.get_memory_iter('big'))
+        self.assertEqual(data, ''.join(self.cache.get_cached_iter('big')))
+        self.assertEqual((data[:100], 2048), self.cache.memory.get('big', 0))
+
+        # Served partly from memory, partly from disk
+        self.assertEqual(data, ''.join(self.cache.get_cached_iter('big')))
+        self.assertEqual(data[50:150],
+                         ''.join(self.cache.get_cached_iter('big', 50, 100)))
+        self.assertEqual(data[200:300],
+                         ''.join(self.cache.get_cached_iter('big', 200, 100)))
+        # A file_wrapper only wants data held in full
+        self.assertEqual(None, self.cache.get_memory_iter('big', 0, 200,
+                                                          partial=False))
+        self.assertEqual(data[:50], ''.join(
+            self.cache.get_memory_iter('big', 0, 50, partial=False)))
+        self.assertEqual(5, self.cache.driver.get_hit_count('big'))
+
+    def test_deleting_image_drops_it_from_memory(self):
+        self._cache_image('a', 'abc')
+        self._cache_image('b', 'abc')
+        list(self.cache.get_cached_iter('a'))
+        list(self.cache.get_cached_iter('b'))
+
+        self.cache.delete_cached_image('a')
+        self.assertFalse('a' in self.cache.memory)
+        self.assertTrue('b' in self.cache.memory)
+
+        self.cache.delete_all_cached_images()
+        self.assertFalse('b' in self.cache.memory)
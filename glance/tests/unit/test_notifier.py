@@ -43,8 +43,9 @@ TENANT2 = '2c014f32-55eb-467d-8fcb-4bd706012f81'
 
 
 class ImageStub(glance.domain.Image):
-    def get_data(self):
-        return ['01234', '56789']
+    def get_data(self, offset=0, length=None):
+        end = None if length is None else offset + length
+        return ['0123456789'[offset:end]]
 
     def set_data(self, data, size=None):
         for chunk in data:
@@ -536,6 +537,16 @@ class TestImageNotifications(utils.BaseTestCase):
         self.assertEqual(output_log['payload']['bytes_sent'], 10)
         self.assertEqual(output_log['payload']['owner_id'], TENANT1)
 
+    def test_image_get_data_range_notification(self):
+        self.image_proxy.size = 10
+        data = ''.join(self.image_proxy.get_data(offset=2, length=5))
+        self.assertEqual(data, '23456')
+        output_logs = self.notifier.get_logs()
+        self.assertEqual(len(output_logs), 1)
+        output_log = output_logs[0]
+        self.assertEqual(output_log['notification_type'], 'INFO')
+        self.assertEqual(output_log['payload']['bytes_sent'], 5)
+
     def test_image_get_data_size_mismatch(self):
         self.image_proxy.size = 11
         list(self.image_proxy.get_data())
@@ -0,0 +1,196 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import time
+
+import eventlet
+import fixtures
+
+from glance.common import exception
+from glance.image_cache import prefetcher
+import glance.registry.client.v1.api as registry
+import glance.store
+from glance.tests import utils as test_utils
+
+FIXTURE_DATA = '*' * 1024
+
+
+class TestPrefetcher(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPrefetcher, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 5,
+                    image_cache_prefetch_workers=2)
+        self.images = {}
+        self.fetched = []
+
+        def fake_get_image_metadata(context, image_id):
+            try:
+                return self.images[image_id]
+            except KeyError:
+                raise exception.NotFound()
+
+        def fake_get_from_backend(context, location):
+            image_id = location.split('/')[-1]
+            self.fetched.append(image_id)
+            return iter([FIXTURE_DATA]), len(FIXTURE_DATA)
+
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+        self.stubs.Set(glance.store, 'get_from_backend',
+                       fake_get_from_backend)
+        self.prefetcher = prefetcher.Prefetcher()
+        self.cache = self.prefetcher.cache
+
+    def _add_image(self, image_id, size=len(FIXTURE_DATA), status='active'):
+        self.images[image_id] = {
+            'status': status,
+            'size': size,
+            'location': 'file:///images/%s' % image_id,
+            'checksum': hashlib.md5(FIXTURE_DATA).hexdigest(),
+        }
+
+    def test_run_fetches_queue(self):
+        for image_id in ('a', 'b', 'c'):
+            self._add_image(image_id)
+            self.assertTrue(self.cache.queue_image(image_id))
+
+        self.assertTrue(self.prefetcher.run())
+
+        self.assertEqual([], self.cache.get_queued_images())
+        for image_id in ('a', 'b', 'c'):
+            self.assertTrue(self.cache.is_cached(image_id))
+
+    def test_run_fetches_by_priority(self):
+        self.config(image_cache_prefetch_workers=1)
+        for image_id, priority in (('bulk', 0), ('urgent', 10), ('mid', 5)):
+            self._add_image(image_id)
+            self.cache.queue_image(image_id, priority)
+
+        self.assertTrue(self.prefetcher.run())
+
+        self.assertEqual(['urgent', 'mid', 'bulk'], self.fetched)
+
+    def test_run_reports_failures_once(self):
+        self._add_image('inactive', status='queued')
+        self.cache.queue_image('inactive')
+        self.cache.queue_image('unknown')
+
+        self.assertFalse(self.prefetcher.run())
+
+        self.assertEqual(['inactive', 'unknown'],
+                         sorted(self.cache.get_queued_images()))
+
+    def test_image_over_max_size_is_not_fetched(self):
+        self._add_image('small')
+        self._add_image('huge', size=1024 * 10)
+        self.cache.queue_image('small')
+        self.cache.queue_image('huge')
+
+        self.assertFalse(self.prefetcher.run())
+
+        self.assertEqual(['small'], self.fetched)
+        self.assertEqual(['huge'], self.cache.get_queued_images())
+        self.assertEqual({}, self.prefetcher.reserved)
+
+    def test_reservations_count_against_max_size(self):
+        self.prefetcher.reserved['other'] = 1024 * 4
+        self.assertFalse(self.prefetcher._reserve_space('a', 1024 * 2))
+        self.assertTrue(self.prefetcher._reserve_space('a', 1024))
+        self.assertEqual(1024, self.prefetcher.reserved['a'])
+
+    def test_free_space_checked_on_image_shard(self):
+        shard_dirs = [self.useFixture(fixtures.TempDir()).path
+                      for i in xrange(2)]
+        self.config(image_cache_shard_dirs=shard_dirs)
+        self.prefetcher = prefetcher.Prefetcher()
+        driver = self.prefetcher.cache.driver
+        full_shard = driver.get_owner_shard('a')
+        image_ids = dict((driver.get_owner_shard(str(i)), str(i))
+                         for i in xrange(100))
+
+        class FakeStatvfs(object):
+            def __init__(self, path):
+                self.f_frsize = 1
+                self.f_bavail = 512 if path == full_shard else 1024 * 4
+
+        self.stubs.Set(os, 'statvfs', FakeStatvfs)
+        self.assertFalse(self.prefetcher._reserve_space('a', 1024))
+        for shard, image_id in image_ids.iteritems():
+            self.assertEqual(shard != full_shard,
+                             self.prefetcher._reserve_space(image_id, 1024))
+
+    def test_daemon_keeps_consuming_queue(self):
+        self.config(image_cache_prefetch_poll_interval=0)
+        daemon = eventlet.spawn(self.prefetcher.run_daemon)
+        self._add_image('a')
+        self.cache.queue_image('a')
+        for i in xrange(100):
+            eventlet.sleep(0)
+            if self.cache.is_cached('a'):
+                break
+        self.assertTrue(self.cache.is_cached('a'))
+
+        self._add_image('b')
+        self.cache.queue_image('b')
+        for i in xrange(100):
+            eventlet.sleep(0)
+            if self.cache.is_cached('b'):
+                break
+        self.assertTrue(self.cache.is_cached('b'))
+
+        self.prefetcher.stop()
+        daemon.wait()
+
+    def test_daemon_defers_failed_images(self):
+        self.config(image_cache_prefetch_poll_interval=0,
+                    image_cache_prefetch_retry_interval=60)
+        self.cache.queue_image('unknown')
+        daemon = eventlet.spawn(self.prefetcher.run_daemon)
+        for i in xrange(10):
+            eventlet.sleep(0)
+        self.prefetcher.stop()
+        daemon.wait()
+
+        self.assertTrue('unknown' in self.prefetcher.deferred)
+        self.assertEqual(['unknown'], self.cache.get_queued_images())
+
+
+class TestRateLimiter(test_utils.BaseTestCase):
+
+    def test_unlimited(self):
+        limiter = prefetcher.RateLimiter(0)
+        start = time.time()
+        self.assertEqual(['a', 'b'], list(limiter.limit(['a', 'b'])))
+        self.assertEqual(0, limiter.next_time)
+        self.assertTrue(time.time() - start < 0.1)
+
+    def test_limit_spaces_out_reads(self):
+        sleeps = []
+        self.stubs.Set(eventlet, 'sleep', sleeps.append)
+        limiter = prefetcher.RateLimiter(1000)
+
+        list(limiter.limit(['x' * 100] * 3))
+
+        # The first chunk goes straight away, later ones wait their turn
+        self.assertEqual(2, len(sleeps))
+        self.assertTrue(0.09 < sleeps[0] <= 0.1)
+        self.assertTrue(0.19 < sleeps[1] <= 0.2)
@@ -14,12 +14,17 @@
 #    under the License.
 
 import contextlib
+import hashlib
+import os
 import StringIO
 
 import stubout
 
 from glance.common import exception
 from glance.common import utils
+import glance.store
+import glance.store.location
+import glance.store.rbd
 from glance.store.rbd import Store
 from glance.store.rbd import StoreLocation
 from glance.tests.unit import base
@@ -36,6 +41,84 @@ RBD_CONF = {'verbose': True,
 FAKE_CHUNKSIZE = 1
 
 
+class FakeIoctx(object):
+    def __init__(self, conn, pool):
+        self.conn = conn
+        self.pool = pool
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnection(object):
+    connections = []
+
+    def __init__(self, *args, **kwargs):
+        self.connected = False
+        self.shut_down = False
+        self.ioctxs = []
+        FakeConnection.connections.append(self)
+
+    def connect(self):
+        self.connected = True
+
+    def open_ioctx(self, pool):
+        ioctx = FakeIoctx(self, pool)
+        self.ioctxs.append(ioctx)
+        return ioctx
+
+    def get_fsid(self):
+        return 'fake_fsid'
+
+    def shutdown(self):
+        self.shut_down = True
+
+
+class FakeCompletion(object):
+    def __init__(self, image, oncomplete, ret, *args):
+        self.image = image
+        self.oncomplete = oncomplete
+        self.ret = ret
+        self.args = args
+        self.complete = False
+
+    def wait_for_complete_and_cb(self):
+        if not self.complete:
+            self.complete = True
+            self.image.in_flight -= 1
+            self.oncomplete(self, *self.args)
+
+    def get_return_value(self):
+        return self.ret
+
+
+class FakeAioImage(object):
+    def __init__(self, data=''):
+        self.data = data
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.errors = {}
+
+    def _submit(self, oncomplete, offset, ret, *args):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        return FakeCompletion(self, oncomplete,
+                              self.errors.get(offset, ret), *args)
+
+    def stat(self):
+        return {'size': len(self.data)}
+
+    def aio_write(self, data, offset, oncomplete):
+        self.data = (self.data[:offset].ljust(offset, '\0') + data +
+                     self.data[offset + len(data):])
+        return self._submit(oncomplete, offset, 0)
+
+    def aio_read(self, offset, length, oncomplete):
+        data = self.data[offset:offset + length]
+        return self._submit(oncomplete, offset, len(data), data)
+
+
 class TestStore(base.StoreClearingUnitTest):
     def setUp(self):
         """Establish a clean test environment"""
@@ -45,6 +128,14 @@ class TestStore(base.StoreClearingUnitTest):
         self.store = Store()
         self.store.chunk_size = FAKE_CHUNKSIZE
         self.addCleanup(self.stubs.UnsetAll)
+        self.stubs.Set(glance.store.rbd, '_clusters', {})
+        FakeConnection.connections = []
+
+    def _stub_rados(self):
+        if rbd is None:
+            msg = 'RBD store is not available, skip test.'
+            self.skipTest(msg)
+        self.stubs.Set(rados, 'Rados', FakeConnection)
 
     def test_cleanup_when_add_image_exception(self):
         if rbd is None:
@@ -53,20 +144,11 @@ class TestStore(base.StoreClearingUnitTest):
 
         called_commands = []
 
-        class FakeConnection(object):
-            @contextlib.contextmanager
-            def open_ioctx(self, *args, **kwargs):
-                yield None
-
         class FakeImage(object):
             def write(self, *args, **kwargs):
                 called_commands.append('write')
                 return FAKE_CHUNKSIZE
 
-        @contextlib.contextmanager
-        def _fake_rados(*args, **kwargs):
-            yield FakeConnection()
-
         @contextlib.contextmanager
         def _fake_image(*args, **kwargs):
             yield FakeImage()
@@ -79,7 +161,7 @@ class TestStore(base.StoreClearingUnitTest):
         def _fake_delete_image(*args, **kwargs):
             called_commands.append('delete')
 
-        self.stubs.Set(rados, 'Rados', _fake_rados)
+        self.stubs.Set(rados, 'Rados', FakeConnection)
         self.stubs.Set(rbd, 'Image', _fake_image)
         self.stubs.Set(self.store, '_create_image', _fake_create_image)
         self.stubs.Set(self.store, '_delete_image', _fake_delete_image)
@@ -90,3 +172,214 @@ class TestStore(base.StoreClearingUnitTest):
                           utils.LimitingReader(StringIO.StringIO('xx'), 1),
                           2)
         self.assertEqual(called_commands, ['create', 'write', 'delete'])
+
+    def test_connection_reused(self):
+        self._stub_rados()
+        cluster = self.store.get_cluster()
+        self.assertTrue(cluster is self.store.get_cluster())
+        with cluster.open_ioctx('images') as ioctx:
+            first = ioctx
+        with cluster.open_ioctx('images') as ioctx:
+            self.assertTrue(ioctx is first)
+            # Concurrent operations each get their own I/O context
+            with cluster.open_ioctx('images') as other:
+                self.assertFalse(other is first)
+        self.assertEqual(1, len(FakeConnection.connections))
+        conn = FakeConnection.connections[0]
+        self.assertTrue(conn.connected)
+        self.assertEqual(2, len(conn.ioctxs))
+        self.assertEqual('fake_fsid', cluster.get_fsid())
+
+    def test_ioctx_pool_size(self):
+        self._stub_rados()
+        self.config(rbd_store_ioctx_pool_size=1)
+        cluster = self.store.get_cluster()
+        with cluster.open_ioctx('images') as first:
+            with cluster.open_ioctx('images') as second:
+                pass
+        self.assertTrue(first.closed)
+        self.assertFalse(second.closed)
+
+    def test_reconnect_after_error(self):
+        self._stub_rados()
+        cluster = self.store.get_cluster()
+        with cluster.open_ioctx('volumes') as idle:
+            pass
+        old = FakeConnection.connections[0]
+        with cluster.open_ioctx('images') as ioctx:
+            try:
+                with cluster.open_ioctx('images') as failed:
+                    raise rados.Error('timed out')
+            except rados.Error:
+                pass
+            self.assertTrue(idle.closed)
+            self.assertTrue(failed.closed)
+            # The connection is shut down once no operation uses it
+            self.assertFalse(old.shut_down)
+
+            with cluster.open_ioctx('images') as new:
+                self.assertFalse(new.conn is old)
+        self.assertTrue(ioctx.closed)
+        self.assertTrue(old.shut_down)
+        self.assertEqual(2, len(FakeConnection.connections))
+
+    def test_reconnect_after_fork(self):
+        self._stub_rados()
+        cluster = self.store.get_cluster()
+        with cluster.open_ioctx('images'):
+            pass
+        pid = os.getpid()
+        self.stubs.Set(os, 'getpid', lambda: pid + 1)
+        with cluster.open_ioctx('images') as ioctx:
+            self.assertTrue(ioctx.conn is FakeConnection.connections[1])
+        self.assertEqual(2, len(FakeConnection.connections))
+        self.assertFalse(FakeConnection.connections[0].shut_down)
+
+    def test_get_size_reuses_connection(self):
+        self._stub_rados()
+
+        class FakeImage(object):
+            def stat(self):
+                return {'size': 5}
+
+        @contextlib.contextmanager
+        def _fake_image(*args, **kwargs):
+            yield FakeImage()
+
+        self.stubs.Set(rbd, 'Image', _fake_image)
+        loc = glance.store.location.get_location_from_uri(
+            'rbd://fake_fsid/images/fake_image/snap')
+        self.assertEqual(5, self.store.get_size(loc))
+        self.assertEqual(5, self.store.get_size(loc))
+        self.assertEqual(1, len(FakeConnection.connections))
+        self.assertEqual(1, len(FakeConnection.connections[0].ioctxs))
+
+    def _stub_aio_image(self, image):
+        self._stub_rados()
+
+        @contextlib.contextmanager
+        def _fake_image(*args, **kwargs):
+            yield image
+
+        self.stubs.Set(rbd, 'Image', _fake_image)
+
+    def _add_aio(self, data):
+        deleted = []
+
+        def _fake_create_image(*args, **kwargs):
+            return StoreLocation({'image': 'fake_image'})
+
+        self.stubs.Set(self.store, '_create_image', _fake_create_image)
+        self.stubs.Set(self.store, '_delete_image',
+                       lambda *args: deleted.append(args))
+        result = self.store.add('fake_image', StringIO.StringIO(data),
+                                len(data))
+        return result, deleted
+
+    def test_add_aio(self):
+        self.config(rbd_store_aio_queue_depth=3)
+        image = FakeAioImage()
+        self._stub_aio_image(image)
+        (uri, size, checksum, info), deleted = self._add_aio('abcdefgh')
+        self.assertEqual('abcdefgh', image.data)
+        self.assertEqual(8, size)
+        self.assertEqual(hashlib.md5('abcdefgh').hexdigest(), checksum)
+        self.assertEqual(3, image.max_in_flight)
+        self.assertEqual(0, image.in_flight)
+        self.assertEqual([], deleted)
+
+    def test_add_aio_error(self):
+        self.config(rbd_store_aio_queue_depth=3)
+        image = FakeAioImage()
+        image.errors[2] = -5
+        self._stub_aio_image(image)
+        self.assertRaises(glance.store.BackendException,
+                          self._add_aio, 'abcdefgh')
+        self.assertEqual(0, image.in_flight)
+
+    def test_add_aio_disabled(self):
+        self.config(rbd_store_aio_queue_depth=1)
+        written = []
+
+        class FakeImage(FakeAioImage):
+            def write(self, data, offset):
+                written.append((offset, data))
+                return len(data)
+
+        image = FakeImage()
+        self._stub_aio_image(image)
+        self._add_aio('abc')
+        self.assertEqual([(0, 'a'), (1, 'b'), (2, 'c')], written)
+        self.assertEqual(0, image.max_in_flight)
+
+    def test_get_aio(self):
+        self.config(rbd_store_aio_queue_depth=3)
+        image = FakeAioImage('abcdefghij')
+        self._stub_aio_image(image)
+        loc = glance.store.location.get_location_from_uri(
+            'rbd://fake_fsid/images/fake_image/snap')
+        image_file, size = self.store.get(loc, offset=2, length=6)
+        self.assertEqual(6, size)
+        self.assertEqual(['c', 'd', 'e', 'f', 'g', 'h'], list(image_file))
+        self.assertEqual(3, image.max_in_flight)
+        self.assertEqual(0, image.in_flight)
+
+    def test_get_aio_error(self):
+        self.config(rbd_store_aio_queue_depth=3)
+        image = FakeAioImage('abcdefghij')
+        image.errors[4] = -5
+        self._stub_aio_image(image)
+        loc = glance.store.location.get_location_from_uri(
+            'rbd://fake_fsid/images/fake_image/snap')
+        image_file, size = self.store.get(loc)
+        chunks = iter(image_file)
+        self.assertEqual(['a', 'b', 'c', 'd'],
+                         [chunks.next() for i in range(4)])
+        self.assertRaises(glance.store.BackendException, chunks.next)
+        self.assertEqual(0, image.in_flight)
+
+    def test_copy_clone(self):
+        self._stub_rados()
+        calls = []
+
+        class FakeRBD(object):
+            def clone(self, p_ioctx, p_name, p_snapname, c_ioctx, c_name,
+                      features=0):
+                calls.append(('clone', p_ioctx.pool, p_name, p_snapname,
+                              c_ioctx.pool, c_name))
+
+        class FakeImage(object):
+            def stat(self):
+                return {'size': 5}
+
+            def create_snap(self, name):
+                calls.append(('create_snap', name))
+
+            def protect_snap(self, name):
+                calls.append(('protect_snap', name))
+
+        @contextlib.contextmanager
+        def _fake_image(*args, **kwargs):
+            yield FakeImage()
+
+        self.stubs.Set(rbd, 'RBD', FakeRBD)
+        self.stubs.Set(rbd, 'Image', _fake_image)
+        loc = glance.store.location.get_location_from_uri(
+            'rbd://fake_fsid/volumes/fake_image/snap')
+        location, size, checksum, _ = self.store.copy(loc, 'fake_copy', 0)
+        self.assertEqual('rbd://fake_fsid/%s/fake_copy/snap' %
+                         self.store.pool, location)
+        self.assertEqual(5, size)
+        self.assertEqual(None, checksum)
+        self.assertEqual([('clone', 'volumes', 'fake_image', 'snap',
+                           self.store.pool, 'fake_copy'),
+                          ('create_snap', 'snap'),
+                          ('protect_snap', 'snap')], calls)
+
+    def test_copy_other_cluster(self):
+        self._stub_rados()
+        for uri in ('rbd://other_fsid/images/fake_image/snap',
+                    'rbd://fake_image'):
+            loc = glance.store.location.get_location_from_uri(uri)
+            self.assertRaises(exception.StoreCopyNotSupported,
+                              self.store.copy, loc, 'fake_copy', 0)
@@ -20,11 +20,14 @@
 import hashlib
 import StringIO
 
+import boto.exception
 import boto.s3.connection
+import eventlet
 import stubout
 
 from glance.common import exception
 from glance.openstack.common import uuidutils
+import glance.store
 from glance.store.location import get_location_from_uri
 import glance.store.s3
 from glance.store.s3 import Store, get_s3_location
@@ -86,10 +89,52 @@ def stub_out_s3(stubs):
             # Reset the buffer to start
             self.data.seek(0)
             self.read = self.data.read
+            self.bucket.keys[self.name] = self
 
         def get_file(self):
             return self.data
 
+        def open_read(self, headers=None, **kwargs):
+            start, end = headers['Range'][len('bytes='):].split('-')
+            end = int(end) + 1 if end else None
+            data = self.data.getvalue()[int(start):end]
+            self.read = StringIO.StringIO(data).read
+
+        def get_contents_as_string(self, headers=None, **kwargs):
+            self.bucket.ranges.append(headers['Range'])
+            start, end = headers['Range'][len('bytes='):].split('-')
+            data = self.bucket.keys[self.name].data.getvalue()
+            return data[int(start):int(end) + 1]
+
+    class FakeMultiPartUpload:
+        """
+        Acts like a ``boto.s3.multipart.MultiPartUpload``
+        """
+        def __init__(self, bucket, key_name):
+            self.bucket = bucket
+            self.key_name = key_name
+            self.parts = {}
+
+        def upload_part_from_file(self, fp, part_num, md5=None, size=None,
+                                  **kwargs):
+            if part_num == self.bucket.fail_part:
+                raise boto.exception.S3ResponseError(500, 'Internal Error')
+            data = fp.read()
+            if md5 is not None and md5[0] != hashlib.md5(data).hexdigest():
+                raise boto.exception.S3ResponseError(400, 'BadDigest')
+            self.parts[part_num] = data
+
+        def complete_upload(self):
+            data = ''.join([self.parts[part_num]
+                            for part_num in sorted(self.parts)])
+            key = self.bucket.new_key(self.key_name)
+            key.set_contents_from_file(StringIO.StringIO(data))
+            self.bucket.uploads.remove(self)
+            self.bucket.completed.append(len(self.parts))
+
+        def cancel_upload(self):
+            self.bucket.uploads.remove(self)
+
     class FakeBucket:
         """
         Acts like a ``boto.s3.bucket.Bucket``
@@ -97,6 +142,13 @@ def stub_out_s3(stubs):
         def __init__(self, name, keys=None):
             self.name = name
             self.keys = keys or {}
+            # Multipart uploads in progress, and the number of parts of
+            # those completed
+            self.uploads = []
+            self.completed = []
+            self.fail_part = None
+            # Range headers of the ranged downloads
+            self.ranges = []
 
         def __str__(self):
             return self.name
@@ -114,9 +166,13 @@ def stub_out_s3(stubs):
             return key
 
         def new_key(self, key_name):
-            new_key = FakeKey(self, key_name)
-            self.keys[key_name] = new_key
-            return new_key
+            # The key is only stored once its contents are set
+            return FakeKey(self, key_name)
+
+        def initiate_multipart_upload(self, key_name, **kwargs):
+            upload = FakeMultiPartUpload(self, key_name)
+            self.uploads.append(upload)
+            return upload
 
     fixture_buckets = {'glance': FakeBucket('glance')}
     b = fixture_buckets['glance']
@@ -138,6 +194,8 @@ def stub_out_s3(stubs):
               '__init__', fake_connection_constructor)
     stubs.Set(boto.s3.connection.S3Connection,
               'get_bucket', fake_get_bucket)
+    stubs.Set(glance.store.s3, '_connections', {})
+    return fixture_buckets
 
 
 def format_s3_location(user, key, authurl, bucket, obj):
@@ -163,7 +221,7 @@ class TestStore(base.StoreClearingUnitTest):
         self.config(**S3_CONF)
         super(TestStore, self).setUp()
         self.stubs = stubout.StubOutForTesting()
-        stub_out_s3(self.stubs)
+        self.buckets = stub_out_s3(self.stubs)
         self.store = Store()
         self.addCleanup(self.stubs.UnsetAll)
 
@@ -213,6 +271,105 @@ class TestStore(base.StoreClearingUnitTest):
             "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
         (image_s3, image_size) = self.store.get(loc)
 
+    def test_get_range(self):
+        """Test retrieval of a byte range of an image"""
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc, offset=1024, length=10)
+
+        self.assertEqual(image_size, 10)
+        self.assertEqual("*" * 10, "".join(image_s3))
+
+    def test_get_parallel_ranges(self):
+        """Test retrieval of an image as several ranges at a time"""
+        self.store.download_range_size = 1024
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual(image_size, FIVE_KB)
+        self.assertEqual("*" * FIVE_KB, "".join(image_s3))
+        self.assertEqual(['bytes=0-1023', 'bytes=1024-2047',
+                          'bytes=2048-3071', 'bytes=3072-4095',
+                          'bytes=4096-5119'],
+                         sorted(self.buckets['glance'].ranges))
+
+    def test_get_parallel_ranges_of_range(self):
+        """Test retrieval of a byte range of an image as several ranges"""
+        self.store.download_range_size = 1024
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc, offset=100, length=2000)
+
+        self.assertEqual(image_size, 2000)
+        self.assertEqual("*" * 2000, "".join(image_s3))
+        self.assertEqual(['bytes=100-1123', 'bytes=1124-2099'],
+                         sorted(self.buckets['glance'].ranges))
+
+    def test_get_parallel_ranges_in_order(self):
+        """
+        Test that ranges completing out of order are yielded in order
+        """
+        contents = ''.join([chr(ord('a') + i) * 1024 for i in range(5)])
+        self.buckets['glance'].new_key('ordered').set_contents_from_file(
+            StringIO.StringIO(contents))
+        get_range = glance.store.s3._get_range
+
+        def slow_first_range(key, offset, length):
+            if offset == 0:
+                eventlet.sleep(0.01)
+            return get_range(key, offset, length)
+
+        self.stubs.Set(glance.store.s3, '_get_range', slow_first_range)
+        self.store.download_range_size = 1024
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/ordered")
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual(contents, "".join(image_s3))
+
+    def test_get_parallel_ranges_short_read(self):
+        """Test that a range shorter than asked for raises an error"""
+        self.stubs.Set(glance.store.s3, '_get_range',
+                       lambda key, offset, length: '*' * (length - 1))
+        self.store.download_range_size = 1024
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertRaises(glance.store.BackendException, list, image_s3)
+
+    def test_get_single_stream(self):
+        """Test that a concurrency of 1 disables ranged downloads"""
+        self.config(s3_store_download_concurrency=1)
+        self.store = Store()
+        self.store.download_range_size = 1024
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        (image_s3, image_size) = self.store.get(loc)
+
+        self.assertEqual("*" * FIVE_KB, "".join(image_s3))
+        self.assertEqual([], self.buckets['glance'].ranges)
+
+    def test_connection_reused(self):
+        """Test that requests share the connection of their S3 host"""
+        connections = []
+
+        def fake_S3Connection_init(conn, *args, **kwargs):
+            connections.append(conn)
+
+        self.stubs.Set(boto.s3.connection.S3Connection, '__init__',
+                       fake_S3Connection_init)
+        loc = get_location_from_uri(
+            "s3://user:key@auth_address/glance/%s" % FAKE_UUID)
+        self.store.get(loc)
+        self.store.get(loc)
+        self.assertEqual(1, len(connections))
+
+        self.store.get(get_location_from_uri(
+            "s3://user:key@other_address/glance/%s" % FAKE_UUID))
+        self.assertEqual(2, len(connections))
+
     def test_get_non_existing(self):
         """
         Test that trying to retrieve a s3 that doesn't exist
@@ -306,6 +463,63 @@ class TestStore(base.StoreClearingUnitTest):
             self.assertEquals(expected_s3_contents, new_image_contents)
             self.assertEquals(expected_s3_size, new_image_s3_size)
 
+    def _add_multipart(self, image_size, contents=None):
+        """
+        Adds an image with parts of 1KB, uploading at most 2 parts at a
+        time, and checks what was stored
+        """
+        image_id = uuidutils.generate_uuid()
+        if contents is None:
+            contents = "*" * FIVE_KB + "tail"
+        self.store.large_object_size = 1024
+        self.store.large_object_chunk_size = 1024
+        self.store.upload_buffer_size = 3 * 1024
+        location, size, checksum, _ = self.store.add(
+            image_id, StringIO.StringIO(contents), image_size)
+
+        self.assertEquals(len(contents), size)
+        self.assertEquals(hashlib.md5(contents).hexdigest(), checksum)
+        (new_image_s3, new_image_size) = self.store.get(
+            get_location_from_uri(location))
+        self.assertEquals(contents, new_image_s3.getvalue())
+        self.assertEquals([], self.buckets['glance'].uploads)
+
+    def test_add_multipart(self):
+        """Test that large images are streamed in parts"""
+        self._add_multipart(FIVE_KB + 4)
+        self.assertEquals([6], self.buckets['glance'].completed)
+
+    def test_add_multipart_unknown_size(self):
+        """Test that images of unknown size are streamed in parts"""
+        self._add_multipart(0)
+        self.assertEquals([6], self.buckets['glance'].completed)
+
+    def test_add_multipart_single_part(self):
+        """
+        Test that an image of unknown size that fits in one part is
+        uploaded without a multipart upload
+        """
+        self._add_multipart(0, "*" * 100)
+        self._add_multipart(0, "")
+        self.assertEquals([], self.buckets['glance'].completed)
+
+    def test_add_multipart_failure_aborts_upload(self):
+        """
+        Test that a failed part aborts the multipart upload and the
+        image is not stored
+        """
+        self.buckets['glance'].fail_part = 3
+        self.store.large_object_size = 1024
+        self.store.large_object_chunk_size = 1024
+        self.store.upload_buffer_size = 3 * 1024
+        image_id = uuidutils.generate_uuid()
+        self.assertRaises(glance.store.BackendException,
+                          self.store.add,
+                          image_id, StringIO.StringIO("*" * FIVE_KB),
+                          FIVE_KB)
+        self.assertEquals([], self.buckets['glance'].uploads)
+        self.assertFalse(self.buckets['glance'].exists(image_id))
+
     def test_add_already_existing(self):
         """
         Tests that adding an image with an existing identifier
@@ -346,6 +560,14 @@ class TestStore(base.StoreClearingUnitTest):
         """
         self.assertTrue(self._option_required('s3_store_host'))
 
+    def test_small_chunk_size(self):
+        """
+        Tests that parts smaller than S3 allows disable the add method
+        """
+        self.config(s3_store_large_object_chunk_size=4)
+        self.store = Store()
+        self.assertEqual(self.store.add, self.store.add_disabled)
+
     def test_delete(self):
         """
         Test we can delete an existing image in the s3 store
@@ -108,7 +108,8 @@ class TestStoreImage(utils.BaseTestCase):
         self.assertEquals(image.get_data(), 'XXX')
 
     def test_image_get_data_from_second_location(self):
-        def fake_get_from_backend(self, context, location):
+        def fake_get_from_backend(self, context, location, offset=0,
+                                  length=None):
             if UUID1 in location:
                 raise Exception('not allow download from %s' % location)
             else:
@@ -0,0 +1,192 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import StringIO
+
+from glance.common import exception
+from glance.image_cache import warmer
+import glance.registry.client.v1.api as registry
+from glance.tests import utils as test_utils
+
+HOUR = 3600
+
+
+class TestPopularity(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestPopularity, self).setUp()
+        self.path = os.path.join(self.test_dir, 'popularity.json')
+        self.popularity = warmer.Popularity(self.path, HOUR)
+
+    def test_scores_decay(self):
+        self.popularity.record('a', 4, now=0)
+        self.assertEqual(4, self.popularity.score('a', now=0))
+        self.assertEqual(2, self.popularity.score('a', now=HOUR))
+        self.popularity.record('a', now=HOUR)
+        self.assertEqual(1.5, self.popularity.score('a', now=2 * HOUR))
+        self.assertEqual(0, self.popularity.score('unknown', now=0))
+
+    def test_ranked(self):
+        self.popularity.record('old', 8, now=0)
+        self.popularity.record('new', 3, now=2 * HOUR)
+        self.popularity.record('rare', 1, now=2 * HOUR)
+        self.assertEqual(['new', 'old', 'rare'],
+                         self.popularity.ranked(now=2 * HOUR))
+        self.assertEqual(['new', 'old'],
+                         self.popularity.ranked(2, now=2 * HOUR))
+
+    def test_record_cache_hits_counts_new_hits(self):
+        self.popularity.record_cache_hits([{'image_id': 'a', 'hits': 3}],
+                                          now=0)
+        self.assertEqual(3, self.popularity.score('a', now=0))
+        self.popularity.record_cache_hits([{'image_id': 'a', 'hits': 5}],
+                                          now=0)
+        self.assertEqual(5, self.popularity.score('a', now=0))
+        # The image was evicted and cached again
+        self.popularity.record_cache_hits([{'image_id': 'a', 'hits': 1}],
+                                          now=0)
+        self.assertEqual(6, self.popularity.score('a', now=0))
+
+    def test_save_and_load(self):
+        self.popularity.record('a', 2)
+        self.popularity.record('tiny', 0.001)
+        self.popularity.hits['a'] = 2
+        self.popularity.save()
+
+        loaded = warmer.Popularity(self.path, HOUR)
+        loaded.load()
+        self.assertEqual(['a'], loaded.scores.keys())
+        self.assertEqual({'a': 2}, loaded.hits)
+
+    def test_load_ignores_bad_file(self):
+        with open(self.path, 'w') as f:
+            f.write('not json')
+        self.popularity.load()
+        self.assertEqual({}, self.popularity.scores)
+
+
+class TestGetSentImages(test_utils.BaseTestCase):
+
+    def test_get_sent_images(self):
+        messages = [
+            {'event_type': 'image.send', 'publisher_id': 'other',
+             'payload': {'image_id': 'a'}},
+            {'event_type': 'image.send', 'publisher_id': 'me',
+             'payload': {'image_id': 'b'}},
+            {'event_type': 'image.update', 'publisher_id': 'other',
+             'payload': {'id': 'c'}},
+            {'event_type': 'image.send', 'publisher_id': 'other',
+             'payload': {'image_id': 'a'}},
+            'garbage',
+        ]
+        self.assertEqual(['a', 'a'], warmer.get_sent_images(messages, 'me'))
+
+    def test_get_changed_images(self):
+        messages = [
+            {'event_type': 'image.send', 'publisher_id': 'other',
+             'payload': {'image_id': 'a'}},
+            {'event_type': 'image.update', 'publisher_id': 'other',
+             'payload': {'id': 'b'}},
+            {'event_type': 'image.delete', 'publisher_id': 'me',
+             'payload': {'id': 'c'}},
+            'garbage',
+        ]
+        self.assertEqual(set(['b', 'c']),
+                         warmer.get_changed_images(messages))
+
+
+class TestWarmer(test_utils.BaseTestCase):
+
+    def setUp(self):
+        super(TestWarmer, self).setUp()
+        self.config(image_cache_dir=self.test_dir,
+                    image_cache_driver='sqlite',
+                    image_cache_max_size=1024 * 10,
+                    image_cache_warm_count=3,
+                    image_cache_warm_min_score=2.0)
+        self.images = {}
+
+        def fake_get_image_metadata(context, image_id):
+            try:
+                return self.images[image_id]
+            except KeyError:
+                raise exception.NotFound()
+
+        self.stubs.Set(registry, 'get_image_metadata',
+                       fake_get_image_metadata)
+        self.warmer = warmer.Warmer()
+        self.cache = self.warmer.cache
+
+    def _add_image(self, image_id, size=1024, status='active'):
+        self.images[image_id] = {'status': status, 'size': size}
+
+    def test_queues_most_popular_images(self):
+        for image_id, score in (('a', 10), ('b', 5), ('c', 4), ('d', 3),
+                                ('rare', 1)):
+            self._add_image(image_id)
+            self.warmer.popularity.record(image_id, score)
+
+        self.assertEqual(3, self.warmer.queue_popular_images())
+        self.assertEqual(['a', 'b', 'c'], self.cache.get_queued_images())
+        self.assertEqual(-1, self.cache.driver.get_queued_priority('a'))
+
+    def test_cached_images_count_towards_budget(self):
+        self.config(image_cache_warm_max_bytes=2048)
+        self.cache.cache_image_file('a', StringIO.StringIO('*' * 1024))
+        for image_id, score in (('a', 10), ('big', 8), ('b', 5), ('c', 4)):
+            self._add_image(image_id)
+            self.warmer.popularity.record(image_id, score)
+        self._add_image('big', size=4096)
+
+        self.assertEqual(1, self.warmer.queue_popular_images())
+        self.assertEqual(['b'], self.cache.get_queued_images())
+
+    def test_skips_inactive_and_unknown_images(self):
+        self._add_image('queued', status='queued')
+        self._add_image('ok')
+        for image_id in ('queued', 'deleted', 'ok'):
+            self.warmer.popularity.record(image_id, 5)
+
+        self.assertEqual(1, self.warmer.queue_popular_images())
+        self.assertEqual(['ok'], self.cache.get_queued_images())
+        self.assertFalse('deleted' in self.warmer.popularity.scores)
+
+    def test_run_rewarms_pruned_image(self):
+        self._add_image('a')
+        self.cache.cache_image_file('a', StringIO.StringIO('*' * 1024))
+        for i in xrange(3):
+            with self.cache.open_for_read('a'):
+                pass
+        self.assertEqual(0, self.warmer.run())
+
+        self.cache.delete_cached_image('a')
+        self.assertEqual(1, warmer.Warmer().run())
+        self.assertEqual(['a'], self.cache.get_queued_images())
+
+    def test_run_learns_from_notifications(self):
+        class FakeListener(object):
+            hostname = 'me'
+
+            def read_messages(self, limit):
+                return [{'event_type': 'image.send', 'publisher_id': 'peer',
+                         'payload': {'image_id': 'a'}}] * 2
+
+        self._add_image('a')
+        self.warmer.listener = FakeListener()
+        self.assertEqual(1, self.warmer.run())
+        self.assertEqual(['a'], self.cache.get_queued_images())
@@ -115,14 +115,19 @@ class FakeStoreAPI(object):
             'write': write_tenants,
         }
 
-    def get_from_backend(self, context, location):
+    def get_from_backend(self, context, location, offset=0, length=None):
         try:
             scheme = location[:location.find('/') - 1]
             if scheme == 'unknown':
                 raise exception.UnknownScheme(scheme=scheme)
-            return self.data[location]
+            data, size = self.data[location]
         except KeyError:
             raise exception.NotFound()
+        if offset or length is not None:
+            end = None if length is None else offset + length
+            data = data[offset:end]
+            size = len(data)
+        return data, size
 
     def safe_delete_from_backend(self, context, uri, id, **kwargs):
         try:
@@ -22,6 +22,7 @@ import hashlib
 import json
 import StringIO
 
+import eventlet
 from oslo.config import cfg
 import routes
 import webob
@@ -31,9 +32,11 @@ import glance.api.common
 from glance.api.v1 import filters
 from glance.api.v1 import images
 from glance.api.v1 import router
+from glance.api.v1 import upload_utils
 from glance.common import exception
 import glance.common.config
 import glance.context
+import glance.notifier
 from glance.db.sqlalchemy import api as db_api
 from glance.db.sqlalchemy import models as db_models
 from glance.openstack.common import timeutils
@@ -734,6 +737,36 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         res = req.get_response(self.api)
         self.assertEquals(res.status_int, 201)
 
+    def test_add_copy_from_streamed_after_store_copy_declined(self):
+        """Tests the image is prepared once when a store copy is declined"""
+        events = []
+        self.stubs.Set(glance.notifier.Notifier, 'info',
+                       lambda self, event_type, payload:
+                       events.append(event_type))
+        self.stubs.Set(eventlet.GreenPool, 'spawn_n',
+                       lambda self, func, *args: func(*args))
+        self.stubs.Set(images, 'is_in_store', lambda *args: True)
+        self.stubs.Set(upload_utils, 'copy_data_in_store',
+                       lambda *args: None)
+        self.stubs.Set(images.Controller, '_get_from_store',
+                       lambda *args: (StringIO.StringIO('XXX'), 3))
+        fixture_headers = {'x-image-meta-store': 'file',
+                           'x-image-meta-disk-format': 'vhd',
+                           'x-glance-api-copy-from': 'http://glance.com/i.ovf',
+                           'x-image-meta-container-format': 'ovf',
+                           'x-image-meta-name': 'fake image #F'}
+
+        req = webob.Request.blank("/images")
+        req.method = 'POST'
+        for k, v in fixture_headers.iteritems():
+            req.headers[k] = v
+
+        req.headers['Content-Type'] = 'application/octet-stream'
+        res = req.get_response(self.api)
+        self.assertEquals(res.status_int, 201)
+        self.assertEqual(1, events.count('image.prepare'))
+        self.assertEqual(1, events.count('image.upload'))
+
     def test_add_copy_from_with_nonempty_body(self):
         """Tests creates an image from copy-from and nonempty body"""
         fixture_headers = {'x-image-meta-store': 'file',
@@ -1561,6 +1594,23 @@ class TestGlanceAPI(base.IsolatedUnitTest):
         self.assertEqual(res.status_int, 200)
         self.assertEqual(res.content_type, 'application/octet-stream')
         self.assertEqual('chunk00000remainder', res.body)
+        self.assertEqual('bytes', res.headers['Accept-Ranges'])
+
+    def test_show_image_range(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=5-12'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 206)
+        self.assertEqual('bytes 5-12/19', res.headers['Content-Range'])
+        self.assertEqual('8', res.headers['Content-Length'])
+        self.assertEqual('00000rem', res.body)
+
+    def test_show_image_range_not_satisfiable(self):
+        req = webob.Request.blank("/images/%s" % UUID2)
+        req.headers['Range'] = 'bytes=19-'
+        res = req.get_response(self.api)
+        self.assertEqual(res.status_int, 416)
+        self.assertEqual('bytes */19', res.headers['Content-Range'])
 
     def test_show_non_exists_image(self):
         req = webob.Request.blank("/images/%s" % _gen_uuid())
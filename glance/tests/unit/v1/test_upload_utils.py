@@ -343,3 +343,63 @@ class TestUploadUtils(base.StoreClearingUnitTest):
                           req, image_meta, image_data, store, notifier)
 
         self.mox.VerifyAll()
+
+    def test_copy_data_in_store(self):
+        req = unit_test_utils.get_fake_request()
+
+        copy_from = "rbd://fsid/images/source/snap"
+        location = "rbd://fsid/images/%s/snap" % unit_test_utils.UUID1
+        size = 10
+        checksum = "checksum"
+
+        image_meta = {'id': unit_test_utils.UUID1,
+                      'size': size,
+                      'checksum': checksum}
+
+        notifier = self.mox.CreateMockAnything()
+        store = self.mox.CreateMockAnything()
+        store.get_schemes().MultipleTimes().AndReturn(('rbd',))
+        store.copy(
+            mox.IgnoreArg(),
+            image_meta['id'],
+            size).AndReturn((location, size, None, {}))
+
+        self.mox.StubOutWithMock(registry, "update_image_metadata")
+        # The store does not know the checksum, so the supplied one is kept
+        update_data = {'checksum': checksum,
+                       'size': size}
+        registry.update_image_metadata(req.context,
+                                       image_meta['id'],
+                                       update_data
+                                       ).AndReturn(image_meta)
+        self.mox.ReplayAll()
+
+        actual_meta, actual_loc, loc_meta = upload_utils.copy_data_in_store(
+            req, image_meta, copy_from, store, notifier)
+
+        self.mox.VerifyAll()
+
+        self.assertEqual(actual_loc, location)
+
+    def test_copy_data_in_store_not_supported(self):
+        req = unit_test_utils.get_fake_request()
+        image_meta = {'id': unit_test_utils.UUID1,
+                      'size': 10}
+
+        notifier = self.mox.CreateMockAnything()
+        store = self.mox.CreateMockAnything()
+        store.get_schemes().MultipleTimes().AndReturn(('rbd',))
+        store.copy(
+            mox.IgnoreArg(),
+            image_meta['id'],
+            10).AndRaise(exception.StoreCopyNotSupported())
+        self.mox.StubOutWithMock(registry, "update_image_metadata")
+        self.mox.ReplayAll()
+
+        self.assertEqual(None, upload_utils.copy_data_in_store(
+            req, image_meta, "http://example.com/image", store, notifier))
+        self.assertEqual(None, upload_utils.copy_data_in_store(
+            req, image_meta, "rbd://fsid/images/source/snap", store,
+            notifier))
+
+        self.mox.VerifyAll()
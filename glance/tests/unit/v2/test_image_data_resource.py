@@ -57,7 +57,10 @@ class FakeImage(object):
         else:
             self._status = value
 
-    def get_data(self):
+    def get_data(self, offset=0, length=None):
+        if offset or length is not None:
+            end = None if length is None else offset + length
+            return iter(''.join(self.data)[offset:end])
         return self.data
 
     def set_data(self, data, size=None):
@@ -105,6 +108,16 @@ class TestImagesController(base.StoreClearingUnitTest):
         image = self.controller.download(request, unit_test_utils.UUID1)
         self.assertEqual(image.image_id, 'abcd')
 
+    def test_download_range_not_satisfiable(self):
+        request = unit_test_utils.get_fake_request()
+        request.headers['Range'] = 'bytes=10-'
+        image = FakeImage('abcd', size=4,
+                          locations=['http://example.com/image'])
+        self.image_repo.result = image
+        self.assertRaises(webob.exc.HTTPRequestRangeNotSatisfiable,
+                          self.controller.download, request,
+                          unit_test_utils.UUID1)
+
     def test_download_no_location(self):
         request = unit_test_utils.get_fake_request()
         self.image_repo.result = FakeImage('abcd')
@@ -363,6 +376,19 @@ class TestImageDataSerializer(test_utils.BaseTestCase):
         self.assertEqual('application/octet-stream',
                          response.headers['Content-Type'])
 
+    def test_download_range(self):
+        request = webob.Request.blank('/', headers={'Range': 'bytes=1-2'})
+        response = webob.Response()
+        response.request = request
+        checksum = '0745064918b49693cca64d6b6a13d28a'
+        image = FakeImage(size=4, checksum=checksum, data=iter('WXYZ'))
+        self.serializer.download(response, image)
+        self.assertEqual(206, response.status_int)
+        self.assertEqual('XY', response.body)
+        self.assertEqual('2', response.headers['Content-Length'])
+        self.assertEqual('bytes 1-2/4', response.headers['Content-Range'])
+        self.assertFalse('Content-MD5' in response.headers)
+
     def test_upload(self):
         request = webob.Request.blank('/')
         request.environ = {}
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Replays an image access trace against each image cache eviction policy and
+reports the request and byte hit ratios achieved by each.
+
+A trace file has one access per line, made of an image identifier and the
+image size in bytes separated by whitespace. When no trace is given a
+synthetic one is generated: a set of small base images with Zipf-like
+popularity, interleaved with large images that are only requested once.
+
+Example usage::
+
+    $> python tools/cache_policy_benchmark.py --cache-size 10737418240
+    $> python tools/cache_policy_benchmark.py --trace access.log
+"""
+
+import optparse
+import os
+import random
+import sys
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from glance.openstack.common import gettextutils
+gettextutils.install('glance')
+
+from glance.image_cache import policies
+
+MB = 1024 * 1024
+GB = 1024 * MB
+
+
+def load_trace(path):
+    trace = []
+    with open(path) as trace_file:
+        for line in trace_file:
+            fields = line.split()
+            if len(fields) >= 2:
+                trace.append((fields[0], int(fields[1])))
+    return trace
+
+
+def synthetic_trace(accesses, base_images, seed):
+    rng = random.Random(seed)
+    sizes = dict(('base-%d' % i, rng.randint(20 * MB, 2 * GB))
+                 for i in xrange(base_images))
+    weights = [1.0 / (rank + 1) for rank in xrange(base_images)]
+    total = sum(weights)
+
+    trace = []
+    for n in xrange(accesses):
+        if rng.random() < 0.05:
+            # A one-off download of a large snapshot
+            trace.append(('snapshot-%d' % n, rng.randint(10 * GB, 40 * GB)))
+            continue
+        point = rng.random() * total
+        for rank, weight in enumerate(weights):
+            point -= weight
+            if point <= 0:
+                break
+        image_id = 'base-%d' % rank
+        trace.append((image_id, sizes[image_id]))
+    return trace
+
+
+def replay(policy, trace):
+    hits = 0
+    hit_bytes = 0
+    total_bytes = 0
+    for image_id, size in trace:
+        total_bytes += size
+        if image_id in policy:
+            hits += 1
+            hit_bytes += size
+            policy.access(image_id)
+            continue
+        if size > policy.capacity:
+            continue
+        policy.add(image_id, size)
+        while policy.size > policy.capacity:
+            policy.evict()
+    return hits, hit_bytes, total_bytes
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--trace', help='Access trace file to replay')
+    parser.add_option('--cache-size', type='int', default=10 * GB,
+                      help='Cache capacity in bytes [default: %default]')
+    parser.add_option('--accesses', type='int', default=20000,
+                      help='Length of the synthetic trace [default: '
+                           '%default]')
+    parser.add_option('--base-images', type='int', default=200,
+                      help='Number of popular images in the synthetic '
+                           'trace [default: %default]')
+    parser.add_option('--seed', type='int', default=42,
+                      help='Random seed for the synthetic trace '
+                           '[default: %default]')
+    options, args = parser.parse_args()
+
+    if options.trace:
+        trace = load_trace(options.trace)
+    else:
+        trace = synthetic_trace(options.accesses, options.base_images,
+                                options.seed)
+
+    print('%d accesses, cache size %d bytes' %
+          (len(trace), options.cache_size))
+    print('%-6s %10s %10s %10s' % ('policy', 'hit %', 'byte hit %', 'secs'))
+    for name in sorted(policies._POLICY_ALIASES):
+        policy = policies.get_policy(name, options.cache_size)
+        start = time.time()
+        hits, hit_bytes, total_bytes = replay(policy, trace)
+        elapsed = time.time() - start
+        print('%-6s %10.2f %10.2f %10.3f' %
+              (name, 100.0 * hits / max(len(trace), 1),
+               100.0 * hit_bytes / max(total_bytes, 1), elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/python
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compares the throughput of serving a cached image file through the
+glance WSGI server with sendfile(2) against the chunked iterator path.
+
+For each path a server process is started on the loopback interface and
+the file is downloaded repeatedly by a number of concurrent clients. The
+aggregate throughput and the CPU time used by the server are reported.
+
+Example usage::
+
+    $> python tools/cache_sendfile_benchmark.py --size 1024 --requests 20
+"""
+
+import httplib
+import optparse
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from glance.openstack.common import gettextutils
+gettextutils.install('glance')
+
+import eventlet.greenio
+import eventlet.wsgi
+
+from glance.common import utils
+from glance.common import wsgi
+
+MB = 1024 * 1024
+
+
+def make_application(path, use_file_wrapper):
+    size = os.path.getsize(path)
+
+    def application(environ, start_response):
+        start_response('200 OK',
+                       [('Content-Length', str(size)),
+                        ('Content-Type', 'application/octet-stream')])
+        image_file = open(path, 'rb')
+        if use_file_wrapper and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](image_file)
+        return utils.chunkiter(image_file)
+
+    return application
+
+
+def start_server(path, use_file_wrapper):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(128)
+    port = sock.getsockname()[1]
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            eventlet.wsgi.server(eventlet.greenio.GreenSocket(sock),
+                                 make_application(path, use_file_wrapper),
+                                 protocol=wsgi.HttpProtocol,
+                                 log=open(os.devnull, 'w'))
+        finally:
+            os._exit(0)
+    sock.close()
+    return pid, port
+
+
+def download(port, requests, results):
+    for _i in xrange(requests):
+        conn = httplib.HTTPConnection('127.0.0.1', port)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        received = 0
+        while True:
+            data = response.read(MB)
+            if not data:
+                break
+            received += len(data)
+        conn.close()
+        results.append(received)
+
+
+def run(path, use_file_wrapper, requests, concurrency):
+    pid, port = start_server(path, use_file_wrapper)
+    try:
+        results = []
+        threads = [threading.Thread(target=download,
+                                    args=(port, requests, results))
+                   for _i in xrange(concurrency)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        _pid, _status, usage = os.wait4(pid, 0)
+    return sum(results), elapsed, usage.ru_utime + usage.ru_stime
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=512,
+                      help='Size of the test image in MB [default: %default]')
+    parser.add_option('--requests', type='int', default=10,
+                      help='Downloads per client [default: %default]')
+    parser.add_option('--concurrency', type='int', default=4,
+                      help='Number of concurrent clients [default: %default]')
+    parser.add_option('--dir', default=None,
+                      help='Directory for the test image, e.g. the image '
+                           'cache directory [default: system temp dir]')
+    options, args = parser.parse_args()
+
+    if not wsgi.SENDFILE_SUPPORTED:
+        print('pysendfile is not installed, both paths will be chunked')
+
+    fd, path = tempfile.mkstemp(dir=options.dir)
+    try:
+        block = os.urandom(MB)
+        for _i in xrange(options.size):
+            os.write(fd, block)
+        os.close(fd)
+
+        print('%d x %d downloads of a %d MB image' %
+              (options.concurrency, options.requests, options.size))
+        print('%-8s %12s %10s %12s' % ('path', 'MB/s', 'secs', 'server cpu'))
+        for name, use_file_wrapper in (('chunked', False),
+                                       ('sendfile', True)):
+            total, elapsed, cpu = run(path, use_file_wrapper,
+                                      options.requests, options.concurrency)
+            print('%-8s %12.1f %10.2f %12.2f' %
+                  (name, float(total) / MB / max(elapsed, 0.001), elapsed,
+                   cpu))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compares writing and reading an image file with plain buffered I/O against
+the one-pass I/O used by the filesystem store and the image cache, which
+preallocates the file and drops its data from the page cache behind the
+stream.
+
+For each strategy and chunk size an image is written, synced to disk, and
+read back after its pages have been dropped from the page cache. The
+throughput of both passes is reported, together with how much of the file
+is left in the page cache after each of them, as found by mincore(2).
+
+Example usage::
+
+    $> python tools/image_io_benchmark.py --size 2048 --dir /var/lib/glance
+"""
+
+import ctypes
+import ctypes.util
+import mmap
+import optparse
+import os
+import sys
+import tempfile
+import time
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from glance.openstack.common import gettextutils
+gettextutils.install('glance')
+
+from oslo.config import cfg
+
+from glance.common import fileio
+
+CONF = cfg.CONF
+
+MB = 1024 * 1024
+PROT_READ = 1
+MAP_SHARED = 1
+
+
+def get_libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    libc.mmap.restype = ctypes.c_void_p
+    libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int,
+                          ctypes.c_int, ctypes.c_int, ctypes.c_long]
+    libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+    libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                             ctypes.c_char_p]
+    return libc
+
+
+def cached_fraction(libc, path):
+    """Returns the fraction of the pages of a file in the page cache."""
+    size = os.path.getsize(path)
+    if not size:
+        return 0.0
+    pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        addr = libc.mmap(None, size, PROT_READ, MAP_SHARED, fd, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            raise OSError(ctypes.get_errno(), 'mmap failed')
+        try:
+            vec = ctypes.create_string_buffer(pages)
+            if libc.mincore(addr, size, vec) != 0:
+                raise OSError(ctypes.get_errno(), 'mincore failed')
+            resident = sum(ord(c) & 1 for c in vec.raw)
+        finally:
+            libc.munmap(addr, size)
+    finally:
+        os.close(fd)
+    return float(resident) / pages
+
+
+def drop_from_cache(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        fileio.fadvise(fd, 0, 0, fileio.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def write_image(path, size, chunk_size, one_pass):
+    block = os.urandom(chunk_size)
+    f = open(path, 'wb')
+    if one_pass:
+        f = fileio.OnePassFile(f, size)
+    with f:
+        written = 0
+        while written < size:
+            chunk = block[:size - written]
+            f.write(chunk)
+            written += len(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_image(path, chunk_size, one_pass):
+    f = open(path, 'rb')
+    if one_pass:
+        f = fileio.OnePassFile(f)
+    with f:
+        while f.read(chunk_size):
+            pass
+
+
+def timed(func, *args):
+    start = time.time()
+    func(*args)
+    return max(time.time() - start, 0.001)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--size', type='int', default=1024,
+                      help='Size of the test image in MB [default: %default]')
+    parser.add_option('--chunk-sizes', default='65536,1048576',
+                      help='Comma separated chunk sizes in bytes '
+                           '[default: %default]')
+    parser.add_option('--bytes-per-sync', type='int', default=64,
+                      help='image_file_bytes_per_sync in MB '
+                           '[default: %default]')
+    parser.add_option('--dir', default=None,
+                      help='Directory for the test image, e.g. the '
+                           'filesystem store or image cache directory '
+                           '[default: system temp dir]')
+    options, args = parser.parse_args()
+
+    CONF([], project='glance')
+    CONF.set_override('image_file_bytes_per_sync',
+                      options.bytes_per_sync * MB)
+    libc = get_libc()
+    size = options.size * MB
+    chunk_sizes = [int(s) for s in options.chunk_sizes.split(',')]
+
+    fd, path = tempfile.mkstemp(dir=options.dir)
+    os.close(fd)
+    try:
+        print('%d MB image, page cache residency after each pass' %
+              options.size)
+        print('%-9s %9s %10s %8s %10s %8s' %
+              ('strategy', 'chunk', 'write MB/s', 'cached', 'read MB/s',
+               'cached'))
+        for chunk_size in chunk_sizes:
+            for name, one_pass in (('buffered', False), ('one-pass', True)):
+                os.unlink(path)
+                elapsed = timed(write_image, path, size, chunk_size,
+                                one_pass)
+                write_rate = float(size) / MB / elapsed
+                write_cached = cached_fraction(libc, path)
+
+                drop_from_cache(path)
+                elapsed = timed(read_image, path, chunk_size, one_pass)
+                read_rate = float(size) / MB / elapsed
+                read_cached = cached_fraction(libc, path)
+
+                print('%-9s %9d %10.1f %7.0f%% %10.1f %7.0f%%' %
+                      (name, chunk_size, write_rate, write_cached * 100,
+                       read_rate, read_cached * 100))
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+
+if __name__ == '__main__':
+    main()
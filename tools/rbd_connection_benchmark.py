@@ -0,0 +1,222 @@
+#!/usr/bin/python
+
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+# Copyright 2013 OpenStack Foundation
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Compares the latency of the metadata operations and small image reads of
+the RBD store when every operation connects to the Ceph cluster, as the
+store used to, against the persistent connection and pool of I/O contexts
+it keeps now.
+
+The rados and rbd modules are replaced by fakes that sleep for the given
+time to connect, to open an I/O context and to do each operation, so that
+no Ceph cluster is needed. The connect time of a real cluster is that of
+the monitor handshake, authentication and the fetch of the OSD map, and is
+typically tens of milliseconds.
+
+Example usage::
+
+    $> python tools/rbd_connection_benchmark.py --connect-ms 30 --ops 200
+"""
+
+import contextlib
+import optparse
+import os
+import sys
+import time
+import types
+
+possible_topdir = os.path.normpath(os.path.join(os.path.abspath(sys.argv[0]),
+                                   os.pardir,
+                                   os.pardir))
+if os.path.exists(os.path.join(possible_topdir, 'glance', '__init__.py')):
+    sys.path.insert(0, possible_topdir)
+
+from glance.openstack.common import gettextutils
+gettextutils.install('glance')
+
+from oslo.config import cfg
+
+CONF = cfg.CONF
+
+MS = 0.001
+
+
+class Latency(object):
+    connect = 0
+    open_ioctx = 0
+    op = 0
+
+
+class FakeError(Exception):
+    pass
+
+
+class FakeObjectNotFound(FakeError):
+    pass
+
+
+class FakeImageNotFound(Exception):
+    pass
+
+
+class FakeIoctx(object):
+    def close(self):
+        pass
+
+
+class FakeRados(object):
+    def __init__(self, conffile=None, rados_id=None):
+        pass
+
+    def connect(self):
+        time.sleep(Latency.connect)
+
+    def shutdown(self):
+        pass
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        self.shutdown()
+
+    def open_ioctx(self, pool):
+        time.sleep(Latency.open_ioctx)
+        return FakeIoctx()
+
+    def get_fsid(self):
+        return 'fake_fsid'
+
+
+class FakeImage(object):
+    size = 0
+
+    def __init__(self, ioctx, name, snapshot=None):
+        time.sleep(Latency.op)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+    def stat(self):
+        time.sleep(Latency.op)
+        return {'size': FakeImage.size}
+
+    def read(self, offset, length):
+        time.sleep(Latency.op)
+        return '\0' * length
+
+
+def install_fakes():
+    rados = types.ModuleType('rados')
+    rados.Rados = FakeRados
+    rados.Error = FakeError
+    rados.ObjectNotFound = FakeObjectNotFound
+    rbd = types.ModuleType('rbd')
+    rbd.Image = FakeImage
+    rbd.ImageNotFound = FakeImageNotFound
+    sys.modules['rados'] = rados
+    sys.modules['rbd'] = rbd
+
+
+class PerOperationCluster(object):
+
+    """Connects to the cluster for each operation, as the store used to."""
+
+    def __init__(self, conf_file, user):
+        self.conf_file = conf_file
+        self.user = user
+
+    @contextlib.contextmanager
+    def open_ioctx(self, pool):
+        with FakeRados(conffile=self.conf_file, rados_id=self.user) as conn:
+            yield conn.open_ioctx(pool)
+
+    def get_fsid(self):
+        with FakeRados(conffile=self.conf_file, rados_id=self.user) as conn:
+            return conn.get_fsid()
+
+
+def run(func, ops):
+    """Returns the mean latency of a function, in milliseconds."""
+    start = time.time()
+    for i in xrange(ops):
+        func()
+    return (time.time() - start) / ops / MS
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--ops', type='int', default=100,
+                      help='Operations per test [default: %default]')
+    parser.add_option('--connect-ms', type='float', default=20,
+                      help='Time to connect to the cluster, in ms '
+                           '[default: %default]')
+    parser.add_option('--ioctx-ms', type='float', default=1,
+                      help='Time to open an I/O context, in ms '
+                           '[default: %default]')
+    parser.add_option('--op-ms', type='float', default=1,
+                      help='Time of each RBD operation, in ms '
+                           '[default: %default]')
+    parser.add_option('--image-size', type='int', default=64,
+                      help='Size of the small image, in KB '
+                           '[default: %default]')
+    options, args = parser.parse_args()
+
+    install_fakes()
+    import glance.store.location
+    import glance.store.rbd
+
+    CONF([], project='glance')
+    Latency.connect = options.connect_ms * MS
+    Latency.open_ioctx = options.ioctx_ms * MS
+    Latency.op = options.op_ms * MS
+    FakeImage.size = options.image_size * 1024
+
+    store = glance.store.rbd.Store()
+    loc = glance.store.location.Location(
+        'rbd', glance.store.rbd.StoreLocation,
+        uri='rbd://fake_fsid/%s/image/snap' % store.pool)
+
+    def get_size():
+        store.get_size(loc)
+
+    def read_image():
+        image, size = store.get(loc)
+        for chunk in image:
+            pass
+
+    print('Mean latency in ms, connect %.1f ms, open_ioctx %.1f ms, '
+          'operation %.1f ms' % (options.connect_ms, options.ioctx_ms,
+                                 options.op_ms))
+    print('%-14s %10s %10s' % ('connection', 'get_size', 'read'))
+    for name, cluster_cls in (('per-operation', PerOperationCluster),
+                              ('persistent', glance.store.rbd.Cluster)):
+        glance.store.rbd._clusters.clear()
+        cluster = cluster_cls(store.conf_file, store.user)
+        store.get_cluster = lambda: cluster
+        print('%-14s %10.2f %10.2f' % (name, run(get_size, options.ops),
+                                       run(read_image, options.ops)))
+
+
+if __name__ == '__main__':
+    main()